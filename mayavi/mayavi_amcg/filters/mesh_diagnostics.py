@@ -13,8 +13,8 @@ from enthought.tvtk.api import tvtk
 from enthought.mayavi.core.filter import Filter
 from enthought.mayavi.core.traits import DEnum
 from enthought.mayavi.core.dataset_manager import DatasetManager
-from numpy import array
-from sets import Set
+from numpy import cumsum, ones, zeros
+import fluidity.diagnostics.mesh_quality as mesh_quality
 
 ################################################################################
 # `MeshDiagnostics` class.
@@ -165,33 +165,33 @@ class MeshDiagnostics(Filter):
             self._surface_grid = type(self.inputs[0].outputs[0])()
             self._surface_grid.copy_structure(self.inputs[0].outputs[0])
 
-            if (self._surface_grid.points.data_type == 'double'):
-                # tvtk.DataSetSurfaceFilter produces surface points as float
-                # so we need to convert input points from doubles to floats
-                # if necessary
-                float_points = array(self._surface_grid.points, 'float32')
-                self._surface_grid.points = float_points
-
             self._dataset_manager = DatasetManager(dataset=self._surface_grid)
-            surface_points = self._get_surface_points()
-            self._add_stiff_elements(surface_points)
+            surface_point_ids = self._get_surface_point_ids()
+            self._add_stiff_elements(surface_point_ids)
 
-    def _get_surface_points(self):
-        surface_filter = tvtk.DataSetSurfaceFilter()
+    def _get_surface_point_ids(self):
+        # Surface points are identified by their input point IDs, rather than
+        # by comparing coordinates
+        surface_filter = tvtk.DataSetSurfaceFilter(pass_through_point_ids=True)
         surface_filter.set_input(self._surface_grid)
         surface_filter.update()
-        return surface_filter.output.points
-
-    def _add_stiff_elements(self, surface_points):
-        stiff_elements = []
-        surface_points = Set(surface_points)
-
-        for i in range(self._surface_grid.number_of_cells):
-            cell = self._surface_grid.get_cell(i)
-            points = Set(cell.points)
-            val = int(points.issubset(surface_points))
-            stiff_elements.append(val)
+        return surface_filter.output.point_data.get_array('vtkOriginalPointIds').to_array()
+
+    def _get_cell_connectivity(self):
+        # Convert the legacy cell array, with each cell stored as its point
+        # count followed by its point IDs, to offsets and point IDs
+        cells = self._surface_grid.get_cells().to_array()
+        locations = self._surface_grid.cell_locations_array.to_array()
+        offsets = zeros(len(locations) + 1, dtype=int)
+        offsets[1:] = cumsum(cells[locations])
+        mask = ones(len(cells), dtype=bool)
+        mask[locations] = False
+        return offsets, cells[mask]
+
+    def _add_stiff_elements(self, surface_point_ids):
+        offsets, points = self._get_cell_connectivity()
+        stiff_elements = mesh_quality.BoundaryLockedElements(offsets, points, surface_point_ids).astype(int)
 
         array_name = 'Stiff Elements'
-        self._dataset_manager.add_array(array(stiff_elements), array_name, 'cell')
+        self._dataset_manager.add_array(stiff_elements, array_name, 'cell')
         self._dataset_manager.activate(array_name, 'cell')
\ No newline at end of file
@@ -116,12 +116,14 @@ class TensorEigenvectorsEigenvalues(Filter):
             input_grid = self.inputs[0].outputs[0]
             tensor_field = array(input_grid.point_data.get_array(self.active_tensor))
 
-            result = map(lambda x: linalg.eig(reshape(x,(self.dimensions,self.dimensions))), tensor_field)
-            sorted_indices = map(lambda x: argsort(x[0]), result)
+            # Stacked symmetric eigendecomposition, with eigenvalues in
+            # increasing order and eigenvectors in the columns
+            tensors = reshape(tensor_field, (-1, self.dimensions, self.dimensions))
+            all_eigenvalues, all_eigenvectors = linalg.eigh(0.5 * (tensors + tensors.transpose((0, 2, 1))))
 
             for i in range(self.dimensions):
-                eigenvalues  = map(lambda x,y: x[0][y[i]], result, sorted_indices)
-                eigenvectors = map(lambda x,y: x[1][y[i]], result, sorted_indices)
+                eigenvalues  = all_eigenvalues[:, i]
+                eigenvectors = all_eigenvectors[:, :, i]
 
                 eigenvalues_field = tvtk.FloatArray(name=self.active_tensor+'_eigenvalues_'+`i`)
                 eigenvalues_field.from_array(eigenvalues)
@@ -139,7 +141,7 @@ class TensorEigenvectorsEigenvalues(Filter):
 
             for i in range(self.dimensions):
                 eigenvalues = array(self.grid.point_data.get_array(self.active_tensor+'_eigenvalues_'+`i`))
-                edgelengths = map(lambda x: 1/sqrt(x), eigenvalues)
+                edgelengths = 1.0 / sqrt(eigenvalues)
 
                 edgelengths_field = tvtk.FloatArray(name=self.active_tensor+'_edgelengths_'+`i`)
                 edgelengths_field.from_array(edgelengths)
@@ -155,7 +157,7 @@ class TensorEigenvectorsEigenvalues(Filter):
             for i in range(self.dimensions):
                 eigenvectors = array(self.grid.point_data.get_array(self.active_tensor+'_eigenvectors_'+`i`))
                 edgelengths = array(self.grid.point_data.get_array(self.active_tensor+'_edgelengths_'+`i`))
-                proportionaleigenvectors = map(multiply, eigenvectors, edgelengths)
+                proportionaleigenvectors = eigenvectors * edgelengths[:, newaxis]
 
                 proportionaleigenvectors_field = tvtk.FloatArray(name=self.active_tensor+'_proportionaleigenvectors_'+`i`)
                 proportionaleigenvectors_field.from_array(proportionaleigenvectors)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Mesh adjacency lists built from element connectivity arrays.
+
+Element-node connectivity and all returned adjacency lists are in compressed
+sparse row (CSR) form: a pair (offsets, indices), where the entries for row i
+are indices[offsets[i]:offsets[i + 1]]. Entries within each row are sorted in
+increasing order and contain no duplicates.
+"""
+
+import unittest
+
+import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+try:
+  import scipy.sparse
+except ImportError:
+  debug.deprint("Warning: Failed to import scipy.sparse module")
+try:
+  import scipy.sparse.csgraph
+except ImportError:
+  debug.deprint("Warning: Failed to import scipy.sparse.csgraph module")
+
+def FixedLocCsr(connectivity):
+  """
+  Return the CSR form of the supplied (elements x nodes per element)
+  connectivity array
+  """
+
+  connectivity = numpy.asarray(connectivity, dtype = numpy.int64)
+  assert(len(connectivity.shape) == 2)
+
+  nloc = connectivity.shape[1]
+  offsets = numpy.arange(connectivity.shape[0] + 1, dtype = numpy.int64) * nloc
+
+  return offsets, connectivity.reshape(connectivity.size)
+
+def RowIndices(offsets):
+  """
+  Return the row index of every entry of a CSR array with the supplied offsets
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+
+  return numpy.repeat(numpy.arange(len(offsets) - 1, dtype = numpy.int64), numpy.diff(offsets))
+
+def RaggedRanges(starts, lengths):
+  """
+  Return the concatenation of the integer ranges [starts[i], starts[i] +
+  lengths[i])
+  """
+
+  starts = numpy.asarray(starts, dtype = numpy.int64)
+  lengths = numpy.asarray(lengths, dtype = numpy.int64)
+
+  ends = numpy.cumsum(lengths)
+
+  return numpy.arange(ends[-1] if len(ends) > 0 else 0, dtype = numpy.int64) + numpy.repeat(starts - (ends - lengths), lengths)
+
+def CsrFromPairs(rows, cols, nRows, nCols = None):
+  """
+  Return the CSR adjacency defined by the supplied (row, column) pairs.
+  Duplicate pairs are removed.
+  """
+
+  rows = numpy.asarray(rows, dtype = numpy.int64)
+  cols = numpy.asarray(cols, dtype = numpy.int64)
+  assert(rows.shape == cols.shape)
+  if nCols is None:
+    nCols = nRows
+
+  keys = numpy.unique(rows * max(nCols, 1) + cols)
+  rows = keys // max(nCols, 1)
+  cols = keys - rows * max(nCols, 1)
+
+  offsets = numpy.zeros(nRows + 1, dtype = numpy.int64)
+  numpy.cumsum(numpy.bincount(rows, minlength = nRows), out = offsets[1:])
+
+  return offsets, cols
+
+def NeList(offsets, nodes, nodeCount):
+  """
+  Return the node-element list for the supplied CSR element-node connectivity
+  """
+
+  return CsrFromPairs(nodes, RowIndices(offsets), nodeCount, nCols = len(offsets) - 1)
+
+def NNList(offsets, nodes, nodeCount):
+  """
+  Return the node-node list for the supplied CSR element-node connectivity,
+  where two nodes are adjacent if they share an element
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  nodes = numpy.asarray(nodes, dtype = numpy.int64)
+  nlocs = numpy.diff(offsets)
+
+  rows = []
+  cols = []
+  for nloc in numpy.unique(nlocs):
+    groupElements = numpy.nonzero(nlocs == nloc)[0]
+    groupNodes = nodes[offsets[groupElements][:, numpy.newaxis] + numpy.arange(nloc)]
+    for i in range(nloc):
+      for j in range(nloc):
+        if not i == j:
+          rows.append(groupNodes[:, i])
+          cols.append(groupNodes[:, j])
+
+  if len(rows) == 0:
+    return numpy.zeros(nodeCount + 1, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64)
+  else:
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+    # Repeated nodes within an element are not self-adjacent
+    mask = rows != cols
+    return CsrFromPairs(rows[mask], cols[mask], nodeCount)
+
+def EeList(offsets, nodes, nodeCount, includeSelf = False, chunkSize = 1048576):
+  """
+  Return the element-element list for the supplied CSR element-node
+  connectivity, where two elements are adjacent if they share a node. Elements
+  are processed chunkSize connectivity entries at a time, to bound the memory
+  used by intermediate arrays.
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  nodes = numpy.asarray(nodes, dtype = numpy.int64)
+  elementCount = len(offsets) - 1
+
+  neOffsets, neElements = NeList(offsets, nodes, nodeCount)
+
+  rowOffsets = [numpy.zeros(1, dtype = numpy.int64)]
+  cols = []
+  colCount = 0
+  start = 0
+  while start < elementCount:
+    end = start + 1
+    end = max(end, numpy.searchsorted(offsets, offsets[start] + chunkSize, side = "right") - 1)
+    end = min(end, elementCount)
+
+    chunkNodes = nodes[offsets[start]:offsets[end]]
+    chunkOwners = RowIndices(offsets[start:end + 1] - offsets[start])
+    lengths = neOffsets[chunkNodes + 1] - neOffsets[chunkNodes]
+
+    rows = numpy.repeat(chunkOwners, lengths)
+    neighbours = neElements[RaggedRanges(neOffsets[chunkNodes], lengths)]
+    if not includeSelf:
+      mask = neighbours != rows + start
+      rows, neighbours = rows[mask], neighbours[mask]
+    chunkOffsets, chunkCols = CsrFromPairs(rows, neighbours, end - start, nCols = elementCount)
+
+    rowOffsets.append(chunkOffsets[1:] + colCount)
+    cols.append(chunkCols)
+    colCount += len(chunkCols)
+    start = end
+
+  if len(cols) == 0:
+    return rowOffsets[0], numpy.zeros(0, dtype = numpy.int64)
+  else:
+    return numpy.concatenate(rowOffsets), numpy.concatenate(cols)
+
+def SimplexFaceKeys(offsets, nodes):
+  """
+  Return the sorted face node keys for the supplied CSR element-node
+  connectivity, assuming linear simplex elements. Returns a list of
+  (owners, faces) pairs, one per element node count, where faces is a
+  (faces x nodes per face) array with each row in increasing node order and
+  owners contains the element owning each face.
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  nodes = numpy.asarray(nodes, dtype = numpy.int64)
+  nlocs = numpy.diff(offsets)
+
+  keys = []
+  for nloc in numpy.unique(nlocs):
+    if nloc < 2:
+      continue
+    groupElements = numpy.nonzero(nlocs == nloc)[0]
+    groupNodes = nodes[offsets[groupElements][:, numpy.newaxis] + numpy.arange(nloc)]
+
+    faces = numpy.empty((nloc, len(groupElements), nloc - 1), dtype = numpy.int64)
+    for i in range(nloc):
+      faces[i] = numpy.delete(groupNodes, i, axis = 1)
+    faces.shape = (nloc * len(groupElements), nloc - 1)
+    faces.sort(axis = 1)
+
+    keys.append((numpy.tile(groupElements, nloc), faces))
+
+  return keys
+
+def FaceEeList(offsets, nodes):
+  """
+  Return the element-element list for the supplied CSR element-node
+  connectivity, where two elements are adjacent if they share a face. Assumes
+  linear simplex elements.
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  elementCount = len(offsets) - 1
+
+  rows = []
+  cols = []
+  for owners, faces in SimplexFaceKeys(offsets, nodes):
+    # Sort the faces so that matching faces are adjacent
+    order = numpy.lexsort(faces.T[::-1])
+    faces = faces[order]
+    owners = owners[order]
+
+    matches = numpy.nonzero(numpy.all(faces[1:] == faces[:-1], axis = 1))[0]
+    rows += [owners[matches], owners[matches + 1]]
+    cols += [owners[matches + 1], owners[matches]]
+
+  if len(rows) == 0:
+    return numpy.zeros(elementCount + 1, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64)
+  else:
+    return CsrFromPairs(numpy.concatenate(rows), numpy.concatenate(cols), elementCount)
+
+def CsrToSparse(csr, nCols = None):
+  """
+  Return the supplied CSR adjacency as a scipy.sparse.csr_matrix with unit
+  entries
+  """
+
+  offsets, indices = csr
+  nRows = len(offsets) - 1
+  if nCols is None:
+    nCols = nRows
+
+  return scipy.sparse.csr_matrix((numpy.ones(len(indices), dtype = numpy.int8), indices, offsets), shape = (nRows, nCols))
+
+def RestrictedCsr(csr, count):
+  """
+  Return the adjacency between the first count rows of the supplied square CSR
+  adjacency
+  """
+
+  offsets, indices = csr
+  rows = RowIndices(offsets)
+  mask = numpy.logical_and(rows < count, indices < count)
+
+  return CsrFromPairs(rows[mask], indices[mask], count)
+
+def ReverseCuthillMcKee(csr):
+  """
+  Return the reverse Cuthill-McKee ordering of the supplied symmetric CSR
+  adjacency, as an array of row indices in their new order
+  """
+
+  return scipy.sparse.csgraph.reverse_cuthill_mckee(CsrToSparse(csr), symmetric_mode = True).astype(numpy.int64)
+
+def Bandwidth(csr):
+  """
+  Return the bandwidth of the supplied CSR adjacency: the maximum of |i - j|
+  over all entries (i, j)
+  """
+
+  offsets, indices = csr
+  if len(indices) == 0:
+    return 0
+
+  return int(numpy.abs(RowIndices(offsets) - indices).max())
+
+def Profile(csr):
+  """
+  Return the profile (envelope size) of the supplied CSR adjacency: the sum
+  over rows i of i - min(j), for entries (i, j) with j < i
+  """
+
+  offsets, indices = csr
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  rows = RowIndices(offsets)
+  nonEmpty = offsets[1:] > offsets[:-1]
+  if not nonEmpty.any():
+    return 0
+  # Row entries are sorted, so the first entry of each row is its minimum
+  rowMin = numpy.minimum(indices[offsets[:-1][nonEmpty]], numpy.nonzero(nonEmpty)[0])
+
+  return int((numpy.nonzero(nonEmpty)[0] - rowMin).sum())
+
+def MeanIndexDistance(csr):
+  """
+  Return the mean of |i - j| over all entries (i, j) of the supplied CSR
+  adjacency
+  """
+
+  offsets, indices = csr
+  if len(indices) == 0:
+    return 0.0
+
+  return float(numpy.abs(RowIndices(offsets) - indices).mean())
+
+class adjacencyUnittests(unittest.TestCase):
+  def _ToLists(self, csr):
+    offsets, indices = csr
+    return [indices[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+
+  def testFixedLocCsr(self):
+    offsets, nodes = FixedLocCsr([[0, 1, 2], [1, 3, 2]])
+    self.assertEquals(offsets.tolist(), [0, 3, 6])
+    self.assertEquals(nodes.tolist(), [0, 1, 2, 1, 3, 2])
+
+    return
+
+  def testRaggedRanges(self):
+    self.assertEquals(RaggedRanges([3, 0, 7], [2, 0, 3]).tolist(), [3, 4, 7, 8, 9])
+    self.assertEquals(RaggedRanges([], []).tolist(), [])
+
+    return
+
+  def testCsrFromPairs(self):
+    csr = CsrFromPairs([2, 0, 2, 0], [1, 3, 1, 0], 3, nCols = 4)
+    self.assertEquals(self._ToLists(csr), [[0, 3], [], [1]])
+
+    return
+
+  def testNeList(self):
+    offsets, nodes = FixedLocCsr([[0, 1, 2], [1, 3, 2]])
+    self.assertEquals(self._ToLists(NeList(offsets, nodes, 5)), [[0], [0, 1], [0, 1], [1], []])
+
+    return
+
+  def testNNList(self):
+    offsets, nodes = [0, 3, 6, 8], [0, 1, 2, 1, 3, 2, 3, 3]
+    self.assertEquals(self._ToLists(NNList(offsets, nodes, 5)), [[1, 2], [0, 2, 3], [0, 1, 3], [1, 2], []])
+
+    return
+
+  def testCsrToSparse(self):
+    offsets, nodes = FixedLocCsr([[0, 1, 2], [1, 3, 2]])
+    matrix = CsrToSparse(NeList(offsets, nodes, 4), nCols = 2)
+    self.assertEquals(matrix.shape, (4, 2))
+    self.assertEquals(matrix.toarray().tolist(), [[1, 0], [1, 1], [1, 1], [0, 1]])
+
+    return
+
+  def testEeList(self):
+    # Three triangles in a strip, plus a line element
+    offsets, nodes = [0, 3, 6, 9, 11], [0, 1, 2, 1, 3, 2, 3, 4, 2, 4, 5]
+    self.assertEquals(self._ToLists(EeList(offsets, nodes, 6)), [[1, 2], [0, 2], [0, 1, 3], [2]])
+    self.assertEquals(self._ToLists(EeList(offsets, nodes, 6, includeSelf = True)), [[0, 1, 2], [0, 1, 2], [0, 1, 2, 3], [2, 3]])
+    self.assertEquals(self._ToLists(EeList(offsets, nodes, 6, chunkSize = 1)), [[1, 2], [0, 2], [0, 1, 3], [2]])
+
+    return
+
+  def testFaceEeList(self):
+    offsets, nodes = FixedLocCsr([[0, 1, 2], [1, 3, 2], [3, 4, 2]])
+    self.assertEquals(self._ToLists(FaceEeList(offsets, nodes)), [[1], [0, 2], [1]])
+
+    # Two tetrahedra sharing a face, and a third sharing only an edge
+    offsets, nodes = FixedLocCsr([[0, 1, 2, 3], [1, 2, 3, 4], [0, 1, 5, 6]])
+    self.assertEquals(self._ToLists(FaceEeList(offsets, nodes)), [[1], [0], []])
+
+    return
+
+  def testRestrictedCsr(self):
+    csr = NNList([0, 3, 6], [0, 1, 2, 1, 3, 2], 4)
+    self.assertEquals(self._ToLists(RestrictedCsr(csr, 2)), [[1], [0]])
+
+    return
+
+  def testReverseCuthillMcKee(self):
+    # A path graph numbered 0, 4, 1, 3, 2 along its length
+    offsets, nodes = FixedLocCsr([[0, 4], [4, 1], [1, 3], [3, 2]])
+    csr = NNList(offsets, nodes, 5)
+    self.assertEquals(Bandwidth(csr), 4)
+    self.assertEquals(Profile(csr), 6)
+    self.assertAlmostEquals(MeanIndexDistance(csr), 2.5)
+
+    order = ReverseCuthillMcKee(csr)
+    self.assertEquals(sorted(order.tolist()), range(5))
+    newIndex = numpy.empty(5, dtype = numpy.int64)
+    newIndex[order] = numpy.arange(5)
+    newCsr = NNList(offsets, newIndex[nodes], 5)
+    self.assertEquals(Bandwidth(newCsr), 1)
+    self.assertEquals(Profile(newCsr), 4)
+    self.assertAlmostEquals(MeanIndexDistance(newCsr), 1.0)
+
+    return
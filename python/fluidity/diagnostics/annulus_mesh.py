@@ -24,6 +24,12 @@ import os
 import unittest
 
 import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
 import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.filehandling as filehandling
@@ -32,6 +38,7 @@ import fluidity.diagnostics.numbers as numbers
 import fluidity.diagnostics.optimise as optimise
 import fluidity.diagnostics.polytools as polytools
 import fluidity.diagnostics.simplices as simplices
+import fluidity.diagnostics.tensors as tensors
 import fluidity.diagnostics.triangletools as triangletools
 import fluidity.diagnostics.utils as utils
 
@@ -101,15 +108,7 @@ def GenerateAnnulusRZPhiToNode(nRCoords, nZCoords, phiPoints):
   tet annulus mesh
   """
  
-  rzphiToNode = []
-  index = 0
-  for i in range(nRCoords): 
-    rzphiToNode.append([])
-    for j in range(nZCoords):
-      rzphiToNode[i].append([])
-      for k in range(phiPoints):
-        rzphiToNode[i][j].append(index)
-        index += 1
+  rzphiToNode = numpy.arange(nRCoords * nZCoords * phiPoints).reshape((nRCoords, nZCoords, phiPoints)).tolist()
   
   return rzphiToNode
   
@@ -119,16 +118,39 @@ def GenerateAnnulusNodeToRZPhi(nRCoords, nZCoords, phiPoints):
   tet annulus mesh
   """
   
-  nodeToRzphi = []
-  index = 0
-  index = 0
-  for i in range(nRCoords): 
-    for j in range(nZCoords):
-      for k in range(phiPoints):
-        nodeToRzphi.append((i, j, k))
+  nodeToRzphi = [tuple(indices) for indices in numpy.column_stack([indices.flatten() for indices in numpy.indices((nRCoords, nZCoords, phiPoints))]).tolist()]
   
   return nodeToRzphi
 
+def _NormalisedPhiCoords(phiCoords):
+  """
+  Return the supplied phi coordinates mapped into [0, 2 pi], and sorted
+  """
+  
+  phiCoords = numpy.array(phiCoords, dtype = float)
+  lPhiCoords = numpy.mod(phiCoords, 2.0 * math.pi)
+  # Positive multiples of 2 pi map to 2 pi rather than zero
+  lPhiCoords[numpy.logical_and(lPhiCoords == 0.0, phiCoords > 0.0)] = 2.0 * math.pi
+  lPhiCoords.sort()
+  
+  return lPhiCoords
+  
+def _ElementArray(*elementNodes):
+  """
+  Return an (elements x nodes per element) connectivity array, given arrays of
+  element nodes. Each argument is a list of node index arrays (one per element
+  node) for one element per structured cell, and elements are ordered by cell,
+  and then by argument.
+  """
+  
+  elementNodes = [numpy.array(numpy.broadcast_arrays(*nodes)) for nodes in elementNodes]
+  nloc = len(elementNodes[0])
+  # Shape is (elements per cell, nodes per element, cells ...)
+  elementNodes = numpy.array(elementNodes)
+  elementNodes = numpy.rollaxis(numpy.rollaxis(elementNodes, 1, elementNodes.ndim), 0, elementNodes.ndim - 1)
+  
+  return elementNodes.reshape((elementNodes.size // nloc, nloc))
+
 def GenerateAnnulusMesh(rCoords, zCoords, phiCoords, innerWallId = 1, outerWallId = 2, topId = 3, bottomId = 4, leftWallId = 5, rightWallId = 6, volumeId = 0, connectEnds = True):
   """
   Generate a structured 3D linear tet annulus mesh based upon the given r and z
@@ -143,19 +165,9 @@ def GenerateAnnulusMesh(rCoords, zCoords, phiCoords, innerWallId = 1, outerWallI
     debug.dprint("Annulus is blocked")
   
   # Copy and sort the input coords
-  lRCoords = copy.deepcopy(rCoords)
-  lZCoords = copy.deepcopy(zCoords)
-  lPhiCoords = copy.deepcopy(phiCoords)
-  lRCoords.sort()
-  lZCoords.sort()
-  lPhiCoords = []
-  for phi in phiCoords:
-    while phi < 0.0:
-      phi += 2.0 * math.pi
-    while phi > 2.0 * math.pi:
-      phi -= 2.0 * math.pi
-    lPhiCoords.append(phi)
-  lPhiCoords.sort()
+  lRCoords = numpy.sort(numpy.array(rCoords, dtype = float))
+  lZCoords = numpy.sort(numpy.array(zCoords, dtype = float))
+  lPhiCoords = _NormalisedPhiCoords(phiCoords)
   
   phiPoints = len(lPhiCoords)
   if connectEnds:
@@ -166,76 +178,64 @@ def GenerateAnnulusMesh(rCoords, zCoords, phiCoords, innerWallId = 1, outerWallI
   nRCoords = len(rCoords)
   nZCoords = len(zCoords)
   
-  # Generate map from r, z, phi IDs to node IDs
-  rzphiToNode = GenerateAnnulusRZPhiToNode(nRCoords, nZCoords, phiPoints)
+  # Map from r, z, phi IDs to node IDs
+  rzphiToNode = numpy.arange(nRCoords * nZCoords * phiPoints, dtype = numpy.int64).reshape((nRCoords, nZCoords, phiPoints))
         
-  mesh = meshes.Mesh(3)    
+  mesh = meshes.Mesh(3, arrayBacked = True)
   
   # Generate node coordinates
-  for r in lRCoords:
-    for z in lZCoords:
-      for phi in lPhiCoords:
-        x = r * math.cos(phi)
-        y = r * math.sin(phi)
-
-        mesh.AddNodeCoord([x, y, z])
+  r, z, phi = [coords.flatten() for coords in numpy.meshgrid(lRCoords, lZCoords, lPhiCoords, indexing = "ij")]
+  mesh.AddNodeCoordsArray(numpy.column_stack([r * numpy.cos(phi), r * numpy.sin(phi), z]))
+  del r, z, phi
   
   # Generate volume elements
-  for i in range(nRCoords - 1):
-    debug.dprint("Processing radial element strip " + str(i + 1) + " of " + str(nRCoords - 1), 2)
-    for j in range(nZCoords - 1):
-      debug.dprint("Processing vertical element loop " + str(j + 1) + " of " + str(nZCoords - 1), 3)
-      for k in range(phiDivisions):
-        # Out of a hex, construct 6 tets
-        # Construction as in IEEE Transactions on Magnetics, Vol. 26,
-        # No. 2 March 1990 pp. 775-778, Y Tanizume, H Yamashita and
-        # E Nakamae, Fig. 5. a)
-        
-        # Tet 1
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i + 1][j][k], rzphiToNode[i][j][k], rzphiToNode[i + 1][j + 1][k], rzphiToNode[i][j][(k + 1) % phiPoints]], volumeId))
-        # Tet 2
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i + 1][j][k], rzphiToNode[i + 1][j][(k + 1) % phiPoints], rzphiToNode[i][j][(k + 1) % phiPoints], rzphiToNode[i + 1][j + 1][k]], volumeId))
-        # Tet 3
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i + 1][j][(k + 1) % phiPoints], rzphiToNode[i + 1][j + 1][(k + 1) % phiPoints], rzphiToNode[i][j][(k + 1) % phiPoints], rzphiToNode[i + 1][j + 1][k]], volumeId))
-        # Tet 4
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i][j][(k + 1) % phiPoints], rzphiToNode[i + 1][j + 1][k], rzphiToNode[i + 1][j + 1][(k + 1) % phiPoints], rzphiToNode[i][j + 1][(k + 1) % phiPoints]], volumeId))
-        # Tet 5
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i][j][(k + 1) % phiPoints], rzphiToNode[i + 1][j + 1][k], rzphiToNode[i][j + 1][(k + 1) % phiPoints], rzphiToNode[i][j + 1][k]], volumeId))
-        # Tet 6
-        mesh.AddVolumeElement(elements.Element([rzphiToNode[i][j][k], rzphiToNode[i + 1][j + 1][k], rzphiToNode[i][j][(k + 1) % phiPoints], rzphiToNode[i][j + 1][k]], volumeId))
+  i = numpy.arange(nRCoords - 1)[:, numpy.newaxis, numpy.newaxis]
+  j = numpy.arange(nZCoords - 1)[numpy.newaxis, :, numpy.newaxis]
+  k = numpy.arange(phiDivisions)[numpy.newaxis, numpy.newaxis, :]
+  kp = (k + 1) % phiPoints
+  # Out of a hex, construct 6 tets
+  # Construction as in IEEE Transactions on Magnetics, Vol. 26,
+  # No. 2 March 1990 pp. 775-778, Y Tanizume, H Yamashita and
+  # E Nakamae, Fig. 5. a)
+  mesh.AddVolumeElementsArray(_ElementArray( \
+    [rzphiToNode[i + 1, j, k], rzphiToNode[i, j, k], rzphiToNode[i + 1, j + 1, k], rzphiToNode[i, j, kp]], \
+    [rzphiToNode[i + 1, j, k], rzphiToNode[i + 1, j, kp], rzphiToNode[i, j, kp], rzphiToNode[i + 1, j + 1, k]], \
+    [rzphiToNode[i + 1, j, kp], rzphiToNode[i + 1, j + 1, kp], rzphiToNode[i, j, kp], rzphiToNode[i + 1, j + 1, k]], \
+    [rzphiToNode[i, j, kp], rzphiToNode[i + 1, j + 1, k], rzphiToNode[i + 1, j + 1, kp], rzphiToNode[i, j + 1, kp]], \
+    [rzphiToNode[i, j, kp], rzphiToNode[i + 1, j + 1, k], rzphiToNode[i, j + 1, kp], rzphiToNode[i, j + 1, k]], \
+    [rzphiToNode[i, j, k], rzphiToNode[i + 1, j + 1, k], rzphiToNode[i, j, kp], rzphiToNode[i, j + 1, k]]), ids = volumeId)
         
   # Generate surface elements ...
+  i = numpy.arange(nZCoords - 1)[:, numpy.newaxis]
+  j = numpy.arange(phiDivisions)[numpy.newaxis, :]
+  jp = (j + 1) % phiPoints
   # ... for inner wall
-  for i in range(nZCoords - 1):
-    for j in range(phiDivisions):
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[0][i][j], rzphiToNode[0][i][(j + 1) % phiPoints], rzphiToNode[0][i + 1][j]], innerWallId))
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[0][i][(j + 1) % phiPoints], rzphiToNode[0][i + 1][(j + 1) % phiPoints], rzphiToNode[0][i + 1][j]], innerWallId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [rzphiToNode[0, i, j], rzphiToNode[0, i, jp], rzphiToNode[0, i + 1, j]], \
+    [rzphiToNode[0, i, jp], rzphiToNode[0, i + 1, jp], rzphiToNode[0, i + 1, j]]), ids = innerWallId)
   # ... for outer wall
-  for i in range(nZCoords - 1):
-    for j in range(phiDivisions):
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[-1][i][j], rzphiToNode[-1][i][(j + 1) % phiPoints], rzphiToNode[-1][i + 1][j]], outerWallId))
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[-1][i][(j + 1) % phiPoints], rzphiToNode[-1][i + 1][(j + 1) % phiPoints], rzphiToNode[-1][i + 1][j]], outerWallId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [rzphiToNode[-1, i, j], rzphiToNode[-1, i, jp], rzphiToNode[-1, i + 1, j]], \
+    [rzphiToNode[-1, i, jp], rzphiToNode[-1, i + 1, jp], rzphiToNode[-1, i + 1, j]]), ids = outerWallId)
+  i = numpy.arange(nRCoords - 1)[:, numpy.newaxis]
   # ... for top
-  for i in range(nRCoords - 1):
-    for j in range(phiDivisions):
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][-1][j], rzphiToNode[i + 1][-1][j], rzphiToNode[i][-1][(j + 1) % phiPoints]], topId))
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][-1][(j + 1) % phiPoints], rzphiToNode[i + 1][-1][j], rzphiToNode[i + 1][-1][(j + 1) % phiPoints]], topId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [rzphiToNode[i, -1, j], rzphiToNode[i + 1, -1, j], rzphiToNode[i, -1, jp]], \
+    [rzphiToNode[i, -1, jp], rzphiToNode[i + 1, -1, j], rzphiToNode[i + 1, -1, jp]]), ids = topId)
   # ... for bottom
-  for i in range(nRCoords - 1):
-    for j in range(phiDivisions):
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][0][j], rzphiToNode[i + 1][0][j], rzphiToNode[i][0][(j + 1) % phiPoints]], bottomId))
-      mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][0][(j + 1) % phiPoints], rzphiToNode[i + 1][0][j], rzphiToNode[i + 1][0][(j + 1) % phiPoints]], bottomId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [rzphiToNode[i, 0, j], rzphiToNode[i + 1, 0, j], rzphiToNode[i, 0, jp]], \
+    [rzphiToNode[i, 0, jp], rzphiToNode[i + 1, 0, j], rzphiToNode[i + 1, 0, jp]]), ids = bottomId)
   if not connectEnds:
+    j = numpy.arange(nZCoords - 1)[numpy.newaxis, :]
     # ... for left wall
-    for i in range(nRCoords - 1):
-      for j in range(nZCoords - 1):
-        mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][j][0], rzphiToNode[i + 1][j][0], rzphiToNode[i + 1][j + 1][0]], leftWallId))
-        mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][j][0], rzphiToNode[i][j + 1][0], rzphiToNode[i + 1][j + 1][0]], leftWallId))
+    mesh.AddSurfaceElementsArray(_ElementArray( \
+      [rzphiToNode[i, j, 0], rzphiToNode[i + 1, j, 0], rzphiToNode[i + 1, j + 1, 0]], \
+      [rzphiToNode[i, j, 0], rzphiToNode[i, j + 1, 0], rzphiToNode[i + 1, j + 1, 0]]), ids = leftWallId)
     # ... for right wall
-    for i in range(nRCoords - 1):
-      for j in range(nZCoords - 1):
-        mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][j][-1], rzphiToNode[i + 1][j][-1], rzphiToNode[i + 1][j + 1][-1]], rightWallId))
-        mesh.AddSurfaceElement(elements.Element([rzphiToNode[i][j][-1], rzphiToNode[i][j + 1][-1], rzphiToNode[i + 1][j + 1][-1]], rightWallId))
+    mesh.AddSurfaceElementsArray(_ElementArray( \
+      [rzphiToNode[i, j, -1], rzphiToNode[i + 1, j, -1], rzphiToNode[i + 1, j + 1, -1]], \
+      [rzphiToNode[i, j, -1], rzphiToNode[i, j + 1, -1], rzphiToNode[i + 1, j + 1, -1]]), ids = rightWallId)
   
   debug.dprint("Finished generating annulus mesh")
 
@@ -254,17 +254,8 @@ def GenerateAnnulusHorizontalSliceMesh(rCoords, phiCoords, innerWallId = 1, oute
     debug.dprint("Annulus is blocked")
   
   # Copy and sort the input coords
-  lRCoords = copy.deepcopy(rCoords)
-  lPhiCoords = copy.deepcopy(phiCoords)
-  lRCoords.sort()
-  lPhiCoords = []
-  for phi in phiCoords:
-    while phi < 0.0:
-      phi += 2.0 * math.pi
-    while phi > 2.0 * math.pi:
-      phi -= 2.0 * math.pi
-    lPhiCoords.append(phi)
-  lPhiCoords.sort()
+  lRCoords = numpy.sort(numpy.array(rCoords, dtype = float))
+  lPhiCoords = _NormalisedPhiCoords(phiCoords)
   
   phiPoints = len(lPhiCoords)
   if connectEnds:
@@ -274,46 +265,37 @@ def GenerateAnnulusHorizontalSliceMesh(rCoords, phiCoords, innerWallId = 1, oute
     
   nRCoords = len(rCoords)
   
-  # Generate map from r, phi IDs to node IDs
-  rPhiToNode = []
-  index = 0
-  for i in range(nRCoords): 
-    rPhiToNode.append([])
-    for j in range(phiPoints):
-      rPhiToNode[i].append(index)
-      index += 1
+  # Map from r, phi IDs to node IDs
+  rPhiToNode = numpy.arange(nRCoords * phiPoints, dtype = numpy.int64).reshape((nRCoords, phiPoints))
         
-  mesh = meshes.Mesh(2)    
+  mesh = meshes.Mesh(2, arrayBacked = True)
   
   # Generate node coordinates
-  for r in lRCoords:
-    for phi in lPhiCoords:
-      x = r * math.cos(phi)
-      y = r * math.sin(phi)
-
-      mesh.AddNodeCoord([x, y])
+  r, phi = [coords.flatten() for coords in numpy.meshgrid(lRCoords, lPhiCoords, indexing = "ij")]
+  mesh.AddNodeCoordsArray(numpy.column_stack([r * numpy.cos(phi), r * numpy.sin(phi)]))
+  del r, phi
   
   # Generate volume elements
-  for i in range(nRCoords - 1):
-    debug.dprint("Processing radial element strip " + str(i + 1) + " of " + str(nRCoords - 1), 2)
-    for j in range(phiDivisions):
-      mesh.AddVolumeElement(elements.Element([rPhiToNode[i][j], rPhiToNode[i + 1][j], rPhiToNode[i][(j + 1) % phiPoints]], volumeId))
-      mesh.AddVolumeElement(elements.Element([rPhiToNode[i + 1][(j + 1) % phiPoints], rPhiToNode[i + 1][j], rPhiToNode[i][(j + 1) % phiPoints]], volumeId))
+  i = numpy.arange(nRCoords - 1)[:, numpy.newaxis]
+  j = numpy.arange(phiDivisions)[numpy.newaxis, :]
+  jp = (j + 1) % phiPoints
+  mesh.AddVolumeElementsArray(_ElementArray( \
+    [rPhiToNode[i, j], rPhiToNode[i + 1, j], rPhiToNode[i, jp]], \
+    [rPhiToNode[i + 1, jp], rPhiToNode[i + 1, j], rPhiToNode[i, jp]]), ids = volumeId)
 
   # Generate surface elements ...
+  j = numpy.arange(phiDivisions)
+  jp = (j + 1) % phiPoints
   # ... for inner wall
-  for i in range(phiDivisions):
-    mesh.AddSurfaceElement(elements.Element([rPhiToNode[0][i], rPhiToNode[0][(i + 1) % phiPoints]], innerWallId))
+  mesh.AddSurfaceElementsArray(_ElementArray([rPhiToNode[0, j], rPhiToNode[0, jp]]), ids = innerWallId)
   # ... for outer wall
-  for i in range(phiDivisions):
-    mesh.AddSurfaceElement(elements.Element([rPhiToNode[-1][i], rPhiToNode[-1][(i + 1) % phiPoints]], outerWallId))
+  mesh.AddSurfaceElementsArray(_ElementArray([rPhiToNode[-1, j], rPhiToNode[-1, jp]]), ids = outerWallId)
   if not connectEnds:
+    i = numpy.arange(nRCoords - 1)
     # ... for left wall
-    for i in range(nRCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([rPhiToNode[i][0], rPhiToNode[i + 1][0]], leftWallId))
+    mesh.AddSurfaceElementsArray(_ElementArray([rPhiToNode[i, 0], rPhiToNode[i + 1, 0]]), ids = leftWallId)
     # ... for right wall
-    for i in range(nRCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([rPhiToNode[i][-1], rPhiToNode[i + 1][-1]], rightWallId))
+    mesh.AddSurfaceElementsArray(_ElementArray([rPhiToNode[i, -1], rPhiToNode[i + 1, -1]]), ids = rightWallId)
   
   debug.dprint("Finished generating annulus horizontal slice mesh")
 
@@ -356,62 +338,43 @@ def GenerateRectangleMesh(xCoords, yCoords, leftId = 1, rightId = 2, topId = 3,
   nYCoords = len(yCoords)
   
   # Copy and sort the input coords
-  lXCoords = copy.deepcopy(xCoords)
-  lYCoords = copy.deepcopy(yCoords)
-  lXCoords.sort()
-  lYCoords.sort()
-    
-  # Generate map from x, y IDs to node IDs
-  xyToNode = []
-  index = 0
-  for i in range(nXCoords): 
-    xyToNode.append([index + i for i in range(nYCoords)])
-    index += nYCoords
+  lXCoords = numpy.sort(numpy.array(xCoords, dtype = float))
+  lYCoords = numpy.sort(numpy.array(yCoords, dtype = float))
+    
+  # Map from x, y IDs to node IDs
+  xyToNode = numpy.arange(nXCoords * nYCoords, dtype = numpy.int64).reshape((nXCoords, nYCoords))
         
-  mesh = meshes.Mesh(2)    
+  mesh = meshes.Mesh(2, arrayBacked = True)
 
   # Generate node coordinates
-  for x in lXCoords:
-    for y in lYCoords:
-      mesh.AddNodeCoord([x, y])
+  mesh.AddNodeCoordsArray(numpy.column_stack([coords.flatten() for coords in numpy.meshgrid(lXCoords, lYCoords, indexing = "ij")]))
 
+  i = numpy.arange(nXCoords - 1)[:, numpy.newaxis]
+  j = numpy.arange(nYCoords - 1)[numpy.newaxis, :]
   if elementFamilyId == elements.ELEMENT_FAMILY_SIMPLEX:
     # Generate volume elements
-    for i in range(nXCoords - 1):
-      debug.dprint("Processing x element strip " + str(i + 1) + " of " + str(nXCoords - 1), 2)
-      for j in range(nYCoords - 1):
-        debug.dprint("Processing y element strip " + str(i + 1) + " of " + str(nYCoords - 1), 3)
-        # Out of a quad, construct 2 triangles
-        
-        # Triangle 1
-        mesh.AddVolumeElement(elements.Element([xyToNode[i][j], xyToNode[i + 1][j], xyToNode[i + 1][j + 1]], volumeId))
-        # Triangle 2
-        mesh.AddVolumeElement(elements.Element([xyToNode[i][j], xyToNode[i + 1][j + 1], xyToNode[i][j + 1]], volumeId))
+    # Out of a quad, construct 2 triangles
+    mesh.AddVolumeElementsArray(_ElementArray( \
+      [xyToNode[i, j], xyToNode[i + 1, j], xyToNode[i + 1, j + 1]], \
+      [xyToNode[i, j], xyToNode[i + 1, j + 1], xyToNode[i, j + 1]]), ids = volumeId)
   elif elementFamilyId == elements.ELEMENT_FAMILY_CUBIC:
     # Generate volume elements
-    for i in range(nXCoords - 1):
-      debug.dprint("Processing x element strip " + str(i + 1) + " of " + str(nXCoords - 1), 2)
-      for j in range(nYCoords - 1):
-        debug.dprint("Processing y element strip " + str(i + 1) + " of " + str(nYCoords - 1), 3)
-        
-        # Quad
-        mesh.AddVolumeElement(elements.Element([xyToNode[i][j], xyToNode[i + 1][j], xyToNode[i][j + 1], xyToNode[i + 1][j + 1]], volumeId))    
+    mesh.AddVolumeElementsArray(_ElementArray( \
+      [xyToNode[i, j], xyToNode[i + 1, j], xyToNode[i, j + 1], xyToNode[i + 1, j + 1]]), ids = volumeId)
   else:
     raise Exception("Unsupported element family")
   
   # Generate surface elements...
+  i = numpy.arange(nXCoords - 1)
+  j = numpy.arange(nYCoords - 1)
   # ... for left
-  for i in range(nYCoords - 1):
-    mesh.AddSurfaceElement(elements.Element([xyToNode[0][i], xyToNode[0][i + 1]], leftId))
+  mesh.AddSurfaceElementsArray(_ElementArray([xyToNode[0, j], xyToNode[0, j + 1]]), ids = leftId)
   # ... for right
-  for i in range(nYCoords - 1):
-    mesh.AddSurfaceElement(elements.Element([xyToNode[-1][i], xyToNode[-1][i + 1]], rightId)) 
+  mesh.AddSurfaceElementsArray(_ElementArray([xyToNode[-1, j], xyToNode[-1, j + 1]]), ids = rightId)
   # ... for bottom
-  for i in range(nXCoords - 1):
-    mesh.AddSurfaceElement(elements.Element([xyToNode[i][0], xyToNode[i + 1][0]], bottomId))
+  mesh.AddSurfaceElementsArray(_ElementArray([xyToNode[i, 0], xyToNode[i + 1, 0]]), ids = bottomId)
   # ... for top
-  for i in range(nXCoords - 1):
-    mesh.AddSurfaceElement(elements.Element([xyToNode[i][-1], xyToNode[i + 1][-1]], topId))
+  mesh.AddSurfaceElementsArray(_ElementArray([xyToNode[i, -1], xyToNode[i + 1, -1]]), ids = topId)
 
   debug.dprint("Finished generating rectangle mesh")
 
@@ -424,90 +387,68 @@ def GenerateCuboidMesh(xCoords, yCoords, zCoords, leftId = 1, rightId = 2, topId
 
   debug.dprint("Generating cuboid mesh")
 
-  mesh = meshes.Mesh(3)
+  mesh = meshes.Mesh(3, arrayBacked = True)
   
   nXCoords = len(xCoords)
   nYCoords = len(yCoords)
   nZCoords = len(zCoords)
   
   # Copy and sort the input coords
-  lXCoords = copy.deepcopy(xCoords)
-  lYCoords = copy.deepcopy(yCoords)
-  lZCoords = copy.deepcopy(zCoords)
-  lXCoords.sort()
-  lYCoords.sort()
-  lZCoords.sort()
-    
-  # Generate map from x, y, z IDs to node IDs
-  xyzToNode = []
-  index = 0
-  for i in range(nXCoords): 
-    xyzToNode.append([])
-    for j in range(nYCoords):
-      xyzToNode[-1].append([index + i for i in range(nZCoords)])
-      index += nZCoords
+  lXCoords = numpy.sort(numpy.array(xCoords, dtype = float))
+  lYCoords = numpy.sort(numpy.array(yCoords, dtype = float))
+  lZCoords = numpy.sort(numpy.array(zCoords, dtype = float))
+    
+  # Map from x, y, z IDs to node IDs
+  xyzToNode = numpy.arange(nXCoords * nYCoords * nZCoords, dtype = numpy.int64).reshape((nXCoords, nYCoords, nZCoords))
       
   # Generate node coordinates
-  for x in lXCoords:
-    for y in lYCoords:
-      for z in lZCoords:
-        mesh.AddNodeCoord([x, y, z])
+  mesh.AddNodeCoordsArray(numpy.column_stack([coords.flatten() for coords in numpy.meshgrid(lXCoords, lYCoords, lZCoords, indexing = "ij")]))
         
   # Generate volume elements
-  for i in range(nXCoords - 1):
-    debug.dprint("Processing x element strip " + str(i + 1) + " of " + str(nXCoords - 1), 2)
-    for j in range(nYCoords - 1):
-      debug.dprint("Processing y element strip " + str(i + 1) + " of " + str(nYCoords - 1), 3)
-      for k in range(nZCoords - 1):
-        # Out of a hex, construct 6 tets
-        # Construction as in IEEE Transactions on Magnetics, Vol. 26,
-        # No. 2 March 1990 pp. 775-778, Y Tanizume, H Yamashita and
-        # E Nakamae, Fig. 5. a)
-        
-        # Tet 1
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i + 1][j][k], xyzToNode[i][j][k], xyzToNode[i][j][k + 1], xyzToNode[i + 1][j + 1][k]], volumeId))
-        # Tet 2
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i + 1][j][k], xyzToNode[i + 1][j][k + 1], xyzToNode[i + 1][j + 1][k], xyzToNode[i][j][k + 1]], volumeId))
-        # Tet 3
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i + 1][j][k + 1], xyzToNode[i + 1][j + 1][k + 1], xyzToNode[i + 1][j + 1][k], xyzToNode[i][j][k + 1]], volumeId))
-        # Tet 4
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i][j][k + 1], xyzToNode[i + 1][j + 1][k], xyzToNode[i][j + 1][k + 1], xyzToNode[i + 1][j + 1][k + 1]], volumeId))
-        # Tet 5
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i][j][k + 1], xyzToNode[i + 1][j + 1][k], xyzToNode[i][j + 1][k], xyzToNode[i][j + 1][k + 1]], volumeId))
-        # Tet 6
-        mesh.AddVolumeElement(elements.Element([xyzToNode[i][j][k], xyzToNode[i + 1][j + 1][k], xyzToNode[i][j + 1][k], xyzToNode[i][j][k + 1]], volumeId))
+  i = numpy.arange(nXCoords - 1)[:, numpy.newaxis, numpy.newaxis]
+  j = numpy.arange(nYCoords - 1)[numpy.newaxis, :, numpy.newaxis]
+  k = numpy.arange(nZCoords - 1)[numpy.newaxis, numpy.newaxis, :]
+  # Out of a hex, construct 6 tets
+  # Construction as in IEEE Transactions on Magnetics, Vol. 26,
+  # No. 2 March 1990 pp. 775-778, Y Tanizume, H Yamashita and
+  # E Nakamae, Fig. 5. a)
+  mesh.AddVolumeElementsArray(_ElementArray( \
+    [xyzToNode[i + 1, j, k], xyzToNode[i, j, k], xyzToNode[i, j, k + 1], xyzToNode[i + 1, j + 1, k]], \
+    [xyzToNode[i + 1, j, k], xyzToNode[i + 1, j, k + 1], xyzToNode[i + 1, j + 1, k], xyzToNode[i, j, k + 1]], \
+    [xyzToNode[i + 1, j, k + 1], xyzToNode[i + 1, j + 1, k + 1], xyzToNode[i + 1, j + 1, k], xyzToNode[i, j, k + 1]], \
+    [xyzToNode[i, j, k + 1], xyzToNode[i + 1, j + 1, k], xyzToNode[i, j + 1, k + 1], xyzToNode[i + 1, j + 1, k + 1]], \
+    [xyzToNode[i, j, k + 1], xyzToNode[i + 1, j + 1, k], xyzToNode[i, j + 1, k], xyzToNode[i, j + 1, k + 1]], \
+    [xyzToNode[i, j, k], xyzToNode[i + 1, j + 1, k], xyzToNode[i, j + 1, k], xyzToNode[i, j, k + 1]]), ids = volumeId)
   
   # Generate surface elements ...
+  i = numpy.arange(nYCoords - 1)[:, numpy.newaxis]
+  j = numpy.arange(nZCoords - 1)[numpy.newaxis, :]
   # ... for left
-  for i in range(nYCoords - 1):
-    for j in range(nZCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[0][i][j], xyzToNode[0][i][j + 1], xyzToNode[0][i + 1][j]], leftId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[0][i][j + 1], xyzToNode[0][i + 1][j + 1], xyzToNode[0][i + 1][j]], leftId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[0, i, j], xyzToNode[0, i, j + 1], xyzToNode[0, i + 1, j]], \
+    [xyzToNode[0, i, j + 1], xyzToNode[0, i + 1, j + 1], xyzToNode[0, i + 1, j]]), ids = leftId)
   # ... for right
-  for i in range(nYCoords - 1):
-    for j in range(nZCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[-1][i][j], xyzToNode[-1][i][j + 1], xyzToNode[-1][i + 1][j]], rightId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[-1][i][j + 1], xyzToNode[-1][i + 1][j + 1], xyzToNode[-1][i + 1][j]], rightId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[-1, i, j], xyzToNode[-1, i, j + 1], xyzToNode[-1, i + 1, j]], \
+    [xyzToNode[-1, i, j + 1], xyzToNode[-1, i + 1, j + 1], xyzToNode[-1, i + 1, j]]), ids = rightId)
+  i = numpy.arange(nXCoords - 1)[:, numpy.newaxis]
   # ... for front
-  for i in range(nXCoords - 1):
-    for j in range(nZCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][0][j], xyzToNode[i + 1][0][j], xyzToNode[i][0][j + 1]], frontId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][0][j + 1], xyzToNode[i + 1][0][j], xyzToNode[i + 1][0][j + 1]], frontId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[i, 0, j], xyzToNode[i + 1, 0, j], xyzToNode[i, 0, j + 1]], \
+    [xyzToNode[i, 0, j + 1], xyzToNode[i + 1, 0, j], xyzToNode[i + 1, 0, j + 1]]), ids = frontId)
   # ... for back
-  for i in range(nXCoords - 1):
-    for j in range(nZCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][-1][j], xyzToNode[i + 1][-1][j], xyzToNode[i][-1][j + 1]], backId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][-1][j + 1], xyzToNode[i + 1][-1][j], xyzToNode[i + 1][-1][j + 1]], backId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[i, -1, j], xyzToNode[i + 1, -1, j], xyzToNode[i, -1, j + 1]], \
+    [xyzToNode[i, -1, j + 1], xyzToNode[i + 1, -1, j], xyzToNode[i + 1, -1, j + 1]]), ids = backId)
+  j = numpy.arange(nYCoords - 1)[numpy.newaxis, :]
   # ... for bottom
-  for i in range(nXCoords - 1):
-    for j in range(nYCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][j][0], xyzToNode[i + 1][j][0], xyzToNode[i + 1][j + 1][0]], bottomId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][j][0], xyzToNode[i][j + 1][0], xyzToNode[i + 1][j + 1][0]], bottomId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[i, j, 0], xyzToNode[i + 1, j, 0], xyzToNode[i + 1, j + 1, 0]], \
+    [xyzToNode[i, j, 0], xyzToNode[i, j + 1, 0], xyzToNode[i + 1, j + 1, 0]]), ids = bottomId)
   # ... for top
-  for i in range(nXCoords - 1):
-    for j in range(nYCoords - 1):
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][j][-1], xyzToNode[i + 1][j][-1], xyzToNode[i + 1][j + 1][-1]], topId))
-      mesh.AddSurfaceElement(elements.Element([xyzToNode[i][j][-1], xyzToNode[i][j + 1][-1], xyzToNode[i + 1][j + 1][-1]], topId))
+  mesh.AddSurfaceElementsArray(_ElementArray( \
+    [xyzToNode[i, j, -1], xyzToNode[i + 1, j, -1], xyzToNode[i + 1, j + 1, -1]], \
+    [xyzToNode[i, j, -1], xyzToNode[i, j + 1, -1], xyzToNode[i + 1, j + 1, -1]]), ids = topId)
   
   debug.dprint("Finished generating cuboid mesh")
 
@@ -519,22 +460,69 @@ class Remapper:
 
   def Map(self, nodeCoord):
     raise Exception("Unable to evaluate map for non-overloaded Remapper.Map")
+    
+  def MapArray(self, nodeCoords):
+    """
+    Map a (nodes x dim) array of node coordinates. Applies Map to each node
+    unless overloaded.
+    """
+    
+    return numpy.array([self.Map(list(nodeCoord)) for nodeCoord in numpy.asarray(nodeCoords, dtype = float)], dtype = float)
+    
+class ArrayRemapper(Remapper):
+  """
+  Remapper evaluated on arrays of node coordinates. Derived classes overload
+  MapArray, and Map is evaluated via MapArray.
+  """
+  
+  def __init__(self):
+    Remapper.__init__(self)
+    
+    return
 
-class RotationRemapper(Remapper):
+  def Map(self, nodeCoord):
+    return self.MapArray(numpy.array([nodeCoord], dtype = float))[0].tolist()
+    
+  def MapArray(self, nodeCoords):
+    raise Exception("Unable to evaluate map for non-overloaded ArrayRemapper.MapArray")
+
+class RotationRemapper(ArrayRemapper):
   def __init__(self, angle, axis = None):
+    ArrayRemapper.__init__(self)
     self._angle = angle
     self._axis = copy.deepcopy(axis)
     
     return
   
-  def Map(self, coord):
-    return calc.RotatedVector(coord, self._angle, axis = self._axis)
+  def MapArray(self, nodeCoords):
+    return tensors.RotatedVectors(nodeCoords, self._angle, axis = self._axis)
+    
+def _SlopedZ(z, distanceFromInnerWall, distanceFromOuterWall, minZ, maxZ, phiTop, phiBottom):
+  """
+  Return the z coordinates for a domain with top and bottom sloped at the
+  supplied angles
+  """
+  
+  if calc.AlmostEquals(phiTop, 0.0):
+    localMaxZ = maxZ
+  elif phiTop > 0.0:
+    localMaxZ = maxZ - distanceFromOuterWall * math.tan(phiTop)
+  else:
+    localMaxZ = maxZ + distanceFromInnerWall * math.tan(phiTop)
+  if calc.AlmostEquals(phiBottom, 0.0):
+    localMinZ = minZ
+  elif phiBottom > 0.0:
+    localMinZ = minZ + distanceFromInnerWall * math.tan(phiBottom)
+  else:
+    localMinZ = minZ - distanceFromOuterWall * math.tan(phiBottom)
+  
+  return localMinZ + ((z - minZ) / (maxZ - minZ)) * (localMaxZ - localMinZ)
 
-class SlopingAnnulusTopAndBottomRemapper(Remapper):
+class SlopingAnnulusTopAndBottomRemapper(ArrayRemapper):
   def __init__(self, a, b, minZ, maxZ, phiTop, phiBottom):
     assert(b > 0.0)
     assert(maxZ > minZ)
-    Remapper.__init__(self)
+    ArrayRemapper.__init__(self)
     self._a = a
     self._b = b
     self._minZ = minZ
@@ -544,35 +532,18 @@ class SlopingAnnulusTopAndBottomRemapper(Remapper):
 
     return
     
-  def Map(self, coord):
-    if optimise.DebuggingEnabled():
-      assert(len(coord) == 3)
-      assert(coord[2] <= self._maxZ)
-      assert(coord[2] >= self._minZ)
-      
-    distanceFromBottom = coord[2] - self._minZ
-    r = calc.L2Norm(coord[:2])
+  def MapArray(self, nodeCoords):
+    nodeCoords = numpy.array(nodeCoords, dtype = float)
+    r = numpy.sqrt(nodeCoords[:, 0] ** 2 + nodeCoords[:, 1] ** 2)
     if optimise.DebuggingEnabled():
-      assert(r >= self._a and r <= self._b)
-    distanceFromInnerWall = r - self._a
-    distanceFromOuterWall = self._b - r
-
-    if calc.AlmostEquals(self._phiTop, 0.0):
-      localMaxZ = self._maxZ
-    elif self._phiTop > 0.0:
-      localMaxZ = self._maxZ - distanceFromOuterWall * math.tan(self._phiTop)
-    else:
-      localMaxZ = self._maxZ + distanceFromInnerWall * math.tan(self._phiTop)
-    if calc.AlmostEquals(self._phiBottom, 0.0):
-      localMinZ = self._minZ
-    elif self._phiBottom > 0.0:
-      localMinZ = self._minZ + distanceFromInnerWall * math.tan(self._phiBottom)
-    else:
-      localMinZ = self._minZ - distanceFromOuterWall * math.tan(self._phiBottom)
+      assert(nodeCoords.shape[1] == 3)
+      assert((nodeCoords[:, 2] <= self._maxZ).all())
+      assert((nodeCoords[:, 2] >= self._minZ).all())
+      assert((r >= self._a).all() and (r <= self._b).all())
     
-    newZ = localMinZ + (distanceFromBottom / (self._maxZ - self._minZ)) * (localMaxZ - localMinZ)
+    nodeCoords[:, 2] = _SlopedZ(nodeCoords[:, 2], r - self._a, self._b - r, self._minZ, self._maxZ, self._phiTop, self._phiBottom)
 
-    return [coord[0], coord[1], newZ]
+    return nodeCoords
 
 class SlopingAnnulusTopRemapper(SlopingAnnulusTopAndBottomRemapper):
   def __init__(self, a, b, minZ, maxZ, phi):
@@ -586,37 +557,38 @@ class SlopingAnnulusBottomRemapper(SlopingAnnulusTopAndBottomRemapper):
     
     return
     
-class CorkscrewAnnulusRemapper(Remapper):
+class CorkscrewAnnulusRemapper(ArrayRemapper):
   def __init__(self, minZ, maxZ, phi):
     assert(maxZ > minZ)
-    Remapper.__init__(self)
+    ArrayRemapper.__init__(self)
     self._minZ = minZ
     self._maxZ = maxZ
     self._phi = phi
     
     return
     
-  def Map(self, coord):
+  def MapArray(self, nodeCoords):
+    nodeCoords = numpy.array(nodeCoords, dtype = float)
     if optimise.DebuggingEnabled():
-      assert(len(coord) == 3)
-      assert(coord[2] <= self._maxZ)
-      assert(coord[2] >= self._minZ)
+      assert(nodeCoords.shape[1] == 3)
+      assert((nodeCoords[:, 2] <= self._maxZ).all())
+      assert((nodeCoords[:, 2] >= self._minZ).all())
     
-    r = calc.L2Norm(coord[:2])
-    phi = math.atan2(coord[1], coord[0])
+    r = numpy.sqrt(nodeCoords[:, 0] ** 2 + nodeCoords[:, 1] ** 2)
+    phi = numpy.arctan2(nodeCoords[:, 1], nodeCoords[:, 0])
     
-    phi += self._phi * ((coord[2] - self._minZ) / (self._maxZ - self._minZ))
+    phi += self._phi * ((nodeCoords[:, 2] - self._minZ) / (self._maxZ - self._minZ))
     
-    newX = r * math.cos(phi)
-    newY = r * math.sin(phi)
+    nodeCoords[:, 0] = r * numpy.cos(phi)
+    nodeCoords[:, 1] = r * numpy.sin(phi)
     
-    return [newX, newY, coord[2]]
+    return nodeCoords
     
-class SlopingCuboidTopAndBottomRemapper(Remapper):
+class SlopingCuboidTopAndBottomRemapper(ArrayRemapper):
   def __init__(self, a, b, minZ, maxZ, phiTop, phiBottom):
     assert(b > 0.0)
     assert(maxZ > minZ)
-    Remapper.__init__(self)
+    ArrayRemapper.__init__(self)
     self._a = a
     self._b = b
     self._minZ = minZ
@@ -626,32 +598,17 @@ class SlopingCuboidTopAndBottomRemapper(Remapper):
 
     return
     
-  def Map(self, coord):
+  def MapArray(self, nodeCoords):
+    nodeCoords = numpy.array(nodeCoords, dtype = float)
     if optimise.DebuggingEnabled():
-      assert(len(coord) == 3)
-      assert(coord[0] >= self._a and coord[0] <= self._b)
-      assert(coord[2] <= self._maxZ)
-      assert(coord[2] >= self._minZ)
-      
-    distanceFromBottom = coord[2] - self._minZ
-    distanceFromInnerWall = coord[0] - self._a
-    distanceFromOuterWall = self._b - coord[0]
-
-    if calc.AlmostEquals(self._phiTop, 0.0):
-      localMaxZ = self._maxZ
-    elif self._phiTop > 0.0:
-      localMaxZ = self._maxZ - distanceFromOuterWall * math.tan(self._phiTop)
-    else:
-      localMaxZ = self._maxZ + distanceFromInnerWall * math.tan(self._phiTop)
-    if calc.AlmostEquals(self._phiBottom, 0.0):
-      localMinZ = self._minZ
-    elif self._phiBottom > 0.0:
-      localMinZ = self._minZ + distanceFromInnerWall * math.tan(self._phiBottom)
-    else:
-      localMinZ = self._minZ - distanceFromOuterWall * math.tan(self._phiBottom)
-    newZ = localMinZ + (distanceFromBottom / (self._maxZ - self._minZ)) * (localMaxZ - localMinZ)
+      assert(nodeCoords.shape[1] == 3)
+      assert((nodeCoords[:, 0] >= self._a).all() and (nodeCoords[:, 0] <= self._b).all())
+      assert((nodeCoords[:, 2] <= self._maxZ).all())
+      assert((nodeCoords[:, 2] >= self._minZ).all())
+    
+    nodeCoords[:, 2] = _SlopedZ(nodeCoords[:, 2], nodeCoords[:, 0] - self._a, self._b - nodeCoords[:, 0], self._minZ, self._maxZ, self._phiTop, self._phiBottom)
 
-    return [coord[0], coord[1], newZ]
+    return nodeCoords
     
 class SlopingCuboidTopRemapper(SlopingCuboidTopAndBottomRemapper):
   def __init__(self, a, b, minZ, maxZ, phi):
@@ -820,3 +777,18 @@ class annulus_meshUnittests(unittest.TestCase):
     self.assertAlmostEquals(ubound[1], 2.0)
     
     return
+    
+  def testArrayRemapper(self):
+    mesh = GenerateAnnulusMesh(SliceCoordsConstant(1.0, 2.0, 2), SliceCoordsConstant(0.0, 1.0, 2), SliceCoordsConstant(0.0, 2.0 * math.pi, 8)[:-1])
+    for remapper in [RotationRemapper(0.5, axis = [0.0, 0.0, 1.0]), SlopingAnnulusTopRemapper(1.0, 2.0, 0.0, 1.0, 0.1), CorkscrewAnnulusRemapper(0.0, 1.0, 0.2)]:
+      nodeCoords = remapper.MapArray(mesh.GetNodeCoordsArray())
+      self.assertEquals(nodeCoords.shape, (mesh.NodeCount(), 3))
+      for i, nodeCoord in enumerate(mesh.GetNodeCoords()):
+        for j, coord in enumerate(remapper.Map(list(nodeCoord))):
+          self.assertAlmostEquals(nodeCoords[i][j], coord)
+    
+    mesh.RemapNodeCoordsArray(CorkscrewAnnulusRemapper(0.0, 1.0, 0.2).MapArray)
+    for element in mesh.GetVolumeElements():
+      self.assertTrue(simplices.TetVolume(mesh.GetNodeCoords(element.GetNodes()), signed = True) > 0.0)
+    
+    return
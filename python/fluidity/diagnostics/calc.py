@@ -18,7 +18,6 @@
 Some mathematical routines
 """
 
-import copy
 import math
 import unittest
 
@@ -32,6 +31,10 @@ try:
   import scipy.linalg
 except ImportError:
   debug.deprint("Warning: Failed to import scipy.linalg module")
+try:
+  import scipy.sparse.linalg
+except ImportError:
+  debug.deprint("Warning: Failed to import scipy.sparse.linalg module")
 try:
   import scipy.stats
 except ImportError:
@@ -67,25 +70,22 @@ def BilinearlyInterpolate(uLeft, uRight, bLeft, bRight, xRatio, yRatio):
 def LinearlyInterpolateField(v, xDonor, xTarget):
   """
   Linearly interpolate the given 1D field between the donor and target
-  coordinates (which are assumed sorted in increasing order)
+  coordinates (where the donor coordinates are assumed sorted in increasing
+  order). v may have one entry, or one row of components, per donor coordinate.
   """
   
   assert(len(v) == len(xDonor))
   assert(len(v) > 1)
   assert(len(xTarget) > 1)
-  assert(xTarget[0] >= xDonor[0])
-  assert(xTarget[-1] <= xDonor[-1])
+  xTarget = numpy.asarray(xTarget, dtype = float)
+  assert(xTarget.min() >= xDonor[0])
+  assert(xTarget.max() <= xDonor[-1])
   
-  result = numpy.empty(len(xTarget))
-  upper = 1
-  for i, x in enumerate(xTarget):
-    while x > xDonor[upper]:
-      upper += 1
-    lower = upper - 1
-    ratio = (x - xDonor[lower]) / (xDonor[upper] - xDonor[lower])
-    result[i] = LinearlyInterpolate(v[lower], v[upper], ratio)
+  v = numpy.asarray(v, dtype = float)
+  lower, upper, ratio = IndexBinaryBracketSearch(xTarget, xDonor)
+  ratio.shape = ratio.shape + tuple(1 for i in range(len(v.shape) - 1))
     
-  return result
+  return LinearlyInterpolate(v[lower], v[upper], ratio)
   
 def Se(vals, returnMean = False):
   """
@@ -256,56 +256,172 @@ def UnwrappedPhases(phases, min = -math.pi):
   
   return unwrappedPhases
     
+def ExtirpolationWeights(positions, n, order = 6):
+  """
+  Return the grid point indices and weights used to extirpolate values onto a
+  periodic grid of n points, where positions are the (non-integer) grid
+  coordinates of the values. This is the inverse of Lagrange interpolation of
+  the given order - see W H Press and G B Rybicki, The Astrophysical Journal,
+  388:277-280, 1989. The returned arrays contain order entries per position,
+  with entry i * len(positions) + j corresponding to position j.
+  """
+  
+  positions = numpy.asarray(positions, dtype = float)
+  
+  lower = numpy.floor(positions).astype(numpy.int64) - (order - 1) // 2
+  offsets = positions - lower
+  
+  # Lagrange weights of grid points lower, ..., lower + order - 1
+  weights = numpy.empty((order, len(positions)))
+  for i in range(order):
+    weights[i] = 1.0
+    denominator = 1.0
+    for j in range(order):
+      if not j == i:
+        weights[i] *= offsets - j
+        denominator *= i - j
+    weights[i] /= denominator
+  indices = numpy.mod(lower + numpy.arange(order)[:, numpy.newaxis], n).ravel()
+  
+  return indices, weights.ravel()
+
+def _Extirpolate(positions, values, n, order = 6):
+  """
+  Extirpolate the supplied values onto a periodic grid of n points. See
+  ExtirpolationWeights.
+  """
+  
+  indices, weights = ExtirpolationWeights(positions, n, order = order)
+  values = numpy.asarray(values)
+  
+  if numpy.iscomplexobj(values):
+    values = numpy.tile(values, order)
+    return numpy.bincount(indices, weights = weights * values.real, minlength = n) + 1j * numpy.bincount(indices, weights = weights * values.imag, minlength = n)
+  else:
+    return numpy.bincount(indices, weights = weights * numpy.tile(values, order), minlength = n)
+  
+def UniformlySpaced(values):
+  """
+  Return whether the supplied values are uniformly spaced
+  """
+  
+  if len(values) < 3:
+    return True
+  spacings = numpy.diff(values)
+  
+  return numpy.all(numpy.abs(spacings - spacings[0]) <= 1.0e-8 * numpy.abs(values).max())
+
+def ExtirpolationGridSize(count, order = 6):
+  """
+  Return the size of the periodic grid used to evaluate sums at count uniformly
+  spaced frequencies via extirpolation and an FFT
+  """
+  
+  n = 64
+  while n < 4 * order * count:
+    n *= 2
+    
+  return n
+
+def LombScargleTrigonometricSums(omegaT, xMinusMean):
+  """
+  Return the Lomb-Scargle trigonometric sums A, B, C and D (see
+  NormalisedLombScargle.EvaluatePoint) for the supplied products of angular
+  frequency and time, with time varying along the last axis. If omegaT is a
+  (frequency x time) array the frequencies are shared by all series in
+  xMinusMean, which may be a single series or a (series x time) array. If
+  omegaT is a (series x frequency x time) array it contains separate
+  frequencies for each series.
+  """
+  
+  tau = numpy.arctan2(numpy.sin(2.0 * omegaT).sum(axis = -1), numpy.cos(2.0 * omegaT).sum(axis = -1))
+  omegaTMinusTau = omegaT - 0.5 * tau[..., numpy.newaxis]
+  c = numpy.cos(omegaTMinusTau)
+  s = numpy.sin(omegaTMinusTau)
+  del omegaTMinusTau
+  
+  if len(omegaT.shape) == 2:
+    return numpy.dot(xMinusMean, c.T) ** 2, (c * c).sum(axis = -1), \
+      numpy.dot(xMinusMean, s.T) ** 2, (s * s).sum(axis = -1)
+  else:
+    return (c * xMinusMean[:, numpy.newaxis, :]).sum(axis = -1) ** 2, (c * c).sum(axis = -1), \
+      (s * xMinusMean[:, numpy.newaxis, :]).sum(axis = -1) ** 2, (s * s).sum(axis = -1)
+
+def LombScargleExtirpolatedSums(hSums, twoSums, n):
+  """
+  Return the Lomb-Scargle trigonometric sums A, B, C and D (see
+  NormalisedLombScargle.EvaluatePoint) given the sums over n data points of
+  (x - mean) exp(i omega t), hSums, and of exp(2 i omega t), twoSums. hSums may
+  contain a row for each of several series.
+  """
+  
+  hypot = numpy.abs(twoSums)
+  cos2OmegaTau = numpy.where(hypot > 0.0, twoSums.real / numpy.where(hypot > 0.0, hypot, 1.0), 1.0)
+  sin2OmegaTau = numpy.where(hypot > 0.0, twoSums.imag / numpy.where(hypot > 0.0, hypot, 1.0), 0.0)
+  cosOmegaTau = numpy.sqrt(numpy.maximum(0.5 * (1.0 + cos2OmegaTau), 0.0))
+  sinOmegaTau = numpy.sqrt(numpy.maximum(0.5 * (1.0 - cos2OmegaTau), 0.0))
+  sinOmegaTau[sin2OmegaTau < 0.0] *= -1.0
+  
+  return (hSums.real * cosOmegaTau + hSums.imag * sinOmegaTau) ** 2, 0.5 * (n + hypot), \
+    (hSums.imag * cosOmegaTau - hSums.real * sinOmegaTau) ** 2, 0.5 * (n - hypot)
+
+def LombScarglePeriodogram(omegas, n, A, B, C, D):
+  """
+  Return the normalised Lomb-Scargle periodogram of n data points at the
+  supplied angular frequencies, given the trigonometric sums A, B, C and D (see
+  NormalisedLombScargle.EvaluatePoint). The sums may contain a row for each of
+  several series.
+  """
+  
+  # The power as defined in Press and Rybicki is:
+  #   P_N = ((A / B) + (C / D)) / (2.0 * variance)
+  # I prefer something more directly comparable with an equivalent Fourier
+  # amplitude, as follows. Terms with vanishing denominators (e.g. at the
+  # Nyquist frequency for even data) are zero.
+  tolerance = n * Epsilon()
+  power = numpy.where(B > tolerance, A / numpy.where(B > tolerance, B, 1.0), 0.0)
+  power += numpy.where(D > tolerance, C / numpy.where(D > tolerance, D, 1.0), 0.0)
+  periodogram = numpy.sqrt(power / n) / math.sqrt(2.0)
+  periodogram[..., numpy.abs(omegas) <= Epsilon()] = 0.0
+  
+  return periodogram
+    
 class NormalisedLombScargle:
   """
   Class defining a normalised Lomb-Scargle periodogram.
   """
   
+  # Periodograms with fewer than _directEvaluationLimit frequency / data point
+  # products, with at most _directEvaluationDataPoints data points, or at
+  # non-uniformly spaced frequencies, are evaluated directly
+  _directEvaluationLimit = 65536
+  _directEvaluationDataPoints = 64
+  
   def __init__(self, x, t):
     assert(len(x) == len(t))
     
-    self._x = copy.deepcopy(x)
-    self._t = copy.deepcopy(t)
+    x = numpy.array(x, dtype = float)
+    t = numpy.array(t, dtype = float)
     
-    self._t.sort()
+    order = numpy.argsort(t, kind = "mergesort")
+    self._x = x[order]
+    self._t = t[order]
     
-    self._initialise_math()
     self._initialise_parameters()
   
     return
     
-  def _initialise_math(self):
-    """
-    Detect math routines
-    """
-    
-    if NumpySupport():
-      # Use numpy if we can, as the math calls are performance critical
-      self._cos = numpy.cos
-      self._sin = numpy.sin
-      self._atan = numpy.arctan
-      self._atan2 = numpy.arctan2
-    else:
-      # Otherwise, fall back to math
-      debug.deprint("Warning: Unable to use numpy module in Lomb-Scargle periodogram")
-      self._cos = math.cos
-      self._sin = math.sin
-      self._atan = math.atan
-      self._atan2 = math.atan2
-    
-    return
-    
   def _initialise_parameters(self):
     """
     Initialise the parameters used in evaluating the Lomb-Scargle periodogram
     """
     
-    self._mean = MeanVal(self._x)
+    self._mean = self._x.mean()
+    self._variance = ((self._x - self._mean) ** 2).sum() / float(self.DataPointsCount() - 1)
     
-    self._variance = 0.0
-    for x in self._x:
-      self._variance += (x - self._mean) ** 2
-    self._variance /= float(self.DataPointsCount() - 1)
+    # The periodogram is invariant under a time shift. Use times relative to
+    # the first data point for accuracy.
+    self._tShifted = self._t - self._t[0]
     
     debug.dprint("Mean = " + str(self._mean), 3)
     debug.dprint("Variance = " + str(self._variance), 3)
@@ -320,13 +436,7 @@ class NormalisedLombScargle:
     return len(self._x)
     
   def Tau(self, omega):
-    numerator = 0.0
-    denomenator = 0.0
-    for t in self._t:
-      numerator += self._sin(2.0 * omega * t)
-      denomenator += self._cos(2.0 * omega * t)
-    
-    return self._atan2(numerator, denomenator) / (2.0 * omega)
+    return numpy.arctan2(numpy.sin(2.0 * omega * self._t).sum(), numpy.cos(2.0 * omega * self._t).sum()) / (2.0 * omega)
     
   def EvaluatePoint(self, omega):
     """
@@ -336,62 +446,85 @@ class NormalisedLombScargle:
     J D Scargle, The Astrophysical Journal, 263:835-853, 1982).
     """
   
-    if AlmostEquals(omega, 0.0):
-      return 0.0
+    return self.EvaluateDirect([omega])[0]
   
-    tau = self.Tau(omega)
-    
-    A = 0.0
-    B = 0.0
-    C = 0.0
-    D = 0.0
-    
-    for i in range(self.DataPointsCount()):      
-      valMinusMean = self._x[i] - self._mean
-      omegaTMinusTau = omega * (self._t[i] - tau)
-      
-      c = self._cos(omegaTMinusTau)
-      s = self._sin(omegaTMinusTau)
-      
-      A += valMinusMean * c
-      B += c ** 2
-      
-      C += valMinusMean * s
-      D += s ** 2
+  def EvaluateDirect(self, omegas, chunkSize = 1048576):
+    """
+    Evaluate the Lomb-Scargle periodogram at the supplied angular frequencies,
+    using direct calculation. O len(omega) self.DataPointsCount(). Frequencies
+    are evaluated in blocks of at most chunkSize frequency / data point
+    products.
+    """
     
-    A **= 2
-    C **= 2
+    omegas = numpy.array(omegas, dtype = float)
+    n = self.DataPointsCount()
+    valsMinusMean = self._x - self._mean
     
-    # The power as defined in Press and Rybicki is:
-    #   P_N = ((A / B) + (C / D)) / (2.0 * self._variance)
-    # I prefer something more directly comparable with an equivalent Fourier
-    # amplitude, as follows
-    return math.sqrt(((A / B) + (C / D)) / (self.DataPointsCount())) / math.sqrt(2.0)
+    periodogram = numpy.empty(len(omegas))
+    step = max(chunkSize // max(n, 1), 1)
+    for start in range(0, len(omegas), step):
+      lOmegas = omegas[start:start + step]
+      A, B, C, D = LombScargleTrigonometricSums(numpy.outer(lOmegas, self._tShifted), valsMinusMean)
+      periodogram[start:start + step] = LombScarglePeriodogram(lOmegas, n, A, B, C, D)
   
-  def EvaluateDirect(self, omegas):
+    return periodogram
+    
+  def _UniformFrequencySums(self, weights, omega0, dOmega, count, order = 6):
     """
-    Evaluate the Lomb-Scargle periodogram at the supplied angular frequencies,
-    using direct calculation. O len(omega) self.DataPointsCount().
+    Return the sums over data points of weights * exp(i omega t), for count
+    angular frequencies omega = omega0 + k dOmega, using extirpolation onto a
+    regular grid and an FFT
     """
-  
-    return numpy.array([self.EvaluatePoint(omega) for omega in omegas])
+    
+    n = ExtirpolationGridSize(count, order = order)
+    t = self._tShifted
+    positions = numpy.mod(t * (dOmega * n / (2.0 * math.pi)), n)
+    grid = _Extirpolate(positions, weights * numpy.exp(1.0j * omega0 * t), n, order = order)
+    
+    return n * numpy.fft.ifft(grid)[:count]
   
   def EvaluateExtirpilating(self, omegas):
     """
-    Evaluate the Lomb-Scargle periodogram at the supplied angular frequencies,
-    using the algorithm as in W H Press and G B Rybicki, The Astrophysical
-    Journal, 388:277-280, 1989. This method is a place-holder for when/if
-    this is implemented.
+    Evaluate the Lomb-Scargle periodogram at the supplied uniformly spaced
+    angular frequencies, using the algorithm as in W H Press and G B Rybicki,
+    The Astrophysical Journal, 388:277-280, 1989. O(self.DataPointsCount() +
+    len(omegas) log(len(omegas))).
     """
     
-    raise Exception("Not yet implemented")
+    omegas = numpy.array(omegas, dtype = float)
+    if len(omegas) == 0:
+      return numpy.empty(0)
+    if not UniformlySpaced(omegas):
+      raise Exception("Extirpolation requires uniformly spaced frequencies")
+    
+    n = self.DataPointsCount()
+    omega0 = omegas[0]
+    if len(omegas) > 1:
+      dOmega = (omegas[-1] - omegas[0]) / float(len(omegas) - 1)
+    else:
+      dOmega = 1.0
+    
+    # Sums of (x - mean) exp(i omega t), and of exp(2 i omega t)
+    hSums = self._UniformFrequencySums(self._x - self._mean, omega0, dOmega, len(omegas))
+    twoSums = self._UniformFrequencySums(numpy.ones(n), 2.0 * omega0, 2.0 * dOmega, len(omegas))
+    
+    A, B, C, D = LombScargleExtirpolatedSums(hSums, twoSums, n)
+    
+    return LombScarglePeriodogram(omegas, n, A, B, C, D)
   
   def Evaluate(self, omegas):
     """
-    Evaluate the Lomb-Scargle periodogram at the supplied angular frequencies
+    Evaluate the Lomb-Scargle periodogram at the supplied angular frequencies.
+    Uses extirpolation for large periodograms at uniformly spaced frequencies,
+    and direct calculation otherwise.
     """
     
-    return self.EvaluateDirect(omegas)
+    omegas = numpy.array(omegas, dtype = float)
+    n = self.DataPointsCount()
+    if len(omegas) * n > self._directEvaluationLimit and n > self._directEvaluationDataPoints and UniformlySpaced(omegas):
+      return self.EvaluateExtirpilating(omegas)
+    else:
+      return self.EvaluateDirect(omegas)
     
 def DominantModeStructured(amps, dt, N = 250):
   """
@@ -409,50 +542,91 @@ def DominantModeStructured(amps, dt, N = 250):
   
   return DominantModeUnstructured(amps, times, N = N, tMin = tMin, tMax = tMax)
 
-def DominantModeUnstructured(amps, times, N = 250, tMin = None, tMax = None):
+def DominantModeScanFrequencies(times, N = 250, tMin = None, tMax = None, maxScanCount = 65536):
   """
-  Compute the period and amplitude of the dominant mode in an uneven data
-  series.
+  Return the uniformly spaced angular frequencies scanned when searching for
+  the dominant mode in a data series sampled at the supplied times. Scans at
+  four times the frequency resolution of the data, with at least N and up to
+  maxScanCount frequencies.
   """
   
-  def Omegas(ts):
-    return [2.0 * math.pi / t for t in ts]
-  
-  debug.dprint("Finding dominant mode")
-  
-  assert(len(amps) == len(times))
+  times = numpy.asarray(times, dtype = float)
   if tMin is None:
-    tMin = Inf()
-    for i in range(len(times) -1):
-      tMin = min(tMin, times[i + 1] - times[i])
-    tMin *= 2.0
+    tMin = 2.0 * numpy.diff(times).min()
   if tMax is None:
     tMax = 2.0 * (times[-1] - times[0])
   
   debug.dprint("Period bounds = " + str((tMin, tMax)), 1)
   
+  omegaMin, omegaMax = 2.0 * math.pi / tMax, 2.0 * math.pi / tMin
+  span = times.max() - times.min()
+  count = max(N, min(int(4.0 * (omegaMax - omegaMin) * span / (2.0 * math.pi)) + 1, maxScanCount))
+  
+  return numpy.linspace(omegaMin, omegaMax, count)
+  
+def RefineDominantModes(evaluate, omegas, indices, amps, N = 5):
+  """
+  Refine the periods of the dominant modes of one or more series, given the
+  scanned angular frequencies omegas and, for each series, the index and
+  amplitude of the scan maximum. evaluate(series, omegas) must return the
+  amplitudes of the series with the supplied indices at the supplied
+  (series x frequency) array of angular frequencies. Returns arrays of periods
+  and amplitudes.
+  """
+  
+  omegas = numpy.asarray(omegas)
+  indices = numpy.asarray(indices)
+  count = len(omegas)
+  series = numpy.arange(len(indices))
+  t = 2.0 * math.pi / omegas[indices]
+  amp = numpy.array(amps, dtype = float)
+  
+  # Refine the periods between the neighbouring scanned periods, for all
+  # series which have not yet converged together
+  tMin = 2.0 * math.pi / omegas[numpy.minimum(indices + 1, count - 1)]
+  tMax = 2.0 * math.pi / omegas[numpy.maximum(indices - 1, 0)]
+  active = tMax - tMin > 1.0e-10 * t
+  while active.any():
+    debug.dprint("Refining " + str(active.sum()) + " series", 2)
+    
+    lSeries = series[active]
+    ts = tMin[lSeries, numpy.newaxis] + (tMax - tMin)[lSeries, numpy.newaxis] * numpy.linspace(0.0, 1.0, N)
+    lsAmps = evaluate(lSeries, 2.0 * math.pi / ts)
+    lIndices = lsAmps.argmax(axis = 1)
+    improved = lsAmps[numpy.arange(len(lSeries)), lIndices] > amp[lSeries]
+    t[lSeries[improved]] = ts[improved, lIndices[improved]]
+    amp[lSeries[improved]] = lsAmps[improved, lIndices[improved]]
+    dt = (tMax - tMin)[lSeries] / float(N - 1)
+    tMin[lSeries] = numpy.maximum(t[lSeries] - dt, 0.5 * t[lSeries])
+    tMax[lSeries] = t[lSeries] + dt
+    active = tMax - tMin > 1.0e-10 * t
+    
+  return t, amp
+
+def DominantModeUnstructured(amps, times, N = 250, tMin = None, tMax = None, maxScanCount = 65536):
+  """
+  Compute the period and amplitude of the dominant mode in an uneven data
+  series.
+  """
+  
+  debug.dprint("Finding dominant mode")
+  
+  assert(len(amps) == len(times))
+  
   ls = NormalisedLombScargle(amps, times)
   
-  amp = 0.0
-  t = 0.0
-  while True:
-    debug.dprint("Period bounds = " + str((tMin, tMax)), 2)
-    
-    ts = [tMin + (tMax - tMin) * float(i) / float(N - 1) for i in range(N)]
+  def Evaluate(series, omegas):
+    return 2.0 * ls.EvaluateDirect(omegas[0])[numpy.newaxis, :]
+  
+  # Scan uniformly spaced angular frequencies using the fast periodogram, and
+  # then refine the period
+  omegas = DominantModeScanFrequencies(times, N = N, tMin = tMin, tMax = tMax, maxScanCount = maxScanCount)
              # Note the factor of two - we want the least squares harmonic
              # fit amplitude, not the FFT amplitude
-    lsAmps = 2.0 * ls.Evaluate(Omegas(ts))
-    lastT = t
-    amp = 0.0
-    for i, lsAmp in enumerate(lsAmps):
-      if lsAmp > amp:
-        t = ts[i]
-        amp = lsAmp
-    if AlmostEquals(t, lastT):
-      break
-    tMin = t - (tMax - tMin) / float(N - 1)
-    tMax = t + (t - tMin)
-    N = 4
+  lsAmps = 2.0 * ls.Evaluate(omegas)
+  index = lsAmps.argmax()
+  t, amp = RefineDominantModes(Evaluate, omegas, [index], [lsAmps[index]])
+  t, amp = float(t[0]), float(amp[0])
   
   debug.dprint("Period = " + str(t))
   debug.dprint("Amplitude = " + str(amp))
@@ -461,118 +635,220 @@ def DominantModeUnstructured(amps, times, N = 250, tMin = None, tMax = None):
     
   return t, amp
     
+def _SearchValues(val, values, increasing):
+  """
+  Return the supplied search values and sorted values as arrays, in increasing
+  order, for use by the IndexBinary*Search functions
+  """
+  
+  values = numpy.asarray(values)
+  if not increasing:
+    values = values[::-1]
+    
+  if optimise.DebuggingEnabled():
+    assert((numpy.diff(values) >= 0).all())
+    
+  return numpy.asarray(val), values
+  
+def _SearchResult(val, indices):
+  """
+  Return the supplied indices as an int if val is a scalar, and as an array
+  otherwise
+  """
+  
+  if len(numpy.shape(val)) == 0:
+    return int(indices)
+  else:
+    return indices
+
 def IndexBinaryLboundSearch(val, values, increasing = True):
   """
   Find the max (min) index into values such that values[index] <= val, where
   if increasing is True (False), assumes the values are in increasing
-  (decreasing) order
+  (decreasing) order. val may be a single value or an array of values, in which
+  case an array of indices is returned.
   """
-
-  if isinstance(values, numpy.ndarray):
-    values = values.tolist()
-
+  
+  lVal, lValues = _SearchValues(val, values, increasing)
+  lower = numpy.maximum(numpy.searchsorted(lValues, lVal, side = "right") - 1, 0)
   if not increasing:
-    lValues = copy.deepcopy(values)
-    values = lValues
-    values.reverse()
-
-  if optimise.DebuggingEnabled():
-    testValues = copy.deepcopy(values)
-    testValues.sort()
-    assert(values == testValues)
-
-  minLower = 0
-  maxLower = len(values)
-  lower = minLower
-  while maxLower - minLower > 0:
-    # Choose new bounds for lower
-    if values[lower] <= val:
-      minLower = lower
-    else:
-      maxLower = lower
-      
-    # Calculate a new guess for lower
-    oldLower = lower
-    lower = int(float(maxLower + minLower) / 2.0)
-    if oldLower == lower:
-      if maxLower - minLower <= 1:
-        break
-      else:
-        lower += 1
-
-  if increasing:
-    return lower
-  else:
-    return len(values) - lower - 1
+    lower = len(lValues) - lower - 1
+  
+  return _SearchResult(val, lower)
 
 def IndexBinaryUboundSearch(val, values, increasing = True):
   """
   Find the min (max) index into values such that values[index] >= val, where
   if increasing is True (False), assumes the values are in increasing
-  (decreasing) order
+  (decreasing) order. val may be a single value or an array of values, in which
+  case an array of indices is returned.
   """
-
-  if isinstance(values, numpy.ndarray):
-    values = values.tolist()
-
-  if increasing:
-    lValues = copy.deepcopy(values)
-    values = lValues
-    values.reverse()
-
-  if optimise.DebuggingEnabled():
-    testValues = copy.deepcopy(values)
-    testValues.sort()
-    testValues.reverse()
-    assert(values == testValues)
-
-  minUpper = 0
-  maxUpper = len(values) - 1
-  upper = maxUpper
-  while maxUpper - minUpper > 0:
-    # Choose new bounds for lower
-    if values[upper] < val:
-      maxUpper = upper
-    else:
-      minUpper = upper
-      
-    # Calculate a new guess for lower
-    oldUpper = upper
-    upper = int(float(maxUpper + minUpper) / 2.0)
-    if oldUpper == upper:
-      if maxUpper - minUpper <= 1:
-        break
-      else:
-        upper -= 1
-
+  
+  lVal, lValues = _SearchValues(val, values, increasing)
+  upper = numpy.minimum(numpy.searchsorted(lValues, lVal, side = "left"), len(lValues) - 1)
   if not increasing:
-    return upper
+    upper = len(lValues) - upper - 1
+  
+  return _SearchResult(val, upper)
+  
+def IndexBinaryBracketSearch(val, values, increasing = True):
+  """
+  Find the indices of the interval in values bracketing val, and the linear
+  interpolation ratio within that interval. Returns (index0, index1, ratio),
+  where index1 = index0 + 1 and val = values[index0] + ratio *
+  (values[index1] - values[index0]). If increasing is True (False), assumes the
+  values are in increasing (decreasing) order. Values outside the range of
+  values are bracketed by the end interval (and extrapolated). If values
+  contains a single entry, index0 = index1 = 0 and ratio = 0. val may be a
+  single value or an array of values, in which case arrays of indices and
+  ratios are returned.
+  """
+  
+  lVal, lValues = _SearchValues(val, values, increasing)
+  assert(len(lValues) > 0)
+  
+  if len(lValues) == 1:
+    index0 = numpy.zeros(lVal.shape, dtype = int)
+    index1 = index0
+    ratio = numpy.zeros(lVal.shape)
   else:
-    return len(values) - upper - 1
+    if increasing:
+      index0 = numpy.searchsorted(lValues, lVal, side = "right") - 1
+    else:
+      index0 = len(lValues) - numpy.searchsorted(lValues, lVal, side = "left") - 1
+    index0 = numpy.clip(index0, 0, len(lValues) - 2)
+    index1 = index0 + 1
+    values = numpy.asarray(values)
+    ratio = (lVal - values[index0]) / numpy.asarray(values[index1] - values[index0], dtype = float)
+  
+  if len(lVal.shape) == 0:
+    return int(index0), int(index1), float(ratio)
+  else:
+    return index0, index1, ratio
+    
+def LaggedCovariance(v, n, J = 1, method = "trajectory"):
+  """
+  Return the lagged covariance matrix used in a singular systems analysis with
+  window length n and lag J. v may be a 1D array of data, in which case an
+  (n x n) matrix is returned, or a (samples x series) array, in which case a
+  (series x n x n) array is returned. Available methods are:
+    "trajectory" - theta = X X^T / N, where X is the (n x N) trajectory
+                   matrix (as in Broomhead and King). Computed without forming
+                   X, from cumulative sums of lagged products, in
+                   O(n len(v)).
+    "toeplitz"   - theta_jk = c(|j - k| J), where c is the autocovariance of
+                   the whole series (as in Vautard and Ghil). Computed via an
+                   FFT, in O(len(v) log(len(v))).
+  """
+  
+  v = numpy.asarray(v, dtype = float)
+  batch = len(v.shape) > 1
+  if not batch:
+    v = v[:, numpy.newaxis]
+  
+  N_T = v.shape[0]
+  N = N_T - (n - 1) * J
+  assert(N > 0)
+  
+  theta = numpy.empty((v.shape[1], n, n))
+  if method == "trajectory":
+    for d in range(n):
+      # Cumulative sums of v[i] v[i + d J]
+      products = numpy.zeros((N_T - d * J + 1, v.shape[1]))
+      numpy.cumsum(v[:N_T - d * J] * v[d * J:], axis = 0, out = products[1:])
+      j = numpy.arange(n - d)
+      theta[:, j, j + d] = theta[:, j + d, j] = ((products[j * J + N] - products[j * J]) / float(N)).T
+  elif method == "toeplitz":
+    size = 1
+    while size < 2 * N_T:
+      size *= 2
+    fft = numpy.fft.rfft(v, n = size, axis = 0)
+    lags = numpy.arange(n) * J
+    c = numpy.fft.irfft(fft * fft.conj(), n = size, axis = 0)[lags] / (N_T - lags)[:, numpy.newaxis]
+    indices = numpy.abs(numpy.arange(n)[:, numpy.newaxis] - numpy.arange(n)[numpy.newaxis, :])
+    theta[:] = numpy.rollaxis(c[indices], 2)
+  else:
+    raise Exception("Unknown lagged covariance method: " + str(method))
+  
+  if batch:
+    return theta
+  else:
+    return theta[0]
+    
+def LeadingEigenpairs(matrix, modes, randomised = False, oversampling = 10, iterations = 4, seed = None):
+  """
+  Return the leading modes eigenvalues (in decreasing order) and eigenvectors
+  (as columns) of the supplied symmetric matrix. Uses a randomised subspace
+  iteration if randomised is True, and a Lanczos (ARPACK) method for large
+  matrices otherwise.
+  """
+  
+  a = numpy.asarray(matrix, dtype = float)
+  n = a.shape[0]
+  assert(a.shape == (n, n))
+  assert(modes > 0)
+  modes = min(modes, n)
+  
+  if randomised:
+    # As in N Halko, P G Martinsson and J A Tropp, SIAM Review, 53:217-288, 2011
+    q = numpy.random.RandomState(seed).standard_normal((n, min(n, modes + oversampling)))
+    q = numpy.linalg.qr(numpy.dot(a, q))[0]
+    for i in range(iterations):
+      q = numpy.linalg.qr(numpy.dot(a, q))[0]
+    w, v = numpy.linalg.eigh(numpy.dot(q.T, numpy.dot(a, q)))
+    v = numpy.dot(q, v)
+  elif n > 512 and modes < n - 1:
+    w, v = scipy.sparse.linalg.eigsh(a, k = modes, which = "LA")
+  else:
+    w, v = numpy.linalg.eigh(a)
     
-def SSA(v, n, J = 1):
+  order = numpy.argsort(w)[::-1][:modes]
+  
+  return w[order], v[:, order]
+
+def SSA(v, n, J = 1, modes = None, method = "trajectory", randomised = False):
   """
   Perform a singular systems analysis of the supplied array of data. See:
     Inertia-Gravity Wave Generation by Baroclinic Instability, Tom Jacoby,
     First year report, AOPP, September 2007
+  If modes is None, returns the full eigendecomposition of the lagged
+  covariance matrix as returned by Eigendecomposition. Otherwise returns the
+  leading modes eigenvalues and eigenvectors, as returned by
+  LeadingEigenpairs. See LaggedCovariance for the available methods.
   """
   
-  N_T = len(v)
-  N = N_T - (n - 1) * J
-
-  shape = (n, N)
-  debug.dprint("Assembling matrix for SSA, shape = " + str(shape))
-  X = numpy.empty(shape)
-  for i in range(N):
-    for j in range(n):
-      X[j, i] = v[i + j * J]
-  theta = numpy.dot(X, X.transpose()) / float(N)
-  del(X)
+  debug.dprint("Assembling lagged covariance for SSA, shape = " + str((n, n)))
+  theta = LaggedCovariance(v, n, J = J, method = method)
   
   debug.dprint("Performing eigendecomposition")
-  return Eigendecomposition(theta, returnEigenvectors = True)
+  if modes is None:
+    return Eigendecomposition(theta, returnEigenvectors = True)
+  else:
+    return LeadingEigenpairs(theta, modes, randomised = randomised)
+    
+def BatchSSA(v, n, J = 1, modes = None, method = "trajectory"):
+  """
+  Perform a singular systems analysis of each column of the supplied
+  (samples x series) array of data. Returns a (series x modes) array of
+  eigenvalues, in decreasing order, and a (series x n x modes) array of
+  eigenvectors. All modes are returned if modes is None. See LaggedCovariance
+  for the available methods.
+  """
+  
+  v = numpy.asarray(v, dtype = float)
+  assert(len(v.shape) == 2)
   
-def InterpolatedSSA(v, t, N_T, n, J = 1, t0 = None, t1 = None):
+  debug.dprint("Assembling lagged covariances for SSA, shape = " + str((v.shape[1], n, n)))
+  theta = LaggedCovariance(v, n, J = J, method = method)
+  
+  debug.dprint("Performing eigendecompositions")
+  w, vectors = numpy.linalg.eigh(theta)
+  if modes is None:
+    modes = n
+  
+  return w[:, ::-1][:, :modes], vectors[:, :, ::-1][:, :, :modes]
+  
+def InterpolatedSSA(v, t, N_T, n, J = 1, t0 = None, t1 = None, modes = None, method = "trajectory", randomised = False):
   """
   Perform a singular systems analysis of the supplied non-uniform data using
   linear interpolation
@@ -586,11 +862,10 @@ def InterpolatedSSA(v, t, N_T, n, J = 1, t0 = None, t1 = None):
   dt = (t1 - t0) / float(N_T)
   debug.dprint("Interpolation dt: " + str(dt))
   
-  lt = [t0 + i * dt for i in range(N_T)]
+  lt = t0 + numpy.arange(N_T) * dt
   lv = LinearlyInterpolateField(v, t, lt)
-  print lv, lt
     
-  return SSA(lv, n, J = J)
+  return SSA(lv, n, J = J, modes = modes, method = method, randomised = randomised)
     
 def LinearRegression(x, y, returnR = False, returnSe = False):
   """
@@ -1158,6 +1433,56 @@ class calcUnittests(unittest.TestCase):
   
     return
     
+  def testNormalisedLombScargleExtirpolation(self):
+    times = [0.37 * i + 0.2 * math.sin(7.0 * i) for i in range(200)]
+    vals = [math.sin(1.3 * time) + 0.5 * math.cos(4.1 * time) for time in times]
+    omegas = [0.05 * i for i in range(200)]
+    direct = NormalisedLombScargle(vals, times).EvaluateDirect(omegas)
+    extirpolated = NormalisedLombScargle(vals, times).EvaluateExtirpilating(omegas)
+    self.assertEquals(len(extirpolated), len(omegas))
+    for i in range(len(omegas)):
+      self.assertAlmostEquals(direct[i], extirpolated[i], 6)
+    self.assertEquals(utils.IndexOfMax(extirpolated), 26)
+    self.assertRaises(Exception, NormalisedLombScargle(vals, times).EvaluateExtirpilating, [1.0, 2.0, 4.0])
+    
+    # Data points need not be supplied in time order
+    unsorted = NormalisedLombScargle(vals[::-1], times[::-1]).EvaluateDirect(omegas)
+    for i in range(len(omegas)):
+      self.assertAlmostEquals(direct[i], unsorted[i])
+  
+    return
+    
+  def testSSA(self):
+    vals = [math.sin(0.3 * i) + 0.1 * math.cos(1.7 * i) + 1.0 for i in range(100)]
+    n, J = 6, 2
+    N = len(vals) - (n - 1) * J
+    X = numpy.array([[vals[i + j * J] for i in range(N)] for j in range(n)])
+    theta = LaggedCovariance(vals, n, J = J)
+    self.assertAlmostEquals(abs(theta - numpy.dot(X, X.T) / N).max(), 0.0)
+    c = [sum([vals[i] * vals[i + d * J] for i in range(len(vals) - d * J)]) / (len(vals) - d * J) for d in range(n)]
+    theta = LaggedCovariance(vals, n, J = J, method = "toeplitz")
+    for j in range(n):
+      for k in range(n):
+        self.assertAlmostEquals(theta[j, k], c[abs(j - k)])
+    self.assertRaises(Exception, LaggedCovariance, vals, n, J = J, method = "invalid")
+    
+    w, v = SSA(vals, n, J = J)
+    w = sorted(w.real, reverse = True)
+    for randomised in [False, True]:
+      lw, lv = SSA(vals, n, J = J, modes = 2, randomised = randomised)
+      self.assertEquals(lv.shape, (n, 2))
+      for i in range(2):
+        self.assertAlmostEquals(lw[i], w[i])
+        
+    bw, bv = BatchSSA(numpy.column_stack([vals, vals[::-1]]), n, J = J, modes = 2)
+    self.assertEquals(bw.shape, (2, 2))
+    self.assertEquals(bv.shape, (2, n, 2))
+    for i in range(2):
+      self.assertAlmostEquals(bw[0, i], w[i])
+      self.assertAlmostEquals(abs(numpy.dot(bv[0, :, i], lv[:, i])), 1.0)
+  
+    return
+    
   def testDominantModeStructured(self):
     dt = 1.2
     amps = [1.5 * math.sin(2.0 * math.pi * dt * float(i) / float(9)) for i in range(25)]
@@ -1196,6 +1521,9 @@ class calcUnittests(unittest.TestCase):
 
     values = [2, 1, 0]
     self.assertEquals(IndexBinaryLboundSearch(1, values, increasing = False), 1)
+    
+    self.assertEquals(IndexBinaryLboundSearch([-0.1, 0.1, 1.1, 2.1], [0.0, 1.0, 2.0]).tolist(), [0, 0, 1, 2])
+    self.assertEquals(IndexBinaryLboundSearch(numpy.array([-0.1, 0.1, 1.1, 2.1]), [2.0, 1.0, 0.0], increasing = False).tolist(), [2, 2, 1, 0])
 
     return
 
@@ -1226,9 +1554,39 @@ class calcUnittests(unittest.TestCase):
 
     values = [2, 1, 0]
     self.assertEquals(IndexBinaryUboundSearch(1, values, increasing = False), 1)
+    
+    self.assertEquals(IndexBinaryUboundSearch([-0.1, 0.1, 1.1, 2.1], [0.0, 1.0, 2.0]).tolist(), [0, 1, 2, 2])
+    self.assertEquals(IndexBinaryUboundSearch(numpy.array([-0.1, 0.1, 1.1, 2.1]), [2.0, 1.0, 0.0], increasing = False).tolist(), [2, 1, 0, 0])
 
     return
     
+  def testIndexBinaryBracketSearch(self):
+    self.assertEquals(IndexBinaryBracketSearch(0.5, [0.0, 1.0, 2.0]), (0, 1, 0.5))
+    self.assertEquals(IndexBinaryBracketSearch(2.0, [0.0, 1.0, 2.0]), (1, 2, 1.0))
+    self.assertEquals(IndexBinaryBracketSearch(1.5, [2.0, 1.0, 0.0], increasing = False), (0, 1, 0.5))
+    self.assertEquals(IndexBinaryBracketSearch(1.0, [1.0]), (0, 0, 0.0))
+    
+    index0, index1, ratio = IndexBinaryBracketSearch([-1.0, 0.0, 1.0, 1.5, 3.0], [0.0, 1.0, 2.0])
+    self.assertEquals(index0.tolist(), [0, 0, 1, 1, 1])
+    self.assertEquals(index1.tolist(), [1, 1, 2, 2, 2])
+    self.assertEquals(ratio.tolist(), [-1.0, 0.0, 0.0, 0.5, 2.0])
+    
+    index0, index1, ratio = IndexBinaryBracketSearch([0.0, 0.5, 2.0], [2.0, 1.0, 0.0], increasing = False)
+    self.assertEquals(index0.tolist(), [1, 1, 0])
+    self.assertEquals(index1.tolist(), [2, 2, 1])
+    self.assertEquals(ratio.tolist(), [1.0, 0.5, 0.0])
+    
+    return
+    
+  def testLinearlyInterpolateField(self):
+    result = LinearlyInterpolateField([0.0, 2.0, 0.0], [0.0, 1.0, 3.0], [0.0, 0.5, 2.0, 3.0])
+    self.assertEquals(result.tolist(), [0.0, 1.0, 1.0, 0.0])
+    result = LinearlyInterpolateField([[0.0, 1.0], [2.0, 3.0]], [0.0, 1.0], [0.25, 0.5])
+    self.assertEquals(result.tolist(), [[0.5, 1.5], [1.0, 2.0]])
+    self.assertRaises(AssertionError, LinearlyInterpolateField, [0.0, 1.0], [0.0, 1.0], [0.0, 1.5])
+    
+    return
+    
   def testLinearRegression(self):
     eq, r = LinearRegression([0.0, 1.0, 2.0], [2.0, 3.0, 4.0], returnR = True)
     self.assertAlmostEquals(eq[0], 1.0)
@@ -170,15 +170,45 @@ class ElementType(events.Evented):
   def GetElementFamilyId(self):
     return self._elementFamilyIdMap[self.GetElementTypeId()]
     
-class Element(events.Evented):
+class _SharedElementType(ElementType):
   """
-  A single element in a mesh
+  An element type shared via GetElementType. Shared element types cannot be
+  modified.
   """
+  
+  def SetElementTypeId(self, elementTypeId):
+    raise Exception("Shared element types cannot be modified")
+    
+  def SetDim(self, dim):
+    raise Exception("Shared element types cannot be modified")
+    
+  def SetNodeCount(self, nodeCount):
+    raise Exception("Shared element types cannot be modified")
+    
+_elementTypes = {}
+def GetElementType(dim, nodeCount):
+  """
+  Return the element type with the supplied dimension and node count. Element
+  types are cached, and shared between callers.
+  """
+  
+  key = (dim, nodeCount)
+  if not key in _elementTypes:
+    _elementTypes[key] = _SharedElementType(dim = dim, nodeCount = nodeCount)
+    
+  return _elementTypes[key]
+    
+class Element(object):
+  """
+  A single element in a mesh. Elements are slotted and raise no events, as
+  meshes may contain very many of them.
+  """
+  
+  __slots__ = ["_nodes", "_ids", "_dim"]
 
   def __init__(self, nodes = [], ids = None, dim = None):  
     self._nodes = []
-    for node in nodes:
-      self.AddNode(node)
+    self.AddNodes(nodes)
     self.SetIds(ids)
     
     if not dim is None:
@@ -186,6 +216,23 @@ class Element(events.Evented):
     
     return
     
+  def __getstate__(self):
+    # Slotted classes have no __dict__, so the slots of this class and its
+    # subclasses are pickled explicitly (required for pickle protocols 0 and 1)
+    state = {}
+    for cls in type(self).__mro__:
+      for slot in getattr(cls, "__slots__", []):
+        if hasattr(self, slot):
+          state[slot] = getattr(self, slot)
+    
+    return state
+    
+  def __setstate__(self, state):
+    for slot, value in state.items():
+      setattr(self, slot, value)
+    
+    return
+    
   def __str__(self):
     
     if self.HasDim():
@@ -233,8 +280,10 @@ class Element(events.Evented):
     return
     
   def AddNodes(self, nodes):
+    nodes = list(nodes)
     for node in nodes:
-      self.AddNode(node)
+      assert(node >= 0)
+    self._nodes += nodes
     
     return
     
@@ -258,12 +307,7 @@ class Element(events.Evented):
     return self._ids
     
   def SetIds(self, ids):
-    if ids is None:
-      self._ids = []
-    elif utils.CanLen(ids):
-      self._ids = [int(round(id)) for id in ids]
-    else:
-      self._ids = [int(float(ids))]
+    self._ids = NormalisedIds(ids)
     
     return
     
@@ -271,7 +315,298 @@ class Element(events.Evented):
     return len(self._nodes)
     
   def GetType(self):      
-    return ElementType(dim = self.GetDim(), nodeCount = self.GetLoc())
+    return GetElementType(self.GetDim(), self.GetLoc())
+    
+def NormalisedIds(ids):
+  """
+  Return the supplied element IDs as a list of integers
+  """
+  
+  if ids is None:
+    return []
+  elif utils.CanLen(ids):
+    return [int(round(id)) for id in ids]
+  else:
+    return [int(float(ids))]
+    
+class ElementBlock:
+  """
+  Array storage for a set of elements with a common dimension and node count.
+  Element nodes are stored in an (elements x nodes per element) connectivity
+  array, and element IDs in an (elements x IDs) array, padded with zeros where
+  elements have differing numbers of IDs. The block generation is incremented
+  by every removal, which invalidates existing element views.
+  """
+  
+  def __init__(self, nodeCount, dim = None, nodes = None, ids = None):
+    assert(nodeCount >= 0)
+  
+    self._nodeCount = nodeCount
+    self._dim = dim
+    self._count = 0
+    self._generation = 0
+    self._nodes = numpy.empty((0, nodeCount), dtype = numpy.int64)
+    self._ids = numpy.empty((0, 0), dtype = numpy.int64)
+    self._idCounts = numpy.empty(0, dtype = numpy.int64)
+    
+    if not nodes is None:
+      self.AddElements(nodes, ids = ids)
+    
+    return
+    
+  def __str__(self):
+    return "Element block: " + str(self.Count()) + " elements, " + str(self.GetNodeCount()) + " nodes per element"
+    
+  def _Reserve(self, count, idCount):
+    """
+    Grow the storage arrays (geometrically) to hold at least count elements
+    with idCount IDs each
+    """
+    
+    capacity = self._nodes.shape[0]
+    if count > capacity:
+      capacity = max(count, 2 * capacity)
+      nodes = numpy.empty((capacity, self._nodeCount), dtype = numpy.int64)
+      nodes[:self._count] = self._nodes[:self._count]
+      self._nodes = nodes
+      idCounts = numpy.zeros(capacity, dtype = numpy.int64)
+      idCounts[:self._count] = self._idCounts[:self._count]
+      self._idCounts = idCounts
+    if capacity > self._ids.shape[0] or idCount > self._ids.shape[1]:
+      ids = numpy.zeros((capacity, max(idCount, self._ids.shape[1])), dtype = numpy.int64)
+      ids[:self._count, :self._ids.shape[1]] = self._ids[:self._count]
+      self._ids = ids
+      
+    return
+    
+  def Count(self):
+    return self._count
+    
+  def GetGeneration(self):
+    return self._generation
+    
+  def GetNodeCount(self):
+    return self._nodeCount
+    
+  def HasDim(self):
+    return not self._dim is None
+    
+  def GetDim(self):
+    assert(self.HasDim())
+    
+    return self._dim
+    
+  def SetDim(self, dim):
+    assert(dim >= 0)
+    assert(not self.HasDim() or dim == self.GetDim())
+    self._dim = dim
+    
+    return
+    
+  def GetType(self):
+    return GetElementType(self.GetDim(), self.GetNodeCount())
+    
+  def GetNodesArray(self):
+    """
+    Return the (elements x nodes per element) connectivity array
+    """
+    
+    return self._nodes[:self._count]
+    
+  def GetIdsArray(self):
+    """
+    Return the (elements x IDs) array, padded with zeros where elements have
+    fewer IDs
+    """
+    
+    return self._ids[:self._count]
+    
+  def GetIdCounts(self):
+    """
+    Return the number of IDs of each element
+    """
+    
+    return self._idCounts[:self._count]
+    
+  def FixedIdCount(self):
+    """
+    Return the number of IDs per element if all elements have the same number
+    of IDs, and None otherwise
+    """
+  
+    idCounts = self.GetIdCounts()
+    if len(idCounts) == 0:
+      return 0
+    elif numpy.all(idCounts == idCounts[0]):
+      return int(idCounts[0])
+    else:
+      return None
+    
+  def AddElements(self, nodes, ids = None):
+    """
+    Add elements, with nodes given as an (elements x nodes per element) array
+    and IDs (optionally) as a scalar, an (elements,) or an (elements x IDs) array
+    """
+    
+    nodes = numpy.asarray(nodes, dtype = numpy.int64)
+    if nodes.size == 0:
+      nodes = nodes.reshape((nodes.size // max(self._nodeCount, 1), self._nodeCount))
+    assert(len(nodes.shape) == 2 and nodes.shape[1] == self._nodeCount)
+    if optimise.DebuggingEnabled():
+      assert(numpy.all(nodes >= 0))
+    if ids is None:
+      ids = numpy.empty((nodes.shape[0], 0), dtype = numpy.int64)
+    else:
+      ids = numpy.asarray(ids)
+      if not ids.dtype.kind in "iu":
+        ids = numpy.round(ids).astype(numpy.int64)
+      if len(ids.shape) == 0:
+        # A single ID, shared by all elements
+        ids = numpy.repeat(ids, nodes.shape[0]).reshape((nodes.shape[0], 1))
+      elif len(ids.shape) == 1:
+        ids = ids[:, numpy.newaxis]
+    assert(ids.shape[0] == nodes.shape[0])
+    
+    start, end = self._count, self._count + nodes.shape[0]
+    self._Reserve(end, ids.shape[1])
+    self._nodes[start:end] = nodes
+    self._ids[start:end] = 0
+    self._ids[start:end, :ids.shape[1]] = ids
+    self._idCounts[start:end] = ids.shape[1]
+    self._count = end
+    
+    return
+    
+  def AddElement(self, nodes, ids = None):
+    ids = NormalisedIds(ids)
+    self.AddElements([nodes], [ids] if len(ids) > 0 else None)
+    
+    return
+    
+  def RemoveElementByIndex(self, index):
+    if index < 0:
+      index += self._count
+    assert(index >= 0 and index < self._count)
+    self._nodes[index:self._count - 1] = self._nodes[index + 1:self._count]
+    self._ids[index:self._count - 1] = self._ids[index + 1:self._count]
+    self._idCounts[index:self._count - 1] = self._idCounts[index + 1:self._count]
+    self._count -= 1
+    # Removal shifts element indices, so existing views are now stale
+    self._generation += 1
+    
+    return
+    
+  def GetElementNodes(self, index):
+    return self.GetNodesArray()[index].tolist()
+    
+  def SetElementNodes(self, index, nodes):
+    assert(len(nodes) == self._nodeCount)
+    self.GetNodesArray()[index] = nodes
+    
+    return
+    
+  def GetElementIds(self, index):
+    return self.GetIdsArray()[index, :self.GetIdCounts()[index]].tolist()
+    
+  def SetElementIds(self, index, ids):
+    ids = NormalisedIds(ids)
+    self._Reserve(self._count, len(ids))
+    self.GetIdsArray()[index] = 0
+    self.GetIdsArray()[index, :len(ids)] = ids
+    self.GetIdCounts()[index] = len(ids)
+    
+    return
+    
+  def GetElement(self, index):
+    """
+    Return a view of the element with the supplied index
+    """
+    
+    if index < 0:
+      index += self._count
+    assert(index >= 0 and index < self._count)
+    
+    return ElementView(self, index)
+    
+  def GetElements(self):
+    return [ElementView(self, i) for i in range(self._count)]
+    
+class ElementView(Element):
+  """
+  A view of a single element stored in an ElementBlock. Node and ID accessors
+  read and write the block arrays. The node count of a viewed element cannot
+  be changed. A view becomes stale when any element is removed from its block,
+  after which index accessors raise an exception.
+  """
+  
+  __slots__ = ["_block", "_index", "_generation"]
+  
+  def __init__(self, block, index):
+    self._block = block
+    self._index = index
+    self._generation = block.GetGeneration()
+    
+    return
+    
+  def IsStale(self):
+    return not self._generation == self._block.GetGeneration()
+    
+  def _ValidIndex(self):
+    if self.IsStale():
+      raise Exception("Stale element view: an element has been removed from the element block")
+      
+    return self._index
+    
+  def GetBlock(self):
+    return self._block
+    
+  def GetIndex(self):
+    return self._ValidIndex()
+    
+  def HasDim(self):
+    return self._block.HasDim()
+    
+  def GetDim(self):
+    return self._block.GetDim()
+    
+  def SetDim(self, dim):
+    self._block.SetDim(dim)
+    
+    return
+    
+  def NodeCount(self):
+    return self._block.GetNodeCount()
+    
+  def GetNodes(self):
+    return self._block.GetElementNodes(self._ValidIndex())
+    
+  def GetNode(self, index):
+    return int(self._block.GetNodesArray()[self._ValidIndex(), index])
+    
+  def SetNodes(self, nodes):
+    self._block.SetElementNodes(self._ValidIndex(), nodes)
+    
+    return
+    
+  def AddNode(self, node):
+    raise Exception("Cannot change the node count of an array backed element")
+    
+  def RemoveNode(self, node):
+    raise Exception("Cannot change the node count of an array backed element")
+    
+  def RemoveNodeByIndex(self, index):
+    raise Exception("Cannot change the node count of an array backed element")
+    
+  def GetIds(self):
+    return self._block.GetElementIds(self._ValidIndex())
+    
+  def SetIds(self, ids):
+    self._block.SetElementIds(self._ValidIndex(), ids)
+    
+    return
+    
+  def GetLoc(self):
+    return self._block.GetNodeCount()
     
 class elementsUnittests(unittest.TestCase):
   def testElementType(self):
@@ -297,3 +632,96 @@ class elementsUnittests(unittest.TestCase):
     self.assertRaises(AssertionError, type.SetNodeCount, -1)
     
     return
+    
+  def testGetElementType(self):
+    type = GetElementType(3, 4)
+    self.assertEquals(type.GetElementTypeId(), ELEMENT_TETRAHEDRON)
+    self.assertTrue(GetElementType(3, 4) is type)
+    self.assertTrue(Element([0, 1, 2, 3], dim = 3).GetType() is type)
+    self.assertRaises(Exception, type.SetDim, 2)
+    self.assertRaises(Exception, type.SetNodeCount, 8)
+    self.assertRaises(Exception, type.SetElementTypeId, ELEMENT_LINE)
+    self.assertEquals(type.GetElementTypeId(), ELEMENT_TETRAHEDRON)
+    
+    return
+    
+  def testElement(self):
+    element = Element([0, 1, 2], ids = 3)
+    self.assertFalse(element.HasDim())
+    self.assertEquals(element.GetNodes(), [0, 1, 2])
+    self.assertEquals(element.GetIds(), [3])
+    element.AddNodes([3])
+    self.assertEquals(element.NodeCount(), 4)
+    self.assertRaises(AssertionError, element.AddNodes, [-1])
+    self.assertRaises(AttributeError, setattr, element, "_attribute", None)
+    
+    return
+    
+  def testElementBlock(self):
+    block = ElementBlock(3, nodes = [[0, 1, 2], [1, 3, 2]], ids = [7, 8])
+    self.assertEquals(block.Count(), 2)
+    self.assertEquals(block.FixedIdCount(), 1)
+    block.AddElement([2, 3, 4], ids = [9, 10])
+    self.assertEquals(block.Count(), 3)
+    self.assertEquals(block.FixedIdCount(), None)
+    self.assertEquals(block.GetIdsArray().tolist(), [[7, 0], [8, 0], [9, 10]])
+    self.assertEquals(block.GetNodesArray().tolist(), [[0, 1, 2], [1, 3, 2], [2, 3, 4]])
+    
+    block.RemoveElementByIndex(0)
+    self.assertEquals(block.GetNodesArray().tolist(), [[1, 3, 2], [2, 3, 4]])
+    self.assertEquals(block.GetElementIds(1), [9, 10])
+    
+    for i in range(100):
+      block.AddElement([i, i + 1, i + 2])
+    self.assertEquals(block.Count(), 102)
+    self.assertEquals(block.GetElementNodes(101), [99, 100, 101])
+    self.assertEquals(block.GetElementIds(101), [])
+    
+    return
+    
+  def testElementView(self):
+    block = ElementBlock(2, dim = 1, nodes = [[0, 1], [1, 2]])
+    element = block.GetElement(1)
+    self.assertEquals(element.GetNodes(), [1, 2])
+    self.assertEquals(element.GetNode(0), 1)
+    self.assertEquals(element.GetDim(), 1)
+    self.assertEquals(element.GetType().GetElementTypeId(), ELEMENT_LINE)
+    self.assertEquals(element.GetIds(), [])
+    
+    element.SetNodes([2, 3])
+    element.SetIds([4, 5, 6])
+    self.assertEquals(block.GetNodesArray().tolist(), [[0, 1], [2, 3]])
+    self.assertEquals(block.GetElement(1).GetIds(), [4, 5, 6])
+    self.assertEquals(block.GetElement(0).GetIds(), [])
+    self.assertRaises(Exception, element.AddNode, 4)
+    
+    # Removals invalidate existing views
+    views = block.GetElements()
+    block.RemoveElementByIndex(0)
+    self.assertTrue(views[1].IsStale())
+    self.assertRaises(Exception, views[1].GetIds)
+    self.assertRaises(Exception, views[1].GetNodes)
+    self.assertRaises(Exception, views[1].GetIndex)
+    self.assertFalse(block.GetElement(0).IsStale())
+    self.assertEquals(block.GetElement(0).GetNodes(), [2, 3])
+    
+    return
+    
+  def testElementPickle(self):
+    import pickle
+    
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+      element = pickle.loads(pickle.dumps(Element([0, 1, 2], ids = 3), protocol))
+      self.assertEquals(element.GetNodes(), [0, 1, 2])
+      self.assertEquals(element.GetIds(), [3])
+      self.assertFalse(element.HasDim())
+      self.assertEquals(pickle.loads(pickle.dumps(Element([0, 1], dim = 1), protocol)).GetDim(), 1)
+      
+      block = ElementBlock(2, dim = 1, nodes = [[0, 1], [1, 2]], ids = [4, 5])
+      element = pickle.loads(pickle.dumps(block.GetElement(1), protocol))
+      self.assertEquals(element.GetIndex(), 1)
+      self.assertEquals(element.GetNodes(), [1, 2])
+      self.assertEquals(element.GetIds(), [5])
+      self.assertEquals(element.GetDim(), 1)
+    
+    return
@@ -25,6 +25,10 @@ import unittest
 
 import fluidity.diagnostics.debug as debug
 
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
 try:
   import Scientific.IO.NetCDF as netcdf
 except:
@@ -32,7 +36,6 @@ except:
 
 import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.filehandling as filehandling
-import fluidity.diagnostics.structured_fields as structured_fields
 
 class Era15:
   """
@@ -42,14 +45,31 @@ class Era15:
   # Zero point for time data
   _epoch = datetime.datetime(1900, 1, 1, 0, 0, 0)
 
-  def __init__(self, filename, latitudeName = "latitude", longitudeName = "longitude", timeName = "time"):
-    self._file = netcdf.NetCDFFile(filename, "r")
-    self._latitudes = self.Values(latitudeName)
-    self._longitudes = self.Values(longitudeName)
-    self._times = self.Values(timeName)
+  def __init__(self, filename, latitudeName = "latitude", longitudeName = "longitude", timeName = "time", slabCacheSize = 4):
+    """
+    Open the supplied ERA15 data file. filename may alternatively be an open
+    NetCDF file object.
+    """
+    
+    assert(slabCacheSize > 0)
+  
+    if hasattr(filename, "variables"):
+      self._file = filename
+    else:
+      self._file = netcdf.NetCDFFile(filename, "r")
+    self._attributes = {}
+    self._latitudes = numpy.array(self.Values(latitudeName))
+    self._longitudes = numpy.array(self.Values(longitudeName))
+    self._times = numpy.array(self.Values(timeName))
 
     # Longitude wrap-around
-    self._longitudes.append(self._longitudes[0] + 360.0)
+    self._longitudes = numpy.append(self._longitudes, self._longitudes[0] + 360.0)
+    
+    # Least recently used cache of decoded (latitude x longitude) field slabs,
+    # keyed by field name and time index
+    self._slabCacheSize = slabCacheSize
+    self._slabs = {}
+    self._slabKeys = []
 
     debug.dprint(self)
 
@@ -141,6 +161,32 @@ class Era15:
     else:
       return calc.Nan()
 
+  def _Attributes(self, name):
+    """
+    Return the scale factor, offset, fill value and missing value for the
+    supplied field
+    """
+    
+    if not name in self._attributes:
+      self._attributes[name] = (self.ScaleFactor(name), self.AddOffset(name), self.FillValue(name), self.MissingValue(name))
+      
+    return self._attributes[name]
+    
+  def _DecodedArray(self, name, values):
+    """
+    Apply offset and scale to the supplied raw values of the supplied field.
+    Nan, fill and missing values are set to Nan.
+    """
+    
+    scaleFactor, addOffset, fillValue, missingValue = self._Attributes(name)
+    
+    values = numpy.array(values, dtype = float)
+    invalid = numpy.logical_or(values == fillValue, values == missingValue)
+    values = values * scaleFactor + addOffset
+    values[invalid] = calc.Nan()
+    
+    return values
+
   def Value(self, name, index, *indices):
     """
     Index into the supplied field, applying offset, scale and fill and missing
@@ -149,6 +195,7 @@ class Era15:
     """
   
     variable = self.Variable(name)
+    scaleFactor, addOffset, fillValue, missingValue = self._Attributes(name)
     
     value = variable[index]
     for index in indices:
@@ -157,19 +204,41 @@ class Era15:
     
     if calc.IsNan(value):
       raise Exception("Nan value")
-    elif value == self.FillValue(name):
+    elif value == fillValue:
       raise Exception("Fill value")
-    elif value == self.MissingValue(name):
+    elif value == missingValue:
       raise Exception("Missing value")
 
-    return value * self.ScaleFactor(name) + self.AddOffset(name)
+    return value * scaleFactor + addOffset
 
   def Values(self, name):
     """
     Return the supplied field as a list
     """
+    
+    values = self._DecodedArray(name, self.Variable(name)[:])
+    if numpy.isnan(values).any():
+      raise Exception("Nan, fill or missing value")
   
-    return [self.Value(name, i) for i in range(self.VariableLen(name))]
+    return values.tolist()
+    
+  def Slab(self, name, timeIndex):
+    """
+    Return the decoded (latitude x longitude) slab of the supplied field at the
+    supplied time index, with Nan, fill and missing values set to Nan. The most
+    recently used slabs are cached.
+    """
+    
+    key = (name, timeIndex)
+    if key in self._slabs:
+      self._slabKeys.remove(key)
+    else:
+      if len(self._slabKeys) >= self._slabCacheSize:
+        del self._slabs[self._slabKeys.pop(0)]
+      self._slabs[key] = self._DecodedArray(name, self.Variable(name)[timeIndex])
+    self._slabKeys.append(key)
+    
+    return self._slabs[key]
 
   def FieldNames(self):
     """
@@ -188,53 +257,60 @@ class Era15:
   def InterpolatedValue(self, name, latitude, longitude, time): 
     """
     Tri-linearly interpolate the supplied field at the supplied latitude,
-    longitude and time
+    longitude and time. The coordinates may be single values, or arrays (which
+    are broadcast together), in which case an array of values is returned.
     """
-     
-    data = self._file.variables[name]
+    
+    scalar = len(numpy.broadcast(latitude, longitude, time).shape) == 0
+    latitude, longitude, time = [numpy.array(coord, dtype = float).ravel() for coord in numpy.broadcast_arrays(latitude, longitude, time)]
 
-    if latitude > self._latitudes[0] or latitude < self._latitudes[-1]:
-      debug.deprint("latitude = " + str(latitude))
+    if (latitude > self._latitudes[0]).any() or (latitude < self._latitudes[-1]).any():
+      debug.deprint("latitude range = " + str((latitude.min(), latitude.max())))
       debug.deprint("Valid latitude range = " + str((self._latitudes[-1], self._latitudes[0])))
       raise Exception("Invalid latitude")
-    while longitude < 0.0:
-      longitude += 360.0
-    while longitude > 360.0:
-      longitude -= 360.0
+    longitude = numpy.mod(longitude, 360.0)
 
-    if time < self._times[0] or time > self._times[-1]:
-      debug.deprint("time = " + str(time))
+    if (time < self._times[0]).any() or (time > self._times[-1]).any():
+      debug.deprint("time range = " + str((time.min(), time.max())))
       debug.deprint("Valid time range = " + str((self._times[0], self._times[-1])))
       raise Exception("Invalid time")
 
-    left = structured_fields.IndexBinarySearch(longitude, self._longitudes)
-    right = left + 1
-    assert(not right == left)
-    longRatio = (longitude - self._longitudes[left]) / (self._longitudes[right] - self._longitudes[left])
+    left, right, longRatio = calc.IndexBinaryBracketSearch(longitude, self._longitudes)
     left %= len(self._longitudes) - 1
     right %= len(self._longitudes) - 1
 
-    upper = structured_fields.IndexBinaryDecSearch(latitude, self._latitudes)
-    lower = min(upper + 1, len(self._latitudes) - 1)
-    if upper == lower:
-      latRatio = 1.0
-    else:
-      latRatio = (latitude - self._latitudes[lower]) / (self._latitudes[upper] - self._latitudes[lower])
+    upper, lower, latRatio = calc.IndexBinaryBracketSearch(latitude, self._latitudes, increasing = False)
+    latRatio = 1.0 - latRatio
 
-    before = structured_fields.IndexBinarySearch(time, self._times)
-    after = min(before + 1, len(self._times) - 1)
-    if after == before:
-      timeRatio = 1.0
-    else:
-      timeRatio = (time - self._times[before]) / (self._times[after] - self._times[before])
+    before, after, timeRatio = calc.IndexBinaryBracketSearch(time, self._times)
 
-    timeVals = [None, None]
-    for i, timeIndex in enumerate([before, after]):
-      timeVals[i] = calc.BilinearlyInterpolate(self.Value(name, timeIndex, upper, left), self.Value(name, timeIndex, upper, right), \
-        self.Value(name, timeIndex, lower, left), self.Value(name, timeIndex, lower, right), \
-        longRatio, latRatio)
+    # Each point is bilinearly interpolated in its two bracketing time slabs.
+    # Sort the (point, time slab) pairs by time index once, so that each slab
+    # is read once and interpolates a contiguous group of pairs.
+    nPoints = len(time)
+    timeIndices = numpy.append(before, after)
+    points = numpy.append(numpy.arange(nPoints), numpy.arange(nPoints))
+    order = numpy.argsort(timeIndices, kind = "mergesort")
+    groupTimeIndices, groupStarts = numpy.unique(timeIndices[order], return_index = True)
+    groupEnds = numpy.append(groupStarts[1:], len(order))
+    
+    slabValues = numpy.empty(2 * nPoints)
+    for timeIndex, start, end in zip(groupTimeIndices, groupStarts, groupEnds):
+      pairs = order[start:end]
+      lPoints = points[pairs]
+      slab = self.Slab(name, int(timeIndex))
+      lUpper, lLower, lLeft, lRight = upper[lPoints], lower[lPoints], left[lPoints], right[lPoints]
+      slabValues[pairs] = calc.BilinearlyInterpolate(slab[lUpper, lLeft], slab[lUpper, lRight], \
+        slab[lLower, lLeft], slab[lLower, lRight], \
+        longRatio[lPoints], latRatio[lPoints])
+    values = calc.LinearlyInterpolate(slabValues[:nPoints], slabValues[nPoints:], timeRatio)
+    if numpy.isnan(values).any():
+      raise Exception("Nan, fill or missing value")
 
-    return calc.LinearlyInterpolate(timeVals[0], timeVals[1], timeRatio)
+    if scalar:
+      return float(values[0])
+    else:
+      return values
 
   def U10(self, latitude, longitude, time, name = "10u"): 
     """
@@ -252,11 +328,99 @@ class Era15:
    
     return self.InterpolatedValue(name, latitude, longitude, time)
 
+class _MemoryNetcdfVariable:
+  """
+  In-memory stand-in for a NetCDF variable, recording the indices of reads
+  """
+  
+  def __init__(self, values, **attributes):
+    self._values = numpy.array(values)
+    self.reads = []
+    for name, value in attributes.items():
+      setattr(self, name, numpy.array([value]))
+      
+    return
+    
+  def __len__(self):
+    return len(self._values)
+    
+  def __getitem__(self, index):
+    self.reads.append(index)
+    
+    return self._values[index]
+    
+class _MemoryNetcdfFile:
+  """
+  In-memory stand-in for a NetCDF file
+  """
+  
+  def __init__(self, variables):
+    self.variables = variables
+    
+    return
+    
+  def close(self):
+    return
+
 class eraUnittests(unittest.TestCase):
   def testNetcdfSupport(self):
     import Scientific.IO.NetCDF
     
     return
+    
+  def testInterpolatedValue(self):
+    latitudes = numpy.arange(90.0, -90.5, -2.5)
+    longitudes = numpy.arange(0.0, 360.0, 2.5)
+    times = numpy.arange(0.0, 60.0, 6.0)
+    random = numpy.random.RandomState(0)
+    u10 = random.randint(-1000, 1000, (len(times), len(latitudes), len(longitudes))).astype(numpy.int16)
+    u10[0, 0, 0] = -32767
+    variable = _MemoryNetcdfVariable(u10, scale_factor = 0.01, add_offset = 1.5, missing_value = -32767)
+    data = Era15(_MemoryNetcdfFile({"latitude":_MemoryNetcdfVariable(latitudes), "longitude":_MemoryNetcdfVariable(longitudes), \
+      "time":_MemoryNetcdfVariable(times), "10u":variable}), slabCacheSize = 2)
+      
+    def ScalarU10(latitude, longitude, time):
+      # Trilinear interpolation with scalar reads
+      longitude = longitude % 360.0
+      left, right, longRatio = calc.IndexBinaryBracketSearch(longitude, data._longitudes)
+      left %= len(longitudes)
+      right %= len(longitudes)
+      upper, lower, latRatio = calc.IndexBinaryBracketSearch(latitude, latitudes, increasing = False)
+      latRatio = 1.0 - latRatio
+      before, after, timeRatio = calc.IndexBinaryBracketSearch(time, times)
+      timeVals = [calc.BilinearlyInterpolate(data.Value("10u", timeIndex, upper, left), data.Value("10u", timeIndex, upper, right), \
+        data.Value("10u", timeIndex, lower, left), data.Value("10u", timeIndex, lower, right), \
+        longRatio, latRatio) for timeIndex in [before, after]]
+      
+      return calc.LinearlyInterpolate(timeVals[0], timeVals[1], timeRatio)
+      
+    nPoints = 1000
+    pointLatitudes = random.uniform(-90.0, 85.0, nPoints)
+    pointLongitudes = random.uniform(-360.0, 720.0, nPoints)
+    pointTimes = random.uniform(times[0], times[-1], nPoints)
+    pointTimes[:3] = [times[0], times[3], times[-1]]
+    del variable.reads[:]
+    u10s = data.U10(pointLatitudes, pointLongitudes, pointTimes)
+    # Each time slab is read once
+    self.assertEquals(sorted(variable.reads), range(len(times)))
+    self.assertEquals(u10s.shape, (nPoints,))
+    for i in range(nPoints):
+      self.assertAlmostEquals(u10s[i], ScalarU10(pointLatitudes[i], pointLongitudes[i], pointTimes[i]))
+    self.assertAlmostEquals(data.U10(pointLatitudes[0], pointLongitudes[0], pointTimes[0]), u10s[0])
+    self.assertTrue(isinstance(data.U10(pointLatitudes[0], pointLongitudes[0], pointTimes[0]), float))
+      
+    # Recently used slabs are cached
+    data.U10(pointLatitudes, pointLongitudes, times[-1])
+    del variable.reads[:]
+    data.U10(pointLatitudes, pointLongitudes, times[-1])
+    self.assertEquals(variable.reads, [])
+    data.U10(pointLatitudes, pointLongitudes, times[1])
+    self.assertEquals(sorted(variable.reads), [1, 2])
+    
+    self.assertRaises(Exception, data.U10, 90.0, 0.0, times[0])
+    self.assertRaises(Exception, data.U10, 0.0, 0.0, times[-1] + 1.0)
+    
+    return
 
 class eraDataUnittests(unittest.TestCase):
   def testEra15(self):
@@ -264,5 +428,13 @@ class eraDataUnittests(unittest.TestCase):
     data = Era15(filename)
     data.U10(0.0, 0.0, data.DatetimeToHours(datetime.datetime(1992, 1, 1, 0, 0, 0)))
     data.V10(0.0, 0.0, data.DatetimeToHours(datetime.datetime(1992, 1, 1, 0, 0, 0)))
+    
+    latitudes = [0.0, 10.0, -20.0]
+    longitudes = [0.0, 359.0, -45.0]
+    time = data.DatetimeToHours(datetime.datetime(1992, 1, 1, 0, 0, 0))
+    u10s = data.U10(latitudes, longitudes, time)
+    self.assertEquals(len(u10s), 3)
+    for i in range(3):
+      self.assertAlmostEquals(u10s[i], data.U10(latitudes[i], longitudes[i], time))
 
     return
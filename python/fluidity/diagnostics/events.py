@@ -22,27 +22,43 @@ import unittest
 
 class Evented:
   """
-  A base class defining an object which has events
+  A base class defining an object which has events. Handler lists are only
+  created when a handler is first registered, and raising an event with no
+  registered handlers is a no-op.
   """
 
   def __init__(self, eventNames):
-    self._handlers = {}
-    for name in eventNames:
-      self._handlers[name] = []
+    self._eventNames = eventNames
+    self._handlers = None
     
     return
     
+  def _GetHandlers(self):
+    if self._handlers is None:
+      self._handlers = {}
+      for name in self._eventNames:
+        self._handlers[name] = []
+        
+    return self._handlers
+    
+  def HasEventHandlers(self, name):
+    return not self._handlers is None and len(self._handlers[name]) > 0
+    
   def RegisterEventHandler(self, name, handler):
-    self._handlers[name].append(handler)
+    self._GetHandlers()[name].append(handler)
     
     return
     
   def UnregisterEventHandler(self, name, handler):
-    self._handlers[name].remove(handler)
+    self._GetHandlers()[name].remove(handler)
     
     return
     
   def _RaiseEvent(self, name, *args, **namedArgs):
+    if self._handlers is None:
+      assert(name in self._eventNames)
+      return
+      
     for handler in self._handlers[name]:
       handler(*args, **namedArgs)
     
@@ -99,6 +115,7 @@ class eventsUnittests(unittest.TestCase):
         return
           
     test = TestEvented()
+    self.assertTrue(test.HasEventHandlers("event1"))
     self.assertFalse(test.Event1Handled())
     self.assertFalse(test.Event2Handled())
     self.assertEquals(test.GetEvent2Arg(), None)
@@ -124,6 +141,7 @@ class eventsUnittests(unittest.TestCase):
     self.assertEquals(test.GetEvent2Arg(), None)
     
     test.UnregisterEventHandler("event1", test.OnEvent1)
+    self.assertFalse(test.HasEventHandlers("event1"))
     test.RaiseEvent1()
     self.assertFalse(test.Event1Handled())
     self.assertFalse(test.Event2Handled())
@@ -135,3 +153,11 @@ class eventsUnittests(unittest.TestCase):
     self.assertEquals(test.GetEvent2Arg(), 0)
 
     return
+    
+  def testUnhandledEvent(self):
+    evented = Evented(["event"])
+    self.assertFalse(evented.HasEventHandlers("event"))
+    evented._RaiseEvent("event")
+    self.assertRaises(AssertionError, evented._RaiseEvent, "unknownEvent")
+    
+    return
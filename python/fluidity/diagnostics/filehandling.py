@@ -20,6 +20,7 @@ File handling routines
 
 import glob
 import os
+import re
 import shutil
 import subprocess
 import stat
@@ -29,6 +30,11 @@ import unittest
 import fluidity.diagnostics.debug as debug
 import fluidity.diagnostics.utils as utils
 
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
 def FileExtension(filename):
   """
   Return the file extension of the supplied filename (including the ".")
@@ -147,7 +153,7 @@ def Rmdir(path, force = False):
   if force:
     for file in glob.glob(os.path.join(path, "*")):
       if Isdir(file):
-        Rmdir(file)
+        Rmdir(file, force = True)
       else:
         Rm(file)
   os.rmdir(path)
@@ -173,6 +179,35 @@ def FindAndReplace(filename, find, replace):
   
   return
   
+def ReadTokens(filename, dtype = float, commentChar = "#"):
+  """
+  Read all whitespace delimited tokens in the supplied file into a 1D array of
+  the supplied type, in a single pass. Text following commentChar on any line
+  is ignored.
+  """
+  
+  fileHandle = open(filename, "r")
+  text = fileHandle.read()
+  fileHandle.close()
+  
+  if not commentChar is None and commentChar in text:
+    text = re.sub(re.escape(commentChar) + "[^\n]*", "", text)
+  
+  return numpy.fromstring(text, dtype = dtype, sep = " ")
+  
+def WriteRows(fileHandle, rows, format, chunkSize = 65536):
+  """
+  Write the rows of the supplied 2D array to the supplied file handle,
+  formatting each row with the supplied format string. Rows are formatted
+  chunkSize at a time, with a single string format operation per chunk.
+  """
+  
+  for start in range(0, rows.shape[0], chunkSize):
+    chunk = rows[start:start + chunkSize]
+    fileHandle.write((format * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+    
+  return
+  
 class filehandlingUnittests(unittest.TestCase):
   def testFileExtension(self):
     self.assertEquals(FileExtension("a.b"), ".b")
@@ -217,6 +252,18 @@ class filehandlingUnittests(unittest.TestCase):
     
     return
     
+  def testReadWriteRows(self):
+    tempDir = tempfile.mkdtemp()
+    tempFile = os.path.join(tempDir, "test")
+    fileHandle = open(tempFile, "w")
+    fileHandle.write("# Header comment\n")
+    WriteRows(fileHandle, numpy.array([[1, 0.5], [2, 0.1]]), "%d %r # Row comment\n", chunkSize = 1)
+    fileHandle.close()
+    self.assertEquals(ReadTokens(tempFile).tolist(), [1.0, 0.5, 2.0, 0.1])
+    Rmdir(tempDir, force = True)
+    
+    return
+    
   def testFileExists(self): 
     self.assertTrue(FileExists(__file__))
     
@@ -27,6 +27,7 @@ import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.debug as debug
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.filehandling as filehandling
+import fluidity.diagnostics.mesh_cache as mesh_cache
 import fluidity.diagnostics.meshes as meshes
 import fluidity.diagnostics.utils as utils
 
@@ -60,7 +61,15 @@ def ToGidNodeOrder(nodes, type):
 
 def ReadGid(filename):
   """
-  Read a GiD file with the given filename, and return it as a mesh
+  Read a GiD file with the given filename, and return it as a mesh. If the mesh
+  cache is enabled, the mesh is loaded from the cache if a valid entry exists.
+  """
+  
+  return mesh_cache.CachedRead("gid", lambda: _ReadGid(filename), [filename])
+
+def _ReadGid(filename):
+  """
+  Parse a GiD file with the given filename
   """
   
   debug.dprint("Reading GiD mesh with filename " + filename)
@@ -143,7 +152,7 @@ def ReadGid(filename):
         assert(len(lineSplit) == 1 + nnode)
         assert(int(lineSplit[0]) == index)
         # Note: GiD file indexes nodes from 1, Mesh s index nodes from 0
-        mesh.AddVolumeElement(elements.Element(nodes = FromGidNodeOrder([int(node) - 1 for node in lineSplit[1:]],  elements.ElementType(dim = dimension, nodeCount = nnode))))
+        mesh.AddVolumeElement(elements.Element(nodes = FromGidNodeOrder([int(node) - 1 for node in lineSplit[1:]],  elements.GetElementType(dimension, nnode))))
         line = fileHandle.readline()
       break
     line = fileHandle.readline()    
@@ -177,7 +186,7 @@ def WriteGid(mesh, filename):
   fileHandle.write("Elements\n")
   for i, element in enumerate(mesh.GetVolumeElements()):
     # Note: GiD file indexes nodes from 1, Mesh s index nodes from 0
-    fileHandle.write("  " + utils.FormLine([i + 1, ToGidNodeOrder(utils.OffsetList(element.GetNodes(), 1), elements.ElementType(dim = mesh.GetDim(), nodeCount = element.NodeCount()))]))
+    fileHandle.write("  " + utils.FormLine([i + 1, ToGidNodeOrder(utils.OffsetList(element.GetNodes(), 1), elements.GetElementType(mesh.GetDim(), element.NodeCount()))]))
   fileHandle.write("end elements\n")
   
   fileHandle.close()
@@ -18,10 +18,10 @@
 Tools for dealing with gmsh mesh files
 """
 
-import array
 import copy
 import ctypes
 import os
+import sys
 import tempfile
 import unittest
 
@@ -31,8 +31,16 @@ import fluidity.diagnostics.debug as debug
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.filehandling as filehandling
 import fluidity.diagnostics.meshes as meshes
+import fluidity.diagnostics.mesh_cache as mesh_cache
 import fluidity.diagnostics.mesh_halos as mesh_halos
+import fluidity.diagnostics.triangletools as triangletools
 import fluidity.diagnostics.utils as utils
+import fluidity.diagnostics.vtutools as vtktools
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
 
 GMSH_UNKNOWN = None
 GMSH_LINE = 1
@@ -120,231 +128,874 @@ class GmshElementType(elements.ElementType):
     return
     
 
-def ReadMsh(filename):
+def _MshNodeCoords(nodeIds, nodeCoords):
+  """
+  Return the supplied node coordinates, sorted into node ID order and with
+  unused dimensions removed. Assumes dense node IDs, but not necessarily
+  ordered.
+  """
+  
+  nNodes = len(nodeIds)
+  nodeIds = numpy.asarray(nodeIds, dtype = numpy.int64)
+  assert((nodeIds > 0).all())
+  assert((numpy.bincount(nodeIds - 1, minlength = nNodes) <= 1).all())
+
+  coords = numpy.empty((nNodes, 3))
+  coords[nodeIds - 1] = nodeCoords
+  
+  if nNodes == 0:
+    bound = bounds.BoundingBox([calc.Inf() for i in range(3)], [-calc.Inf() for i in range(3)])
+  else:
+    bound = bounds.BoundingBox(coords.min(axis = 0).tolist(), coords.max(axis = 0).tolist())
+  
+  return coords[:, bound.UsedDimIndices()]
+
+def _MshMesh(nodeCoords, elementBlocks):
   """
-  Read a Gmsh msh file
+  Construct a mesh from the supplied node coordinates and (Gmsh type ID,
+  element nodes, element IDs) element blocks. Element nodes are Gmsh node
+  numbers. An array backed mesh is constructed unless the volume or surface
+  elements are of mixed type.
   """
+  
+  dim = nodeCoords.shape[1]
+  
+  surfaceBlocks = []
+  volumeBlocks = []
+  for typeId, nodes, ids in elementBlocks:
+    type = GmshElementType(gmshElementTypeId = typeId)
+    nodes = nodes[:, FromGmshNodeOrder(range(type.GetNodeCount()), type)] - 1
+    if type.GetDim() == dim - 1:
+      surfaceBlocks.append((nodes, ids))
+    elif type.GetDim() == dim:
+      volumeBlocks.append((nodes, ids))
+    else:
+      debug.deprint("Warning: Element of type " + str(type) + " encountered in " + str(dim) + " dimensions")
       
-  def ReadNonCommentLine(fileHandle):
+  arrayBacked = True
+  for blocks in [surfaceBlocks, volumeBlocks]:
+    if len(set([nodes.shape[1] for nodes, ids in blocks])) > 1:
+      arrayBacked = False
+  
+  mesh = meshes.Mesh(dim, arrayBacked = arrayBacked)
+  mesh.AddNodeCoordsArray(nodeCoords)
+  for nodes, ids in surfaceBlocks:
+    mesh.AddSurfaceElementsArray(nodes, ids = ids)
+  for nodes, ids in volumeBlocks:
+    mesh.AddVolumeElementsArray(nodes, ids = ids)
+    
+  return mesh
+  
+def _MshRecordRunLength(tokens, start, recordLength, blockSize = 1024):
+  """
+  Return the number of consecutive ASCII element records, starting at the
+  supplied token index, with the same element type and number of IDs as the
+  first record. Records are compared in blocks of increasing size, so that
+  long runs are found with few array operations.
+  """
+  
+  typeId, nIds = tokens[start + 1], tokens[start + 2]
+  maxCount = (len(tokens) - start) // recordLength
+  count = 1
+  while count < maxCount:
+    end = min(count + blockSize, maxCount)
+    headers = tokens[start + count * recordLength:start + end * recordLength].reshape((end - count, recordLength))[:, 1:3]
+    mismatches = numpy.nonzero((headers[:, 0] != typeId) | (headers[:, 1] != nIds))[0]
+    if len(mismatches) > 0:
+      return count + mismatches[0]
+    count = end
+    blockSize *= 2
+    
+  return count
+  
+def _ReadNonCommentLine(fileHandle):
+  line = fileHandle.readline()
+  while len(line) > 0:
+    line = line.strip()
+    if len(line) > 0:
+      return line
     line = fileHandle.readline()
+    
+  return line
+  
+def _ReadMshOneByte(fileHandle):
+  """
+  Read the binary one at the end of the MeshFormat section, and return the
+  byte order of the file
+  """
+  
+  one = numpy.fromfile(fileHandle, dtype = numpy.int32, count = 1)
+  if one[0] == 1:
+    return "<" if sys.byteorder == "little" else ">"
+  elif one.byteswap()[0] == 1:
+    return ">" if sys.byteorder == "little" else "<"
+  else:
+    raise Exception("Invalid one byte")
+  
+class Msh4Reader:
+  """
+  Block-at-a-time reader for Gmsh MSH 4.1 binary files. On construction the
+  file header and entities are read, and the node and element entity blocks
+  are indexed (without reading their data). Node and element data can then
+  be streamed in chunks of at most chunkSize nodes or elements.
+  """
+  
+  def __init__(self, filename):
+    self._fileHandle = open(filename, "rb")
+    
+    line = _ReadNonCommentLine(self._fileHandle)
+    assert(line == "$MeshFormat")
+    lineSplit = _ReadNonCommentLine(self._fileHandle).split()
+    assert(len(lineSplit) == 3)
+    version = float(lineSplit[0])
+    fileType = int(lineSplit[1])
+    dataSize = int(lineSplit[2])
+    if not version >= 4.1 or version >= 5.0:
+      raise Exception("Unsupported version " + str(version))
+    if not fileType == 1:
+      raise Exception("Only binary MSH 4.x files are supported")
+    if not dataSize == 8:
+      raise Exception("Unrecognised size_t size " + str(dataSize))
+    byteOrder = _ReadMshOneByte(self._fileHandle)
+    self._intType = numpy.dtype(byteOrder + "i4")
+    self._sizeType = numpy.dtype(byteOrder + "u8")
+    self._realType = numpy.dtype(byteOrder + "f8")
+    line = _ReadNonCommentLine(self._fileHandle)
+    assert(line == "$EndMeshFormat")
+    
+    self._physicalTags = {}
+    self._entityBound = None
+    self._nodeBlocks = []
+    self._elementBlocks = []
+    self._nodeCount = 0
+    self._maxNodeTag = 0
+    self._elementCount = 0
+    line = _ReadNonCommentLine(self._fileHandle)
     while len(line) > 0:
-      line = line.strip()
-      if len(line) > 0:
-        return line
-      line = fileHandle.readline()
+      assert(line.startswith("$"))
+      section = line[1:]
+      if section == "Entities":
+        self._ReadEntities()
+        line = _ReadNonCommentLine(self._fileHandle)
+      elif section == "Nodes":
+        self._IndexNodes()
+        line = _ReadNonCommentLine(self._fileHandle)
+      elif section == "Elements":
+        self._IndexElements()
+        line = _ReadNonCommentLine(self._fileHandle)
+      else:
+        # Skip all other sections
+        line = _ReadNonCommentLine(self._fileHandle)
+        while len(line) > 0 and not line == "$End" + section:
+          line = _ReadNonCommentLine(self._fileHandle)
+      assert(line == "$End" + section)
+      line = _ReadNonCommentLine(self._fileHandle)
+    
+    return
+    
+  def _Read(self, dtype, count):
+    data = numpy.fromfile(self._fileHandle, dtype = dtype, count = count)
+    assert(len(data) == count)
+    
+    return data
+    
+  def _ReadEntities(self):
+    counts = self._Read(self._sizeType, 4)
+    for dim in range(4):
+      for i in range(counts[dim]):
+        tag = int(self._Read(self._intType, 1)[0])
+        # Points store a coordinate, other entities a bounding box
+        bound = self._Read(self._realType, 3 if dim == 0 else 6)
+        lbound, ubound = bound[:3], bound[-3:]
+        if self._entityBound is None:
+          self._entityBound = (lbound, ubound)
+        else:
+          self._entityBound = (numpy.minimum(self._entityBound[0], lbound), numpy.maximum(self._entityBound[1], ubound))
+        nPhysicalTags = int(self._Read(self._sizeType, 1)[0])
+        self._physicalTags[(dim, tag)] = self._Read(self._intType, nPhysicalTags).tolist()
+        if dim > 0:
+          nBoundingEntities = int(self._Read(self._sizeType, 1)[0])
+          self._Read(self._intType, nBoundingEntities)
+    
+    return
+    
+  def _IndexNodes(self):
+    nBlocks, self._nodeCount, minTag, self._maxNodeTag = self._Read(self._sizeType, 4)
+    for i in range(nBlocks):
+      entityDim, entityTag, parametric = self._Read(self._intType, 3)
+      nNodes = int(self._Read(self._sizeType, 1)[0])
+      nComps = 3 + (entityDim if parametric else 0)
+      position = self._fileHandle.tell()
+      self._nodeBlocks.append((int(entityDim), int(entityTag), nNodes, nComps, position))
+      self._fileHandle.seek(position + nNodes * (self._sizeType.itemsize + nComps * self._realType.itemsize))
+    
+    return
+    
+  def _IndexElements(self):
+    nBlocks, self._elementCount, minTag, maxTag = self._Read(self._sizeType, 4)
+    for i in range(nBlocks):
+      entityDim, entityTag, typeId = self._Read(self._intType, 3)
+      nElements = int(self._Read(self._sizeType, 1)[0])
+      nodeCount = GmshElementType(gmshElementTypeId = int(typeId)).GetNodeCount()
+      position = self._fileHandle.tell()
+      self._elementBlocks.append((int(entityDim), int(entityTag), int(typeId), nElements, nodeCount, position))
+      self._fileHandle.seek(position + nElements * (1 + nodeCount) * self._sizeType.itemsize)
+      
+    return
+    
+  def NodeCount(self):
+    return int(self._nodeCount)
+    
+  def MaxNodeTag(self):
+    return int(self._maxNodeTag)
+    
+  def ElementBlockInfo(self, dim = None):
+    """
+    Return a list of (entity dim, entity tag, Gmsh type ID, element count)
+    for each element block, or for each element block of the supplied
+    dimension if dim is not None
+    """
+    
+    return [(entityDim, entityTag, typeId, int(nElements)) for entityDim, entityTag, typeId, nElements, nodeCount, position in self._elementBlocks \
+      if dim is None or GmshElementType(gmshElementTypeId = typeId).GetDim() == dim]
+    
+  def ElementCount(self, dim = None):
+    """
+    Return the number of elements, or the number of elements of the supplied
+    dimension if dim is not None
+    """
+    
+    if dim is None:
+      return int(self._elementCount)
+    else:
+      return sum([block[3] for block in self.ElementBlockInfo(dim = dim)])
+    
+  def ElementDim(self):
+    """
+    Return the maximum element dimension
+    """
+    
+    return max([GmshElementType(gmshElementTypeId = block[2]).GetDim() for block in self._elementBlocks] + [0])
+    
+  def GetBoundingBox(self):
+    """
+    Return the bounding box of all entities, or None if the file contains no
+    entities
+    """
+    
+    if self._entityBound is None:
+      return None
+    else:
+      return bounds.BoundingBox(self._entityBound[0].tolist(), self._entityBound[1].tolist())
+    
+  def GetPhysicalTags(self, entityDim, entityTag):
+    """
+    Return the physical tags of the supplied entity
+    """
+    
+    if (entityDim, entityTag) in self._physicalTags:
+      return self._physicalTags[(entityDim, entityTag)]
+    else:
+      return []
+    
+  def NodeBlocks(self, chunkSize = 1048576):
+    """
+    Generator yielding (entity dim, entity tag, node tags, node coordinates)
+    chunks, with node coordinates in an (nodes x 3) array
+    """
+    
+    for entityDim, entityTag, nNodes, nComps, position in self._nodeBlocks:
+      coordPosition = position + nNodes * self._sizeType.itemsize
+      for start in range(0, nNodes, chunkSize):
+        count = min(chunkSize, nNodes - start)
+        self._fileHandle.seek(position + start * self._sizeType.itemsize)
+        tags = self._Read(self._sizeType, count).astype(numpy.int64)
+        self._fileHandle.seek(coordPosition + start * nComps * self._realType.itemsize)
+        coords = self._Read(self._realType, count * nComps).reshape((count, nComps))[:, :3]
+        yield entityDim, entityTag, tags, coords
+        
+    return
+    
+  def ElementBlocks(self, chunkSize = 1048576, dim = None):
+    """
+    Generator yielding (entity dim, entity tag, Gmsh type ID, element tags,
+    element nodes) chunks. Element nodes are Gmsh node tags, in Gmsh node
+    order. If dim is not None, only elements of the supplied dimension are
+    read.
+    """
+    
+    for entityDim, entityTag, typeId, nElements, nodeCount, position in self._elementBlocks:
+      if not dim is None and not GmshElementType(gmshElementTypeId = typeId).GetDim() == dim:
+        continue
+      for start in range(0, nElements, chunkSize):
+        count = min(chunkSize, nElements - start)
+        self._fileHandle.seek(position + start * (1 + nodeCount) * self._sizeType.itemsize)
+        data = self._Read(self._sizeType, count * (1 + nodeCount)).reshape((count, 1 + nodeCount)).astype(numpy.int64)
+        yield entityDim, entityTag, typeId, data[:, 0], data[:, 1:]
+        
+    return
+    
+  def Close(self):
+    self._fileHandle.close()
+    
+    return
+    
+class Msh4Writer:
+  """
+  Block-at-a-time writer for Gmsh MSH 4.1 binary files. Entities, given as
+  (dim, tag, physical tags, lower bound, upper bound) tuples, are written on
+  construction. Node blocks, and then element blocks, can then be written one
+  at a time. Section headers are completed on Close.
+  """
+  
+  def __init__(self, filename, entities):
+    self._fileHandle = open(filename, "wb")
+    
+    self._fileHandle.write("$MeshFormat\n")
+    self._fileHandle.write(utils.FormLine([4.1, 1, numpy.dtype(numpy.uint64).itemsize]))
+    numpy.array([1], dtype = numpy.int32).tofile(self._fileHandle)
+    self._fileHandle.write("\n$EndMeshFormat\n")
+    
+    self._fileHandle.write("$Entities\n")
+    dimEntities = [[entity for entity in entities if entity[0] == dim] for dim in range(4)]
+    numpy.array([len(entities) for entities in dimEntities], dtype = numpy.uint64).tofile(self._fileHandle)
+    for dim, entities in enumerate(dimEntities):
+      for entityDim, tag, physicalTags, lbound, ubound in entities:
+        numpy.array([tag], dtype = numpy.int32).tofile(self._fileHandle)
+        numpy.array(list(lbound) if dim == 0 else list(lbound) + list(ubound), dtype = numpy.float64).tofile(self._fileHandle)
+        numpy.array([len(physicalTags)], dtype = numpy.uint64).tofile(self._fileHandle)
+        numpy.array(physicalTags, dtype = numpy.int32).tofile(self._fileHandle)
+        if dim > 0:
+          # No bounding entities
+          numpy.array([0], dtype = numpy.uint64).tofile(self._fileHandle)
+    self._fileHandle.write("\n$EndEntities\n")
+    
+    self._section = None
+    
+    return
+    
+  def _BeginSection(self, section):
+    self._EndSection()
+    
+    self._fileHandle.write("$" + section + "\n")
+    self._section = section
+    self._headerPosition = self._fileHandle.tell()
+    # numEntityBlocks, count, minTag, maxTag, completed by _EndSection
+    self._header = [0, 0, 0, 0]
+    numpy.array(self._header, dtype = numpy.uint64).tofile(self._fileHandle)
+    
+    return
+    
+  def _EndSection(self):
+    if self._section is None:
+      return
+    
+    position = self._fileHandle.tell()
+    self._fileHandle.seek(self._headerPosition)
+    numpy.array(self._header, dtype = numpy.uint64).tofile(self._fileHandle)
+    self._fileHandle.seek(position)
+    self._fileHandle.write("\n$End" + self._section + "\n")
+    self._section = None
+    
+    return
+    
+  def _UpdateHeader(self, tags):
+    if len(tags) == 0:
+      return
+    
+    if self._header[1] == 0:
+      self._header[2] = int(tags.min())
+    else:
+      self._header[2] = min(self._header[2], int(tags.min()))
+    self._header[3] = max(self._header[3], int(tags.max()))
+    self._header[0] += 1
+    self._header[1] += len(tags)
+    
+    return
+    
+  def WriteNodeBlock(self, entityDim, entityTag, tags, coords):
+    """
+    Write a block of nodes, with coordinates given as a (nodes x 3) array
+    """
+    
+    if self._section == "Elements":
+      raise Exception("Nodes must be written before elements")
+    elif self._section is None:
+      self._BeginSection("Nodes")
+      
+    tags = numpy.asarray(tags, dtype = numpy.uint64)
+    numpy.array([entityDim, entityTag, 0], dtype = numpy.int32).tofile(self._fileHandle)
+    numpy.array([len(tags)], dtype = numpy.uint64).tofile(self._fileHandle)
+    tags.tofile(self._fileHandle)
+    numpy.asarray(coords, dtype = numpy.float64).reshape((len(tags), 3)).tofile(self._fileHandle)
+    self._UpdateHeader(tags)
+    
+    return
+    
+  def WriteElementBlock(self, entityDim, entityTag, gmshTypeId, tags, nodes):
+    """
+    Write a block of elements, with nodes given as an (elements x nodes per
+    element) array of Gmsh node tags in Gmsh node order
+    """
+    
+    if not self._section == "Elements":
+      self._BeginSection("Elements")
+      
+    tags = numpy.asarray(tags, dtype = numpy.uint64)
+    numpy.array([entityDim, entityTag, gmshTypeId], dtype = numpy.int32).tofile(self._fileHandle)
+    numpy.array([len(tags)], dtype = numpy.uint64).tofile(self._fileHandle)
+    data = numpy.empty((len(tags), 1 + numpy.shape(nodes)[1]), dtype = numpy.uint64)
+    data[:, 0] = tags
+    data[:, 1:] = nodes
+    data.tofile(self._fileHandle)
+    self._UpdateHeader(tags)
+    
+    return
+    
+  def Close(self):
+    self._EndSection()
+    self._fileHandle.close()
+    
+    return
+    
+def _ReadMsh4(filename):
+  """
+  Read the node coordinates and element blocks of a Gmsh MSH 4.1 binary file.
+  Element IDs are the entity physical tag (or zero if the entity has no
+  physical tags) and the entity tag.
+  """
+  
+  reader = Msh4Reader(filename)
+  
+  nodeTags = []
+  nodeCoords = []
+  for entityDim, entityTag, tags, coords in reader.NodeBlocks():
+    nodeTags.append(tags)
+    nodeCoords.append(coords)
+  if len(nodeTags) == 0:
+    nodeTags, nodeCoords = numpy.zeros(0, dtype = numpy.int64), numpy.zeros((0, 3))
+  else:
+    nodeTags, nodeCoords = numpy.concatenate(nodeTags), numpy.concatenate(nodeCoords)
+  # Map (possibly sparse) node tags onto Gmsh node numbers
+  order = numpy.argsort(nodeTags)
+  nodeNumbers = numpy.zeros(nodeTags.max() + 1 if len(nodeTags) > 0 else 1, dtype = numpy.int64)
+  nodeNumbers[nodeTags[order]] = numpy.arange(1, len(nodeTags) + 1)
+  nodeCoords = _MshNodeCoords(numpy.arange(1, len(nodeTags) + 1), nodeCoords[order])
+  
+  elementBlocks = []
+  for entityDim, entityTag, typeId, tags, nodes in reader.ElementBlocks():
+    physicalTags = reader.GetPhysicalTags(entityDim, entityTag)
+    ids = numpy.empty((len(tags), 2), dtype = numpy.int64)
+    ids[:, 0] = physicalTags[0] if len(physicalTags) > 0 else 0
+    ids[:, 1] = entityTag
+    elementBlocks.append((typeId, nodeNumbers[nodes], ids))
+    
+  reader.Close()
+  
+  return nodeCoords, elementBlocks
+  
+def _Msh4NodeNumbering(reader):
+  """
+  Return an array mapping the Gmsh node tags of the supplied Msh4Reader to
+  zero-based node numbers, filled as node blocks are streamed by
+  _Msh4NodeBlocks. Only this map is held in memory while streaming.
+  """
+  
+  nodeNumbers = numpy.empty(reader.MaxNodeTag() + 1, dtype = numpy.int64)
+  nodeNumbers.fill(-1)
+  
+  return nodeNumbers
+  
+def _Msh4NodeBlocks(reader, nodeNumbers, chunkSize = 1048576):
+  """
+  Generator yielding chunks of node coordinates from the supplied Msh4Reader,
+  numbering nodes in file order in the supplied node numbering
+  """
+  
+  index = 0
+  for entityDim, entityTag, tags, coords in reader.NodeBlocks(chunkSize = chunkSize):
+    nodeNumbers[tags] = numpy.arange(index, index + len(tags))
+    index += len(tags)
+    yield coords
+    
+  return
+  
+def _Msh4ElementBlocks(reader, nodeNumbers, dim, chunkSize = 1048576):
+  """
+  Generator yielding (element type, nodes, ID) chunks for the elements of the
+  supplied dimension in the supplied Msh4Reader. Nodes are zero-based node
+  numbers in the supplied node numbering, in Fluidity node order. The ID is the
+  entity physical tag (or zero if the entity has no physical tags).
+  """
+  
+  for entityDim, entityTag, typeId, tags, nodes in reader.ElementBlocks(chunkSize = chunkSize, dim = dim):
+    type = GmshElementType(gmshElementTypeId = typeId)
+    nodes = nodeNumbers[nodes[:, FromGmshNodeOrder(range(type.GetNodeCount()), type)]]
+    if (nodes < 0).any():
+      raise Exception("Element references an unknown node")
+    physicalTags = reader.GetPhysicalTags(entityDim, entityTag)
+    yield type, nodes, physicalTags[0] if len(physicalTags) > 0 else 0
+    
+  return
+  
+def Msh4ToTriangle(filename, baseName, coordDim = None, sphericalShell = False, chunkSize = 1048576):
+  """
+  Convert a Gmsh MSH 4.1 binary file to triangle files with the given base
+  name, streaming at most chunkSize nodes or elements at a time so that meshes
+  larger than memory can be converted. Nodes are numbered in file order.
+  Elements of the highest dimension are written to the .ele file and elements
+  of one lower dimension to the .bound, .edge or .face file, each with their
+  entity physical tag as a single ID. Node coordinates are restricted to the
+  dimensions used by the mesh if coordDim is None, and to the first coordDim
+  dimensions otherwise. If sphericalShell is True, the .node file header
+  records one dimension fewer than the number of coordinates.
+  """
+  
+  def FileFooter():
+    return "# Created by gmshtools.Msh4ToTriangle\n" + \
+           "# Command: " + " ".join(sys.argv) + "\n"
+  
+  debug.dprint("Converting " + filename + " to triangle mesh with base name " + baseName)
+  
+  reader = Msh4Reader(filename)
+  dim = reader.ElementDim()
+  if not dim in [1, 2, 3]:
+    reader.Close()
+    raise Exception("Invalid mesh dimension: " + str(dim))
+  nodeCounts = set([GmshElementType(gmshElementTypeId = block[2]).GetNodeCount() for block in reader.ElementBlockInfo(dim = dim)])
+  if len(nodeCounts) > 1:
+    reader.Close()
+    raise Exception("Mixed element types not supported")
+  nodeCount = nodeCounts.pop() if len(nodeCounts) > 0 else 0
+    
+  if coordDim is None:
+    bound = reader.GetBoundingBox()
+    dimIndices = range(dim) if bound is None else bound.UsedDimIndices()
+  else:
+    dimIndices = range(coordDim)
+  nodeFileDim = len(dimIndices)
+  if sphericalShell:
+    nodeFileDim -= 1
+  
+  # Write the .node file
+  debug.dprint("Writing .node file")
+  
+  nodeNumbers = _Msh4NodeNumbering(reader)
+  fileHandle = open(baseName + ".node", "w")
+  fileHandle.write(utils.FormLine([reader.NodeCount(), nodeFileDim, 0, 0]))
+  index = 1
+  for coords in _Msh4NodeBlocks(reader, nodeNumbers, chunkSize = chunkSize):
+    nodeData = numpy.empty((coords.shape[0], 1 + len(dimIndices)))
+    nodeData[:, 0] = numpy.arange(index, index + coords.shape[0])
+    nodeData[:, 1:] = coords[:, dimIndices]
+    filehandling.WriteRows(fileHandle, nodeData, "%d" + " %r" * len(dimIndices) + "\n")
+    index += coords.shape[0]
+  fileHandle.write(FileFooter())
+  fileHandle.close()
+  
+  # Write the .bound, .edge or .face file, and the .ele file
+  for elementDim, extension in [(dim - 1, {1:".bound", 2:".edge", 3:".face"}[dim]), (dim, ".ele")]:
+    debug.dprint("Writing " + extension + " file")
+    
+    fileHandle = open(baseName + extension, "w")
+    if elementDim == dim:
+      fileHandle.write(utils.FormLine([reader.ElementCount(dim = dim), nodeCount, 1]))
+    else:
+      fileHandle.write(utils.FormLine([reader.ElementCount(dim = elementDim), 1]))
+    index = 1
+    for type, nodes, id in _Msh4ElementBlocks(reader, nodeNumbers, elementDim, chunkSize = chunkSize):
+      elementData = triangletools._TriangleElementData(nodes, numpy.array([[id]] * nodes.shape[0], dtype = numpy.int64))
+      elementData[:, 0] += index - 1
+      filehandling.WriteRows(fileHandle, elementData, " ".join(["%d" for i in range(elementData.shape[1])]) + "\n")
+      index += nodes.shape[0]
+    fileHandle.write(FileFooter())
+    fileHandle.close()
+    
+  reader.Close()
+  
+  debug.dprint("Finished converting to triangle mesh")
+  
+  return
+  
+def Msh4ToVtu(filename, vtuFilename, chunkSize = 1048576):
+  """
+  Convert a Gmsh MSH 4.1 binary file to an ASCII vtu, streaming at most
+  chunkSize nodes or elements at a time so that meshes larger than memory can
+  be converted. Surface elements are written before volume elements, with their
+  entity physical tag as an "IDs" cell field, as in meshes.Mesh.ToVtu.
+  """
+  
+  def WriteDataArray(fileHandle, type, name, components, blocks, format):
+    fileHandle.write('        <DataArray type="' + type + '"' + ("" if name is None else ' Name="' + name + '"') + ' NumberOfComponents="' + str(components) + '" format="ascii">\n')
+    for block in blocks:
+      filehandling.WriteRows(fileHandle, block, format)
+    fileHandle.write('        </DataArray>\n')
+    
+    return
+  
+  debug.dprint("Converting " + filename + " to vtu " + vtuFilename)
+  
+  reader = Msh4Reader(filename)
+  dim = reader.ElementDim()
+  elementDims = [elementDim for elementDim in [dim - 1, dim] if elementDim >= 0]
+  # Cell types, offsets and IDs are known from the element block headers
+  blockInfo = []
+  for elementDim in elementDims:
+    blockInfo += reader.ElementBlockInfo(dim = elementDim)
+  cellCount = sum([block[3] for block in blockInfo])
+  
+  def CellBlocks(column):
+    offset = 0
+    for entityDim, entityTag, typeId, nElements in blockInfo:
+      for start in range(0, nElements, chunkSize):
+        count = min(chunkSize, nElements - start)
+        gmshType = GmshElementType(gmshElementTypeId = typeId)
+        if column == "offsets":
+          yield numpy.arange(offset + gmshType.GetNodeCount(), offset + (count + 1) * gmshType.GetNodeCount(), gmshType.GetNodeCount())[:, numpy.newaxis]
+        elif column == "types":
+          yield numpy.array([[vtktools.VtkType(dim = gmshType.GetDim(), nodeCount = gmshType.GetNodeCount()).GetVtkTypeId()]] * count)
+        else:
+          physicalTags = reader.GetPhysicalTags(entityDim, entityTag)
+          yield numpy.array([[physicalTags[0] if len(physicalTags) > 0 else 0]] * count)
+        offset += count * gmshType.GetNodeCount()
+        
+    return
+    
+  def ConnectivityBlocks():
+    for elementDim in elementDims:
+      for type, nodes, id in _Msh4ElementBlocks(reader, nodeNumbers, elementDim, chunkSize = chunkSize):
+        vtkType = vtktools.VtkType(dim = type.GetDim(), nodeCount = type.GetNodeCount())
+        yield nodes[:, vtktools.ToVtkNodeOrder(range(type.GetNodeCount()), vtkType)].reshape((-1, 1))
+      
+    return
+  
+  nodeNumbers = _Msh4NodeNumbering(reader)
+  fileHandle = open(vtuFilename, "w")
+  fileHandle.write('<?xml version="1.0"?>\n')
+  fileHandle.write('<VTKFile type="UnstructuredGrid" version="0.1" byte_order="LittleEndian">\n')
+  fileHandle.write('  <UnstructuredGrid>\n')
+  fileHandle.write('    <Piece NumberOfPoints="' + str(reader.NodeCount()) + '" NumberOfCells="' + str(cellCount) + '">\n')
+  fileHandle.write('      <Points>\n')
+  WriteDataArray(fileHandle, "Float64", None, 3, _Msh4NodeBlocks(reader, nodeNumbers, chunkSize = chunkSize), "%r %r %r\n")
+  fileHandle.write('      </Points>\n')
+  fileHandle.write('      <Cells>\n')
+  WriteDataArray(fileHandle, "Int64", "connectivity", 1, ConnectivityBlocks(), "%d\n")
+  WriteDataArray(fileHandle, "Int64", "offsets", 1, CellBlocks("offsets"), "%d\n")
+  WriteDataArray(fileHandle, "UInt8", "types", 1, CellBlocks("types"), "%d\n")
+  fileHandle.write('      </Cells>\n')
+  fileHandle.write('      <CellData Scalars="IDs">\n')
+  WriteDataArray(fileHandle, "Float64", "IDs", 1, CellBlocks("ids"), "%d\n")
+  fileHandle.write('      </CellData>\n')
+  fileHandle.write('    </Piece>\n')
+  fileHandle.write('  </UnstructuredGrid>\n')
+  fileHandle.write('</VTKFile>\n')
+  fileHandle.close()
+  
+  reader.Close()
+  
+  debug.dprint("Finished converting to vtu")
+  
+  return
+  
+def _WriteMsh4(mesh, filename):
+  """
+  Write a Gmsh MSH 4.1 binary file. One entity is written per element
+  dimension and first element ID, with the first ID as its physical tag.
+  """
+  
+  nodeCoords = numpy.zeros((mesh.NodeCoordsCount(), 3))
+  nodeCoords[:, :mesh.GetDim()] = mesh.GetNodeCoordsArray()
+  
+  entities = []
+  entityBlocks = []
+  for dim, blocks in [(mesh.GetDim() - 1, mesh.GetSurfaceElementArrayBlocks()), (mesh.GetDim(), mesh.GetVolumeElementArrayBlocks())]:
+    if dim < 0:
+      continue
+    physicalIds = numpy.concatenate([ids[:, 0] if ids.shape[1] > 0 else numpy.zeros(ids.shape[0], dtype = numpy.int64) for nodes, ids in blocks] + [numpy.zeros(0, dtype = numpy.int64)])
+    for i, physicalId in enumerate(numpy.unique(physicalIds)):
+      entityNodes = []
+      for nodes, ids in blocks:
+        mask = (ids[:, 0] if ids.shape[1] > 0 else numpy.zeros(ids.shape[0], dtype = numpy.int64)) == physicalId
+        if mask.any():
+          type = GmshElementType(dim = dim, nodeCount = nodes.shape[1])
+          entityBlocks.append((dim, i + 1, type.GetGmshElementTypeId(), nodes[mask][:, ToGmshNodeOrder(range(nodes.shape[1]), type)] + 1))
+          entityNodes.append(nodes[mask].ravel())
+      entityCoords = nodeCoords[numpy.concatenate(entityNodes)]
+      entities.append((dim, i + 1, [int(physicalId)] if physicalId > 0 else [], entityCoords.min(axis = 0), entityCoords.max(axis = 0)))
       
-    return line
+  # Assign the nodes to the first volume entity
+  nodeEntity = (mesh.GetDim(), 1)
+  if not nodeEntity in [entity[:2] for entity in entities]:
+    entities.append((mesh.GetDim(), 1, [], nodeCoords.min(axis = 0) if mesh.NodeCoordsCount() > 0 else numpy.zeros(3), nodeCoords.max(axis = 0) if mesh.NodeCoordsCount() > 0 else numpy.zeros(3)))
+  
+  writer = Msh4Writer(filename, entities)
+  writer.WriteNodeBlock(nodeEntity[0], nodeEntity[1], numpy.arange(1, mesh.NodeCoordsCount() + 1), nodeCoords)
+  index = 1
+  for dim, tag, typeId, nodes in entityBlocks:
+    writer.WriteElementBlock(dim, tag, typeId, numpy.arange(index, index + nodes.shape[0]), nodes)
+    index += nodes.shape[0]
+  writer.Close()
+  
+  return
+  
+def ReadMsh(filename):
+  """
+  Read a Gmsh msh file. MSH 2.x (binary or ASCII) and MSH 4.1 (binary) files
+  are supported. If the mesh cache is enabled, the mesh is loaded from the cache
+  if a valid entry exists.
+  """
+  
+  basename = filename.split(".")[0]
+  
+  return mesh_cache.CachedRead("msh", lambda: _ReadMsh(filename), [filename, basename + ".halo"])
+
+def _ReadMsh(filename):
+  """
+  Parse a Gmsh msh file
+  """
+  
+  def ReadSectionTokens(fileHandle, dtype):
+    # Tokenise all remaining lines in a section in bulk
+    lines = []
+    for line in iter(fileHandle.readline, ""):
+      if line.startswith("$"):
+        break
+      lines.append(line)
+    
+    return numpy.fromstring("".join(lines), dtype = dtype, sep = " "), line.strip()
   
-  fileHandle = open(filename, "r")
+  fileHandle = open(filename, "rb")
 
   basename = filename.split(".")[0]
   hasHalo = filehandling.FileExists(basename + ".halo")
   
   # Read the MeshFormat section
   
-  line = ReadNonCommentLine(fileHandle)
+  line = _ReadNonCommentLine(fileHandle)
   assert(line == "$MeshFormat")
   
-  line = ReadNonCommentLine(fileHandle)
+  line = _ReadNonCommentLine(fileHandle)
   lineSplit = line.split()
   assert(len(lineSplit) == 3)
   version = float(lineSplit[0])
   fileType = int(lineSplit[1])
   dataSize = int(lineSplit[2])  
-  if fileType == 1:
+  if version >= 4.0:
+    # MSH 4.x format
+    
+    nodeCoords, elementBlocks = _ReadMsh4(filename)
+  elif fileType == 1:
     # Binary format
     
     if dataSize == 4:
-      realFormat = "f"
+      realFormat = "f4"
     elif dataSize == 8:
-      realFormat = "d"
+      realFormat = "f8"
     else:
       raise Exception("Unrecognised real size " + str(dataSize))
       
-    iArr = array.array("i")    
-    iArr.fromfile(fileHandle, 1)
-    if iArr[0] == 1:
-      swap = False
-    else:
-      iArr.byteswap()
-      if iArr[0] == 1:
-        swap = True
-      else:
-        raise Exception("Invalid one byte")
+    byteOrder = _ReadMshOneByte(fileHandle)
+    intType = numpy.dtype(byteOrder + "i4")
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$EndMeshFormat")
     
     # Read the Nodes section
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$Nodes")    
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     nNodes = int(line)
-    # Assume dense node IDs, but not necessarily ordered
-    seenNode = [False for i in range(nNodes)]
-    nodeIds = []
-    nodes = []
-    lbound = [calc.Inf() for i in range(3)]
-    ubound = [-calc.Inf() for i in range(3)]
-    for i in range(nNodes):
-      iArr = array.array("i")
-      rArr = array.array(realFormat)
-      iArr.fromfile(fileHandle, 1)
-      rArr.fromfile(fileHandle, 3)
-      if swap:
-        iArr.byteswap()
-        rArr.byteswap()
-      nodeId = iArr[0]
-      coord = rArr
-      assert(nodeId > 0)
-      assert(not seenNode[nodeId - 1])
-      seenNode[nodeId - 1] = True
-      nodeIds.append(nodeId)
-      nodes.append(coord)
-      for j in range(3):
-        lbound[j] = min(lbound[j], coord[j])
-        ubound[j] = max(ubound[j], coord[j])
-    
-    line = ReadNonCommentLine(fileHandle)
+    nodeData = numpy.fromfile(fileHandle, dtype = numpy.dtype([("id", intType), ("coord", byteOrder + realFormat, (3,))]), count = nNodes)
+    assert(len(nodeData) == nNodes)
+    nodeCoords = _MshNodeCoords(nodeData["id"], nodeData["coord"])
+    del nodeData
+    
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$EndNodes")
       
-    nodes = utils.KeyedSort(nodeIds, nodes)
-    bound = bounds.BoundingBox(lbound, ubound)
-    indices = bound.UsedDimIndices()
-    dim = len(indices)
-    if dim < 3:
-      nodes = [[coord[index] for index in indices] for coord in nodes]
-    
-    mesh = meshes.Mesh(dim)
-    mesh.AddNodeCoords(nodes)
-      
     # Read the Elements section
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$Elements")  
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     nEles = int(line)
+    elementBlocks = []
     i = 0
     while i < nEles:
-      iArr = array.array("i")
-      iArr.fromfile(fileHandle, 3)
-      if swap:
-        iArr.byteswap()
-      typeId = iArr[0]
-      nSubEles = iArr[1]
-      nIds = iArr[2]
-      
+      typeId, nSubEles, nIds = numpy.fromfile(fileHandle, dtype = intType, count = 3)
       type = GmshElementType(gmshElementTypeId = typeId)
       
-      for j in range(nSubEles):
-        iArr = array.array("i")
-        iArr.fromfile(fileHandle, 1 + nIds + type.GetNodeCount())
-        if swap:
-          iArr.byteswap()
-        eleId = iArr[0]
-        assert(eleId > 0)
-        ids = iArr[1:1 + nIds]
-        nodes = FromGmshNodeOrder(utils.OffsetList(iArr[-type.GetNodeCount():], -1), type)
-        
-        element = elements.Element(nodes, ids)
-        
-        if type.GetDim() == dim - 1:
-          mesh.AddSurfaceElement(element)
-        elif type.GetDim() == dim:
-          mesh.AddVolumeElement(element)
-        else:
-          debug.deprint("Warning: Element of type " + str(type) + " encountered in " + str(dim) + " dimensions")
+      # Read the whole block of elements at once
+      recordLength = 1 + nIds + type.GetNodeCount()
+      data = numpy.fromfile(fileHandle, dtype = intType, count = nSubEles * recordLength)
+      assert(len(data) == nSubEles * recordLength)
+      data = data.reshape((nSubEles, recordLength)).astype(numpy.int64)
+      assert((data[:, 0] > 0).all())
+      elementBlocks.append((typeId, data[:, 1 + nIds:], data[:, 1:1 + nIds]))
           
       i += nSubEles
     assert(i == nEles)
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$EndElements")
   elif fileType == 0:
     # ASCII format
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$EndMeshFormat")
     
     # Read the Nodes section
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$Nodes")
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     nNodes = int(line)
-    # Assume dense node IDs, but not necessarily ordered
-    seenNode = [False for i in range(nNodes)]
-    nodeIds = []
-    nodes = []
-    lbound = [calc.Inf() for i in range(3)]
-    ubound = [-calc.Inf() for i in range(3)]
-    for i in range(nNodes):
-      line = ReadNonCommentLine(fileHandle)
-      lineSplit = line.split()
-      assert(len(lineSplit) == 4)
-      nodeId = int(lineSplit[0])
-      coord = [float(comp) for comp in lineSplit[1:]]
-      assert(nodeId > 0)
-      assert(not seenNode[nodeId - 1])
-      seenNode[nodeId - 1] = True
-      nodeIds.append(nodeId)
-      nodes.append(coord)
-      for j in range(3):
-        lbound[j] = min(lbound[j], coord[j])
-        ubound[j] = max(ubound[j], coord[j])
-    
-    line = ReadNonCommentLine(fileHandle)
+    nodeData, line = ReadSectionTokens(fileHandle, float)
     assert(line == "$EndNodes")
-      
-    nodes = utils.KeyedSort(nodeIds, nodes)
-    bound = bounds.BoundingBox(lbound, ubound)
-    indices = bound.UsedDimIndices()
-    dim = len(indices)
-    if dim < 3:
-      nodes = [[coord[index] for index in indices] for coord in nodes]
-    
-    mesh = meshes.Mesh(dim)
-    mesh.AddNodeCoords(nodes)
+    assert(len(nodeData) == 4 * nNodes)
+    nodeData = nodeData.reshape((nNodes, 4))
+    nodeCoords = _MshNodeCoords(nodeData[:, 0].astype(numpy.int64), nodeData[:, 1:])
+    del nodeData
     
     # Read the Elements section
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     assert(line == "$Elements")  
     
-    line = ReadNonCommentLine(fileHandle)
+    line = _ReadNonCommentLine(fileHandle)
     nEles = int(line)
-    for i in range(nEles):
-      line = ReadNonCommentLine(fileHandle)
-      lineSplit = line.split()
-      assert(len(lineSplit) > 3)
-      eleId = int(lineSplit[0])
-      assert(eleId > 0)
-      typeId = int(lineSplit[1])
-      nIds = int(lineSplit[2])
-      
-      type = GmshElementType(gmshElementTypeId = typeId)
-      ids = [int(id) for id in lineSplit[3:3 + nIds]]
-      nodes = FromGmshNodeOrder([int(node) - 1 for node in lineSplit[-type.GetNodeCount():]], type)
-      element = elements.Element(nodes, ids)
-      if type.GetDim() == dim - 1:
-        mesh.AddSurfaceElement(element)
-      elif type.GetDim() == dim:
-        mesh.AddVolumeElement(element)
-      else:
-        debug.deprint("Warning: Element of type " + str(type) + " encountered in " + str(dim) + " dimensions")
-    
-    line = ReadNonCommentLine(fileHandle)
+    tokens, line = ReadSectionTokens(fileHandle, numpy.int64)
     assert(line == "$EndElements")
+    elementBlocks = []
+    i = 0
+    start = 0
+    while start < len(tokens):
+      # Records with the same element type and number of IDs have the same
+      # length, so each run of such records is handled as a single block
+      typeId, nIds = tokens[start + 1], tokens[start + 2]
+      type = GmshElementType(gmshElementTypeId = typeId)
+      recordLength = 3 + nIds + type.GetNodeCount()
+      nSubEles = _MshRecordRunLength(tokens, start, recordLength)
+      
+      data = tokens[start:start + nSubEles * recordLength].reshape((nSubEles, recordLength))
+      assert((data[:, 0] > 0).all())
+      elementBlocks.append((typeId, data[:, 3 + nIds:], data[:, 3:3 + nIds]))
+      
+      i += nSubEles
+      start += nSubEles * recordLength
+    assert(i == nEles)
     
     # Ignore all remaining sections
   else:
     raise Exception("File type " + str(fileType) + " not recognised")
   
   fileHandle.close()
+  
+  mesh = _MshMesh(nodeCoords, elementBlocks)
 
   if hasHalo:
     # Read the .halo file
@@ -358,11 +1009,42 @@ def ReadMsh(filename):
   
   return mesh
   
-def WriteMsh(mesh, filename, binary = True):
+def _MshElementBlocks(mesh):
+  """
+  Return the elements of the supplied mesh as a list of (Gmsh type ID,
+  element IDs, element nodes) blocks. Element nodes are Gmsh node numbers, in
+  Gmsh node order.
+  """
+  
+  elementBlocks = []
+  for dim, blocks in [(mesh.GetDim() - 1, mesh.GetSurfaceElementArrayBlocks()), (mesh.GetDim(), mesh.GetVolumeElementArrayBlocks())]:
+    for nodes, ids in blocks:
+      type = GmshElementType(dim = dim, nodeCount = nodes.shape[1])
+      elementBlocks.append((type.GetGmshElementTypeId(), ids, nodes[:, ToGmshNodeOrder(range(nodes.shape[1]), type)] + 1))
+      
+  return elementBlocks
+  
+def WriteMsh(mesh, filename, binary = True, version = 2.1):
   """
-  Write a Gmsh msh file
+  Write a Gmsh msh file. MSH 2.1 (binary or ASCII) and MSH 4.1 (binary) output
+  is supported.
   """
   
+  if version >= 4.0:
+    if not binary:
+      raise Exception("Only binary MSH 4.x output is supported")
+    elif not version == 4.1:
+      raise Exception("Unsupported version " + str(version))
+    _WriteMsh4(mesh, filename)
+    return
+  elif not version == 2.1:
+    raise Exception("Unsupported version " + str(version))
+  
+  nodeCoords = numpy.zeros((mesh.NodeCoordsCount(), 3))
+  nodeCoords[:, :mesh.GetDim()] = mesh.GetNodeCoordsArray()
+  elementBlocks = _MshElementBlocks(mesh)
+  nEles = mesh.SurfaceElementCount() + mesh.VolumeElementCount()
+  
   if binary:
     # Binary format
     
@@ -370,13 +1052,11 @@ def WriteMsh(mesh, filename, binary = True):
     
     # Write the MeshFormat section    
     fileHandle.write("$MeshFormat\n")
-    version = 2.1
     fileType = 1
     dataSize = ctypes.sizeof(ctypes.c_double)
     fileHandle.write(utils.FormLine([version, fileType, dataSize]))
     
-    iArr = array.array("i", [1])
-    iArr.tofile(fileHandle)
+    numpy.array([1], dtype = numpy.int32).tofile(fileHandle)
     fileHandle.write("\n")
     
     fileHandle.write("$EndMeshFormat\n")
@@ -386,16 +1066,11 @@ def WriteMsh(mesh, filename, binary = True):
     fileHandle.write("$Nodes\n")
     fileHandle.write(utils.FormLine([mesh.NodeCoordsCount()]))
     
-    for i, nodeCoord in enumerate(mesh.GetNodeCoords()):
-      nodeCoord = list(nodeCoord)
-      while len(nodeCoord) < 3:
-        nodeCoord.append(0.0)
-      assert(len(nodeCoord) == 3)
-      
-      iArr = array.array("i", [i + 1])
-      rArr = array.array("d", nodeCoord)
-      iArr.tofile(fileHandle)
-      rArr.tofile(fileHandle) 
+    nodeData = numpy.empty(mesh.NodeCoordsCount(), dtype = numpy.dtype([("id", numpy.int32), ("coord", numpy.float64, (3,))]))
+    nodeData["id"] = numpy.arange(1, mesh.NodeCoordsCount() + 1)
+    nodeData["coord"] = nodeCoords
+    nodeData.tofile(fileHandle)
+    del nodeData
     fileHandle.write("\n")     
     
     fileHandle.write("$EndNodes\n")
@@ -403,29 +1078,19 @@ def WriteMsh(mesh, filename, binary = True):
     # Write the Elements section
         
     fileHandle.write("$Elements\n")
-    fileHandle.write(utils.FormLine([mesh.SurfaceElementCount() + mesh.VolumeElementCount()]))
-    
-    eleSort = {}
-    for ele in mesh.GetSurfaceElements() + mesh.GetVolumeElements():
-      eleType = ele.GetType()
-      gmshType = GmshElementType(dim = eleType.GetDim(), nodeCount = eleType.GetNodeCount())
-      
-      key = (gmshType.GetGmshElementTypeId(), len(ele.GetIds()))
-      if key in eleSort:
-        eleSort[key].append(ele)
-      else:
-        eleSort[key] = [ele]
+    fileHandle.write(utils.FormLine([nEles]))
     
     index = 1
-    for gmshEleId, nIds in eleSort:
-      eles = eleSort[(gmshEleId, nIds)]
-      iArr = array.array("i", [gmshEleId, len(eles), nIds])
-      iArr.tofile(fileHandle)
-      for ele in eles:
-        iArr = array.array("i", [index] + list(ele.GetIds()) + utils.OffsetList(ToGmshNodeOrder(ele.GetNodes(), ele.GetType()), 1))
-        iArr.tofile(fileHandle)
-        index += 1
-    assert(index == mesh.SurfaceElementCount() + mesh.VolumeElementCount() + 1)
+    for gmshEleId, ids, nodes in elementBlocks:
+      nSubEles, nIds = ids.shape
+      numpy.array([gmshEleId, nSubEles, nIds], dtype = numpy.int32).tofile(fileHandle)
+      eleData = numpy.empty((nSubEles, 1 + nIds + nodes.shape[1]), dtype = numpy.int32)
+      eleData[:, 0] = numpy.arange(index, index + nSubEles)
+      eleData[:, 1:1 + nIds] = ids
+      eleData[:, 1 + nIds:] = nodes
+      eleData.tofile(fileHandle)
+      index += nSubEles
+    assert(index == nEles + 1)
     fileHandle.write("\n")
     
     fileHandle.write("$EndElements\n")
@@ -436,7 +1101,6 @@ def WriteMsh(mesh, filename, binary = True):
     
     # Write the MeshFormat section    
     fileHandle.write("$MeshFormat\n")
-    version = 2.1
     fileType = 0
     dataSize = ctypes.sizeof(ctypes.c_double)
     fileHandle.write(utils.FormLine([version, fileType, dataSize]))    
@@ -446,24 +1110,32 @@ def WriteMsh(mesh, filename, binary = True):
     
     fileHandle.write("$Nodes\n")
     fileHandle.write(utils.FormLine([mesh.NodeCoordsCount()]))
-    for i, nodeCoord in enumerate(mesh.GetNodeCoords()):
-      nodeCoord = list(nodeCoord)
-      while len(nodeCoord) < 3:
-        nodeCoord.append(0.0)
-      assert(len(nodeCoord) == 3)
-      fileHandle.write(utils.FormLine([i + 1, nodeCoord]))
+    nodeData = numpy.empty((mesh.NodeCoordsCount(), 4))
+    nodeData[:, 0] = numpy.arange(1, mesh.NodeCoordsCount() + 1)
+    nodeData[:, 1:] = nodeCoords
+    filehandling.WriteRows(fileHandle, nodeData, "%d %r %r %r\n")
+    del nodeData
     fileHandle.write("$EndNodes\n")
     
     # Write the Elements section
     
     fileHandle.write("$Elements\n")
-    fileHandle.write(utils.FormLine([mesh.SurfaceElementCount() + mesh.VolumeElementCount()]))
-    for i, ele in enumerate(mesh.GetSurfaceElements() + mesh.GetVolumeElements()):
-      eleType = ele.GetType()
-      gmshType = GmshElementType(dim = eleType.GetDim(), nodeCount = eleType.GetNodeCount())
-      ids = ele.GetIds()
-      fileHandle.write(utils.FormLine([i + 1, gmshType.GetGmshElementTypeId(), len(ids), ids, utils.OffsetList(ToGmshNodeOrder(ele.GetNodes(), eleType), 1)]))
+    fileHandle.write(utils.FormLine([nEles]))
+    index = 1
+    for gmshEleId, ids, nodes in elementBlocks:
+      nSubEles, nIds = ids.shape
+      eleData = numpy.empty((nSubEles, 3 + nIds + nodes.shape[1]), dtype = numpy.int64)
+      eleData[:, 0] = numpy.arange(index, index + nSubEles)
+      eleData[:, 1] = gmshEleId
+      eleData[:, 2] = nIds
+      eleData[:, 3:3 + nIds] = ids
+      eleData[:, 3 + nIds:] = nodes
+      filehandling.WriteRows(fileHandle, eleData, " ".join(["%d" for i in range(eleData.shape[1])]) + "\n")
+      index += nSubEles
+    assert(index == nEles + 1)
     fileHandle.write("$EndElements\n")
+    
+  fileHandle.close()
   
   return
     
@@ -522,3 +1194,153 @@ class gmshtoolsUnittests(unittest.TestCase):
     self.assertEquals(oldMesh.VolumeElementCount(), newMesh.VolumeElementCount())
     
     return
+    
+  def testReadMshBlocks(self):
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "temp.msh")
+    fileHandle = open(filename, "w")
+    fileHandle.write("""$MeshFormat
+2.1 0 8
+$EndMeshFormat
+$Nodes
+5
+2 1.0 0.0 0.0
+1 0.0 0.0 0.0
+3 0.0 1.0 0.0
+4 1.0 1.0 0.0
+5 2.0 1.0 0.0
+$EndNodes
+$Elements
+6
+1 1 2 7 1 1 2
+2 1 2 8 2 2 5
+3 2 2 1 0 1 2 3
+4 1 1 9 4 3
+5 2 2 1 0 2 4 3
+
+6 2 2 2 0 2 5 4
+$EndElements
+""")
+    fileHandle.close()
+    mesh = ReadMsh(filename)
+    self.assertEquals(mesh.GetDim(), 2)
+    self.assertTrue(mesh.IsArrayBacked())
+    self.assertEquals(mesh.GetNodeCoordsArray().tolist(), [[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+    self.assertEquals(mesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2], [1, 3, 2], [1, 4, 3]])
+    self.assertEquals(mesh.GetVolumeElementIdsArray().tolist(), [[1, 0], [1, 0], [2, 0]])
+    self.assertEquals(mesh.GetSurfaceElementNodesArray().tolist(), [[0, 1], [1, 4], [3, 2]])
+    self.assertEquals(mesh.GetSurfaceElement(2).GetIds(), [9])
+    
+    WriteMsh(mesh, filename, binary = True)
+    newMesh = ReadMsh(filename)
+    filehandling.Rmdir(tempDir, force = True)
+    self.assertEquals(newMesh.GetNodeCoordsArray().tolist(), mesh.GetNodeCoordsArray().tolist())
+    self.assertEquals(newMesh.GetVolumeElementNodesArray().tolist(), mesh.GetVolumeElementNodesArray().tolist())
+    self.assertEquals(sorted([element.GetIds()[0] for element in newMesh.GetSurfaceElements()]), [7, 8, 9])
+    
+    return
+    
+  def testMshQuadIo(self):
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "temp")
+    oldMesh = meshes.Mesh(2)
+    oldMesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [0.5, 2.0]])
+    oldMesh.AddVolumeElement(elements.Element(nodes = [0, 1, 2, 3]))
+    oldMesh.AddVolumeElement(elements.Element(nodes = [2, 3, 4]))
+    for binary in [False, True]:
+      WriteMsh(oldMesh, filename, binary = binary)
+      newMesh = ReadMsh(filename)
+      # Mixed volume element types give a list backed mesh
+      self.assertFalse(newMesh.IsArrayBacked())
+      self.assertEquals(newMesh.GetVolumeElement(0).GetNodes(), [0, 1, 2, 3])
+      self.assertEquals(newMesh.GetVolumeElement(1).GetNodes(), [2, 3, 4])
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
+  def testMsh4Io(self):
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "temp.msh")
+    oldMesh = meshes.Mesh(2, arrayBacked = True)
+    oldMesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+    oldMesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2], [1, 4, 3]], ids = [[1, 1], [1, 1], [2, 2]])
+    oldMesh.AddSurfaceElementsArray([[0, 1], [1, 4], [3, 2]], ids = [7, 8, 7])
+    WriteMsh(oldMesh, filename, version = 4.1)
+    self.assertRaises(Exception, WriteMsh, oldMesh, filename, binary = False, version = 4.1)
+    
+    newMesh = ReadMsh(filename)
+    self.assertEquals(newMesh.GetDim(), 2)
+    self.assertEquals(newMesh.GetNodeCoordsArray().tolist(), oldMesh.GetNodeCoordsArray().tolist())
+    self.assertEquals(newMesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2], [1, 3, 2], [1, 4, 3]])
+    self.assertEquals(newMesh.GetVolumeElementIdsArray()[:, 0].tolist(), [1, 1, 2])
+    self.assertEquals(newMesh.GetSurfaceElementNodesArray().tolist(), [[0, 1], [3, 2], [1, 4]])
+    self.assertEquals(newMesh.GetSurfaceElementIdsArray()[:, 0].tolist(), [7, 7, 8])
+    
+    # Stream the file in chunks
+    reader = Msh4Reader(filename)
+    self.assertEquals(reader.NodeCount(), 5)
+    self.assertEquals(reader.ElementCount(), 6)
+    nodeBlocks = list(reader.NodeBlocks(chunkSize = 2))
+    self.assertEquals(len(nodeBlocks), 3)
+    self.assertEquals(numpy.concatenate([block[2] for block in nodeBlocks]).tolist(), [1, 2, 3, 4, 5])
+    self.assertEquals(numpy.concatenate([block[3] for block in nodeBlocks])[:, :2].tolist(), oldMesh.GetNodeCoordsArray().tolist())
+    elementBlocks = list(reader.ElementBlocks(chunkSize = 1))
+    self.assertEquals(len(elementBlocks), 6)
+    self.assertEquals([block[3][0] for block in elementBlocks], [1, 2, 3, 4, 5, 6])
+    self.assertEquals(reader.GetPhysicalTags(1, 2), [8])
+    reader.Close()
+    
+    # Sparse node tags
+    writer = Msh4Writer(filename, [(2, 1, [3], [0.0, 0.0, 0.0], [1.0, 1.0, 0.0])])
+    writer.WriteNodeBlock(2, 1, [10, 30], [[0.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    writer.WriteNodeBlock(2, 1, [20], [[1.0, 0.0, 0.0]])
+    writer.WriteElementBlock(2, 1, GMSH_TRIANGLE, [1], [[10, 20, 30]])
+    self.assertRaises(Exception, writer.WriteNodeBlock, 2, 1, [40], [[1.0, 1.0, 0.0]])
+    writer.Close()
+    newMesh = ReadMsh(filename)
+    filehandling.Rmdir(tempDir, force = True)
+    self.assertEquals(newMesh.GetNodeCoordsArray().tolist(), [[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+    self.assertEquals(newMesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2]])
+    self.assertEquals(newMesh.GetVolumeElementIdsArray().tolist(), [[3, 1]])
+    
+    return
+    
+  def testMsh4Conversion(self):
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "temp.msh")
+    mesh = meshes.Mesh(2, arrayBacked = True)
+    mesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+    mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2], [1, 4, 3]], ids = [[1, 1], [1, 1], [2, 2]])
+    mesh.AddSurfaceElementsArray([[0, 1], [1, 4], [3, 2]], ids = [7, 8, 7])
+    WriteMsh(mesh, filename, version = 4.1)
+    mesh = ReadMsh(filename)
+    
+    # Convert with a chunk size smaller than every node and element block
+    baseName = os.path.join(tempDir, "temp")
+    Msh4ToTriangle(filename, baseName, chunkSize = 1)
+    newMesh = triangletools.ReadTriangle(baseName, cache = False)
+    self.assertEquals(newMesh.GetDim(), 2)
+    self.assertEquals(newMesh.GetNodeCoordsArray().tolist(), mesh.GetNodeCoordsArray().tolist())
+    self.assertEquals(newMesh.GetVolumeElementNodesArray().tolist(), mesh.GetVolumeElementNodesArray().tolist())
+    self.assertEquals(newMesh.GetVolumeElementIdsArray()[:, 0].tolist(), mesh.GetVolumeElementIdsArray()[:, 0].tolist())
+    self.assertEquals(newMesh.GetSurfaceElementNodesArray().tolist(), mesh.GetSurfaceElementNodesArray().tolist())
+    self.assertEquals(newMesh.GetSurfaceElementIdsArray()[:, 0].tolist(), mesh.GetSurfaceElementIdsArray()[:, 0].tolist())
+    Msh4ToTriangle(filename, baseName, coordDim = 3, sphericalShell = True, chunkSize = 2)
+    self.assertEquals(open(baseName + ".node").readline().split(), ["5", "2", "0", "0"])
+    
+    if vtktools.VtkSupport():
+      vtuFilename = os.path.join(tempDir, "temp.vtu")
+      Msh4ToVtu(filename, vtuFilename, chunkSize = 1)
+      vtu = vtktools.vtu(vtuFilename)
+      oldVtu = mesh.ToVtu()
+      self.assertEquals(vtu.ugrid.GetNumberOfPoints(), oldVtu.ugrid.GetNumberOfPoints())
+      self.assertEquals(vtu.GetLocations().tolist(), oldVtu.GetLocations().tolist())
+      self.assertEquals(vtu.ugrid.GetNumberOfCells(), oldVtu.ugrid.GetNumberOfCells())
+      for i in range(vtu.ugrid.GetNumberOfCells()):
+        self.assertEquals(vtu.ugrid.GetCellType(i), oldVtu.ugrid.GetCellType(i))
+        self.assertEquals(vtu.GetCellPoints(i).tolist(), oldVtu.GetCellPoints(i).tolist())
+      self.assertEquals(vtu.GetScalarField("IDs").tolist(), oldVtu.GetScalarField("IDs").tolist())
+      
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
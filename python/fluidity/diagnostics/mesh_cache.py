@@ -0,0 +1,592 @@
+#!/usr/bin/env python
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Binary mesh cache. Parsed meshes are stored as .npz bundles (node
+coordinates, element connectivity and IDs, and halos), keyed by the path, size
+and modification time of each of the source files they were read from, and by
+the source of the reader module. A cache entry is discarded and regenerated
+whenever any of its source files or its reader change.
+
+Caching is disabled by default, and is enabled if $FLUIDITY_MESH_CACHE is set
+to "1" (or by calling SetCacheEnabled(True)). The cache directory is
+$FLUIDITY_MESH_CACHE_DIR if set, and otherwise $XDG_CACHE_HOME/fluidity/meshes
+(defaulting to ~/.cache/fluidity/meshes). Entries unused for longer than
+$FLUIDITY_MESH_CACHE_MAX_AGE seconds (default 30 days) are evicted, and least
+recently used entries are evicted while the cache is larger than
+$FLUIDITY_MESH_CACHE_MAX_SIZE bytes (default 1 GiB).
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import fluidity.diagnostics.debug as debug
+import fluidity.diagnostics.elements as elements
+import fluidity.diagnostics.mesh_halos as mesh_halos
+import fluidity.diagnostics.meshes as meshes
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
+# Increment when the bundle layout changes, to invalidate existing entries
+_cacheFormatVersion = 1
+
+_cacheEnabled = os.environ.get("FLUIDITY_MESH_CACHE", "0") == "1"
+_cacheDirectory = None
+# Source files smaller than this (in bytes) are parsed directly
+_cacheMinimumSize = 1048576
+_cacheMaximumSize = int(os.environ.get("FLUIDITY_MESH_CACHE_MAX_SIZE", 1024 ** 3))
+_cacheMaximumAge = float(os.environ.get("FLUIDITY_MESH_CACHE_MAX_AGE", 30 * 24 * 60 * 60))
+
+def CacheEnabled():
+  return _cacheEnabled
+
+def SetCacheEnabled(enabled):
+  global _cacheEnabled
+  _cacheEnabled = enabled
+
+  return
+
+def GetCacheDirectory():
+  if not _cacheDirectory is None:
+    return _cacheDirectory
+  elif "FLUIDITY_MESH_CACHE_DIR" in os.environ:
+    return os.environ["FLUIDITY_MESH_CACHE_DIR"]
+  else:
+    cacheHome = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cacheHome, "fluidity", "meshes")
+
+def SetCacheDirectory(directory):
+  """
+  Set the cache directory. If directory is None the default is restored.
+  """
+
+  global _cacheDirectory
+  _cacheDirectory = directory
+
+  return
+
+def GetCacheMinimumSize():
+  return _cacheMinimumSize
+
+def SetCacheMinimumSize(size):
+  """
+  Set the total source file size (in bytes) below which meshes are not cached
+  """
+
+  assert(size >= 0)
+
+  global _cacheMinimumSize
+  _cacheMinimumSize = size
+
+  return
+
+def GetCacheMaximumSize():
+  return _cacheMaximumSize
+
+def SetCacheMaximumSize(size):
+  """
+  Set the total cache size (in bytes) above which least recently used entries
+  are evicted
+  """
+
+  assert(size >= 0)
+
+  global _cacheMaximumSize
+  _cacheMaximumSize = size
+
+  return
+
+def GetCacheMaximumAge():
+  return _cacheMaximumAge
+
+def SetCacheMaximumAge(age):
+  """
+  Set the time (in seconds) since last use after which entries are evicted
+  """
+
+  assert(age >= 0)
+
+  global _cacheMaximumAge
+  _cacheMaximumAge = age
+
+  return
+
+def _CacheEntries():
+  """
+  Return a list of (last use time, size, filename) for all cache entries,
+  least recently used first
+  """
+
+  directory = GetCacheDirectory()
+  if not os.path.isdir(directory):
+    return []
+  entries = []
+  for filename in os.listdir(directory):
+    if filename.endswith(".npz"):
+      filename = os.path.join(directory, filename)
+      try:
+        stat = os.stat(filename)
+      except OSError:
+        # Removed by a concurrent process
+        continue
+      entries.append((stat.st_mtime, stat.st_size, filename))
+  entries.sort()
+
+  return entries
+
+def PruneCache():
+  """
+  Evict entries unused for longer than the maximum age, and then least recently
+  used entries until the cache is no larger than the maximum size
+  """
+
+  entries = _CacheEntries()
+  size = sum([entry[1] for entry in entries])
+  minimumTime = time.time() - GetCacheMaximumAge()
+  for lastUse, entrySize, filename in entries:
+    if lastUse >= minimumTime and size <= GetCacheMaximumSize():
+      break
+    try:
+      os.remove(filename)
+      debug.dprint("Evicted mesh cache file " + filename)
+    except OSError:
+      pass
+    size -= entrySize
+
+  return
+
+def ClearCache():
+  """
+  Remove all entries from the cache directory
+  """
+
+  directory = GetCacheDirectory()
+  if not os.path.isdir(directory):
+    return
+  for filename in os.listdir(directory):
+    if filename.endswith(".npz"):
+      os.remove(os.path.join(directory, filename))
+
+  return
+
+def _ReaderSignature(Reader):
+  """
+  Return a signature string for the supplied reader, hashing the source of the
+  module defining it and of the modules used to store meshes
+  """
+
+  sha = hashlib.sha1()
+  for name in [Reader.__module__, __name__, meshes.__name__, elements.__name__, mesh_halos.__name__]:
+    filename = getattr(sys.modules.get(name), "__file__", None)
+    if filename is None:
+      sha.update(_EncodedKey(name))
+      continue
+    if filename.endswith(".pyc") or filename.endswith(".pyo"):
+      filename = filename[:-1]
+    fileHandle = open(filename, "rb")
+    sha.update(fileHandle.read())
+    fileHandle.close()
+
+  return sha.hexdigest()
+
+def _SourceSignature(filenames, readerSignature = ""):
+  """
+  Return a signature string for the supplied source files, recording the path,
+  size and modification time of each file (or its absence), and the supplied
+  reader signature
+  """
+
+  signature = ["version " + str(_cacheFormatVersion), "reader " + readerSignature]
+  for filename in filenames:
+    path = os.path.abspath(filename)
+    if os.path.isfile(path):
+      stat = os.stat(path)
+      signature.append("%s %d %r" % (path, stat.st_size, stat.st_mtime))
+    else:
+      signature.append(path + " absent")
+
+  return "\n".join(signature)
+
+def _SourceSize(filenames):
+  size = 0
+  for filename in filenames:
+    if os.path.isfile(filename):
+      size += os.path.getsize(filename)
+
+  return size
+
+def _EncodedKey(key):
+  """
+  Return the supplied key string as bytes, encoding unicode strings as UTF-8
+  """
+
+  if isinstance(key, bytes):
+    return key
+  else:
+    return key.encode("utf-8")
+
+def _CacheFilename(name, filenames, readerSignature = ""):
+  key = hashlib.sha1(_EncodedKey("\n".join([name, readerSignature] + [os.path.abspath(filename) for filename in filenames]))).hexdigest()
+
+  return os.path.join(GetCacheDirectory(), name + "_" + key + ".npz")
+
+def _Csr(rows):
+  offsets = numpy.zeros(len(rows) + 1, dtype = numpy.int64)
+  offsets[1:] = numpy.cumsum([len(row) for row in rows])
+  if offsets[-1] == 0:
+    values = numpy.zeros(0, dtype = numpy.int64)
+  else:
+    values = numpy.concatenate([numpy.asarray(row, dtype = numpy.int64) for row in rows])
+
+  return offsets, values
+
+def _CsrRows(offsets, values):
+  return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+def _ElementStoreArrays(mesh, GetElementBlock, GetElements, prefix, arrays):
+  """
+  Add the arrays for a mesh element store to the supplied array dictionary. The
+  store is flattened to (offsets, values) pairs for the nodes and IDs, so that
+  mixed element types and ID counts are preserved in order.
+  """
+
+  if mesh.IsArrayBacked() and not GetElementBlock() is None:
+    elementStore = GetElementBlock()
+    count = elementStore.Count()
+    nodeCount = elementStore.GetNodeCount()
+    arrays[prefix + "NodeOffsets"] = numpy.arange(count + 1, dtype = numpy.int64) * nodeCount
+    arrays[prefix + "Nodes"] = elementStore.GetNodesArray().reshape(count * nodeCount)
+    idCounts = elementStore.GetIdCounts()
+    ids = elementStore.GetIdsArray()
+    arrays[prefix + "IdOffsets"] = numpy.zeros(count + 1, dtype = numpy.int64)
+    arrays[prefix + "IdOffsets"][1:] = numpy.cumsum(idCounts)
+    arrays[prefix + "Ids"] = ids[numpy.arange(ids.shape[1]) < idCounts.reshape((count, 1))]
+  else:
+    elementStore = GetElements()
+    arrays[prefix + "NodeOffsets"], arrays[prefix + "Nodes"] = _Csr([element.GetNodes() for element in elementStore])
+    arrays[prefix + "IdOffsets"], arrays[prefix + "Ids"] = _Csr([element.GetIds() for element in elementStore])
+
+  return
+
+def _AddElementStore(mesh, arrays, prefix, AddElement, AddElementsArray):
+  nodeOffsets, nodes = arrays[prefix + "NodeOffsets"], arrays[prefix + "Nodes"]
+  idOffsets, ids = arrays[prefix + "IdOffsets"], arrays[prefix + "Ids"]
+  count = len(nodeOffsets) - 1
+  if count == 0:
+    return
+
+  nodeCounts = numpy.diff(nodeOffsets)
+  idCounts = numpy.diff(idOffsets)
+  if mesh.IsArrayBacked() and (idCounts == idCounts[0]).all():
+    AddElementsArray(nodes.reshape((count, nodeCounts[0])), ids = ids.reshape((count, idCounts[0])))
+  else:
+    for elementNodes, elementIds in zip(_CsrRows(nodeOffsets, nodes), _CsrRows(idOffsets, ids)):
+      AddElement(elements.Element(nodes = elementNodes.tolist(), ids = elementIds.tolist()))
+
+  return
+
+def _HaloArrays(halo, prefix, arrays):
+  if halo.HasNOwnedNodes():
+    nOwnedNodes = halo.GetNOwnedNodes()
+  else:
+    nOwnedNodes = -1
+  arrays[prefix + "Meta"] = numpy.array([halo.GetProcess(), halo.GetNProcesses(), nOwnedNodes], dtype = numpy.int64)
+  arrays[prefix + "SendOffsets"], arrays[prefix + "Sends"] = _Csr(halo.GetSends())
+  arrays[prefix + "ReceiveOffsets"], arrays[prefix + "Receives"] = _Csr(halo.GetReceives())
+
+  return
+
+def _ArraysHalo(arrays, prefix):
+  process, nProcesses, nOwnedNodes = [int(value) for value in arrays[prefix + "Meta"]]
+  if nOwnedNodes < 0:
+    nOwnedNodes = None
+
+  return mesh_halos.Halo(process, nProcesses, nOwnedNodes = nOwnedNodes, \
+    sends = _CsrRows(arrays[prefix + "SendOffsets"], arrays[prefix + "Sends"]), \
+    receives = _CsrRows(arrays[prefix + "ReceiveOffsets"], arrays[prefix + "Receives"]))
+
+def MeshArrays(mesh, prefix = ""):
+  """
+  Return a dictionary of arrays storing the supplied mesh
+  """
+
+  arrays = {}
+  arrays[prefix + "Meta"] = numpy.array([mesh.GetDim(), int(mesh.IsArrayBacked()), int(mesh.HasHalos())], dtype = numpy.int64)
+  arrays[prefix + "NodeCoords"] = mesh.GetNodeCoordsArray()
+  _ElementStoreArrays(mesh, mesh.GetVolumeElementBlock, mesh.GetVolumeElements, prefix + "Volume", arrays)
+  _ElementStoreArrays(mesh, mesh.GetSurfaceElementBlock, mesh.GetSurfaceElements, prefix + "Surface", arrays)
+
+  if mesh.HasHalos():
+    halos = mesh.GetHalos()
+    arrays[prefix + "HalosMeta"] = numpy.array([halos.GetProcess(), halos.GetNProcesses(), halos.GetNLevels()], dtype = numpy.int64)
+    levels = numpy.zeros((2, halos.GetNLevels()), dtype = numpy.int64)
+    for level in halos.NodeHaloLevels():
+      levels[0, level - 1] = 1
+      _HaloArrays(halos.GetNodeHalo(level), prefix + "NodeHalo" + str(level), arrays)
+    for level in halos.ElementHaloLevels():
+      levels[1, level - 1] = 1
+      _HaloArrays(halos.GetElementHalo(level), prefix + "ElementHalo" + str(level), arrays)
+    arrays[prefix + "HaloLevels"] = levels
+
+  return arrays
+
+def ArraysMesh(arrays, prefix = ""):
+  """
+  Construct a mesh from a dictionary of arrays, as returned by MeshArrays
+  """
+
+  dim, arrayBacked, hasHalos = arrays[prefix + "Meta"]
+
+  mesh = meshes.Mesh(int(dim), arrayBacked = bool(arrayBacked))
+  mesh.AddNodeCoordsArray(arrays[prefix + "NodeCoords"])
+  _AddElementStore(mesh, arrays, prefix + "Surface", mesh.AddSurfaceElement, mesh.AddSurfaceElementsArray)
+  _AddElementStore(mesh, arrays, prefix + "Volume", mesh.AddVolumeElement, mesh.AddVolumeElementsArray)
+
+  if hasHalos:
+    process, nProcesses, nLevels = [int(value) for value in arrays[prefix + "HalosMeta"]]
+    halos = mesh_halos.Halos(process = process, nProcesses = nProcesses, nLevels = nLevels)
+    levels = arrays[prefix + "HaloLevels"]
+    for level in range(1, nLevels + 1):
+      if levels[0, level - 1]:
+        halos.SetNodeHalo(level, _ArraysHalo(arrays, prefix + "NodeHalo" + str(level)))
+      if levels[1, level - 1]:
+        halos.SetElementHalo(level, _ArraysHalo(arrays, prefix + "ElementHalo" + str(level)))
+    mesh.SetHalos(halos)
+  else:
+    mesh.SetHalos(None)
+
+  return mesh
+
+def _SaveCacheEntry(cacheFilename, signature, result):
+  directory = os.path.dirname(cacheFilename)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  if isinstance(result, tuple):
+    meshList = list(result)
+  else:
+    meshList = [result]
+  arrays = {"signature":numpy.array(signature), "meta":numpy.array([len(meshList), int(isinstance(result, tuple))], dtype = numpy.int64)}
+  for i, mesh in enumerate(meshList):
+    arrays.update(MeshArrays(mesh, prefix = "mesh" + str(i)))
+
+  # Write to a temporary file and rename, so that concurrent readers never see
+  # a partially written entry
+  handle, tempFilename = tempfile.mkstemp(dir = directory, suffix = ".tmp")
+  fileHandle = os.fdopen(handle, "wb")
+  try:
+    numpy.savez(fileHandle, **arrays)
+  finally:
+    fileHandle.close()
+  os.rename(tempFilename, cacheFilename)
+
+  return
+
+def _LoadCacheEntry(cacheFilename, signature):
+  """
+  Load a cache entry, returning None if it does not match the supplied source
+  signature
+  """
+
+  npzFile = numpy.load(cacheFilename)
+  try:
+    if not str(npzFile["signature"]) == signature:
+      return None
+    arrays = dict(npzFile.items())
+  finally:
+    npzFile.close()
+
+  nMeshes, isTuple = arrays["meta"]
+  meshList = [ArraysMesh(arrays, prefix = "mesh" + str(i)) for i in range(nMeshes)]
+
+  if isTuple:
+    return tuple(meshList)
+  else:
+    assert(nMeshes == 1)
+    return meshList[0]
+
+def CachedRead(name, Reader, filenames):
+  """
+  Return Reader(), which must return a mesh or a tuple of meshes read from the
+  supplied source files, loading the result from the cache if caching is
+  enabled and a valid entry exists. name identifies the reader.
+  """
+
+  if not CacheEnabled() or _SourceSize(filenames) < GetCacheMinimumSize():
+    return Reader()
+
+  readerSignature = _ReaderSignature(Reader)
+  cacheFilename = _CacheFilename(name, filenames, readerSignature)
+  signature = _SourceSignature(filenames, readerSignature)
+
+  if os.path.isfile(cacheFilename):
+    try:
+      result = _LoadCacheEntry(cacheFilename, signature)
+      if not result is None:
+        debug.dprint("Loaded mesh from cache file " + cacheFilename)
+        # Record the use, for least recently used eviction
+        os.utime(cacheFilename, None)
+        return result
+    except Exception as e:
+      debug.deprint("Warning: Failed to load mesh cache file " + cacheFilename + ": " + str(e))
+
+  result = Reader()
+
+  try:
+    _SaveCacheEntry(cacheFilename, signature, result)
+    debug.dprint("Wrote mesh cache file " + cacheFilename)
+    PruneCache()
+  except Exception as e:
+    debug.deprint("Warning: Failed to write mesh cache file " + cacheFilename + ": " + str(e))
+
+  return result
+
+class mesh_cacheUnittests(unittest.TestCase):
+  def testMeshArrays(self):
+    mesh = meshes.Mesh(2)
+    mesh.AddNodeCoords(([0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]))
+    mesh.AddVolumeElement(elements.Element([0, 1, 2], ids = 1))
+    mesh.AddVolumeElement(elements.Element([0, 1, 2, 3], ids = [2, 3]))
+    mesh.AddSurfaceElement(elements.Element([0, 1]))
+    halo = mesh_halos.Halo(process = 0, nProcesses = 2, nOwnedNodes = 3, sends = [[], [1, 2]], receives = [[], [3]])
+    mesh.SetHalos(mesh_halos.Halos(process = 0, nProcesses = 2, nodeHalos = [halo]))
+
+    newMesh = ArraysMesh(MeshArrays(mesh))
+    self.assertFalse(newMesh.IsArrayBacked())
+    self.assertTrue(numpy.all(newMesh.GetNodeCoordsArray() == mesh.GetNodeCoordsArray()))
+    self.assertEquals([element.GetNodes() for element in newMesh.GetVolumeElements()], [[0, 1, 2], [0, 1, 2, 3]])
+    self.assertEquals([element.GetIds() for element in newMesh.GetVolumeElements()], [[1], [2, 3]])
+    self.assertEquals(newMesh.GetSurfaceElement(0).GetIds(), [])
+    newHalos = newMesh.GetHalos()
+    self.assertEquals(newHalos.NodeHaloLevels(), [1])
+    self.assertEquals(newHalos.ElementHaloCount(), 0)
+    self.assertEquals(newHalos.GetNodeHalo(1).GetNOwnedNodes(), 3)
+    self.assertEquals(newHalos.GetNodeHalo(1).GetSends(1).tolist(), [1, 2])
+    self.assertEquals(newHalos.GetNodeHalo(1).GetReceives(0).tolist(), [])
+
+    mesh = meshes.Mesh(2, arrayBacked = True)
+    mesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]])
+    mesh.AddVolumeElementsArray([[0, 1, 2], [0, 2, 3]], ids = [4, 5])
+    mesh.AddSurfaceElement(elements.Element([0, 1], ids = [1]))
+    mesh.AddSurfaceElement(elements.Element([1, 2], ids = [1, 7]))
+
+    newMesh = ArraysMesh(MeshArrays(mesh))
+    self.assertTrue(newMesh.IsArrayBacked())
+    self.assertEquals(newMesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2], [0, 2, 3]])
+    self.assertEquals(newMesh.GetVolumeElementIdsArray().tolist(), [[4], [5]])
+    self.assertEquals([element.GetIds() for element in newMesh.GetSurfaceElements()], [[1], [1, 7]])
+
+    return
+
+  def testCachedRead(self):
+    tempDir = tempfile.mkdtemp()
+    oldEnabled, oldDirectory, oldMinimumSize = CacheEnabled(), _cacheDirectory, GetCacheMinimumSize()
+    SetCacheEnabled(True)
+    SetCacheDirectory(os.path.join(tempDir, "cache"))
+    SetCacheMinimumSize(0)
+    try:
+      sourceFilename = os.path.join(tempDir, "source")
+      fileHandle = open(sourceFilename, "w")
+      fileHandle.write("1.0\n")
+      fileHandle.close()
+
+      reads = []
+      def Reader():
+        reads.append(None)
+        mesh = meshes.Mesh(1, arrayBacked = True)
+        mesh.AddNodeCoordsArray([[float(open(sourceFilename).read())]])
+        return mesh, meshes.Mesh(1)
+
+      mesh, holeMesh = CachedRead("test", Reader, [sourceFilename])
+      self.assertEquals(len(reads), 1)
+      mesh, holeMesh = CachedRead("test", Reader, [sourceFilename])
+      self.assertEquals(len(reads), 1)
+      self.assertEquals(mesh.GetNodeCoordsArray().tolist(), [[1.0]])
+      self.assertEquals(holeMesh.NodeCount(), 0)
+
+      # Modifying the source invalidates the entry
+      fileHandle = open(sourceFilename, "w")
+      fileHandle.write("20.0\n")
+      fileHandle.close()
+      mesh, holeMesh = CachedRead("test", Reader, [sourceFilename])
+      self.assertEquals(len(reads), 2)
+      self.assertEquals(mesh.GetNodeCoordsArray().tolist(), [[20.0]])
+
+      ClearCache()
+      self.assertEquals(os.listdir(GetCacheDirectory()), [])
+    finally:
+      SetCacheEnabled(oldEnabled)
+      SetCacheDirectory(oldDirectory)
+      SetCacheMinimumSize(oldMinimumSize)
+      shutil.rmtree(tempDir)
+
+    return
+
+  def testPruneCache(self):
+    tempDir = tempfile.mkdtemp()
+    oldEnabled, oldDirectory, oldMinimumSize = CacheEnabled(), _cacheDirectory, GetCacheMinimumSize()
+    oldMaximumSize, oldMaximumAge = GetCacheMaximumSize(), GetCacheMaximumAge()
+    SetCacheEnabled(True)
+    SetCacheDirectory(os.path.join(tempDir, "cache"))
+    SetCacheMinimumSize(0)
+    try:
+      sourceFilenames = [os.path.join(tempDir, "source" + str(i)) for i in range(3)]
+      for sourceFilename in sourceFilenames:
+        open(sourceFilename, "w").close()
+      def Reader():
+        mesh = meshes.Mesh(1, arrayBacked = True)
+        mesh.AddNodeCoordsArray(numpy.zeros((64, 1)))
+        return mesh
+
+      # Entries are evicted least recently used first
+      CachedRead("test", Reader, sourceFilenames[:1])
+      entrySize = _CacheEntries()[0][1]
+      SetCacheMaximumSize(2 * entrySize)
+      now = time.time()
+      os.utime(_CacheEntries()[0][2], (now - 20.0, now - 20.0))
+      CachedRead("test", Reader, sourceFilenames[1:2])
+      os.utime(_CacheEntries()[1][2], (now - 10.0, now - 10.0))
+      CachedRead("test", Reader, sourceFilenames[:1])
+      CachedRead("test", Reader, sourceFilenames[2:])
+      self.assertEquals(len(_CacheEntries()), 2)
+      self.assertFalse(os.path.isfile(_CacheFilename("test", sourceFilenames[1:2], _ReaderSignature(Reader))))
+      self.assertTrue(os.path.isfile(_CacheFilename("test", sourceFilenames[:1], _ReaderSignature(Reader))))
+
+      # Entries older than the maximum age are evicted
+      SetCacheMaximumAge(60.0)
+      os.utime(_CacheEntries()[0][2], (now - 120.0, now - 120.0))
+      PruneCache()
+      self.assertEquals(len(_CacheEntries()), 1)
+
+      # Unicode keys are encoded
+      self.assertEquals(_EncodedKey(u"\u00e9"), u"\u00e9".encode("utf-8"))
+    finally:
+      SetCacheEnabled(oldEnabled)
+      SetCacheDirectory(oldDirectory)
+      SetCacheMinimumSize(oldMinimumSize)
+      SetCacheMaximumSize(oldMaximumSize)
+      SetCacheMaximumAge(oldMaximumAge)
+      shutil.rmtree(tempDir)
+
+    return
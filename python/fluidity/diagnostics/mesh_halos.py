@@ -30,28 +30,28 @@ import unittest
 import fluidity.diagnostics.debug as debug
 
 try:
-  import xml.dom.ext
+  import numpy
 except ImportError:
-  pass
+  debug.deprint("Warning: Failed to import numpy module")
 try:
-  import xml.dom.minidom
+  import xml.etree.cElementTree as ElementTree
 except ImportError:
-  debug.deprint("Warning: Failed to import xml.dom.minidom module")
+  try:
+    import xml.etree.ElementTree as ElementTree
+  except ImportError:
+    debug.deprint("Warning: Failed to import xml.etree.ElementTree module")
+try:
+  import xml.sax.saxutils
+except ImportError:
+  debug.deprint("Warning: Failed to import xml.sax.saxutils module")
 
 import fluidity.diagnostics.filehandling as filehandling
 import fluidity.diagnostics.optimise as optimise
-import fluidity.diagnostics.utils as utils
 
 def XmlSupport():
   try:
-    import xml.dom.minidom
-    return True
-  except ImportError:
-    return False
-
-def XmlExtSupport():
-  try:
-    import xml.dom.ext
+    import xml.etree.ElementTree
+    import xml.sax.saxutils
     return True
   except ImportError:
     return False
@@ -59,9 +59,17 @@ def XmlExtSupport():
 def HaloIOSupport():
   return XmlSupport()
 
+def _IndexArray(indices):
+  indices = numpy.array(indices, dtype = numpy.int64).reshape(len(indices))
+  assert((indices >= 0).all())
+  
+  return indices
+
 class Halo:
   """
-  A halo.
+  A halo. Sends and receives are stored as one index array per process.
+  Single sends and receives added with AddSend and AddReceive are buffered, and
+  appended to the index arrays on the next read.
   """
 
   def __init__(self, process, nProcesses, nOwnedNodes = None, sends = None, receives = None):
@@ -71,17 +79,19 @@ class Halo:
     self._process = process
     self._nProcesses = nProcesses
     self._nOwnedNodes = None
+    self._newSends = {}
+    self._newReceives = {}
     
     if not nOwnedNodes is None:
       self.SetNOwnedNodes(nOwnedNodes)
     if not sends is None:
       self.SetSends(sends)
     else:
-      self._sends = [[] for i in range(nProcesses)]
+      self._sends = [numpy.zeros(0, dtype = numpy.int64) for i in range(nProcesses)]
     if not receives is None:
       self.SetReceives(receives)
     else:
-      self._receives = [[] for i in range(nProcesses)]
+      self._receives = [numpy.zeros(0, dtype = numpy.int64) for i in range(nProcesses)]
     
     return
   
@@ -106,83 +116,133 @@ class Halo:
     
     return
   
+  def _Sends(self):
+    """
+    Return the send index arrays, appending any buffered sends
+    """
+    
+    for process, sends in self._newSends.items():
+      self._sends[process] = numpy.append(self._sends[process], sends)
+    self._newSends = {}
+    
+    return self._sends
+    
+  def _Receives(self):
+    """
+    Return the receive index arrays, appending any buffered receives
+    """
+    
+    for process, receives in self._newReceives.items():
+      self._receives[process] = numpy.append(self._receives[process], receives)
+    self._newReceives = {}
+    
+    return self._receives
+  
   def SendCount(self, process):
-    return len(self._sends[process])
+    return len(self._Sends()[process])
   
   def ReceiveCount(self, process):
-    return len(self._receives[process])
+    return len(self._Receives()[process])
   
   def GetSend(self, process, index):
-    return self._sends[process][index]
+    return self._Sends()[process][index]
   
   def GetReceive(self, process, index):
-    return self._receives[process][index]
+    return self._Receives()[process][index]
   
   def GetSends(self, process = None):
     if process is None:
-      return self._sends
+      return self._Sends()
     else:
-      return self._sends[process]
+      return self._Sends()[process]
   
   def GetReceives(self, process = None):
     if process is None:
-      return self._receives
+      return self._Receives()
     else:
-      return self._receives[process]
+      return self._Receives()[process]
     
   def AddSend(self, process, send):
+    """
+    Add a single send. Sends are buffered until next read, but AddSends should
+    be preferred when adding many sends.
+    """
+    
     assert(send >= 0)
+    assert(process >= 0 and process < self.GetNProcesses())
   
-    self._sends[process].append(send)
+    self._newSends.setdefault(process, []).append(send)
+    
+    return
   
   def AddReceive(self, process, receive):
+    """
+    Add a single receive. Receives are buffered until next read, but
+    AddReceives should be preferred when adding many receives.
+    """
+    
     assert(receive >= 0)
+    assert(process >= 0 and process < self.GetNProcesses())
+    
+    self._newReceives.setdefault(process, []).append(receive)
+    
+    return
+    
+  def AddSends(self, process, sends):
+    """
+    Append an array of sends
+    """
+    
+    processSends = _IndexArray(sends)
+    self._Sends()
+    self._sends[process] = numpy.append(self._sends[process], processSends)
+    
+    return
+    
+  def AddReceives(self, process, receives):
+    """
+    Append an array of receives
+    """
+    
+    processReceives = _IndexArray(receives)
+    self._Receives()
+    self._receives[process] = numpy.append(self._receives[process], processReceives)
     
-    self._receives[process].append(receive)
+    return
   
   def SetSend(self, process, index, send):
     assert(send >= 0)
     
-    self._sends[process][index] = send
+    self._Sends()[process][index] = send
     
     return
     
   def SetReceive(self, process, index, receive):
     assert(receive >= 0)
     
-    self._receives[process][index] = receive
+    self._Receives()[process][index] = receive
   
     return
   
   def SetSends(self, sends, process = None):
     if process is None:
-      nProcesses = self.GetNProcesses()
-      assert(len(sends) == nProcesses)
+      assert(len(sends) == self.GetNProcesses())
       
-      self._sends = [[None for i in range(len(sends[i]))] for i in range(nProcesses)]
-      for i, sendArray in enumerate(sends):
-        for j, send in enumerate(sendArray):
-          self.SetSend(i, j, send)
+      self._sends = [_IndexArray(processSends) for processSends in sends]
+      self._newSends = {}
     else:
-      self._sends[process] = [None for i in range(len(sends))]
-      for i, send in enumerate(sends):
-        self.SetSend(process, i, send)
+      self._Sends()[process] = _IndexArray(sends)
     
     return
   
   def SetReceives(self, receives, process = None):
     if process is None:
-      nProcesses = self.GetNProcesses()
-      assert(len(receives) == nProcesses)
+      assert(len(receives) == self.GetNProcesses())
       
-      self._receives = [[None for i in range(len(receives[i]))] for i in range(nProcesses)]
-      for i, receiveArray in enumerate(receives):
-        for j, receive in enumerate(receiveArray):
-          self.SetReceive(i, j, receive)
+      self._receives = [_IndexArray(processReceives) for processReceives in receives]
+      self._newReceives = {}
     else:
-      self._receives[process] = [None for i in range(len(receives))]
-      for i, receive in enumerate(receives):
-        self.SetReceive(process, i, receive)
+      self._Receives()[process] = _IndexArray(receives)
     
     return
     
@@ -199,17 +259,12 @@ class Halo:
     nOwnedNodes = self.GetNOwnedNodes()
     
     # All sends must be owned
-    for sends in self._sends:
-      if len(sends) > 0 and max(sends) >= nOwnedNodes:
-        return False
-    # All receives must be non-owned
-    for receives in self._receives:
-      if len(receives) > 0 and min(receives) < nOwnedNodes:
-        return False
-    # All receives must be unique and consecutive
-    allReceives = utils.ExpandList(self._receives)
-    allReceives.sort()
-    if not allReceives == range(nOwnedNodes, nOwnedNodes + len(allReceives)):
+    allSends = numpy.concatenate(self._Sends())
+    if len(allSends) > 0 and allSends.max() >= nOwnedNodes:
+      return False
+    # All receives must be non-owned, unique and consecutive
+    allReceives = numpy.sort(numpy.concatenate(self._Receives()))
+    if not numpy.array_equal(allReceives, numpy.arange(nOwnedNodes, nOwnedNodes + len(allReceives))):
       return False
     
     return True
@@ -342,74 +397,70 @@ class Halos:
         
 def ReadHalos(filename):
   """
-  Read a Fluidity .halo file
+  Read a Fluidity .halo file. The file is parsed incrementally, with each halo
+  data element discarded once its sends and receives have been read, and each
+  halo element discarded once the halo has been read.
   """
   
-  xmlFile = xml.dom.minidom.parse(filename)
-  
-  halosRootEle = xmlFile.getElementsByTagName("halos")
-  assert(len(halosRootEle) == 1)
-  halosRootEle = halosRootEle[0]
-  haloProcess = int(halosRootEle.attributes["process"].nodeValue)
-  nprocs = int(halosRootEle.attributes["nprocs"].nodeValue)
-
-  halosEle = halosRootEle.getElementsByTagName("halo")
-  halos = Halos(process = haloProcess, nProcesses = nprocs)
-  for haloEle in halosEle:
-    try:
-      level = int(haloEle.attributes["level"].nodeValue)
-    except KeyError:
-      # Backwards compatibility
-      level = int(haloEle.attributes["tag"].nodeValue)
-      
-    n_private_nodes = int(haloEle.attributes["n_private_nodes"].nodeValue)
-    
-    halo = Halo(process = haloProcess, nProcesses = nprocs, nOwnedNodes = n_private_nodes)
-    
-    processes = []
-    haloDataEles = haloEle.getElementsByTagName("halo_data")
-    for haloDataEle in haloDataEles:
-      process = int(haloDataEle.attributes["process"].nodeValue)
+  def IndexArray(text):
+    if text is None:
+      return numpy.zeros(0, dtype = numpy.int64)
+    else:
+      return numpy.fromstring(text, dtype = numpy.int64, sep = " ")
+  
+  halos = None
+  halo = None
+  for event, ele in ElementTree.iterparse(filename, events = ("start", "end")):
+    if event == "start":
+      if ele.tag == "halos":
+        assert(halos is None)
+        halosEle = ele
+        haloProcess = int(ele.attrib["process"])
+        nprocs = int(ele.attrib["nprocs"])
+        halos = Halos(process = haloProcess, nProcesses = nprocs)
+      elif ele.tag == "halo":
+        assert(not halos is None)
+        try:
+          level = int(ele.attrib["level"])
+        except KeyError:
+          # Backwards compatibility
+          level = int(ele.attrib["tag"])
+        n_private_nodes = int(ele.attrib["n_private_nodes"])
+        
+        halo = Halo(process = haloProcess, nProcesses = nprocs, nOwnedNodes = n_private_nodes)
+        processes = numpy.zeros(nprocs, dtype = bool)
+    elif ele.tag == "halo_data":
+      process = int(ele.attrib["process"])
       assert(process >= 0 and process < nprocs)
-      assert(not process in processes)
-      processes.append(process)
+      assert(not processes[process])
+      processes[process] = True
       
-      sendEle = haloDataEle.getElementsByTagName("send")
+      sendEle = ele.findall("send")
       assert(len(sendEle) == 1)
-      sendEle = sendEle[0]
-      sendEleChildren = sendEle.childNodes
-      sends = None
-      for child in sendEleChildren:
-        if child.nodeType == child.TEXT_NODE:
-          sends = map(int, child.nodeValue.split())
-          break
-      if not sends is None:
-        if level > 0:
-          halo.SetSends(utils.OffsetList(sends, -1), process = process)
-        else:
-          halo.SetSends(sends, process = process)
-      
-      receiveEle = haloDataEle.getElementsByTagName("receive")
+      sends = IndexArray(sendEle[0].text)
+      receiveEle = ele.findall("receive")
       assert(len(receiveEle) == 1)
-      receiveEle = receiveEle[0]
-      receiveEleChildren = receiveEle.childNodes
-      receives = None
-      for child in receiveEleChildren:
-        if child.nodeType == child.TEXT_NODE:
-          receives = map(int, child.nodeValue.split())
-          break
-      if not receives is None:
-        if level > 0:
-          halo.SetReceives(utils.OffsetList(receives, -1), process = process)
-        else:
-          halo.SetReceives(receives, process = process)
-    
-    if level > 0:
-      assert(not halos.HasNodeHalo(level))
-      halos.SetNodeHalo(level, halo)
-    else:
-      assert(not halos.HasElementHalo(-level))
-      halos.SetElementHalo(-level, halo)
+      receives = IndexArray(receiveEle[0].text)
+      if level > 0:
+        sends -= 1
+        receives -= 1
+      halo.SetSends(sends, process = process)
+      halo.SetReceives(receives, process = process)
+      
+      ele.clear()
+    elif ele.tag == "halo":
+      if level > 0:
+        assert(not halos.HasNodeHalo(level))
+        halos.SetNodeHalo(level, halo)
+      else:
+        assert(not halos.HasElementHalo(-level))
+        halos.SetElementHalo(-level, halo)
+      halo = None
+      
+      # Discard the halo element, so that emptied halo elements do not
+      # accumulate in the root element
+      halosEle.clear()
+  assert(not halos is None)
     
   return halos
   
@@ -417,51 +468,42 @@ def WriteHalos(halos, filename):
   """
   Write a Fluidity .halo file
   """
-    
-  xmlfile = xml.dom.minidom.Document()
   
-  halosRootEle = xmlfile.createElement("halos")
-  halosRootEle.setAttribute("process", str(halos.GetProcess()))
-  halosRootEle.setAttribute("nprocs", str(halos.GetNProcesses()))
-  xmlfile.appendChild(halosRootEle)
+  def IndexText(indices):
+    return " ".join(map(str, numpy.asarray(indices).tolist()))
+  
+  handle = open(filename, "w")
+  xmlfile = xml.sax.saxutils.XMLGenerator(handle, "utf-8")
+  xmlfile.startDocument()
+  xmlfile.startElement("halos", {"process":str(halos.GetProcess()), "nprocs":str(halos.GetNProcesses())})
   
   halos = halos.LevelHaloDict()
   for level in halos.keys():
     halo = halos[level]
-  
-    haloEle = xmlfile.createElement("halo")
-    haloEle.setAttribute("level", str(level))
-    haloEle.setAttribute("n_private_nodes", str(halo.GetNOwnedNodes()))
-    halosRootEle.appendChild(haloEle)
     
-    for i, process in enumerate(range(halo.GetNProcesses())):
-      haloDataEle = xmlfile.createElement("halo_data")
-      haloDataEle.setAttribute("process", str(i))
-      haloEle.appendChild(haloDataEle)
-      
-      sendEle = xmlfile.createElement("send")
-      haloDataEle.appendChild(sendEle)
-      
-      if level > 0:
-        sendText = xmlfile.createTextNode(utils.FormLine(utils.OffsetList(utils.ExpandList(halo.GetSends(process = i)), 1), delimiter = " ", newline = False))
-      else:
-        sendText = xmlfile.createTextNode(utils.FormLine(utils.ExpandList(halo.GetSends(process = i)), delimiter = " ", newline = False))
-      sendEle.appendChild(sendText)
-      
-      receiveEle = xmlfile.createElement("receive")
-      haloDataEle.appendChild(receiveEle)
-      
-      if level > 0:
-        receiveText = xmlfile.createTextNode(utils.FormLine(utils.OffsetList(utils.ExpandList(halo.GetReceives(process = i)), 1), delimiter = " ", newline = False))
-      else:
-        receiveText = xmlfile.createTextNode(utils.FormLine(utils.ExpandList(halo.GetReceives(process = i)), delimiter = " ", newline = False))
-      receiveEle.appendChild(receiveText)
-  
-  handle = open(filename, "w")
-  if XmlExtSupport():
-    xml.dom.ext.PrettyPrint(xmlfile, handle)
-  else:
-    xmlfile.writexml(handle)
+    handle.write("\n")
+    xmlfile.startElement("halo", {"level":str(level), "n_private_nodes":str(halo.GetNOwnedNodes())})
+    
+    # Node halos are written with indices from one, element halos from zero
+    offset = 1 if level > 0 else 0
+    for process in range(halo.GetNProcesses()):
+      handle.write("\n")
+      xmlfile.startElement("halo_data", {"process":str(process)})
+      xmlfile.startElement("send", {})
+      xmlfile.characters(IndexText(halo.GetSends(process = process) + offset))
+      xmlfile.endElement("send")
+      xmlfile.startElement("receive", {})
+      xmlfile.characters(IndexText(halo.GetReceives(process = process) + offset))
+      xmlfile.endElement("receive")
+      xmlfile.endElement("halo_data")
+    
+    handle.write("\n")
+    xmlfile.endElement("halo")
+    
+  handle.write("\n")
+  xmlfile.endElement("halos")
+  xmlfile.endDocument()
+  handle.write("\n")
   handle.flush()
   handle.close()
   
@@ -474,6 +516,26 @@ class mesh_halosUnittests(unittest.TestCase):
     
     return
 
+  def testHaloAddSendsReceives(self):
+    halo = Halo(process = 0, nProcesses = 2, sends = [[0], []])
+    halo.AddSend(0, 1)
+    halo.AddSend(1, 2)
+    halo.AddSends(0, [3, 4])
+    halo.AddSend(0, 5)
+    self.assertEquals(halo.SendCount(0), 5)
+    self.assertEquals(halo.GetSends(0).tolist(), [0, 1, 3, 4, 5])
+    self.assertEquals(halo.GetSends(1).tolist(), [2])
+    halo.AddReceive(1, 6)
+    halo.AddReceives(1, numpy.array([7, 8]))
+    halo.AddReceive(1, 9)
+    self.assertEquals(halo.GetReceive(1, 3), 9)
+    self.assertEquals([receives.tolist() for receives in halo.GetReceives()], [[], [6, 7, 8, 9]])
+    halo.AddReceive(0, 10)
+    halo.SetReceives([[11], [12]])
+    self.assertEquals([receives.tolist() for receives in halo.GetReceives()], [[11], [12]])
+    
+    return
+
   def testHaloTrailingReceivesOrdered(self):
     self.assertTrue(Halo(process = 0, nProcesses = 1, nOwnedNodes = 2, sends = [[0, 1]], receives = [[2, 3]]).TrailingReceivesOrdered())
     self.assertTrue(Halo(process = 0, nProcesses = 1, nOwnedNodes = 2, sends = [[1, 0]], receives = [[3, 2]]).TrailingReceivesOrdered())
@@ -502,14 +564,35 @@ class mesh_halosUnittests(unittest.TestCase):
     self.assertEquals(halo2.GetProcess(), 0)
     self.assertEquals(halo1.GetNProcesses(), 1)
     self.assertEquals(halo2.GetNProcesses(), 1)
-    self.assertEquals(halo1.GetSends(process = 0), [0, 1])
-    self.assertEquals(halo2.GetSends(process = 0), [0, 2, 1])
-    self.assertEquals(halo1.GetReceives(process = 0), [3, 4])
-    self.assertEquals(halo2.GetReceives(process = 0), [3, 5, 4])
+    self.assertEquals(halo1.GetSends(process = 0).tolist(), [0, 1])
+    self.assertEquals(halo2.GetSends(process = 0).tolist(), [0, 2, 1])
+    self.assertEquals(halo1.GetReceives(process = 0).tolist(), [3, 4])
+    self.assertEquals(halo2.GetReceives(process = 0).tolist(), [3, 5, 4])
     
     filehandling.Rmdir(tempDir, force = True)
     
     return
+    
+  def testElementHalosIO(self):
+    nodeHalo = Halo(process = 1, nProcesses = 2, nOwnedNodes = 2, sends = [[0, 1], []], receives = [[2], []])
+    elementHalo = Halo(process = 1, nProcesses = 2, nOwnedNodes = 1, sends = [[0], []], receives = [[1, 2], []])
+    halos = Halos(process = 1, nProcesses = 2, nodeHalos = [nodeHalo], elementHalos = [elementHalo])
+    
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "halos")
+    
+    WriteHalos(halos, filename)
+    halos = ReadHalos(filename)
+    filehandling.Rmdir(tempDir, force = True)
+    self.assertEquals(halos.GetProcess(), 1)
+    self.assertEquals(halos.NodeHaloLevels(), [1])
+    self.assertEquals(halos.ElementHaloLevels(), [1])
+    self.assertEquals(halos.GetNodeHalo(1).GetSends(process = 0).tolist(), [0, 1])
+    self.assertEquals(halos.GetNodeHalo(1).ReceiveCount(1), 0)
+    self.assertEquals(halos.GetElementHalo(1).GetReceives(process = 0).tolist(), [1, 2])
+    self.assertTrue(halos.GetNodeHalo(1).TrailingReceivesOrdered())
+    
+    return
   
 class mesh_halosDataUnittests(unittest.TestCase):
   def testReadHalos(self):
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Mesh quality measures, computed in bulk from node coordinate and connectivity
+arrays. Element measures assume linear simplex elements, given as an
+(elements x nodes per element) connectivity array. Measures are evaluated for
+whole meshes, or streamed over a series of dumps with histogram summaries.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import fluidity.diagnostics.adjacency as adjacency
+import fluidity.diagnostics.debug as debug
+import fluidity.diagnostics.meshes as meshes
+import fluidity.diagnostics.simplices as simplices
+import fluidity.diagnostics.vtutools as vtktools
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
+# Quantities evaluated by MeshQuality
+QUALITY_QUANTITIES = ["EdgeLength", "EdgeRatio", "AspectRatio", "DihedralAngle", "Volume", "BoundaryLocked"]
+
+def Edges(offsets, nodes, nodeCount):
+  """
+  Return the unique edges for the supplied CSR element-node connectivity (see
+  adjacency.py), as an (edges x 2) array with each row in increasing node
+  order. Every pair of nodes sharing an element forms an edge, as for linear
+  simplices.
+  """
+
+  offsets, indices = adjacency.NNList(offsets, nodes, nodeCount)
+  rows = adjacency.RowIndices(offsets)
+  mask = indices > rows
+
+  return numpy.column_stack([rows[mask], indices[mask]])
+
+def EdgeLengths(nodeCoords, edges):
+  """
+  Return the lengths of the supplied (edges x 2) edges
+  """
+
+  nodeCoords = numpy.asarray(nodeCoords, dtype = float)
+  edges = numpy.asarray(edges, dtype = numpy.int64)
+  if len(edges) == 0:
+    return numpy.zeros(0)
+  vectors = nodeCoords[edges[:, 1]] - nodeCoords[edges[:, 0]]
+
+  return numpy.sqrt((vectors * vectors).sum(axis = 1))
+
+def _ElementNodePairs(nloc):
+  return numpy.array([[i, j] for i in range(nloc) for j in range(i + 1, nloc)], dtype = numpy.int64).reshape((nloc * (nloc - 1) // 2, 2))
+
+def ElementEdgeLengths(nodeCoords, elementNodes):
+  """
+  Return the edge lengths of each of the supplied simplices, as an (elements x
+  edges per element) array
+  """
+
+  coords = numpy.asarray(nodeCoords, dtype = float)[numpy.asarray(elementNodes, dtype = numpy.int64)]
+  pairs = _ElementNodePairs(coords.shape[1])
+  vectors = coords[:, pairs[:, 1]] - coords[:, pairs[:, 0]]
+
+  return numpy.sqrt((vectors * vectors).sum(axis = 2))
+
+def EdgeRatios(nodeCoords, elementNodes):
+  """
+  Return the ratio of the longest to the shortest edge of each of the supplied
+  simplices
+  """
+
+  lengths = ElementEdgeLengths(nodeCoords, elementNodes)
+
+  with numpy.errstate(divide = "ignore", invalid = "ignore"):
+    return lengths.max(axis = 1) / lengths.min(axis = 1)
+
+def Volumes(nodeCoords, elementNodes, signed = False):
+  """
+  Return the volumes of the supplied simplices
+  """
+
+  return simplices.SimplexVolumes(numpy.asarray(nodeCoords, dtype = float)[numpy.asarray(elementNodes, dtype = numpy.int64)], signed = signed)
+
+def _BarycentricGradients(coords):
+  """
+  Return the barycentric coordinate gradients of the supplied (elements x nodes
+  x dim) simplices, as an (elements x nodes x dim) array, together with a mask
+  of the non-degenerate simplices. Gradients of degenerate simplices are NaN.
+  """
+
+  nElements, nloc, dim = coords.shape
+  assert(nloc == dim + 1)
+
+  vectors = coords[:, 1:] - coords[:, :1]
+  scale = numpy.abs(vectors).max(axis = (1, 2)) if nElements > 0 else numpy.zeros(0)
+  valid = numpy.abs(numpy.linalg.det(vectors)) > 1.0e-12 * scale ** dim
+
+  gradients = numpy.empty(coords.shape)
+  gradients[~valid] = numpy.nan
+  # x - x_0 = vectors^T lambda', so the gradient of lambda'_i is column i of
+  # vectors^-1
+  gradients[valid, 1:] = numpy.linalg.inv(vectors[valid]).transpose((0, 2, 1))
+  gradients[valid, 0] = -gradients[valid, 1:].sum(axis = 1)
+
+  return gradients, valid
+
+def AspectRatios(nodeCoords, elementNodes):
+  """
+  Return the aspect ratio of each of the supplied simplices, defined as the
+  circumradius divided by dim times the inradius. This is one for a regular
+  simplex, and infinite for a degenerate simplex.
+  """
+
+  coords = numpy.asarray(nodeCoords, dtype = float)[numpy.asarray(elementNodes, dtype = numpy.int64)]
+  dim = coords.shape[2]
+  gradients, valid = _BarycentricGradients(coords)
+
+  ratios = numpy.empty(coords.shape[0])
+  ratios[~valid] = numpy.inf
+
+  # The inradius is 1 / sum_i |grad lambda_i|
+  inradii = 1.0 / numpy.sqrt((gradients[valid] ** 2).sum(axis = 2)).sum(axis = 1)
+  # The circumcentre c (relative to node 0) satisfies vectors c = |vectors|^2 / 2
+  vectors = coords[valid, 1:] - coords[valid, :1]
+  centres = numpy.einsum("nji,nj->ni", gradients[valid, 1:], 0.5 * (vectors * vectors).sum(axis = 2))
+  circumradii = numpy.sqrt((centres * centres).sum(axis = 1))
+  ratios[valid] = circumradii / (dim * inradii)
+
+  return ratios
+
+def DihedralAngles(nodeCoords, elementNodes):
+  """
+  Return the dihedral angles (in radians) of each of the supplied simplices,
+  as an (elements x facet pairs) array. For triangles these are the interior
+  angles. Angles of degenerate simplices are NaN.
+  """
+
+  coords = numpy.asarray(nodeCoords, dtype = float)[numpy.asarray(elementNodes, dtype = numpy.int64)]
+  gradients, valid = _BarycentricGradients(coords)
+
+  # Barycentric gradients are inward facet normals, and the dihedral angle
+  # between facets i and j has cosine -n_i . n_j
+  normals = gradients / numpy.sqrt((gradients * gradients).sum(axis = 2))[:, :, numpy.newaxis]
+  pairs = _ElementNodePairs(coords.shape[1])
+  cosines = -(normals[:, pairs[:, 0]] * normals[:, pairs[:, 1]]).sum(axis = 2)
+
+  with numpy.errstate(invalid = "ignore"):
+    return numpy.arccos(numpy.clip(cosines, -1.0, 1.0))
+
+def BoundaryNodes(offsets, nodes, nodeCount):
+  """
+  Return a mask of the nodes lying on the boundary of the supplied CSR
+  element-node connectivity, where boundary faces are those owned by a single
+  element. Assumes linear simplex elements.
+  """
+
+  boundary = numpy.zeros(nodeCount, dtype = bool)
+  for owners, faces in adjacency.SimplexFaceKeys(offsets, nodes):
+    order = numpy.lexsort(faces.T[::-1])
+    faces = faces[order]
+    if len(faces) == 0:
+      continue
+    same = numpy.all(faces[1:] == faces[:-1], axis = 1)
+    unique = numpy.ones(len(faces), dtype = bool)
+    unique[1:] &= ~same
+    unique[:-1] &= ~same
+    boundary[faces[unique].flatten()] = True
+
+  return boundary
+
+def BoundaryLockedElements(offsets, nodes, boundaryNodes):
+  """
+  Return a mask of the elements of the supplied CSR element-node connectivity
+  with all nodes on the boundary. boundaryNodes is a node mask or an array of
+  boundary node indices.
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  nodes = numpy.asarray(nodes, dtype = numpy.int64)
+  boundaryNodes = numpy.asarray(boundaryNodes)
+  if not boundaryNodes.dtype == bool:
+    mask = numpy.zeros(max(nodes.max() + 1 if len(nodes) > 0 else 0, boundaryNodes.max() + 1 if len(boundaryNodes) > 0 else 0), dtype = bool)
+    mask[boundaryNodes] = True
+    boundaryNodes = mask
+  if len(offsets) == 1:
+    return numpy.zeros(0, dtype = bool)
+
+  # Count the non-boundary nodes of each element
+  interior = numpy.zeros(len(nodes) + 1, dtype = numpy.int64)
+  numpy.cumsum(~boundaryNodes[nodes], out = interior[1:])
+
+  return interior[offsets[1:]] == interior[offsets[:-1]]
+
+def MeshQuality(mesh, quantities = QUALITY_QUANTITIES):
+  """
+  Return a dictionary of quality measure arrays for the volume elements of the
+  supplied mesh, which must contain linear simplices. quantities is a list of
+  entries in QUALITY_QUANTITIES. DihedralAngle values are in degrees.
+  """
+
+  for quantity in quantities:
+    if not quantity in QUALITY_QUANTITIES:
+      raise Exception("Unrecognised quality quantity: " + str(quantity))
+
+  nodeCoords = mesh.GetNodeCoordsArray()
+  elementNodes = mesh.GetVolumeElementNodesArray()
+  offsets, nodes = adjacency.FixedLocCsr(elementNodes)
+
+  quality = {}
+  if "EdgeLength" in quantities:
+    quality["EdgeLength"] = EdgeLengths(nodeCoords, Edges(offsets, nodes, mesh.NodeCount()))
+  if len(elementNodes) == 0:
+    for quantity in quantities:
+      if not quantity in quality:
+        quality[quantity] = numpy.zeros(0)
+    return quality
+
+  if "EdgeRatio" in quantities:
+    quality["EdgeRatio"] = EdgeRatios(nodeCoords, elementNodes)
+  if "AspectRatio" in quantities:
+    quality["AspectRatio"] = AspectRatios(nodeCoords, elementNodes)
+  if "DihedralAngle" in quantities:
+    quality["DihedralAngle"] = numpy.degrees(DihedralAngles(nodeCoords, elementNodes).flatten())
+  if "Volume" in quantities:
+    quality["Volume"] = Volumes(nodeCoords, elementNodes)
+  if "BoundaryLocked" in quantities:
+    quality["BoundaryLocked"] = BoundaryLockedElements(offsets, nodes, BoundaryNodes(offsets, nodes, mesh.NodeCount())).astype(float)
+
+  return quality
+
+def VtuQuality(vtu, quantities = QUALITY_QUANTITIES):
+  """
+  Return a dictionary of quality measure arrays for the supplied vtu (see
+  MeshQuality)
+  """
+
+  return MeshQuality(meshes.VtuToMesh(vtu, arrayBacked = True), quantities = quantities)
+
+def HistogramSummary(values, bins = 10, valueRange = None):
+  """
+  Return a dictionary summarising the supplied values, with entries "count",
+  "min", "max", "mean", "counts", "edges" and "outside". Non-finite values are
+  excluded. bins is the number of bins, or an array of bin edges. If bins is a
+  number of bins, the edges span valueRange if supplied, and the range of the
+  values otherwise. "outside" is the number of values outside the bin edges,
+  which are included in the count, min, max and mean but not in the bin counts.
+  """
+
+  values = numpy.asarray(values, dtype = float).flatten()
+  values = values[numpy.isfinite(values)]
+
+  if len(values) == 0:
+    if numpy.isscalar(bins):
+      if valueRange is None:
+        valueRange = (0.0, 1.0)
+      edges = numpy.linspace(valueRange[0], valueRange[1], bins + 1)
+    else:
+      edges = numpy.asarray(bins, dtype = float)
+    return {"count":0, "min":numpy.nan, "max":numpy.nan, "mean":numpy.nan, "counts":numpy.zeros(len(edges) - 1, dtype = numpy.int64), "edges":edges, "outside":0}
+
+  if numpy.isscalar(bins):
+    counts, edges = numpy.histogram(values, bins = bins, range = valueRange)
+  else:
+    counts, edges = numpy.histogram(values, bins = bins)
+
+  return {"count":len(values), "min":values.min(), "max":values.max(), "mean":values.mean(), "counts":counts, "edges":edges, "outside":len(values) - int(counts.sum())}
+
+def VtuTime(vtu, timeFieldName = "Time"):
+  """
+  Return the time of the supplied vtu, read from the field timeFieldName, or
+  the unique field whose name ends with timeFieldName. Returns None if there is
+  no such field.
+  """
+
+  fieldNames = vtu.GetFieldNames()
+  if not timeFieldName in fieldNames:
+    fieldNames = [fieldName for fieldName in fieldNames if fieldName.endswith(timeFieldName)]
+    if len(fieldNames) == 0:
+      return None
+    elif len(fieldNames) > 1:
+      raise Exception("Found multiple time fields: " + str(fieldNames))
+    timeFieldName = fieldNames[0]
+
+  return float(vtu.GetScalarField(timeFieldName)[0])
+
+def DumpSeriesQuality(filenames, quantities = QUALITY_QUANTITIES, bins = 10, timeFieldName = "Time", ranges = None):
+  """
+  Generator yielding a (filename, time, summaries) tuple for each of the
+  supplied vtu or pvtu dumps, where summaries maps each quality quantity to its
+  HistogramSummary. Dumps are read one at a time. bins is the number of bins or
+  an array of bin edges, or a dictionary of these for each quantity. The bin
+  edges of each quantity are common to all dumps, so that histograms can be
+  compared over the series. Where a number of bins is supplied, the edges span
+  ranges, a (min, max) pair or a dictionary of these for each quantity, if
+  supplied, and otherwise the range of the values in the first dump with any
+  (finite) values.
+  """
+
+  edges = {}
+  for filename in filenames:
+    debug.dprint("Evaluating mesh quality for " + filename)
+    vtu = vtktools.vtu(filename)
+    time = VtuTime(vtu, timeFieldName = timeFieldName)
+    quality = VtuQuality(vtu, quantities = quantities)
+    del vtu
+
+    summaries = {}
+    for quantity in quantities:
+      if quantity in edges:
+        summaries[quantity] = HistogramSummary(quality[quantity], bins = edges[quantity])
+        continue
+        
+      if isinstance(bins, dict):
+        quantityBins = bins[quantity]
+      else:
+        quantityBins = bins
+      if isinstance(ranges, dict):
+        quantityRange = ranges.get(quantity, None)
+      else:
+        quantityRange = ranges
+      summary = HistogramSummary(quality[quantity], bins = quantityBins, valueRange = quantityRange)
+      if not numpy.isscalar(quantityBins) or not quantityRange is None or summary["count"] > 0:
+        edges[quantity] = summary["edges"]
+      summaries[quantity] = summary
+
+    yield filename, time, summaries
+
+def WriteQualityHistograms(series, filename):
+  """
+  Write histogram summaries, as yielded by DumpSeriesQuality, to a text file.
+  Each line contains the filename, time, quantity, value count, minimum,
+  maximum and mean, the number of values outside the bin edges, the number of
+  bins, the bin edges and the bin counts. Lines are written as each dump is
+  processed.
+  """
+
+  fileHandle = open(filename, "w")
+  fileHandle.write("# filename time quantity count min max mean outside nbins edges[nbins + 1] counts[nbins]\n")
+  for dumpFilename, time, summaries in series:
+    for quantity in sorted(summaries.keys()):
+      summary = summaries[quantity]
+      fields = [dumpFilename, repr(time), quantity, str(summary["count"]), repr(float(summary["min"])), repr(float(summary["max"])), repr(float(summary["mean"])), str(summary["outside"]), str(len(summary["counts"]))]
+      fields += [repr(float(edge)) for edge in summary["edges"]]
+      fields += [str(count) for count in summary["counts"]]
+      fileHandle.write(" ".join(fields) + "\n")
+    fileHandle.flush()
+  fileHandle.close()
+
+  return
+
+class mesh_qualityUnittests(unittest.TestCase):
+  def testEdges(self):
+    offsets, nodes = adjacency.FixedLocCsr([[0, 1, 2], [1, 3, 2]])
+    edges = Edges(offsets, nodes, 4)
+    self.assertEquals(edges.tolist(), [[0, 1], [0, 2], [1, 2], [1, 3], [2, 3]])
+    lengths = EdgeLengths([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]], edges)
+    self.assertTrue(numpy.allclose(lengths, [1.0, 1.0, math.sqrt(2.0), 1.0, 1.0]))
+
+    return
+
+  def testSimplexMeasures(self):
+    nodeCoords = [[0.0, 0.0], [1.0, 0.0], [0.5, math.sqrt(3.0) / 2.0], [0.0, 1.0], [2.0, 0.0]]
+    elementNodes = [[0, 1, 2], [0, 1, 3], [0, 1, 4]]
+    self.assertTrue(numpy.allclose(EdgeRatios(nodeCoords, elementNodes)[:2], [1.0, math.sqrt(2.0)]))
+    self.assertTrue(numpy.allclose(Volumes(nodeCoords, elementNodes), [math.sqrt(3.0) / 4.0, 0.5, 0.0]))
+
+    ratios = AspectRatios(nodeCoords, elementNodes)
+    self.assertAlmostEquals(ratios[0], 1.0)
+    # Right isosceles triangle: R = sqrt(2) / 2, r = 1 - sqrt(2) / 2
+    self.assertAlmostEquals(ratios[1], (math.sqrt(2.0) / 2.0) / (2.0 * (1.0 - math.sqrt(2.0) / 2.0)))
+    self.assertEquals(ratios[2], numpy.inf)
+
+    angles = numpy.degrees(DihedralAngles(nodeCoords, elementNodes))
+    self.assertTrue(numpy.allclose(angles[0], 60.0))
+    self.assertTrue(numpy.allclose(sorted(angles[1]), [45.0, 45.0, 90.0]))
+    self.assertTrue(numpy.isnan(angles[2]).all())
+
+    # Regular tetrahedron
+    nodeCoords = [[1.0, 1.0, 1.0], [1.0, -1.0, -1.0], [-1.0, 1.0, -1.0], [-1.0, -1.0, 1.0]]
+    self.assertAlmostEquals(AspectRatios(nodeCoords, [[0, 1, 2, 3]])[0], 1.0)
+    self.assertTrue(numpy.allclose(DihedralAngles(nodeCoords, [[0, 1, 2, 3]]), math.acos(1.0 / 3.0)))
+
+    return
+
+  def testBoundaryLockedElements(self):
+    # A fan of four triangles about a central node, plus a corner triangle
+    offsets, nodes = adjacency.FixedLocCsr([[0, 1, 4], [1, 2, 4], [2, 3, 4], [3, 0, 4], [1, 5, 2]])
+    boundary = BoundaryNodes(offsets, nodes, 6)
+    self.assertEquals(boundary.tolist(), [True, True, True, True, False, True])
+    self.assertEquals(BoundaryLockedElements(offsets, nodes, boundary).tolist(), [False, False, False, False, True])
+    self.assertEquals(BoundaryLockedElements(offsets, nodes, [1, 2, 4]).tolist(), [False, True, False, False, False])
+
+    return
+
+  def testMeshQuality(self):
+    mesh = meshes.Mesh(2, arrayBacked = True)
+    mesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2]])
+    quality = MeshQuality(mesh)
+    self.assertEquals(sorted(quality.keys()), sorted(QUALITY_QUANTITIES))
+    self.assertEquals(len(quality["EdgeLength"]), 5)
+    self.assertEquals(len(quality["DihedralAngle"]), 6)
+    self.assertEquals(quality["BoundaryLocked"].tolist(), [1.0, 1.0])
+    self.assertRaises(Exception, MeshQuality, mesh, ["Skewness"])
+
+    summary = HistogramSummary(quality["EdgeLength"], bins = 2)
+    self.assertEquals(summary["count"], 5)
+    self.assertEquals(summary["counts"].tolist(), [4, 1])
+    self.assertAlmostEquals(summary["max"], math.sqrt(2.0))
+    self.assertEquals(HistogramSummary([numpy.nan], bins = [0.0, 1.0])["count"], 0)
+
+    return
+
+  def testDumpSeriesQuality(self):
+    tempDir = tempfile.mkdtemp()
+    filenames = []
+    for i, scale in enumerate([1.0, 2.0]):
+      mesh = meshes.Mesh(2, arrayBacked = True)
+      mesh.AddNodeCoordsArray(scale * numpy.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]]))
+      mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2]])
+      vtu = mesh.ToVtu(includeSurface = False)
+      vtu.AddScalarField("ElapsedTime", numpy.array([0.5 * i] * 4))
+      filenames.append(os.path.join(tempDir, "dump_" + str(i) + ".vtu"))
+      vtu.Write(filenames[-1])
+    self.assertEquals(VtuTime(vtktools.vtu(filenames[1])), 0.5)
+    self.assertEquals(VtuTime(vtktools.vtu(filenames[1]), timeFieldName = "Temperature"), None)
+    
+    # Bin edges are fixed by the first dump
+    series = list(DumpSeriesQuality(iter(filenames), quantities = ["EdgeLength"], bins = 2))
+    self.assertEquals([entry[0] for entry in series], filenames)
+    self.assertEquals([entry[1] for entry in series], [0.0, 0.5])
+    summaries = [entry[2]["EdgeLength"] for entry in series]
+    self.assertEquals(summaries[1]["edges"].tolist(), summaries[0]["edges"].tolist())
+    self.assertEquals(summaries[0]["counts"].tolist(), [4, 1])
+    self.assertEquals(summaries[1]["counts"].tolist(), [0, 0])
+    self.assertEquals(summaries[1]["count"], 5)
+    self.assertEquals(summaries[1]["outside"], 5)
+    
+    # Bin edges spanning a supplied range
+    series = list(DumpSeriesQuality(filenames, quantities = ["EdgeLength"], bins = 3, ranges = (0.0, 3.0)))
+    self.assertEquals(series[0][2]["EdgeLength"]["counts"].tolist(), [0, 5, 0])
+    self.assertEquals(series[1][2]["EdgeLength"]["counts"].tolist(), [0, 0, 5])
+    self.assertEquals(series[1][2]["EdgeLength"]["outside"], 0)
+    
+    logFilename = os.path.join(tempDir, "histograms.log")
+    WriteQualityHistograms(DumpSeriesQuality(filenames, quantities = ["EdgeLength"], bins = 3, ranges = (0.0, 3.0)), logFilename)
+    lines = [line.split() for line in open(logFilename) if not line.startswith("#")]
+    shutil.rmtree(tempDir)
+    self.assertEquals([line[0] for line in lines], filenames)
+    self.assertEquals([float(line[1]) for line in lines], [0.0, 0.5])
+    self.assertEquals(lines[1][2:4], ["EdgeLength", "5"])
+    self.assertEquals(lines[1][7:9], ["0", "3"])
+    self.assertEquals([float(edge) for edge in lines[1][9:13]], [0.0, 1.0, 2.0, 3.0])
+    self.assertEquals(lines[1][13:], ["0", "0", "5"])
+
+    return
@@ -27,6 +27,7 @@ try:
 except:
   debug.deprint("Warning: Failed to import numpy module")
 
+import fluidity.diagnostics.adjacency as adjacency
 import fluidity.diagnostics.bounds as bounds
 import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.elements as elements
@@ -40,23 +41,40 @@ try:
   import vtk
 except ImportError:
   debug.deprint("Warning: Failed to import vtk module")
+try:
+  from vtk.util import numpy_support
+except ImportError:
+  debug.deprint("Warning: Failed to import vtk.util.numpy_support module")
         
 class Mesh(events.Evented):
   """
   A mesh. Consists of nodes (with coordinates), volume elements and surface
   elements. Has a defined dimension. Nodes are indexed from zero.
+  
+  If arrayBacked is True, node coordinates are stored in a (nodes x dim)
+  array, and volume and surface elements are each stored in an
+  elements.ElementBlock (so all volume elements, and all surface elements,
+  must have the same node count). Elements are then accessed via
+  elements.ElementView objects.
   """
 
-  def __init__(self, dim, nodeCoords = [], volumeElements = [], surfaceElements = [], halos = None):
+  def __init__(self, dim, nodeCoords = [], volumeElements = [], surfaceElements = [], halos = None, arrayBacked = False):
     events.Evented.__init__(self, ["nodesAdded"])
   
     assert(dim >= 0)
   
-    self._nodeCoords = []
-    self._volumeElements = []
-    self._surfaceElements = []
-  
     self._dim = dim
+    self._arrayBacked = arrayBacked
+    
+    if arrayBacked:
+      self._nodeCoords = numpy.empty((0, dim))
+      self._nodeCount = 0
+      self._volumeElements = None
+      self._surfaceElements = None
+    else:
+      self._nodeCoords = []
+      self._volumeElements = []
+      self._surfaceElements = []
     
     for nodeCoord in nodeCoords:
       self.AddNodeCoord(nodeCoord)
@@ -77,16 +95,25 @@ class Mesh(events.Evented):
     
   def GetDim(self):
     return self._dim
+    
+  def IsArrayBacked(self):
+    return self._arrayBacked
         
   def NodeCount(self):
-    return len(self._nodeCoords)
+    if self._arrayBacked:
+      return self._nodeCount
+    else:
+      return len(self._nodeCoords)
     
   def NodeCoordsCount(self):
     return self.NodeCount()
     
   def GetNodeCoords(self, indices = None):
     if indices is None:
-      return self._nodeCoords
+      if self._arrayBacked:
+        return self._nodeCoords[:self._nodeCount]
+      else:
+        return self._nodeCoords
     else:
       coords = []
       for index in indices:
@@ -95,27 +122,73 @@ class Mesh(events.Evented):
       return coords
     
   def GetNodeCoord(self, index):
-    return self._nodeCoords[index]
+    return self.GetNodeCoords()[index]
 
   def SetNodeCoord(self, index, nodeCoord):
     assert(len(nodeCoord) == self._dim)
-    self._nodeCoords[index] = nodeCoord
+    self.GetNodeCoords()[index] = nodeCoord
 
     return
     
   def AddNodeCoord(self, nodeCoord):
     assert(len(nodeCoord) == self._dim)
-    self._nodeCoords.append(nodeCoord)
+    if self._arrayBacked:
+      self._AddNodeCoordsArray([nodeCoord])
+    else:
+      self._nodeCoords.append(nodeCoord)
     
     self._RaiseEvent("nodesAdded")
     
     return
     
   def AddNodeCoords(self, nodeCoords):
-    for nodeCoord in nodeCoords:
-      self.AddNodeCoord(nodeCoord)
+    if self._arrayBacked:
+      self.AddNodeCoordsArray(nodeCoords)
+    else:
+      for nodeCoord in nodeCoords:
+        self.AddNodeCoord(nodeCoord)
           
     return
+    
+  def _AddNodeCoordsArray(self, nodeCoords):
+    nodeCoords = numpy.asarray(nodeCoords, dtype = float)
+    nodeCoords = nodeCoords.reshape((nodeCoords.size // max(self._dim, 1), self._dim))
+    
+    count = self._nodeCount + nodeCoords.shape[0]
+    if count > self._nodeCoords.shape[0]:
+      # Grow geometrically
+      newNodeCoords = numpy.empty((max(count, 2 * self._nodeCoords.shape[0]), self._dim))
+      newNodeCoords[:self._nodeCount] = self._nodeCoords[:self._nodeCount]
+      self._nodeCoords = newNodeCoords
+    self._nodeCoords[self._nodeCount:count] = nodeCoords
+    self._nodeCount = count
+    
+    return
+    
+  def AddNodeCoordsArray(self, nodeCoords):
+    """
+    Add node coordinates, given as a (nodes x dim) array
+    """
+    
+    if self._arrayBacked:
+      self._AddNodeCoordsArray(nodeCoords)
+      self._RaiseEvent("nodesAdded")
+    else:
+      for nodeCoord in numpy.asarray(nodeCoords, dtype = float):
+        self.AddNodeCoord(nodeCoord)
+        
+    return
+    
+  def GetNodeCoordsArray(self):
+    """
+    Return the node coordinates as a (nodes x dim) array. This is a view of the
+    mesh data for array backed meshes, and a copy otherwise.
+    """
+    
+    if self._arrayBacked:
+      return self.GetNodeCoords()
+    else:
+      return numpy.array(self._nodeCoords, dtype = float).reshape((self.NodeCount(), self._dim))
 
   def RemapNodeCoords(self, Map):
     for i, nodeCoord in enumerate(self.GetNodeCoords()):
@@ -123,20 +196,66 @@ class Mesh(events.Evented):
 
     return
     
+  def RemapNodeCoordsArray(self, Map):
+    """
+    Remap the node coordinates, where Map is applied to the (nodes x dim) array
+    of all node coordinates (e.g. annulus_mesh.Remapper.MapArray)
+    """
+    
+    nodeCoords = numpy.asarray(Map(self.GetNodeCoordsArray()), dtype = float)
+    assert(nodeCoords.shape == (self.NodeCount(), self._dim))
+    if self._arrayBacked:
+      self._nodeCoords[:self._nodeCount] = nodeCoords
+    else:
+      self._nodeCoords = nodeCoords.tolist()
+
+    return
+    
   def _RemoveNodeCoordByIndex(self, index):
-    del self._nodeCoords[index]
+    if self._arrayBacked:
+      if index < 0:
+        index += self._nodeCount
+      self._nodeCoords[index:self._nodeCount - 1] = self._nodeCoords[index + 1:self._nodeCount]
+      self._nodeCount -= 1
+    else:
+      del self._nodeCoords[index]
     
   def ValidNode(self, node):
     return node >= 0 and node<= self.NodeCoordsCount() - 1
     
+  def _ElementBlock(self, block, nodeCount, dim):
+    """
+    Return the supplied element block, creating it if it does not exist
+    """
+    
+    if block is None:
+      block = elements.ElementBlock(nodeCount, dim = dim)
+    elif not block.GetNodeCount() == nodeCount:
+      raise Exception("Array backed meshes do not support mixed element types")
+    
+    return block
+    
   def VolumeElementCount(self):
-    return len(self._volumeElements)
+    if self._arrayBacked:
+      if self._volumeElements is None:
+        return 0
+      return self._volumeElements.Count()
+    else:
+      return len(self._volumeElements)
     
   def GetVolumeElements(self):
-    return self._volumeElements
+    if self._arrayBacked:
+      if self._volumeElements is None:
+        return []
+      return self._volumeElements.GetElements()
+    else:
+      return self._volumeElements
     
   def GetVolumeElement(self, index):
-    return self._volumeElements[index]
+    if self._arrayBacked:
+      return self._volumeElements.GetElement(index)
+    else:
+      return self._volumeElements[index]
     
   def AddVolumeElement(self, element):
     if optimise.DebuggingEnabled():
@@ -144,7 +263,11 @@ class Mesh(events.Evented):
         assert(self.ValidNode(node))
         
     element.SetDim(self.GetDim())
-    self._volumeElements.append(element)
+    if self._arrayBacked:
+      self._volumeElements = self._ElementBlock(self._volumeElements, element.NodeCount(), self.GetDim())
+      self._volumeElements.AddElement(element.GetNodes(), element.GetIds())
+    else:
+      self._volumeElements.append(element)
     
     return
     
@@ -154,19 +277,135 @@ class Mesh(events.Evented):
     
     return
     
+  def AddVolumeElementsArray(self, nodes, ids = None):
+    """
+    Add volume elements, with nodes given as an (elements x nodes per element)
+    array and IDs (optionally) as a scalar, an (elements,) or an (elements x IDs)
+    array
+    """
+    
+    if self._arrayBacked:
+      nodes = numpy.asarray(nodes, dtype = numpy.int64)
+      self._volumeElements = self._ElementBlock(self._volumeElements, nodes.shape[1], self.GetDim())
+      self._volumeElements.AddElements(nodes, ids = ids)
+    else:
+      self.AddVolumeElements(elements.ElementBlock(numpy.shape(nodes)[1], nodes = nodes, ids = ids).GetElements())
+    
+    return
+    
+  def _ElementNodesArray(self, elementStore, dim):
+    if self._arrayBacked:
+      if elementStore is None:
+        return numpy.empty((0, 0), dtype = numpy.int64)
+      return elementStore.GetNodesArray()
+    elif len(elementStore) == 0:
+      return numpy.empty((0, 0), dtype = numpy.int64)
+    else:
+      nodes = numpy.array([element.GetNodes() for element in elementStore], dtype = numpy.int64)
+      if not len(nodes.shape) == 2:
+        raise Exception("Mixed element types cannot be stored in a single array")
+      return nodes
+      
+  def _ElementIdsArray(self, elementStore):
+    if self._arrayBacked:
+      if elementStore is None:
+        return numpy.empty((0, 0), dtype = numpy.int64)
+      if elementStore.FixedIdCount() is None:
+        raise Exception("Elements have differing numbers of IDs")
+      return elementStore.GetIdsArray()
+    elif len(elementStore) == 0:
+      return numpy.empty((0, 0), dtype = numpy.int64)
+    else:
+      ids = numpy.array([element.GetIds() for element in elementStore], dtype = numpy.int64)
+      if not len(ids.shape) == 2:
+        raise Exception("Elements have differing numbers of IDs")
+      return ids
+      
+  def _ElementArrayBlocks(self, elementStore):
+    if self._arrayBacked:
+      if elementStore is None:
+        return []
+      nodes = elementStore.GetNodesArray()
+      ids = elementStore.GetIdsArray()
+      idCounts = elementStore.GetIdCounts()
+      blocks = []
+      for idCount in numpy.unique(idCounts):
+        mask = idCounts == idCount
+        if mask.all():
+          blocks.append((nodes, ids[:, :idCount]))
+        else:
+          blocks.append((nodes[mask], ids[mask, :idCount]))
+      return blocks
+    else:
+      blockElements = {}
+      keys = []
+      for element in elementStore:
+        key = (element.NodeCount(), len(element.GetIds()))
+        if key in blockElements:
+          blockElements[key].append(element)
+        else:
+          blockElements[key] = [element]
+          keys.append(key)
+      return [(numpy.array([element.GetNodes() for element in blockElements[key]], dtype = numpy.int64).reshape((len(blockElements[key]), key[0])), \
+               numpy.array([element.GetIds() for element in blockElements[key]], dtype = numpy.int64).reshape((len(blockElements[key]), key[1]))) for key in keys]
+               
+  def GetVolumeElementArrayBlocks(self):
+    """
+    Return the volume elements as a list of (nodes, IDs) array pairs, one per
+    combination of element node count and number of IDs
+    """
+    
+    return self._ElementArrayBlocks(self._volumeElements)
+    
+  def GetVolumeElementBlock(self):
+    """
+    Return the elements.ElementBlock storing the volume elements of an array
+    backed mesh, or None if there are no volume elements
+    """
+    
+    assert(self._arrayBacked)
+    
+    return self._volumeElements
+    
+  def GetVolumeElementNodesArray(self):
+    """
+    Return the volume element nodes as an (elements x nodes per element) array.
+    This is a view of the mesh data for array backed meshes, and a copy
+    otherwise.
+    """
+    
+    return self._ElementNodesArray(self._volumeElements, self.GetDim())
+    
+  def GetVolumeElementIdsArray(self):
+    """
+    Return the volume element IDs as an (elements x IDs) array
+    """
+    
+    return self._ElementIdsArray(self._volumeElements)
+    
   def RemoveVolumeElement(self, element):
-    self._volumeElements.remove(element)
+    if self._arrayBacked:
+      assert(isinstance(element, elements.ElementView) and element.GetBlock() is self._volumeElements)
+      # Raises if the view is stale
+      self._volumeElements.RemoveElementByIndex(element.GetIndex())
+    else:
+      self._volumeElements.remove(element)
     
     return
     
   def RemoveVolumeElementByIndex(self, index):
-    del self._volumeElements[index]
+    if self._arrayBacked:
+      self._volumeElements.RemoveElementByIndex(index)
+    else:
+      del self._volumeElements[index]
     
     return
     
   def MixedVolumeElements(self):
     if(self.VolumeElementCount() == 0):
       return False
+    elif self._arrayBacked:
+      return False
       
     nnode = self.GetVolumeElement(0).NodeCount()
     for element in self.GetVolumeElements()[1:]:
@@ -178,6 +417,8 @@ class Mesh(events.Evented):
   def VolumeElementFixedNodeCount(self):
     if self.VolumeElementCount() == 0:
       return 0
+    elif self._arrayBacked:
+      return self._volumeElements.GetNodeCount()
   
     nnode = self.GetVolumeElement(0).NodeCount()
     if optimise.DebuggingEnabled():
@@ -187,13 +428,26 @@ class Mesh(events.Evented):
     return nnode
     
   def SurfaceElementCount(self):
-    return len(self._surfaceElements)
+    if self._arrayBacked:
+      if self._surfaceElements is None:
+        return 0
+      return self._surfaceElements.Count()
+    else:
+      return len(self._surfaceElements)
     
   def GetSurfaceElements(self):
-    return self._surfaceElements
+    if self._arrayBacked:
+      if self._surfaceElements is None:
+        return []
+      return self._surfaceElements.GetElements()
+    else:
+      return self._surfaceElements
     
   def GetSurfaceElement(self, index):
-    return self._surfaceElements[index]
+    if self._arrayBacked:
+      return self._surfaceElements.GetElement(index)
+    else:
+      return self._surfaceElements[index]
     
   def AddSurfaceElement(self, element):
     if optimise.DebuggingEnabled():
@@ -201,7 +455,11 @@ class Mesh(events.Evented):
         assert(self.ValidNode(node))
         
     element.SetDim(self.GetDim() - 1)
-    self._surfaceElements.append(element)
+    if self._arrayBacked:
+      self._surfaceElements = self._ElementBlock(self._surfaceElements, element.NodeCount(), self.GetDim() - 1)
+      self._surfaceElements.AddElement(element.GetNodes(), element.GetIds())
+    else:
+      self._surfaceElements.append(element)
     
     return  
   
@@ -211,13 +469,71 @@ class Mesh(events.Evented):
     
     return
     
+  def AddSurfaceElementsArray(self, nodes, ids = None):
+    """
+    Add surface elements, with nodes given as an (elements x nodes per element)
+    array and IDs (optionally) as a scalar, an (elements,) or an (elements x IDs)
+    array
+    """
+    
+    if self._arrayBacked:
+      nodes = numpy.asarray(nodes, dtype = numpy.int64)
+      self._surfaceElements = self._ElementBlock(self._surfaceElements, nodes.shape[1], self.GetDim() - 1)
+      self._surfaceElements.AddElements(nodes, ids = ids)
+    else:
+      self.AddSurfaceElements(elements.ElementBlock(numpy.shape(nodes)[1], nodes = nodes, ids = ids).GetElements())
+    
+    return
+    
+  def GetSurfaceElementNodesArray(self):
+    """
+    Return the surface element nodes as an (elements x nodes per element)
+    array. This is a view of the mesh data for array backed meshes, and a copy
+    otherwise.
+    """
+    
+    return self._ElementNodesArray(self._surfaceElements, self.GetDim() - 1)
+    
+  def GetSurfaceElementIdsArray(self):
+    """
+    Return the surface element IDs as an (elements x IDs) array
+    """
+    
+    return self._ElementIdsArray(self._surfaceElements)
+    
+  def GetSurfaceElementArrayBlocks(self):
+    """
+    Return the surface elements as a list of (nodes, IDs) array pairs, one per
+    combination of element node count and number of IDs
+    """
+    
+    return self._ElementArrayBlocks(self._surfaceElements)
+    
+  def GetSurfaceElementBlock(self):
+    """
+    Return the elements.ElementBlock storing the surface elements of an array
+    backed mesh, or None if there are no surface elements
+    """
+    
+    assert(self._arrayBacked)
+    
+    return self._surfaceElements
+    
   def RemoveSurfaceElement(self, element):
-    self._surfaceElements.remove(element)
+    if self._arrayBacked:
+      assert(isinstance(element, elements.ElementView) and element.GetBlock() is self._surfaceElements)
+      # Raises if the view is stale
+      self._surfaceElements.RemoveElementByIndex(element.GetIndex())
+    else:
+      self._surfaceElements.remove(element)
     
     return
     
   def RemoveSurfaceElementByIndex(self, index):
-    del self._surfaceElements[index]
+    if self._arrayBacked:
+      self._surfaceElements.RemoveElementByIndex(index)
+    else:
+      del self._surfaceElements[index]
     
     return
     
@@ -242,6 +558,8 @@ class Mesh(events.Evented):
   def MixedSurfaceElements(self):
     if(self.SurfaceElementCount() == 0):
       return False
+    elif self._arrayBacked:
+      return False
       
     nnode = self.GetSurfaceElement(0).NodeCount()
     for element in self.GetSurfaceElements()[1:]:
@@ -253,6 +571,8 @@ class Mesh(events.Evented):
   def SurfaceElementFixedNodeCount(self):
     if self.SurfaceElementCount() == 0:
       return 0
+    elif self._arrayBacked:
+      return self._surfaceElements.GetNodeCount()
   
     nnode = self.GetSurfaceElement(0).NodeCount()
     if optimise.DebuggingEnabled():
@@ -262,6 +582,12 @@ class Mesh(events.Evented):
     return nnode
     
   def BoundingBox(self):
+    if self._arrayBacked:
+      if self.NodeCount() == 0:
+        return bounds.BoundingBox([calc.Inf() for i in range(self.GetDim())], [-calc.Inf() for i in range(self.GetDim())])
+      nodeCoords = self.GetNodeCoords()
+      return bounds.BoundingBox(nodeCoords.min(axis = 0).tolist(), nodeCoords.max(axis = 0).tolist())
+  
     lbound = [calc.Inf() for i in range(self.GetDim())]
     ubound = [-calc.Inf() for i in range(self.GetDim())]
     for nodeCoord in self.GetNodeCoords():
@@ -273,9 +599,59 @@ class Mesh(events.Evented):
           
     return bounds.BoundingBox(lbound, ubound)
     
+  def _ToVtuArrays(self, includeSurface, includeVolume, idsName):
+    dim = self.GetDim()
+    
+    coords = numpy.zeros((self.NodeCount(), 3))
+    coords[:, :dim] = self.GetNodeCoords()
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    points.SetData(numpy_support.numpy_to_vtk(coords, deep = 1))
+    
+    vtu = vtktools.vtu()
+    vtu.ugrid.SetPoints(points)
+    
+    if includeSurface or includeVolume:
+      blocks = []
+      if includeSurface and not self._surfaceElements is None:
+        blocks.append(self._surfaceElements)
+      if includeVolume and not self._volumeElements is None:
+        blocks.append(self._volumeElements)
+      
+      cellTypes = []
+      cellNodes = []
+      cellIds = []
+      for block in blocks:
+        type = vtktools.VtkType(dim = block.GetDim(), nodeCount = block.GetNodeCount())
+        permutation = vtktools.ToVtkNodeOrder(range(block.GetNodeCount()), type)
+        cellTypes.append(numpy.repeat(type.GetVtkTypeId(), block.Count()))
+        cellNodes.append(block.GetNodesArray()[:, permutation].ravel())
+        # Add just the first ID
+        ids = numpy.where(block.GetIdCounts() > 0, block.GetIdsArray()[:, 0] if block.GetIdsArray().shape[1] > 0 else 0, 0)
+        cellIds.append(ids.astype(float))
+      
+      if len(blocks) > 0:
+        counts = numpy.concatenate([numpy.repeat(block.GetNodeCount(), block.Count()) for block in blocks])
+        offsets = numpy.zeros(len(counts) + 1, dtype = numpy.int64)
+        numpy.cumsum(counts, out = offsets[1:])
+        vtktools.VtuSetCells(vtu, numpy.concatenate(cellTypes), offsets, numpy.concatenate(cellNodes))
+        cellIds = numpy.concatenate(cellIds)
+      else:
+        cellIds = numpy.empty(0)
+      
+      # Add the boundary and/or region IDs
+      cellData = numpy_support.numpy_to_vtk(cellIds, deep = 1, array_type = vtk.VTK_DOUBLE)
+      cellData.SetName(idsName)
+      vtu.ugrid.GetCellData().AddArray(cellData)
+    
+    return vtu
+    
   def ToVtu(self, includeSurface = True, includeVolume = True, idsName = "IDs"):
     dim = self.GetDim()
     assert(dim <= 3)
+    
+    if self._arrayBacked:
+      return self._ToVtuArrays(includeSurface, includeVolume, idsName)
   
     ugrid = vtk.vtkUnstructuredGrid()
     
@@ -337,57 +713,283 @@ class Mesh(events.Evented):
     
     return vtu
   
-  def NNList(self):
-    nnList = [[] for i in range(self.NodeCoordsCount())]
-    for element in self.GetSurfaceElements() + self.GetVolumeElements():
-      type = element.GetType()
-      assert(type.GetElementFamilyId() == elements.ELEMENT_FAMILY_SIMPLEX and type.GetDegree() == 1)
-      nodes = element.GetNodes()
-      for node in nodes:
-        for cNode in nodes:
-          if not cNode == node:
-            nnList[node].append(cNode)
-    
-    for nList in nnList:
-      utils.StripListDuplicates(nList)
+  def _ElementConnectivity(self, includeSurface = False, includeVolume = True):
+    """
+    Return the element-node connectivity, in compressed sparse row form (see
+    adjacency.py). Surface elements precede volume elements.
+    """
+    
+    offsets = [numpy.zeros(1, dtype = numpy.int64)]
+    nodes = []
+    nodeTotal = 0
+    for include, store in [(includeSurface, self._surfaceElements), (includeVolume, self._volumeElements)]:
+      if not include or store is None:
+        continue
+      elif self._arrayBacked:
+        storeOffsets, storeNodes = adjacency.FixedLocCsr(store.GetNodesArray())
+      else:
+        storeNodes = numpy.array([node for element in store for node in element.GetNodes()], dtype = numpy.int64)
+        storeOffsets = numpy.zeros(len(store) + 1, dtype = numpy.int64)
+        numpy.cumsum([element.NodeCount() for element in store], out = storeOffsets[1:])
+      offsets.append(storeOffsets[1:] + nodeTotal)
+      nodes.append(storeNodes)
+      nodeTotal += len(storeNodes)
       
-    return nnList
-  
-  def NeList(self):
-    neList = [[] for i in range(self.NodeCoordsCount())]
-    for i, element in enumerate(self.GetVolumeElements()):
-      nodes = element.GetNodes()
-      for node in nodes:  
-        if not i in neList[node]:
-          neList[node].append(i)
-        
-    for eList in neList:
-      utils.StripListDuplicates(eList)
+    if len(nodes) == 0:
+      return offsets[0], numpy.zeros(0, dtype = numpy.int64)
+    else:
+      return numpy.concatenate(offsets), numpy.concatenate(nodes)
+    
+  def _AssertLinearSimplices(self):
+    types = set()
+    if self._arrayBacked:
+      for block in [self._surfaceElements, self._volumeElements]:
+        if not block is None:
+          types.add((block.GetDim(), block.GetNodeCount()))
+    else:
+      for element in self.GetSurfaceElements() + self.GetVolumeElements():
+        types.add((element.GetDim(), element.NodeCount()))
+    for dim, nodeCount in types:
+      type = elements.GetElementType(dim, nodeCount)
+      assert(type.GetElementFamilyId() == elements.ELEMENT_FAMILY_SIMPLEX and type.GetDegree() == 1)
       
-    return neList
+    return
   
-  def EeList(self):
-    neList = self.NeList()
+  def NNList(self, sparse = False):
+    """
+    Return the node-node list, in compressed sparse row form (see adjacency.py).
+    If sparse is True, a scipy.sparse.csr_matrix is returned instead.
+    """
+    
+    self._AssertLinearSimplices()
   
-    eeList = [[] for i in range(self.VolumeElementCount())]
-    for i, element in enumerate(self.GetVolumeElements()):
-      nodes = element.GetNodes()
-      for node in nodes:
-        for ele in neList[node]:
-          if not ele == i and not ele in eeList[i]:
-            eeList[i].append(ele)
+    offsets, nodes = self._ElementConnectivity(includeSurface = True)
+    nnList = adjacency.NNList(offsets, nodes, self.NodeCoordsCount())
+    if sparse:
+      return adjacency.CsrToSparse(nnList)
+    else:
+      return nnList
+  
+  def NeList(self, sparse = False):
+    """
+    Return the node-volume element list, in compressed sparse row form (see
+    adjacency.py). If sparse is True, a scipy.sparse.csr_matrix is returned
+    instead.
+    """
+    
+    offsets, nodes = self._ElementConnectivity()
+    neList = adjacency.NeList(offsets, nodes, self.NodeCoordsCount())
+    if sparse:
+      return adjacency.CsrToSparse(neList, nCols = self.VolumeElementCount())
+    else:
+      return neList
+  
+  def EeList(self, sparse = False):
+    """
+    Return the volume element-volume element list, where two elements are
+    adjacent if they share a node, in compressed sparse row form (see
+    adjacency.py). If sparse is True, a scipy.sparse.csr_matrix is returned
+    instead.
+    """
+  
+    offsets, nodes = self._ElementConnectivity()
+    eeList = adjacency.EeList(offsets, nodes, self.NodeCoordsCount())
+    if sparse:
+      return adjacency.CsrToSparse(eeList)
+    else:
+      return eeList
+     
+  def _RenumberableNodeCount(self):
+    """
+    Return the number of leading nodes that may be renumbered. Where the mesh
+    has node halos only owned nodes are renumbered, so that halo receive nodes
+    remain trailing and ordered.
+    """
+    
+    if self.HasHalos() and self.GetHalos().NodeHaloCount() > 0:
+      return self.GetNOwnedNodes()
+    else:
+      return self.NodeCount()
+    
+  def NodeRenumbering(self, method = "rcm"):
+    """
+    Return a node renumbering as an array of node indices in their new order.
+    method is one of:
+      "rcm"     - reverse Cuthill-McKee ordering of the node-node graph
+      "hilbert" - Hilbert curve ordering of the node coordinates
+      "morton"  - Morton (Z-order) curve ordering of the node coordinates
+    """
+    
+    count = self._RenumberableNodeCount()
+    if method == "rcm":
+      offsets, nodes = self._ElementConnectivity(includeSurface = True)
+      nnList = adjacency.RestrictedCsr(adjacency.NNList(offsets, nodes, self.NodeCount()), count)
+      order = adjacency.ReverseCuthillMcKee(nnList)
+    elif method in ["hilbert", "morton"]:
+      coords = self.GetNodeCoordsArray()[:count]
+      if method == "hilbert":
+        keys = HilbertKeys(coords)
+      else:
+        keys = MortonKeys(coords)
+      order = numpy.argsort(keys, kind = "mergesort")
+    else:
+      raise Exception("Unrecognised renumbering method: " + str(method))
+      
+    return numpy.concatenate([order, numpy.arange(count, self.NodeCount(), dtype = numpy.int64)])
+    
+  def _RenumberedElements(self, mesh, elementStore, newNodeIndices, AddElement, AddElementsArray):
+    """
+    Add the supplied elements to mesh, with renumbered nodes and sorted by their
+    minimum new node index. Returns the element order.
+    """
+    
+    if self._arrayBacked:
+      if elementStore is None:
+        return numpy.zeros(0, dtype = numpy.int64)
+      nodes = newNodeIndices[elementStore.GetNodesArray()]
+      order = numpy.argsort(nodes.min(axis = 1), kind = "mergesort")
+      if not elementStore.FixedIdCount() is None:
+        AddElementsArray(nodes[order], ids = elementStore.GetIdsArray()[order, :elementStore.FixedIdCount()])
+        return order
+      ids = [elementStore.GetElementIds(index) for index in order]
+      nodes = nodes[order]
+    else:
+      nodes = [newNodeIndices[element.GetNodes()] for element in elementStore]
+      order = numpy.argsort([elementNodes.min() if len(elementNodes) > 0 else -1 for elementNodes in nodes], kind = "mergesort")
+      ids = [elementStore[index].GetIds() for index in order]
+      nodes = [nodes[index] for index in order]
+      
+    for elementNodes, elementIds in zip(nodes, ids):
+      AddElement(elements.Element(nodes = elementNodes.tolist(), ids = list(elementIds)))
+    
+    return order
+    
+  def Renumbered(self, method = "rcm", nodeOrder = None):
+    """
+    Return a copy of the mesh with nodes renumbered (see NodeRenumbering), or
+    reordered according to nodeOrder if supplied. Volume and surface elements
+    are sorted by their minimum new node index. Halos are renumbered
+    accordingly.
+    """
+    
+    if nodeOrder is None:
+      nodeOrder = self.NodeRenumbering(method = method)
+    nodeOrder = numpy.asarray(nodeOrder, dtype = numpy.int64)
+    assert(nodeOrder.shape == (self.NodeCount(),))
+    newNodeIndices = numpy.empty(self.NodeCount(), dtype = numpy.int64)
+    newNodeIndices[nodeOrder] = numpy.arange(self.NodeCount())
+    
+    mesh = Mesh(self.GetDim(), arrayBacked = self._arrayBacked)
+    mesh.AddNodeCoordsArray(self.GetNodeCoordsArray()[nodeOrder])
+    self._RenumberedElements(mesh, self._surfaceElements, newNodeIndices, mesh.AddSurfaceElement, mesh.AddSurfaceElementsArray)
+    volumeOrder = self._RenumberedElements(mesh, self._volumeElements, newNodeIndices, mesh.AddVolumeElement, mesh.AddVolumeElementsArray)
+    newVolumeIndices = numpy.empty(len(volumeOrder), dtype = numpy.int64)
+    newVolumeIndices[volumeOrder] = numpy.arange(len(volumeOrder))
+    
+    if not self.HasHalos():
+      mesh.SetHalos(None)
+    else:
+      def RenumberedHalo(halo, newIndices):
+        if halo is None:
+          return None
+        nOwnedNodes = None
+        if halo.HasNOwnedNodes():
+          nOwnedNodes = halo.GetNOwnedNodes()
+        return mesh_halos.Halo(halo.GetProcess(), halo.GetNProcesses(), nOwnedNodes = nOwnedNodes, \
+          sends = [newIndices[sends] for sends in halo.GetSends()], receives = [newIndices[receives] for receives in halo.GetReceives()])
+    
+      halos = self.GetHalos()
+      newHalos = mesh_halos.Halos(halos.GetProcess(), halos.GetNProcesses(), nLevels = halos.GetNLevels())
+      for level in halos.NodeHaloLevels():
+        newHalos.SetNodeHalo(level, RenumberedHalo(halos.GetNodeHalo(level), newNodeIndices))
+      for level in halos.ElementHaloLevels():
+        newHalos.SetElementHalo(level, RenumberedHalo(halos.GetElementHalo(level), newVolumeIndices))
+      mesh.SetHalos(newHalos)
+      
+    return mesh
     
-    return eeList
+  def LocalityMetrics(self):
+    """
+    Return a dictionary of node and element numbering locality metrics:
+      "bandwidth"             - bandwidth of the node-node graph
+      "profile"               - profile (envelope size) of the node-node graph
+      "meanNeighbourDistance" - mean index distance between adjacent nodes
+      "meanElementNodeSpread" - mean over volume elements of the difference
+                                between their maximum and minimum node indices
+      "meanElementDistance"   - mean index distance between volume elements
+                                sharing a node
+    """
+    
+    offsets, nodes = self._ElementConnectivity(includeSurface = True)
+    nnList = adjacency.NNList(offsets, nodes, self.NodeCount())
+    
+    offsets, nodes = self._ElementConnectivity()
+    if len(offsets) > 1:
+      nodes = numpy.maximum.reduceat(nodes, offsets[:-1]) - numpy.minimum.reduceat(nodes, offsets[:-1])
+      meanElementNodeSpread = float(nodes.mean())
+    else:
+      meanElementNodeSpread = 0.0
+    
+    return {"bandwidth":adjacency.Bandwidth(nnList), \
+            "profile":adjacency.Profile(nnList), \
+            "meanNeighbourDistance":adjacency.MeanIndexDistance(nnList), \
+            "meanElementNodeSpread":meanElementNodeSpread, \
+            "meanElementDistance":adjacency.MeanIndexDistance(self.EeList())}
      
-def VtuToMesh(vtu, idsName = "IDs"):
+def _VtuToArrayMesh(vtu, dim, dimIndices, idsName):
+  """
+  Construct an array backed mesh from the supplied vtu
+  """
+  
+  mesh = Mesh(dim, arrayBacked = True)
+  
+  # Read the points
+  mesh.AddNodeCoordsArray(vtktools.VtuPointCoordinates(vtu)[:, dimIndices])
+  
+  # Read the boundary / region IDs
+  cellData = vtu.ugrid.GetCellData().GetArray(idsName)
+  if not cellData is None:
+    cellIds = numpy_support.vtk_to_numpy(cellData).reshape(vtu.ugrid.GetNumberOfCells())
+  
+  # Read the elements
+  offsets, nodes = vtktools.VtuCellConnectivity(vtu)
+  cellTypes = vtktools.VtuCellTypes(vtu)
+  typeIds = numpy.unique(cellTypes)
+  types = [vtktools.VtkType(vtkTypeId = typeId) for typeId in typeIds]
+  for elementDim, AddElementsArray in [(dim - 1, mesh.AddSurfaceElementsArray), (dim, mesh.AddVolumeElementsArray)]:
+    dimTypes = [(typeId, type) for typeId, type in zip(typeIds, types) if type.GetDim() == elementDim]
+    if len(dimTypes) == 0:
+      continue
+    elif len(dimTypes) > 1:
+      raise Exception("Array backed meshes do not support mixed element types")
+    typeId, type = dimTypes[0]
+    
+    cells = numpy.nonzero(cellTypes == typeId)[0]
+    nodeCount = type.GetNodeCount()
+    cellNodes = nodes[offsets[cells][:, numpy.newaxis] + numpy.arange(nodeCount)]
+    cellNodes = cellNodes[:, vtktools.FromVtkNodeOrder(range(nodeCount), type)]
+    if cellData is None:
+      AddElementsArray(cellNodes)
+    else:
+      AddElementsArray(cellNodes, ids = cellIds[cells])
+  if not sum([type.GetDim() in [dim - 1, dim] for type in types]) == len(types):
+    debug.deprint("Warning: Found element in vtu that is neither a surface nor volume element")
+  
+  return mesh
+
+def VtuToMesh(vtu, idsName = "IDs", arrayBacked = False):
   """
-  Construct a mesh from the supplied vtu
+  Construct a mesh from the supplied vtu. If arrayBacked is True, an array
+  backed mesh is constructed.
   """
   
   dim = vtktools.VtuDim(vtu)
   boundingBox = vtktools.VtuBoundingBox(vtu)
   dimIndices = boundingBox.UsedDimIndices()
   
+  if arrayBacked:
+    return _VtuToArrayMesh(vtu, dim, dimIndices, idsName)
+  
   mesh = Mesh(dim)
   
   # Read the points
@@ -440,18 +1042,110 @@ def NodeUniversalNumbers(meshes, level = None):
   bases = [0]
   for halo in halos[:-1]:
     bases.append(bases[-1] + halo.GetNOwnedNodes())
-  unns = [range(bases[i], bases[i] + halo.GetNOwnedNodes()) for i, halo in enumerate(halos)]
-  for i, mesh in enumerate(meshes):
-    unns[i] += [None for i in range(mesh.NodeCount() - halos[i].GetNOwnedNodes())]
+  unns = [numpy.empty(mesh.NodeCount(), dtype = numpy.int64) for mesh in meshes]
+  for i, halo in enumerate(halos):
+    unns[i][:halo.GetNOwnedNodes()] = numpy.arange(bases[i], bases[i] + halo.GetNOwnedNodes())
+    unns[i][halo.GetNOwnedNodes():] = -1
   
   for i, halo in enumerate(halos):
     for process in range(halo.GetNProcesses()):
-      sends = halo.GetSends(process)
-      receives = halos[process].GetReceives(i)
-      for j, receive in enumerate(receives):
-        unns[process][receive] = unns[i][sends[j]]
+      unns[process][halos[process].GetReceives(i)] = unns[i][halo.GetSends(process)]
     
-  return unns
+  return [[None if unn < 0 else unn for unn in processUnns.tolist()] for processUnns in unns]
+    
+def _QuantisedCoords(coords, bits):
+  """
+  Return the supplied (points x dim) coordinates scaled to integers in
+  [0, 2 ** bits) over the smallest enclosing cube of their bounding box
+  """
+  
+  coords = numpy.asarray(coords, dtype = float)
+  lbound = coords.min(axis = 0)
+  extent = (coords.max(axis = 0) - lbound).max()
+  if extent <= 0.0:
+    extent = 1.0
+  scaled = (coords - lbound) / extent * ((1 << bits) - 1)
+  
+  return numpy.round(scaled).astype(numpy.uint64)
+  
+def _InterleavedBits(coords, bits):
+  """
+  Return keys formed by interleaving the bits of the supplied integer
+  coordinates, most significant bit first
+  """
+  
+  dim = coords.shape[1]
+  keys = numpy.zeros(coords.shape[0], dtype = numpy.uint64)
+  one = numpy.uint64(1)
+  for bit in range(bits - 1, -1, -1):
+    for i in range(dim):
+      keys = (keys << one) | ((coords[:, i] >> numpy.uint64(bit)) & one)
+      
+  return keys
+  
+def _CurveBits(dim, bits):
+  if bits is None:
+    bits = min(63 // max(dim, 1), 31)
+  assert(bits * dim <= 64)
+  
+  return bits
+
+def MortonKeys(coords, bits = None):
+  """
+  Return the Morton (Z-order) curve keys of the supplied (points x dim)
+  coordinates, quantised to 2 ** bits cells per dimension over their bounding
+  cube
+  """
+  
+  coords = numpy.asarray(coords, dtype = float)
+  bits = _CurveBits(coords.shape[1], bits)
+  if coords.shape[0] == 0:
+    return numpy.zeros(0, dtype = numpy.uint64)
+  
+  return _InterleavedBits(_QuantisedCoords(coords, bits), bits)
+  
+def HilbertKeys(coords, bits = None):
+  """
+  Return the Hilbert curve keys of the supplied (points x dim) coordinates,
+  quantised to 2 ** bits cells per dimension over their bounding cube. Uses
+  Skilling's transpose algorithm (AIP Conf. Proc. 707, 381 (2004)), applied to
+  all points at once.
+  """
+  
+  coords = numpy.asarray(coords, dtype = float)
+  dim = coords.shape[1]
+  bits = _CurveBits(dim, bits)
+  if coords.shape[0] == 0:
+    return numpy.zeros(0, dtype = numpy.uint64)
+  
+  x = _QuantisedCoords(coords, bits)
+  zero = numpy.uint64(0)
+  
+  # Inverse undo
+  q = 1 << (bits - 1)
+  while q > 1:
+    p = numpy.uint64(q - 1)
+    for i in range(dim):
+      high = (x[:, i] & numpy.uint64(q)) != zero
+      # Invert where the bit is set, and exchange the low bits otherwise
+      x[high, 0] ^= p
+      t = (x[:, 0] ^ x[:, i]) & p
+      t[high] = zero
+      x[:, 0] ^= t
+      x[:, i] ^= t
+    q >>= 1
+    
+  # Gray encode
+  for i in range(1, dim):
+    x[:, i] ^= x[:, i - 1]
+  t = numpy.zeros(x.shape[0], dtype = numpy.uint64)
+  q = 1 << (bits - 1)
+  while q > 1:
+    t[(x[:, dim - 1] & numpy.uint64(q)) != zero] ^= numpy.uint64(q - 1)
+    q >>= 1
+  x ^= t[:, numpy.newaxis]
+  
+  return _InterleavedBits(x, bits)
     
 class meshesUnittests(unittest.TestCase):
   def testLowerDimVtuToMesh(self):
@@ -519,3 +1213,183 @@ class meshesUnittests(unittest.TestCase):
     self.assertEquals(oldMesh.VolumeElementCount(), newMesh.VolumeElementCount())
     
     return
+    
+  def testArrayBackedMesh(self):
+    mesh = Mesh(2, arrayBacked = True)
+    self.assertTrue(mesh.IsArrayBacked())
+    mesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    mesh.AddNodeCoord([2.0, 3.0])
+    mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2]], ids = [5, 6])
+    mesh.AddSurfaceElement(elements.Element(nodes = [0, 1], ids = 7))
+    mesh.AddSurfaceElementsArray([[1, 3], [3, 2], [2, 0]], ids = [8, 9, 10])
+    self.assertEquals(mesh.NodeCount(), 5)
+    self.assertEquals(mesh.VolumeElementCount(), 2)
+    self.assertEquals(mesh.SurfaceElementCount(), 4)
+    self.assertEquals(list(mesh.GetNodeCoord(4)), [2.0, 3.0])
+    self.assertEquals(mesh.GetVolumeElement(1).GetNodes(), [1, 3, 2])
+    self.assertEquals(mesh.GetSurfaceElement(0).GetIds(), [7])
+    self.assertEquals(mesh.GetSurfaceElementIdsArray()[:, 0].tolist(), [7, 8, 9, 10])
+    self.assertEquals(mesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2], [1, 3, 2]])
+    self.assertEquals(mesh.VolumeElementFixedNodeCount(), 3)
+    self.assertFalse(mesh.MixedSurfaceElements())
+    self.assertRaises(Exception, mesh.AddVolumeElement, elements.Element(nodes = [0, 1, 3, 2]))
+    
+    # Element views write through to the mesh
+    mesh.GetSurfaceElement(3).SetIds([11])
+    self.assertEquals(mesh.GetSurfaceElementIdsArray()[3, 0], 11)
+    mesh.RemoveSurfaceElementByIndex(0)
+    self.assertEquals(mesh.SurfaceElementCount(), 3)
+    self.assertEquals(mesh.GetSurfaceElement(0).GetIds(), [8])
+    
+    bbox = mesh.BoundingBox()
+    self.assertEquals(list(bbox.GetLbound()), [0.0, 0.0])
+    self.assertEquals(list(bbox.GetUbound()), [2.0, 3.0])
+    
+    # Array and list backed meshes agree
+    listMesh = Mesh(2)
+    listMesh.AddNodeCoords(mesh.GetNodeCoords())
+    listMesh.AddVolumeElementsArray(mesh.GetVolumeElementNodesArray(), ids = mesh.GetVolumeElementIdsArray())
+    self.assertEquals(listMesh.GetVolumeElementNodesArray().tolist(), mesh.GetVolumeElementNodesArray().tolist())
+    self.assertEquals(listMesh.GetNodeCoordsArray().tolist(), mesh.GetNodeCoordsArray().tolist())
+    
+    return
+    
+  def testRemoveElementViews(self):
+    for arrayBacked in [False, True]:
+      mesh = Mesh(2, arrayBacked = arrayBacked)
+      mesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+      mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2], [1, 4, 3]], ids = [1, 2, 3])
+      mesh.AddSurfaceElementsArray([[0, 1], [1, 4]], ids = [4, 5])
+      
+      volumeElements = list(mesh.GetVolumeElements())
+      surfaceElements = list(mesh.GetSurfaceElements())
+      mesh.RemoveVolumeElement(volumeElements[0])
+      mesh.RemoveSurfaceElement(surfaceElements[1])
+      if arrayBacked:
+        # Views taken before a removal are stale, and must not silently refer
+        # to a different element
+        self.assertRaises(Exception, volumeElements[1].GetIds)
+        self.assertRaises(Exception, mesh.RemoveVolumeElement, volumeElements[2])
+        self.assertRaises(Exception, surfaceElements[0].GetNodes)
+        mesh.RemoveVolumeElement(mesh.GetVolumeElement(1))
+      else:
+        self.assertEquals(volumeElements[1].GetIds(), [2])
+        mesh.RemoveVolumeElement(volumeElements[2])
+      self.assertEquals([element.GetIds() for element in mesh.GetVolumeElements()], [[2]])
+      self.assertEquals([element.GetIds() for element in mesh.GetSurfaceElements()], [[4]])
+    
+    return
+    
+  def testArrayBackedVtuInteroperability(self):
+    oldMesh = Mesh(2, arrayBacked = True)
+    oldMesh.AddNodeCoordsArray([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+    oldMesh.AddVolumeElementsArray([[0, 1, 2, 3]], ids = [1])
+    oldMesh.AddSurfaceElementsArray([[0, 1], [1, 3], [3, 2], [2, 0]], ids = [2, 3, 4, 5])
+    vtu = oldMesh.ToVtu()
+    self.assertEquals(vtu.ugrid.GetNumberOfCells(), 5)
+    self.assertEquals(vtktools.VtuGetCellField(vtu, "IDs").flatten().tolist(), [2.0, 3.0, 4.0, 5.0, 1.0])
+    
+    listMesh = VtuToMesh(vtu)
+    self.assertEquals(listMesh.GetVolumeElement(0).GetNodes(), [0, 1, 2, 3])
+    arrayMesh = VtuToMesh(vtu, arrayBacked = True)
+    self.assertTrue(arrayMesh.IsArrayBacked())
+    self.assertEquals(arrayMesh.GetVolumeElementNodesArray().tolist(), [[0, 1, 2, 3]])
+    self.assertEquals(arrayMesh.GetSurfaceElementNodesArray().tolist(), oldMesh.GetSurfaceElementNodesArray().tolist())
+    self.assertEquals(arrayMesh.GetSurfaceElementIdsArray()[:, 0].tolist(), [2, 3, 4, 5])
+    self.assertEquals(arrayMesh.GetNodeCoordsArray().tolist(), oldMesh.GetNodeCoordsArray().tolist())
+    
+    return
+    
+  def testElementConnectivity(self):
+    for arrayBacked in [False, True]:
+      # Empty element stores must not break the running node offsets
+      mesh = Mesh(2, arrayBacked = arrayBacked)
+      mesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+      mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2]])
+      offsets, nodes = mesh._ElementConnectivity(includeSurface = True)
+      self.assertEquals(offsets.tolist(), [0, 3, 6])
+      self.assertEquals(nodes.tolist(), [0, 1, 2, 1, 3, 2])
+      
+      mesh.AddSurfaceElementsArray([[0, 1]])
+      offsets, nodes = mesh._ElementConnectivity(includeSurface = True)
+      self.assertEquals(offsets.tolist(), [0, 2, 5, 8])
+      self.assertEquals(nodes.tolist(), [0, 1, 0, 1, 2, 1, 3, 2])
+    
+    return
+    
+  def testAdjacencyLists(self):
+    for arrayBacked in [False, True]:
+      mesh = Mesh(2, arrayBacked = arrayBacked)
+      mesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0], [2.0, 1.0]])
+      mesh.AddVolumeElementsArray([[0, 1, 2], [1, 3, 2], [1, 4, 3]])
+      mesh.AddSurfaceElementsArray([[0, 1], [1, 4]])
+      
+      offsets, nodes = mesh.NNList()
+      self.assertEquals([nodes[offsets[i]:offsets[i + 1]].tolist() for i in range(5)], [[1, 2], [0, 2, 3, 4], [0, 1, 3], [1, 2, 4], [1, 3]])
+      offsets, eles = mesh.NeList()
+      self.assertEquals([eles[offsets[i]:offsets[i + 1]].tolist() for i in range(5)], [[0], [0, 1, 2], [0, 1], [1, 2], [2]])
+      offsets, eles = mesh.EeList()
+      self.assertEquals([eles[offsets[i]:offsets[i + 1]].tolist() for i in range(3)], [[1, 2], [0, 2], [0, 1]])
+      
+      self.assertEquals(mesh.NeList(sparse = True).shape, (5, 3))
+      self.assertEquals(mesh.EeList(sparse = True).toarray().tolist(), [[0, 1, 1], [1, 0, 1], [1, 1, 0]])
+    
+    return
+    
+  def testSpaceFillingCurveKeys(self):
+    grid = numpy.array([[i, j] for i in range(8) for j in range(8)], dtype = float)
+    
+    # Consecutive cells along a Hilbert curve are face neighbours
+    order = numpy.argsort(HilbertKeys(grid, bits = 3))
+    self.assertTrue(numpy.all(numpy.abs(numpy.diff(grid[order], axis = 0)).sum(axis = 1) == 1.0))
+    
+    keys = MortonKeys(grid, bits = 3)
+    self.assertEquals(sorted(keys.tolist()), range(64))
+    self.assertEquals(keys[:3].tolist(), [0, 1, 4])
+    
+    return
+    
+  def testRenumbered(self):
+    # A strip of triangles, with nodes numbered alternately from each end
+    nodeCount = 12
+    positions = numpy.array([i // 2 if i % 2 == 0 else nodeCount - 1 - i // 2 for i in range(nodeCount)])
+    coords = numpy.array([[float(position // 2), float(position % 2)] for position in positions])
+    nodeAt = numpy.argsort(positions)
+    triangles = [[nodeAt[i], nodeAt[i + 1], nodeAt[i + 2]] for i in range(nodeCount - 2)]
+    
+    for arrayBacked in [False, True]:
+      mesh = Mesh(2, arrayBacked = arrayBacked)
+      mesh.AddNodeCoordsArray(coords)
+      mesh.AddVolumeElementsArray(triangles, ids = range(len(triangles)))
+      mesh.AddSurfaceElementsArray([[nodeAt[0], nodeAt[1]]], ids = [7])
+      
+      before = mesh.LocalityMetrics()
+      for method in ["rcm", "hilbert", "morton"]:
+        newMesh = mesh.Renumbered(method = method)
+        after = newMesh.LocalityMetrics()
+        self.assertTrue(after["bandwidth"] < before["bandwidth"])
+        self.assertTrue(after["profile"] < before["profile"])
+        self.assertTrue(after["meanElementNodeSpread"] < before["meanElementNodeSpread"])
+        
+        # The renumbered mesh has the same elements
+        self.assertEquals(newMesh.NodeCount(), nodeCount)
+        self.assertEquals(sorted([tuple(sorted(map(tuple, newMesh.GetNodeCoordsArray()[element.GetNodes()].tolist()))) + tuple(element.GetIds()) for element in newMesh.GetVolumeElements()]), \
+                          sorted([tuple(sorted(map(tuple, coords[element.GetNodes()].tolist()))) + tuple(element.GetIds()) for element in mesh.GetVolumeElements()]))
+        self.assertEquals(newMesh.GetSurfaceElement(0).GetIds(), [7])
+        
+    # Only owned nodes are renumbered when the mesh has halos
+    halo = mesh_halos.Halo(process = 0, nProcesses = 2, nOwnedNodes = 10, sends = [[], [0, 9]], receives = [[], [10, 11]])
+    mesh = Mesh(2)
+    mesh.AddNodeCoordsArray(coords[nodeAt])
+    mesh.AddVolumeElementsArray([[i, i + 1, i + 2] for i in range(nodeCount - 2)])
+    mesh.SetHalos(mesh_halos.Halos(process = 0, nProcesses = 2, nodeHalos = [halo, halo]))
+    nodeOrder = numpy.concatenate([numpy.roll(numpy.arange(10), 3), [10, 11]])
+    newMesh = mesh.Renumbered(nodeOrder = nodeOrder)
+    newHalo = newMesh.GetHalos().GetNodeHalo(2)
+    self.assertEquals(newHalo.GetNOwnedNodes(), 10)
+    self.assertEquals(newHalo.GetSends(1).tolist(), [3, 2])
+    self.assertEquals(newHalo.GetReceives(1).tolist(), [10, 11])
+    self.assertEquals(mesh.NodeRenumbering()[10:].tolist(), [10, 11])
+    self.assertEquals(sorted(mesh.NodeRenumbering(method = "hilbert").tolist()), range(12))
+    
+    return
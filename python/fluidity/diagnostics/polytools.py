@@ -19,6 +19,8 @@ Tools for dealing with .poly files.
 """
 
 import copy
+import itertools
+import multiprocessing
 import os
 import subprocess
 import sys
@@ -27,8 +29,15 @@ import time
 import unittest
 
 import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.filehandling as filehandling
+import fluidity.diagnostics.mesh_cache as mesh_cache
 import fluidity.diagnostics.meshes as meshes
 import fluidity.diagnostics.triangletools as triangletools
 import fluidity.diagnostics.utils as utils
@@ -36,7 +45,16 @@ import fluidity.diagnostics.utils as utils
 def ReadPoly(filename):
   """
   Read a .poly file, and return is as two meshes: the poly mesh, and the hole
-  nodes. Facet information is flattened, to create a single mesh surface.
+  nodes. Facet information is flattened, to create a single mesh surface. If the
+  mesh cache is enabled, the meshes are loaded from the cache if a valid entry
+  exists.
+  """
+  
+  return mesh_cache.CachedRead("poly", lambda: _ReadPoly(filename), [filename])
+
+def _ReadPoly(filename):
+  """
+  Parse a .poly file
   """
   
   def StripComment(line):
@@ -170,33 +188,39 @@ def WritePoly(mesh, filename, holeMesh = None):
   polyHandle.write(utils.FormLine([mesh.NodeCount(), mesh.GetDim(), 0, 0]))
   
   # Write the nodes
-  for i in range(mesh.NodeCount()):
-    polyHandle.write(utils.FormLine([i + 1, mesh.GetNodeCoord(i)]))
+  nodeData = numpy.empty((mesh.NodeCount(), 1 + mesh.GetDim()))
+  nodeData[:, 0] = numpy.arange(1, mesh.NodeCount() + 1)
+  nodeData[:, 1:] = mesh.GetNodeCoordsArray()
+  filehandling.WriteRows(polyHandle, nodeData, "%d" + " %r" * mesh.GetDim() + "\n")
+  del nodeData
   
   # Write the facets meta data
   polyHandle.write("# Facets\n")
+  blocks = mesh.GetSurfaceElementArrayBlocks()
   nFacetIds = 0
-  for i in range(mesh.SurfaceElementCount()):
-    if i == 0:
-      nFacetIds = len(mesh.GetSurfaceElement(i).GetIds())
-    else:
-      assert(nFacetIds == len(mesh.GetSurfaceElement(i).GetIds()))
+  if len(blocks) > 0:
+    nFacetIds = blocks[0][1].shape[1]
+  for nodes, ids in blocks:
+    assert(ids.shape[1] == nFacetIds)
   polyHandle.write(utils.FormLine([mesh.SurfaceElementCount(), nFacetIds]))
   
-  # Write the facets
-  if mesh.GetDim() == 2:
-    # This is the facet specification as in the Triangle documentation
-    # http://www.cs.cmu.edu/~quake/triangle.poly.html
-    for i in range(mesh.SurfaceElementCount()):
+  # Write the facets. Facets with differing node counts are written grouped by
+  # node count.
+  index = 1
+  for nodes, ids in blocks:
+    if mesh.GetDim() == 2:
+      # This is the facet specification as in the Triangle documentation
+      # http://www.cs.cmu.edu/~quake/triangle.poly.html
       # Note: .poly indexes nodes from 1, Mesh s index nodes from 0
-      polyHandle.write(utils.FormLine([i + 1, utils.OffsetList(mesh.GetSurfaceElement(i).GetNodes(), 1), mesh.GetSurfaceElement(i).GetIds()]))
-  else:
-    # This is the facet specification as in the Tetgen documentation
-    # http://tetgen.berlios.de/fformats.poly.html
-    for i in range(mesh.SurfaceElementCount()):
-      polyHandle.write(utils.FormLine([1, 0, mesh.GetSurfaceElement(i).GetIds()]))
+      facetData = numpy.column_stack([numpy.arange(index, index + nodes.shape[0]), nodes + 1, ids])
+      filehandling.WriteRows(polyHandle, facetData, " ".join(["%d" for i in range(facetData.shape[1])]) + "\n")
+    else:
+      # This is the facet specification as in the Tetgen documentation
+      # http://tetgen.berlios.de/fformats.poly.html
       # Note: .poly indexes nodes from 1, Mesh s index nodes from 0
-      polyHandle.write(utils.FormLine([mesh.GetSurfaceElement(i).NodeCount(), utils.OffsetList(mesh.GetSurfaceElement(i).GetNodes(), 1)]))
+      facetData = numpy.column_stack([ids, nodes + 1])
+      filehandling.WriteRows(polyHandle, facetData, "1 0" + " %d" * ids.shape[1] + "\n" + str(nodes.shape[1]) + " %d" * nodes.shape[1] + "\n")
+    index += nodes.shape[0]
   
   # Write the hole list meta data
   polyHandle.write("# Holes\n")
@@ -214,22 +238,22 @@ def WritePoly(mesh, filename, holeMesh = None):
   
   return
   
-def TriangulateMesh(mesh, holeMesh = None, commandLineSwitches = []):
+def _MesherCommand(executable, filename, commandLineSwitches):
   """
-  Triangulate the given mesh file using Triangle
+  Return the Triangle or TetGen command for meshing the given poly file
   """
-    
-  tempDir = tempfile.mkdtemp()
-  polyFilename = os.path.join(tempDir, "temp.poly")
-  WritePoly(mesh, polyFilename, holeMesh = holeMesh)
-  mesh = TriangulatePoly(polyFilename, commandLineSwitches = commandLineSwitches)
-  filehandling.Rmdir(tempDir, force = True)
   
-  return mesh
-    
-def TriangulatePoly(polyFilename, commandLineSwitches = []):
+  command = [executable, "-p"]
+  if debug.GetDebugLevel() > 1:
+    command.append("-V")
+  command += commandLineSwitches
+  command.append(filename)
+  
+  return command
+  
+def _MeshPoly(executable, polyFilename, commandLineSwitches, description):
   """
-  Triangulate the given poly file using Triangle
+  Mesh the given poly file using Triangle or TetGen
   """
 
   assert(filehandling.FileExtension(polyFilename) == ".poly")
@@ -238,27 +262,167 @@ def TriangulatePoly(polyFilename, commandLineSwitches = []):
   tempFile = os.path.join(tempDir, os.path.basename(polyFilename))
   filehandling.Cp(polyFilename, tempFile)
 
-  command = ["triangle", "-p"]
+  command = _MesherCommand(executable, tempFile, commandLineSwitches)
   if debug.GetDebugLevel() > 1:
-    command.append("-V")
     stdout = None
     stderr = None
   else:
     stdout = subprocess.PIPE
     stderr = subprocess.PIPE
-  command += commandLineSwitches
-  command.append(tempFile)
-  debug.dprint("Triangulation command: " + utils.FormLine(command, delimiter = " ", newline = False))
+  debug.dprint(description + " command: " + utils.FormLine(command, delimiter = " ", newline = False))
   proc = subprocess.Popen(command, stdout = stdout, stderr = stderr)
-  proc.wait()
+  proc.communicate()
   assert(proc.returncode == 0)
   
-  mesh = triangletools.ReadTriangle(tempFile[:-5] + ".1")
+  # The output is temporary, so bypass the mesh cache
+  mesh = triangletools.ReadTriangle(tempFile[:-5] + ".1", cache = False)
+  
+  filehandling.Rmdir(tempDir, force = True)
+  
+  return mesh
+  
+def DefaultJobCount():
+  """
+  Return the default number of concurrent meshing jobs (the number of CPUs)
+  """
+  
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+  
+def _StartMeshJob(executable, workerDir, mesh, holeMesh, commandLineSwitches):
+  """
+  Start a Triangle or TetGen process for the given mesh in the given worker
+  scratch directory, and return the process. Output is logged to job.log in the
+  worker directory.
+  """
+  
+  # Clear the output of the worker's previous job
+  for filename in os.listdir(workerDir):
+    os.remove(os.path.join(workerDir, filename))
+  
+  polyFilename = os.path.join(workerDir, "job.poly")
+  WritePoly(mesh, polyFilename, holeMesh = holeMesh)
+  
+  command = _MesherCommand(executable, polyFilename, commandLineSwitches)
+  # Log to a file rather than a pipe, so that verbose output cannot block the
+  # mesher while other jobs are polled, and so that concurrent jobs do not
+  # interleave their output
+  logHandle = open(os.path.join(workerDir, "job.log"), "w")
+  proc = subprocess.Popen(command, stdout = logHandle, stderr = subprocess.STDOUT)
+  logHandle.close()
+  
+  return proc
+    
+def _FinishMeshJob(executable, workerDir, proc, index):
+  """
+  Read the output mesh of a completed Triangle or TetGen job. The job log is
+  echoed at debug level 3.
+  """
+  
+  logFilename = os.path.join(workerDir, "job.log")
+  if filehandling.FileExists(logFilename):
+    logHandle = open(logFilename, "r")
+    log = logHandle.readlines()
+    logHandle.close()
+  else:
+    log = []
+  debug.dprint("".join(log), 3, newline = False)
+  
+  if not proc.returncode == 0:
+    message = executable + " failed for mesh " + str(index) + " with return code " + str(proc.returncode)
+    if len(log) > 0:
+      message += ":\n" + "".join(log[-10:])
+    raise Exception(message)
+    
+  # The output is temporary, so bypass the mesh cache
+  return triangletools.ReadTriangle(os.path.join(workerDir, "job.1"), cache = False)
+  
+def _MeshPolys(executable, inputMeshes, holeMeshes, commandLineSwitches, jobs, pollInterval):
+  """
+  Mesh each of the given meshes using Triangle or TetGen, with up to jobs
+  processes running concurrently. Each worker reuses a single scratch
+  directory. Yields (index, mesh) pairs as jobs complete.
+  """
+  
+  if jobs is None:
+    jobs = DefaultJobCount()
+  assert(jobs > 0)
+  if holeMeshes is None:
+    holeMeshes = itertools.repeat(None)
+  
+  tempDir = tempfile.mkdtemp()
+  workerDirs = [os.path.join(tempDir, "worker" + str(i)) for i in range(jobs)]
+  for workerDir in workerDirs:
+    os.mkdir(workerDir)
+  
+  pending = enumerate(itertools.izip(inputMeshes, holeMeshes))
+  # Map from worker to (mesh index, process)
+  running = {}
+  try:
+    while True:
+      # Start jobs on idle workers
+      for worker in range(jobs):
+        if worker in running:
+          continue
+        try:
+          index, (mesh, holeMesh) = pending.next()
+        except StopIteration:
+          break
+        debug.dprint("Starting " + executable + " job for mesh " + str(index))
+        running[worker] = (index, _StartMeshJob(executable, workerDirs[worker], mesh, holeMesh, commandLineSwitches))
+      if len(running) == 0:
+        break
+      
+      # Collect completed jobs
+      finished = [worker for worker in running if not running[worker][1].poll() is None]
+      if len(finished) == 0:
+        time.sleep(pollInterval)
+        continue
+      for worker in finished:
+        index, proc = running.pop(worker)
+        yield index, _FinishMeshJob(executable, workerDirs[worker], proc, index)
+  finally:
+    # Clean up after completion, failure or early generator close
+    for index, proc in running.values():
+      if proc.poll() is None:
+        proc.kill()
+        proc.wait()
+    filehandling.Rmdir(tempDir, force = True)
+    
+  return
   
+def TriangulateMesh(mesh, holeMesh = None, commandLineSwitches = []):
+  """
+  Triangulate the given mesh file using Triangle
+  """
+    
+  tempDir = tempfile.mkdtemp()
+  polyFilename = os.path.join(tempDir, "temp.poly")
+  WritePoly(mesh, polyFilename, holeMesh = holeMesh)
+  mesh = TriangulatePoly(polyFilename, commandLineSwitches = commandLineSwitches)
   filehandling.Rmdir(tempDir, force = True)
   
   return mesh
   
+def TriangulateMeshes(inputMeshes, holeMeshes = None, commandLineSwitches = [], jobs = None, pollInterval = 0.01):
+  """
+  Triangulate each of the given meshes using Triangle, running up to jobs
+  (default the number of CPUs) Triangle processes concurrently. holeMeshes, if
+  supplied, gives the hole mesh for each mesh. Yields (index, mesh) pairs, in
+  order of completion.
+  """
+  
+  return _MeshPolys("triangle", inputMeshes, holeMeshes, commandLineSwitches, jobs, pollInterval)
+    
+def TriangulatePoly(polyFilename, commandLineSwitches = []):
+  """
+  Triangulate the given poly file using Triangle
+  """
+  
+  return _MeshPoly("triangle", polyFilename, commandLineSwitches, "Triangulation")
+  
 def TetrahedralizeMesh(mesh, holeMesh = None, commandLineSwitches = []):
   """
   Tetrahedralise the given mesh using TetGen
@@ -271,38 +435,23 @@ def TetrahedralizeMesh(mesh, holeMesh = None, commandLineSwitches = []):
   filehandling.Rmdir(tempDir, force = True)
   
   return mesh
+  
+def TetrahedralizeMeshes(inputMeshes, holeMeshes = None, commandLineSwitches = [], jobs = None, pollInterval = 0.01):
+  """
+  Tetrahedralise each of the given meshes using TetGen, running up to jobs
+  (default the number of CPUs) TetGen processes concurrently. holeMeshes, if
+  supplied, gives the hole mesh for each mesh. Yields (index, mesh) pairs, in
+  order of completion.
+  """
+  
+  return _MeshPolys("tetgen", inputMeshes, holeMeshes, commandLineSwitches, jobs, pollInterval)
     
 def TetrahedralizePoly(polyFilename, commandLineSwitches = []):
   """
   Tetrahedralise the given poly using TetGen
   """
-
-  assert(filehandling.FileExtension(polyFilename) == ".poly")
-
-  tempDir = tempfile.mkdtemp()
-  tempFile = os.path.join(tempDir, os.path.basename(polyFilename))
-  filehandling.Cp(polyFilename, tempFile)
-
-  command = ["tetgen", "-p"]
-  if debug.GetDebugLevel() > 1:
-    command.append("-V")
-    stdout = None
-    stderr = None
-  else:
-    stdout = subprocess.PIPE
-    stderr = subprocess.PIPE
-  command += commandLineSwitches
-  command.append(tempFile)
-  debug.dprint("Tetrahedralization command: " + utils.FormLine(command, delimiter = " ", newline = False))
-  proc = subprocess.Popen(command, stdout = stdout, stderr = stderr)
-  proc.wait()
-  assert(proc.returncode == 0)
-  
-  mesh = triangletools.ReadTriangle(tempFile[:-5] + ".1")
   
-  filehandling.Rmdir(tempDir, force = True)
-  
-  return mesh
+  return _MeshPoly("tetgen", polyFilename, commandLineSwitches, "Tetrahedralization")
   
 class polytoolsUnittests(unittest.TestCase):
   def testPolyIo(self):
@@ -358,6 +507,29 @@ class polytoolsUnittests(unittest.TestCase):
     
     return
     
+  def testWritePolyFacets(self):
+    tempDir = tempfile.mkdtemp()
+    
+    for dim, nodeCoords, facets in [(2, [[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]], [[0, 1], [1, 2], [2, 0]]), \
+      (3, [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]], [[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])]:
+      oldMesh = meshes.Mesh(dim, arrayBacked = True)
+      oldMesh.AddNodeCoordsArray(nodeCoords)
+      oldMesh.AddSurfaceElementsArray(facets, ids = range(1, len(facets) + 1))
+      filename = os.path.join(tempDir, "temp.poly")
+      WritePoly(oldMesh, filename)
+      newMesh, newHoleMesh = ReadPoly(filename)
+      self.assertEquals(newMesh.NodeCount(), len(nodeCoords))
+      for i, nodeCoord in enumerate(nodeCoords):
+        self.assertEquals(list(newMesh.GetNodeCoord(i)), nodeCoord)
+      self.assertEquals(newMesh.SurfaceElementCount(), len(facets))
+      for i, facet in enumerate(facets):
+        self.assertEquals(list(newMesh.GetSurfaceElement(i).GetNodes()), facet)
+        self.assertEquals(list(newMesh.GetSurfaceElement(i).GetIds()), [i + 1])
+      self.assertEquals(newHoleMesh.NodeCount(), 0)
+        
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
     
   def testTriangulatePoly(self):
     tempDir = tempfile.mkdtemp()
@@ -399,3 +571,44 @@ class polytoolsUnittests(unittest.TestCase):
     filehandling.Rmdir(tempDir, force = True)
     
     return
+    
+  def testTriangulateMeshes(self):
+    inputMeshes = []
+    for i in range(3):
+      mesh = meshes.Mesh(2)
+      mesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]] + [[0.1, 0.1 * (j + 1)] for j in range(i + 1)])
+      mesh.AddSurfaceElement(elements.Element([0, 1]))
+      mesh.AddSurfaceElement(elements.Element([1, 2]))
+      mesh.AddSurfaceElement(elements.Element([2, 0]))
+      inputMeshes.append(mesh)
+      
+    indices = []
+    for index, mesh in TriangulateMeshes(inputMeshes, commandLineSwitches = ["-YY"], jobs = 2):
+      indices.append(index)
+      self.assertEquals(mesh.NodeCount(), inputMeshes[index].NodeCount())
+      self.assertEquals(mesh.VolumeElementCount(), 2 * index + 3)
+    indices.sort()
+    self.assertEquals(indices, range(3))
+    
+    return
+    
+  def testMeshJobLog(self):
+    mesh = meshes.Mesh(2)
+    mesh.AddNodeCoords([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]])
+    mesh.AddSurfaceElement(elements.Element([0, 1]))
+    
+    # The Python interpreter rejects the "-p" switch, and writes its usage to
+    # the job log, which must be reported at the default debug level
+    debugLevel = debug.GetDebugLevel()
+    debug.SetDebugLevel(2)
+    try:
+      self.assertRaises(Exception, list, _MeshPolys(sys.executable, [mesh], None, [], 1, 0.01))
+      try:
+        list(_MeshPolys(sys.executable, [mesh], None, [], 1, 0.01))
+      except Exception as e:
+        message = str(e)
+    finally:
+      debug.SetDebugLevel(debugLevel)
+    self.assertTrue("usage" in message.lower())
+    
+    return
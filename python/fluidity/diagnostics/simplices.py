@@ -25,6 +25,13 @@ Tools for dealing with tetrahedra
 
 import unittest
 
+import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
 import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.optimise as optimise
@@ -34,7 +41,7 @@ def SimplexEdgeVectors(nodeCoords):
   Return the edge vectors for the tetrahedron with the supplied node coordinates
   """
   
-  type = elements.ElementType(dim = len(nodeCoords[0]), nodeCount = len(nodeCoords))
+  type = elements.GetElementType(len(nodeCoords[0]), len(nodeCoords))
   assert(type.GetElementFamilyId() == elements.ELEMENT_FAMILY_SIMPLEX)
   
   return [[nodeCoord[i] - nodeCoords[0][i] for i in range(type.GetDim())] for nodeCoord in nodeCoords[1:]]
@@ -44,15 +51,10 @@ def SimplexVolume(nodeCoords, signed = False):
   Return the volume of the simplex with the supplied node coordinates
   """
   
-  type = elements.ElementType(dim = len(nodeCoords[0]), nodeCount = len(nodeCoords))
+  type = elements.GetElementType(len(nodeCoords[0]), len(nodeCoords))
   assert(type.GetElementFamilyId() == elements.ELEMENT_FAMILY_SIMPLEX)
-    
-  volume = calc.Determinant(SimplexEdgeVectors(nodeCoords)) / calc.Factorial(type.GetDim())
   
-  if signed:
-    return volume
-  else:
-    return abs(volume)
+  return float(SimplexVolumes([nodeCoords], signed = signed)[0])
     
 def TetVolume(nodeCoords, signed = False):
   """
@@ -60,7 +62,7 @@ def TetVolume(nodeCoords, signed = False):
   """
   
   if optimise.DebuggingEnabled():
-    type = elements.ElementType(dim = len(nodeCoords[0]), nodeCount = len(nodeCoords))
+    type = elements.GetElementType(len(nodeCoords[0]), len(nodeCoords))
     assert(type.GetElementTypeId() == elements.ELEMENT_TETRAHEDRON)
     
   return SimplexVolume(nodeCoords, signed = signed)
@@ -70,16 +72,86 @@ def SimplexIntegral(nodeCoords, nodeCoordVals):
   Integrate a P1 field over a simplex
   """
     
-  type = elements.ElementType(dim = len(nodeCoords[0]), nodeCount = len(nodeCoords))
+  type = elements.GetElementType(len(nodeCoords[0]), len(nodeCoords))
   assert(type.GetElementFamilyId() == elements.ELEMENT_FAMILY_SIMPLEX)
   assert(len(nodeCoordVals) == type.GetNodeCount())
+  
+  return SimplexIntegrals([nodeCoords], [nodeCoordVals])[0]
+  
+def _SimplexNodeCoordsArray(nodeCoords):
+  """
+  Return the supplied simplex node coordinates as a (simplices x nodes x dim)
+  array
+  """
+  
+  nodeCoords = numpy.asarray(nodeCoords, dtype = float)
+  assert(len(nodeCoords.shape) == 3)
+  assert(nodeCoords.shape[1] == nodeCoords.shape[2] + 1)
+  
+  return nodeCoords
+  
+def Determinants(matrices):
+  """
+  Return the determinants of the supplied (matrices x n x n) array. 1x1, 2x2
+  and 3x3 determinants are expanded explicitly.
+  """
+  
+  matrices = numpy.asarray(matrices, dtype = float)
+  assert(len(matrices.shape) == 3 and matrices.shape[1] == matrices.shape[2])
+  
+  n = matrices.shape[1]
+  if n == 1:
+    return matrices[:, 0, 0].copy()
+  elif n == 2:
+    return matrices[:, 0, 0] * matrices[:, 1, 1] - matrices[:, 0, 1] * matrices[:, 1, 0]
+  elif n == 3:
+    return matrices[:, 0, 0] * (matrices[:, 1, 1] * matrices[:, 2, 2] - matrices[:, 1, 2] * matrices[:, 2, 1]) \
+         - matrices[:, 0, 1] * (matrices[:, 1, 0] * matrices[:, 2, 2] - matrices[:, 1, 2] * matrices[:, 2, 0]) \
+         + matrices[:, 0, 2] * (matrices[:, 1, 0] * matrices[:, 2, 1] - matrices[:, 1, 1] * matrices[:, 2, 0])
+  else:
+    return numpy.linalg.det(matrices)
+
+def SimplexVolumes(nodeCoords, signed = False):
+  """
+  Return the volumes of the simplices with the supplied node coordinates, given
+  as a (simplices x nodes x dim) array
+  """
+  
+  nodeCoords = _SimplexNodeCoordsArray(nodeCoords)
+  
+  volumes = Determinants(nodeCoords[:, 1:, :] - nodeCoords[:, :1, :])
+  volumes /= calc.Factorial(nodeCoords.shape[2])
+  
+  if signed:
+    return volumes
+  else:
+    return numpy.abs(volumes)
     
-  integral = nodeCoordVals[0]
-  for val in nodeCoordVals[1:]:
-    integral += val
-  integral *= SimplexVolume(nodeCoords) / float(type.GetNodeCount())
+def SimplexBarycentres(nodeCoords):
+  """
+  Return the barycentres of the simplices with the supplied node coordinates,
+  given as a (simplices x nodes x dim) array, as a (simplices x dim) array
+  """
+  
+  nodeCoords = _SimplexNodeCoordsArray(nodeCoords)
+  
+  return nodeCoords.mean(axis = 1)
+
+def SimplexIntegrals(nodeCoords, nodeCoordVals):
+  """
+  Integrate a P1 field over each of the simplices with the supplied node
+  coordinates, given as a (simplices x nodes x dim) array. The field values
+  are given as a (simplices x nodes) or (simplices x nodes x components)
+  array.
+  """
+  
+  nodeCoordVals = numpy.asarray(nodeCoordVals, dtype = float)
+  assert(nodeCoordVals.shape[:2] == numpy.shape(nodeCoords)[:2])
   
-  return integral
+  volumes = SimplexVolumes(nodeCoords)
+  volumes.shape = volumes.shape + tuple(1 for i in range(len(nodeCoordVals.shape) - 2))
+  
+  return nodeCoordVals.mean(axis = 1) * volumes
 
 class simplicesUnittests(unittest.TestCase):
   def testSimplexVolume(self):
@@ -108,3 +180,49 @@ class simplicesUnittests(unittest.TestCase):
     self.assertRaises(Exception, SimplexIntegral, [[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]], [1.0, 1.0, 1.0, 1.0])
     
     return
+    
+  def testSimplexVolumes(self):
+    volumes = SimplexVolumes([[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]], [[0.0, 0.0], [0.0, 1.0], [1.0, 0.0]]], signed = True)
+    self.assertAlmostEquals(volumes[0], 0.5)
+    self.assertAlmostEquals(volumes[1], -0.5)
+    volumes = SimplexVolumes([[[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]]])
+    self.assertAlmostEquals(volumes[0], 1.0 / 6.0)
+    
+    self.assertRaises(AssertionError, SimplexVolumes, [[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [1.0, 1.0]]])
+    
+    return
+    
+  def testSimplexIntegrals(self):
+    integrals = SimplexIntegrals([[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]], [[1.0, 1.0], [2.0, 1.0], [1.0, 2.0]]], [[1.0, 1.0, 1.0], [2.0, 2.0, 5.0]])
+    self.assertAlmostEquals(integrals[0], 0.5)
+    self.assertAlmostEquals(integrals[1], 1.5)
+    integrals = SimplexIntegrals([[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]]], [[[1.0, 2.0], [1.0, 2.0], [1.0, 2.0]]])
+    self.assertEquals(integrals.shape, (1, 2))
+    self.assertAlmostEquals(integrals[0][0], 0.5)
+    self.assertAlmostEquals(integrals[0][1], 1.0)
+    
+    self.assertRaises(AssertionError, SimplexIntegrals, [[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]]], [[1.0, 1.0, 1.0, 1.0]])
+    
+    return
+    
+  def testDeterminants(self):
+    for n in range(1, 5):
+      matrices = numpy.random.random((10, n, n))
+      determinants = Determinants(matrices)
+      self.assertEquals(determinants.shape, (10,))
+      for i, determinant in enumerate(numpy.linalg.det(matrices)):
+        self.assertAlmostEquals(determinants[i], determinant)
+        
+    return
+    
+  def testSimplexBarycentres(self):
+    barycentres = SimplexBarycentres([[[0.0, 0.0], [3.0, 0.0], [0.0, 3.0]], [[1.0, 1.0], [2.0, 1.0], [3.0, 4.0]]])
+    self.assertEquals(barycentres.shape, (2, 2))
+    self.assertAlmostEquals(barycentres[0][0], 1.0)
+    self.assertAlmostEquals(barycentres[0][1], 1.0)
+    self.assertAlmostEquals(barycentres[1][0], 2.0)
+    self.assertAlmostEquals(barycentres[1][1], 2.0)
+    
+    self.assertRaises(AssertionError, SimplexBarycentres, [[[0.0, 0.0], [1.0, 0.0]]])
+    
+    return
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Batch spectral analysis of many time series sharing a time axis, e.g. all
+statistics in a .stat file or all detectors in a detector array
+"""
+
+import math
+import unittest
+
+import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+try:
+  import scipy.sparse
+except ImportError:
+  debug.deprint("Warning: Failed to import scipy.sparse module")
+
+import fluidity.diagnostics.calc as calc
+
+def SeriesArray(series):
+  """
+  Return the supplied series as a 2D (series x time) array. series may be a
+  single series, a list of series, or a 2D array.
+  """
+
+  series = numpy.asarray(series, dtype = float)
+  if len(series.shape) == 1:
+    series = series[numpy.newaxis, :]
+  assert(len(series.shape) == 2)
+
+  return series
+
+def StatSeriesArray(stat, paths):
+  """
+  Return a (series x time) array containing the supplied paths in the supplied
+  stat
+  """
+
+  return SeriesArray([stat[path] for path in paths])
+
+def NormalisedFfts(values, divisions = None, returnPhases = False):
+  """
+  Perform a normalised fast Fourier transform of every row of the supplied
+  (series x time) array. Batch version of calc.NormalisedFft.
+  """
+
+  values = SeriesArray(values)
+  if divisions is None:
+    divisions = values.shape[1]
+
+  fft = numpy.fft.rfft(values, n = divisions, axis = 1) / divisions
+
+  if returnPhases:
+    return numpy.abs(fft), numpy.angle(fft)
+  else:
+    return numpy.abs(fft)
+
+class BatchLombScargle:
+  """
+  Class defining normalised Lomb-Scargle periodograms of every row of a
+  (series x time) array, sampled at common times. Batch version of
+  calc.NormalisedLombScargle. Trigonometric sums over the sample times are
+  computed once and shared by all series.
+  """
+
+  # As calc.NormalisedLombScargle
+  _directEvaluationLimit = 65536
+  _directEvaluationDataPoints = 64
+
+  def __init__(self, x, t, chunkSize = 1048576):
+    x = SeriesArray(x)
+    t = numpy.array(t, dtype = float)
+    assert(x.shape[1] == len(t))
+
+    order = numpy.argsort(t, kind = "mergesort")
+    self._x = x[:, order]
+    self._t = t[order]
+    self._chunkSize = chunkSize
+
+    self._xMinusMean = self._x - self._x.mean(axis = 1)[:, numpy.newaxis]
+    # The periodogram is invariant under a time shift. Use times relative to
+    # the first data point for accuracy.
+    self._tShifted = self._t - self._t[0]
+
+    return
+
+  def SeriesCount(self):
+    """
+    Return the number of series
+    """
+
+    return self._x.shape[0]
+
+  def DataPointsCount(self):
+    """
+    Return the number of data points in each series
+    """
+
+    return self._x.shape[1]
+
+  def _SeriesValues(self, series = None):
+    """
+    Return the values, minus their means, of the series with the supplied
+    indices, or of all series if series is None
+    """
+
+    if series is None:
+      return self._xMinusMean
+    else:
+      return self._xMinusMean[series]
+
+  def EvaluateDirect(self, omegas, series = None):
+    """
+    Evaluate the periodograms at the supplied angular frequencies, using direct
+    calculation. Returns a (series x frequency) array. If series is supplied,
+    evaluates only the periodograms of the series with the supplied indices.
+    Frequencies are evaluated in blocks of at most chunkSize frequency / data
+    point products.
+    """
+
+    omegas = numpy.array(omegas, dtype = float)
+    n = self.DataPointsCount()
+    xMinusMean = self._SeriesValues(series)
+
+    periodograms = numpy.empty((xMinusMean.shape[0], len(omegas)))
+    step = max(self._chunkSize // max(n, 1), 1)
+    for start in range(0, len(omegas), step):
+      lOmegas = omegas[start:start + step]
+      A, B, C, D = calc.LombScargleTrigonometricSums(numpy.outer(lOmegas, self._tShifted), xMinusMean)
+      periodograms[:, start:start + step] = calc.LombScarglePeriodogram(lOmegas, n, A, B, C, D)
+
+    return periodograms
+
+  def EvaluateSeriesDirect(self, omegas, series = None):
+    """
+    Evaluate the periodograms at the supplied (series x frequency) array of
+    angular frequencies, with a separate set of frequencies for each series,
+    using direct calculation. If series is supplied, evaluates only the
+    periodograms of the series with the supplied indices. Series are evaluated
+    in blocks of at most chunkSize frequency / data point products.
+    """
+
+    if series is None:
+      series = numpy.arange(self.SeriesCount())
+    omegas = numpy.array(omegas, dtype = float)
+    assert(omegas.shape[0] == len(series))
+    n = self.DataPointsCount()
+
+    periodograms = numpy.empty(omegas.shape)
+    step = max(self._chunkSize // max(n * omegas.shape[1], 1), 1)
+    for start in range(0, omegas.shape[0], step):
+      lOmegas = omegas[start:start + step]
+      A, B, C, D = calc.LombScargleTrigonometricSums(lOmegas[:, :, numpy.newaxis] * self._tShifted, self._xMinusMean[series[start:start + step]])
+      periodograms[start:start + step] = calc.LombScarglePeriodogram(lOmegas, n, A, B, C, D)
+
+    return periodograms
+
+  def EvaluateExtirpolating(self, omegas, series = None, order = 6):
+    """
+    Evaluate the periodograms at the supplied uniformly spaced angular
+    frequencies, using extirpolation as in
+    calc.NormalisedLombScargle.EvaluateExtirpilating. If series is supplied,
+    evaluates only the periodograms of the series with the supplied indices.
+    The extirpolation weights are formed once as a sparse matrix and applied to
+    all series together, in blocks of at most chunkSize grid points / series
+    products.
+    """
+
+    omegas = numpy.array(omegas, dtype = float)
+    xMinusMean = self._SeriesValues(series)
+    if len(omegas) == 0:
+      return numpy.empty((xMinusMean.shape[0], 0))
+    if not calc.UniformlySpaced(omegas):
+      raise Exception("Extirpolation requires uniformly spaced frequencies")
+
+    n = self.DataPointsCount()
+    count = len(omegas)
+    omega0 = omegas[0]
+    if count > 1:
+      dOmega = (omegas[-1] - omegas[0]) / float(count - 1)
+    else:
+      dOmega = 1.0
+
+    def ExtirpolationMatrix(omega0, dOmega):
+      gridSize = calc.ExtirpolationGridSize(count, order = order)
+      t = self._tShifted
+      indices, weights = calc.ExtirpolationWeights(numpy.mod(t * (dOmega * gridSize / (2.0 * math.pi)), gridSize), gridSize, order = order)
+      weights = weights * numpy.tile(numpy.exp(1.0j * omega0 * t), order)
+
+      return scipy.sparse.csr_matrix((weights, (indices, numpy.tile(numpy.arange(n), order))), shape = (gridSize, n))
+
+    # Sums of exp(2 i omega t), shared by all series
+    matrix = ExtirpolationMatrix(2.0 * omega0, 2.0 * dOmega)
+    twoSums = matrix.shape[0] * numpy.fft.ifft(matrix.dot(numpy.ones(n)))[:count]
+    del matrix
+
+    # Sums of (x - mean) exp(i omega t), for each series
+    matrix = ExtirpolationMatrix(omega0, dOmega)
+    periodograms = numpy.empty((xMinusMean.shape[0], count))
+    step = max(self._chunkSize // matrix.shape[0], 1)
+    for start in range(0, xMinusMean.shape[0], step):
+      hSums = (matrix.shape[0] * numpy.fft.ifft(matrix.dot(xMinusMean[start:start + step].T), axis = 0)[:count]).T
+      A, B, C, D = calc.LombScargleExtirpolatedSums(hSums, twoSums, n)
+      periodograms[start:start + step] = calc.LombScarglePeriodogram(omegas, n, A, B, C, D)
+
+    return periodograms
+
+  def Evaluate(self, omegas, series = None):
+    """
+    Evaluate the periodograms at the supplied angular frequencies. If series is
+    supplied, evaluates only the periodograms of the series with the supplied
+    indices. Uses extirpolation for large periodograms at uniformly spaced
+    frequencies, and direct calculation otherwise.
+    """
+
+    omegas = numpy.array(omegas, dtype = float)
+    n = self.DataPointsCount()
+    if len(omegas) * n > self._directEvaluationLimit and n > self._directEvaluationDataPoints and calc.UniformlySpaced(omegas):
+      return self.EvaluateExtirpolating(omegas, series = series)
+    else:
+      return self.EvaluateDirect(omegas, series = series)
+
+  def DominantModes(self, N = 250, tMin = None, tMax = None, maxScanCount = 65536):
+    """
+    Compute the period and amplitude of the dominant mode in every series.
+    Returns arrays of periods and amplitudes. See
+    calc.DominantModeUnstructured.
+    """
+
+    def Evaluate(series, omegas):
+      return 2.0 * self.EvaluateSeriesDirect(omegas, series = series)
+
+    omegas = calc.DominantModeScanFrequencies(self._t, N = N, tMin = tMin, tMax = tMax, maxScanCount = maxScanCount)
+
+    # Scan the frequencies for blocks of at most chunkSize series / frequency
+    # products, keeping only the maximum for each series
+    indices = numpy.empty(self.SeriesCount(), dtype = int)
+    amp = numpy.empty(self.SeriesCount())
+    step = max(self._chunkSize // len(omegas), 1)
+    for start in range(0, self.SeriesCount(), step):
+      series = numpy.arange(start, min(start + step, self.SeriesCount()))
+      lsAmps = 2.0 * self.Evaluate(omegas, series = series)
+      indices[series] = lsAmps.argmax(axis = 1)
+      amp[series] = lsAmps[numpy.arange(len(series)), indices[series]]
+
+    t, amp = calc.RefineDominantModes(Evaluate, omegas, indices, amp)
+
+    return t, amp
+
+def DominantModesStructured(values, dt, N = 250, chunkSize = 1048576):
+  """
+  Compute the periods and amplitudes of the dominant modes in every row of the
+  supplied (series x time) array of even data. Batch version of
+  calc.DominantModeStructured.
+  """
+
+  values = SeriesArray(values)
+  nScans = values.shape[1]
+  times = numpy.arange(nScans) * dt
+
+  return BatchLombScargle(values, times, chunkSize = chunkSize).DominantModes(N = N, tMin = 2.0 * dt, tMax = nScans * dt)
+
+def DominantModesUnstructured(values, times, N = 250, tMin = None, tMax = None, maxScanCount = 65536, chunkSize = 1048576):
+  """
+  Compute the periods and amplitudes of the dominant modes in every row of the
+  supplied (series x time) array of uneven data, sampled at the supplied
+  times. Batch version of calc.DominantModeUnstructured.
+  """
+
+  debug.dprint("Finding dominant modes")
+
+  t, amp = BatchLombScargle(values, times, chunkSize = chunkSize).DominantModes(N = N, tMin = tMin, tMax = tMax, maxScanCount = maxScanCount)
+
+  debug.dprint("Done")
+
+  return t, amp
+
+class spectralUnittests(unittest.TestCase):
+  def testNormalisedFfts(self):
+    values = [[math.sin(2.0 * math.pi * i / 8.0) for i in range(16)], [1.0 for i in range(16)]]
+    amps, phases = NormalisedFfts(values, returnPhases = True)
+    self.assertEquals(amps.shape, (2, 9))
+    for i in range(2):
+      refAmps, refPhases = calc.NormalisedFft(values[i], returnPhases = True)
+      for j in range(9):
+        self.assertAlmostEquals(amps[i, j], refAmps[j])
+        self.assertAlmostEquals(phases[i, j], refPhases[j])
+
+    return
+
+  def testBatchLombScargle(self):
+    times = [0.37 * i + 0.2 * math.sin(7.0 * i) for i in range(200)]
+    values = [[math.sin(1.3 * time) + 0.5 * math.cos(4.1 * time) for time in times], \
+      [math.cos(0.7 * time) for time in times]]
+    omegas = [0.05 * i for i in range(200)]
+
+    ls = BatchLombScargle(values, times, chunkSize = 1000)
+    self.assertEquals(ls.SeriesCount(), 2)
+    self.assertEquals(ls.DataPointsCount(), 200)
+    direct = ls.EvaluateDirect(omegas)
+    extirpolated = ls.EvaluateExtirpolating(omegas)
+    self.assertEquals(direct.shape, (2, 200))
+    for i in range(2):
+      ref = calc.NormalisedLombScargle(values[i], times).EvaluateDirect(omegas)
+      for j in range(len(omegas)):
+        self.assertAlmostEquals(direct[i, j], ref[j])
+        self.assertAlmostEquals(extirpolated[i, j], ref[j], 6)
+    for i, periodograms in enumerate([ls.EvaluateDirect(omegas, series = [1]), ls.EvaluateExtirpolating(omegas, series = [1])]):
+      self.assertEquals(periodograms.shape, (1, 200))
+      for j in range(len(omegas)):
+        self.assertAlmostEquals(periodograms[0, j], [direct, extirpolated][i][1, j])
+    self.assertRaises(Exception, ls.EvaluateExtirpolating, [1.0, 2.0, 4.0])
+
+    return
+
+  def testDominantModes(self):
+    dt = 1.2
+    values = [[1.5 * math.sin(2.0 * math.pi * dt * float(i) / float(9)) for i in range(25)], \
+      [0.5 * math.cos(2.0 * math.pi * dt * float(i) / float(5)) for i in range(25)]]
+
+    t, amp = DominantModesStructured(values, dt)
+    self.assertAlmostEquals(t[0], 9.0, 0)
+    self.assertAlmostEquals(amp[0], 1.5, 1)
+    self.assertAlmostEquals(t[1], 5.0, 0)
+    self.assertAlmostEquals(amp[1], 0.5, 1)
+    for i in range(2):
+      refT, refAmp = calc.DominantModeStructured(values[i], dt)
+      self.assertAlmostEquals(t[i], refT)
+      self.assertAlmostEquals(amp[i], refAmp)
+
+    # Scanning one series at a time gives the same modes
+    chunkedT, chunkedAmp = BatchLombScargle(values, numpy.arange(25) * dt, chunkSize = 1).DominantModes(tMin = 2.0 * dt, tMax = 25 * dt)
+    for i in range(2):
+      self.assertAlmostEquals(chunkedT[i], t[i])
+      self.assertAlmostEquals(chunkedAmp[i], amp[i])
+
+    return
@@ -35,10 +35,10 @@ except:
 
 import fluidity.diagnostics.annulus_mesh as annulus_mesh
 import fluidity.diagnostics.calc as calc
-import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.meshes as meshes
 import fluidity.diagnostics.optimise as optimise
 import fluidity.diagnostics.utils as utils
+import fluidity.diagnostics.vtutools as vtktools
 
 class StructuredField2D:
   def __init__(self, xCoords, yCoords, type = None, shape = None, data = None, name = None):
@@ -134,6 +134,14 @@ class StructuredField2D:
   def GetData(self):
     return utils.ExpandList(self._data)
       
+  def GetDataArray(self):
+    """
+    Return the field data as an (x coords x y coords) array, with additional
+    trailing dimensions for fields with a shape
+    """
+    
+    return numpy.array(self._data, dtype = float)
+      
   def SetData(self, data):
     assert(len(data) <= self.XCoordsCount() * self.YCoordsCount())
     
@@ -154,55 +162,63 @@ class StructuredField2D:
     
     assert(self.XCoordsCount() > 0 and self.YCoordsCount() > 0)
     assert(x >= self.XCoord(0) and x <= self.XCoord(-1))
-    assert(y >= self.YCoord(0) and y < self.YCoord(-1))
+    assert(y >= self.YCoord(0) and y <= self.YCoord(-1))
     
-    # Peform a binary search for the left index
-    left = calc.IndexBinaryLboundSearch(x, self.XCoords())
-        
-    # Perform  a binary search for the lower index
-    lower = calc.IndexBinaryLboundSearch(y, self.YCoords())
-    
-    if self.XCoordsCount() > 1:
-      right = left + 1
-    else:
-      # This is slightly inefficient (could avoid a linear interpolation if we
-      # wanted)
-      right = left
-      
-    if self.YCoordsCount() > 1:
-      upper = lower + 1
-    else:
-      # This is slightly inefficient (could avoid a linear interpolation if we
-      # wanted)
-      upper = lower
+    # Find the bracketing indices and interpolation ratios
+    left, right, xRatio = calc.IndexBinaryBracketSearch(x, self.XCoords())
+    lower, upper, yRatio = calc.IndexBinaryBracketSearch(y, self.YCoords())
     
     debug.dprint("left = " + str(left), 3)
     debug.dprint("lower = " + str(lower), 3)
       
     return calc.BilinearlyInterpolate(self.GetVal(left, upper), self.GetVal(right, upper), self.GetVal(left, lower), self.GetVal(right, lower), \
-      (x - self.XCoord(left)) / (self.XCoord(right) - self.XCoord(left)), (y - self.YCoord(lower)) / (self.YCoord(upper) - self.YCoord(lower)))
+      xRatio, yRatio)
+      
+  def LinearlyInterpolateArray(self, x, y):
+    """
+    Probe the slice data at the supplied arrays of x and y coordinates, by
+    linearly interpolating from the surrounding data points. Returns an array
+    of values with one entry per coordinate.
+    """
+    
+    x = numpy.asarray(x, dtype = float)
+    y = numpy.asarray(y, dtype = float)
+    assert(x.shape == y.shape)
+    assert(self.XCoordsCount() > 0 and self.YCoordsCount() > 0)
+    if x.size > 0:
+      assert(x.min() >= self.XCoord(0) and x.max() <= self.XCoord(-1))
+      assert(y.min() >= self.YCoord(0) and y.max() <= self.YCoord(-1))
+    
+    # Find the bracketing indices and interpolation ratios for all coordinates
+    left, right, xRatio = calc.IndexBinaryBracketSearch(x, self.XCoords())
+    lower, upper, yRatio = calc.IndexBinaryBracketSearch(y, self.YCoords())
+    
+    data = self.GetDataArray()
+    ratioShape = x.shape + tuple(1 for i in range(len(data.shape) - 2))
+    xRatio.shape = ratioShape
+    yRatio.shape = ratioShape
+    
+    return calc.BilinearlyInterpolate(data[left, upper], data[right, upper], data[left, lower], data[right, lower], \
+      xRatio, yRatio)
       
   def Mesh(self, quadMesh = False):
-    mesh = meshes.Mesh(2)
-    
-    yxToNode = []
-    index = 0
-    for yCoord in self.YCoords():
-      yxToNode.append([])
-      for xCoord in self.XCoords():
-        mesh.AddNodeCoord([xCoord, yCoord])
-        yxToNode[-1].append(index)
-        index +=1
-            
-    for i in range(self.XCoordsCount())[:-1]:
-      for j in range(self.YCoordsCount())[:-1]:
-        if quadMesh:
-          mesh.AddVolumeElement(elements.Element([yxToNode[j + 1][i], yxToNode[j + 1][i + 1], yxToNode[j][i], yxToNode[j][i + 1]]))
-        else:
-          # Default to triangle mesh, as quad quadrature is currently broken in
-          # Fluidity
-          mesh.AddVolumeElement(elements.Element([yxToNode[j][i], yxToNode[j + 1][i], yxToNode[j][i + 1]]))
-          mesh.AddVolumeElement(elements.Element([yxToNode[j + 1][i], yxToNode[j + 1][i + 1], yxToNode[j][i + 1]]))
+    mesh = meshes.Mesh(2, arrayBacked = True)
+    
+    # Nodes are ordered with x varying fastest
+    xCoords, yCoords = numpy.meshgrid(numpy.array(self.XCoords(), dtype = float), numpy.array(self.YCoords(), dtype = float))
+    mesh.AddNodeCoordsArray(numpy.column_stack([xCoords.ravel(), yCoords.ravel()]))
+    yxToNode = numpy.arange(self.XCoordsCount() * self.YCoordsCount(), dtype = numpy.int64).reshape((self.YCoordsCount(), self.XCoordsCount()))
+    
+    # Cells are ordered with y varying fastest
+    i, j = [indices.ravel() for indices in numpy.meshgrid(numpy.arange(self.XCoordsCount() - 1), numpy.arange(self.YCoordsCount() - 1), indexing = "ij")]
+    if quadMesh:
+      nodes = numpy.column_stack([yxToNode[j + 1, i], yxToNode[j + 1, i + 1], yxToNode[j, i], yxToNode[j, i + 1]])
+    else:
+      # Default to triangle mesh, as quad quadrature is currently broken in
+      # Fluidity
+      nodes = numpy.column_stack([yxToNode[j, i], yxToNode[j + 1, i], yxToNode[j, i + 1], \
+        yxToNode[j + 1, i], yxToNode[j + 1, i + 1], yxToNode[j, i + 1]]).reshape((2 * len(i), 3))
+    mesh.AddVolumeElementsArray(nodes)
     
     return mesh
       
@@ -215,13 +231,9 @@ class StructuredField2D:
     if name is None:
       name = "UnknownField"
     
-    data = []
-    for i in range(self.YCoordsCount()):
-      for j in range(self.XCoordsCount()):
-        data.append(self.GetVal(j, i))
-    data = numpy.array(data)
-    data.shape = (self.XCoordsCount() * self.YCoordsCount(), self._DataLen())
-    vtu.AddField(name, data)
+    # Nodes are ordered with x varying fastest
+    data = numpy.swapaxes(self.GetDataArray(), 0, 1)
+    vtktools.VtuAddFieldArray(vtu, name, data.reshape((self.XCoordsCount() * self.YCoordsCount(), self._DataLen())))
     
     if not calc.AlmostEquals(axis[0], 0.0) or not calc.AlmostEquals(axis[1], 1.0) or not calc.AlmostEquals(axis[2], 0.0):
       transform = vtk.vtkTransform()
@@ -243,6 +255,22 @@ class StructuredField2D:
     
     return vtu
 
+  def ProjectToVtu(self, vtu, name = None):
+    """
+    Linearly interpolate the field onto the nodes of the supplied vtu, using
+    the x and y node coordinates, and add it to the vtu
+    """
+    
+    if name is None:
+      name = self.GetName()
+      if name is None:
+        name = "UnknownField"
+    
+    coords = vtktools.VtuPointCoordinates(vtu)
+    vtktools.VtuAddFieldArray(vtu, name, self.LinearlyInterpolateArray(coords[:, 0], coords[:, 1]))
+    
+    return
+
 class structured_fieldsUnittests(unittest.TestCase):
   def testStructuredField2D(self):
     field = StructuredField2D(annulus_mesh.SliceCoordsConstant(0.0, 1.0, 3), \
@@ -265,6 +293,15 @@ class structured_fieldsUnittests(unittest.TestCase):
     self.assertRaises(AssertionError, field.LinearlyInterpolate, 0.5, -0.1)
     self.assertRaises(AssertionError, field.LinearlyInterpolate, 0.5, 1.1)
     
+    vals = field.LinearlyInterpolateArray([0.5, 0.0, 0.5, 1.0], [0.0, 0.5, 0.5, 1.0])
+    self.assertEquals(vals.shape, (4, 1))
+    self.assertAlmostEquals(vals[0, 0], 0.5)
+    self.assertAlmostEquals(vals[1, 0], 1.0)
+    self.assertAlmostEquals(vals[2, 0], 1.5)
+    self.assertAlmostEquals(vals[3, 0], 3.0)
+    self.assertRaises(AssertionError, field.LinearlyInterpolateArray, [0.5, 1.1], [0.5, 0.5])
+    self.assertRaises(AssertionError, field.LinearlyInterpolateArray, [0.5, 0.5], [-0.1, 0.5])
+    
     return
     
   def testVtuInteroperability(self):
@@ -318,4 +355,15 @@ class structured_fieldsUnittests(unittest.TestCase):
     self.assertAlmostEquals(data[2], 2.0)
     self.assertAlmostEquals(data[3], 3.0)
     
+    # Test projection onto a vtu
+    vtu = StructuredField2D(annulus_mesh.SliceCoordsConstant(0.0, 1.0, 2), \
+      annulus_mesh.SliceCoordsConstant(0.0, 1.0, 2), \
+      type = float, shape = (1,), name = "Grid").ToVtu()
+    field.ProjectToVtu(vtu)
+    locations = vtu.GetLocations()
+    data = vtu.GetScalarField("Test")
+    self.assertEquals(len(data), 9)
+    for location, datum in zip(locations, data):
+      self.assertAlmostEquals(datum, location[0] + 2.0 * location[1])
+    
     return
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Batched operations on vector and tensor fields. Fields are stored as stacked
+arrays, with shape (N, dim) for vectors and (N, dim, dim) for tensors.
+"""
+
+import math
+import unittest
+
+import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
+def TensorArray(field):
+  """
+  Return the supplied tensor field as an (N, dim, dim) array. Accepts (N, dim,
+  dim) arrays or flattened (N, dim * dim) arrays.
+  """
+
+  field = numpy.asarray(field, dtype = float)
+  if len(field.shape) == 3:
+    assert(field.shape[1] == field.shape[2])
+    return field
+
+  assert(len(field.shape) == 2)
+  dim = int(round(math.sqrt(field.shape[1])))
+  assert(dim * dim == field.shape[1])
+
+  return field.reshape((field.shape[0], dim, dim))
+
+def SymmetricPart(tensors):
+  """
+  Return the symmetric parts of the supplied tensors
+  """
+
+  tensors = TensorArray(tensors)
+
+  return 0.5 * (tensors + tensors.transpose((0, 2, 1)))
+
+def SymmetricEigendecomposition(tensors, returnEigenvectors = False, chunkSize = 1048576):
+  """
+  Perform an eigendecomposition of each of the supplied symmetric tensors.
+  Eigenvalues are returned as an (N, dim) array, in increasing order for each
+  tensor. If returnEigenvectors is True, the eigenvectors are also returned,
+  as an (N, dim, dim) array with the eigenvector for eigenvalue i in column i.
+  Tensors are processed chunkSize at a time, to bound the memory used by
+  intermediate arrays.
+  """
+
+  tensors = TensorArray(tensors)
+  n, dim = tensors.shape[:2]
+
+  eigenvalues = numpy.empty((n, dim))
+  if returnEigenvectors:
+    eigenvectors = numpy.empty((n, dim, dim))
+  for start in range(0, n, chunkSize):
+    chunk = SymmetricPart(tensors[start:start + chunkSize])
+    if returnEigenvectors:
+      eigenvalues[start:start + chunkSize], eigenvectors[start:start + chunkSize] = numpy.linalg.eigh(chunk)
+    else:
+      eigenvalues[start:start + chunkSize] = numpy.linalg.eigvalsh(chunk)
+
+  if returnEigenvectors:
+    return eigenvalues, eigenvectors
+  else:
+    return eigenvalues
+
+def MinEigenvalues(tensors):
+  """
+  Return the minimum eigenvalue of each of the supplied symmetric tensors
+  """
+
+  return SymmetricEigendecomposition(tensors)[:, 0]
+
+def MaxEigenvalues(tensors):
+  """
+  Return the maximum eigenvalue of each of the supplied symmetric tensors
+  """
+
+  return SymmetricEigendecomposition(tensors)[:, -1]
+
+def MetricEdgeLengths(eigenvalues):
+  """
+  Return the edge lengths prescribed by the supplied metric tensor eigenvalues
+  """
+
+  return 1.0 / numpy.sqrt(eigenvalues)
+
+def RotationMatrix(angle, axis = None):
+  """
+  Return the matrix for a rotation by the supplied angle (in radians). In 2D
+  the axis must be None. In 3D the rotation is about the supplied axis,
+  following the right hand rule.
+  """
+
+  c, s = math.cos(angle), math.sin(angle)
+
+  if axis is None:
+    return numpy.array([[c, -s], [s, c]])
+
+  assert(len(axis) == 3)
+  axis = numpy.asarray(axis, dtype = float)
+  axis = axis / numpy.sqrt(numpy.dot(axis, axis))
+  cross = numpy.array([[0.0, -axis[2], axis[1]], [axis[2], 0.0, -axis[0]], [-axis[1], axis[0], 0.0]])
+
+  return c * numpy.identity(3) + s * cross + (1.0 - c) * numpy.outer(axis, axis)
+
+def RotatedVectors(vectors, angle, axis = None):
+  """
+  Rotate each of the supplied vectors
+  """
+
+  matrix = RotationMatrix(angle, axis = axis)
+
+  return numpy.einsum("ij,nj->ni", matrix, numpy.asarray(vectors, dtype = float))
+
+def RotatedTensors(tensors, angle, axis = None):
+  """
+  Rotate each of the supplied tensors
+  """
+
+  matrix = RotationMatrix(angle, axis = axis)
+
+  return numpy.einsum("ij,njk,lk->nil", matrix, TensorArray(tensors), matrix)
+
+class tensorsUnittests(unittest.TestCase):
+  def testTensorArray(self):
+    self.assertEquals(TensorArray(numpy.zeros((5, 9))).shape, (5, 3, 3))
+    self.assertEquals(TensorArray(numpy.zeros((5, 4))).shape, (5, 2, 2))
+    self.assertEquals(TensorArray(numpy.zeros((5, 3, 3))).shape, (5, 3, 3))
+    self.assertRaises(AssertionError, TensorArray, numpy.zeros((5, 3)))
+
+    return
+
+  def testSymmetricEigendecomposition(self):
+    tensors = [[[2.0, 0.0], [0.0, 1.0]], [[2.0, 1.0], [1.0, 2.0]], [[4.0, 0.0], [0.0, 4.0]]]
+    w = SymmetricEigendecomposition(tensors, chunkSize = 2)
+    self.assertEquals(w.shape, (3, 2))
+    self.assertAlmostEquals(w[0][0], 1.0)
+    self.assertAlmostEquals(w[0][1], 2.0)
+    self.assertAlmostEquals(w[1][0], 1.0)
+    self.assertAlmostEquals(w[1][1], 3.0)
+
+    w, v = SymmetricEigendecomposition(tensors, returnEigenvectors = True)
+    for i, tensor in enumerate(tensors):
+      for j in range(2):
+        self.assertTrue(numpy.allclose(numpy.dot(tensor, v[i][:, j]), w[i][j] * v[i][:, j]))
+
+    self.assertAlmostEquals(MinEigenvalues(tensors)[1], 1.0)
+    self.assertAlmostEquals(MaxEigenvalues(tensors)[1], 3.0)
+    self.assertAlmostEquals(MetricEdgeLengths(MinEigenvalues(tensors))[2], 0.5)
+
+    return
+
+  def testRotatedVectors(self):
+    vecs = RotatedVectors([[1.0, 0.0]], math.pi / 4.0)
+    self.assertAlmostEquals(vecs[0][0], 1.0 / math.sqrt(2))
+    self.assertAlmostEquals(vecs[0][1], 1.0 / math.sqrt(2))
+
+    vecs = RotatedVectors([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0]], math.pi / 4.0, axis = (0.0, 1.0, 0.0))
+    self.assertAlmostEquals(vecs[0][0], 1.0 / math.sqrt(2))
+    self.assertAlmostEquals(vecs[0][1], 0.0)
+    self.assertAlmostEquals(vecs[0][2], -1.0 / math.sqrt(2))
+    self.assertAlmostEquals(vecs[1][0], 1.0 / math.sqrt(2))
+    self.assertAlmostEquals(vecs[1][1], 0.0)
+    self.assertAlmostEquals(vecs[1][2], 1.0 / math.sqrt(2))
+
+    return
+
+  def testRotatedTensors(self):
+    tensors = RotatedTensors([[[1.0, 0.0, 0.0], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]], math.pi / 2.0, axis = (0.0, 0.0, 1.0))
+    self.assertTrue(numpy.allclose(tensors[0], [[0.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 0.0]]))
+
+    # Rotation preserves eigenvalues
+    tensors = numpy.array([[[3.0, 1.0, 0.0], [1.0, 2.0, 0.5], [0.0, 0.5, 1.0]]])
+    self.assertTrue(numpy.allclose(SymmetricEigendecomposition(RotatedTensors(tensors, 0.3, axis = (1.0, 2.0, 3.0))), SymmetricEigendecomposition(tensors)))
+
+    return
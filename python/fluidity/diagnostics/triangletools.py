@@ -28,29 +28,83 @@ import fluidity.diagnostics.debug as debug
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.filehandling as filehandling
 import fluidity.diagnostics.mesh_halos as mesh_halos
+import fluidity.diagnostics.mesh_cache as mesh_cache
 import fluidity.diagnostics.meshes as meshes
 import fluidity.diagnostics.utils as utils
 
-def ReadTriangle(baseName):
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
+def _ReadTriangleFile(filename, nHeader, dtype = None):
   """
-  Read triangle files with the given base name, and return it as a mesh
+  Read a triangle file in a single pass. Returns the header, as a list of
+  integers, and the entries, as an (entries x columns) array.
+  """
+  
+  if dtype is None:
+    dtype = numpy.int64
+  
+  tokens = filehandling.ReadTokens(filename, dtype = dtype)
+  assert(len(tokens) >= nHeader)
+  header = [int(token) for token in tokens[:nHeader]]
+  for value in header:
+    assert(value >= 0)
+  
+  nEntries = header[0]
+  data = tokens[nHeader:]
+  if nEntries == 0:
+    assert(len(data) == 0)
+    return header, data.reshape((0, 0))
+  assert(len(data) % nEntries == 0)
+  
+  return header, data.reshape((nEntries, len(data) // nEntries))
+  
+def _WriteTriangleFile(filename, header, data, format, footer):
+  """
+  Write a triangle file, with entries given as an (entries x columns) array
+  """
+  
+  fileHandle = open(filename, "w")
+  fileHandle.write(utils.FormLine(header))
+  filehandling.WriteRows(fileHandle, data, format)
+  fileHandle.write(footer)
+  fileHandle.close()
+  
+  return
+  
+def _TriangleElementData(nodes, ids):
+  """
+  Return triangle file entries for elements with the supplied nodes and IDs
+  """
+  
+  data = numpy.empty((nodes.shape[0], 1 + nodes.shape[1] + ids.shape[1]), dtype = numpy.int64)
+  data[:, 0] = numpy.arange(1, nodes.shape[0] + 1)
+  # Note: Triangle mesh indexes nodes from 1, Mesh s index nodes from 0
+  data[:, 1:1 + nodes.shape[1]] = nodes + 1
+  data[:, 1 + nodes.shape[1]:] = ids
+  
+  return data
+
+def ReadTriangle(baseName, cache = True):
+  """
+  Read triangle files with the given base name, and return it as a mesh. If
+  cache is True and the mesh cache is enabled, the mesh is loaded from the mesh
+  cache if a valid entry exists.
+  """
+  
+  if not cache:
+    return _ReadTriangle(baseName)
+  
+  filenames = [baseName + extension for extension in [".node", ".bound", ".edge", ".face", ".ele", ".halo"]]
+  
+  return mesh_cache.CachedRead("triangle", lambda: _ReadTriangle(baseName), filenames)
+
+def _ReadTriangle(baseName):
+  """
+  Parse triangle files with the given base name
   """
-      
-  def StripComment(line):
-    if "#" in line:
-      return line.split("#")[0]
-    else:
-      return line
-      
-  def ReadNonCommentLine(fileHandle):
-    line = fileHandle.readline()
-    while len(line) > 0:
-      line = StripComment(line).strip()
-      if len(line) > 0:
-        return line
-      line = fileHandle.readline()
-      
-    return line
   
   # Determine which files exist
   assert(filehandling.FileExists(baseName + ".node"))
@@ -61,158 +115,56 @@ def ReadTriangle(baseName):
   hasHalo = filehandling.FileExists(baseName + ".halo")
     
   # Read the .node file
-  
-  nodeHandle = file(baseName + ".node", "r")
-  
-  # Extract the meta data
-  line = ReadNonCommentLine(nodeHandle)
-  lineSplit = line.split()
-  assert(len(lineSplit) == 4)
-  nNodes = int(lineSplit[0])
-  assert(nNodes >= 0)
-  dim = int(lineSplit[1])
-  assert(dim >= 0)
-  nNodeAttrs = int(lineSplit[2])
-  assert(nNodeAttrs >= 0)
-  nNodeIds = int(lineSplit[3])
-  assert(nNodeIds >= 0)
-  
-  mesh = meshes.Mesh(dim)
-  
-  # Read the nodes
   debug.dprint("Reading .node file")
   
-  for line in nodeHandle.readlines():
-    line = StripComment(line)
-    if len(line.strip()) == 0:
-      continue
-    lineSplit = line.split()
-    assert(len(lineSplit) == 1 + dim + nNodeAttrs + nNodeIds)
-    mesh.AddNodeCoord([float(coord) for coord in lineSplit[1:dim + 1]])
-  assert(mesh.NodeCoordsCount() == nNodes)
-  nodeHandle.close()
+  (nNodes, dim, nNodeAttrs, nNodeIds), nodeData = _ReadTriangleFile(baseName + ".node", 4, dtype = float)
+  assert(nNodes == 0 or nodeData.shape[1] == 1 + dim + nNodeAttrs + nNodeIds)
+  
+  mesh = meshes.Mesh(dim, arrayBacked = True)
+  if nNodes > 0:
+    mesh.AddNodeCoordsArray(nodeData[:, 1:dim + 1])
+  del nodeData
     
   if hasBound and dim == 1:
     # Read the .bound file
     debug.dprint("Reading .bound file")
     
-    boundHandle = file(baseName + ".bound", "r")
-    
-    # Extract the meta data
-    line = ReadNonCommentLine(boundHandle)
-    lineSplit = line.split()
-    assert(len(lineSplit) == 2)
-    nBounds = int(lineSplit[0])
-    assert(nBounds >= 0)
-    nBoundIds = int(lineSplit[1])
-    assert(nBoundIds >= 0)
-    
-    # Read the bounds
-    for line in boundHandle.readlines():
-      line = StripComment(line)
-      if len(line.strip()) == 0:
-        continue
-      lineSplit = line.split()
-      assert(len(lineSplit) == 2 + nBoundIds)
-      element = elements.Element()
-      for node in lineSplit[1:2]:
-        element.AddNode(int(node) - 1)
-      element.SetIds([int(boundId) for boundId in lineSplit[2:]])
-      mesh.AddSurfaceElement(element)
+    (nBounds, nBoundIds), boundData = _ReadTriangleFile(baseName + ".bound", 2)
+    if nBounds > 0:
+      assert(boundData.shape[1] == 2 + nBoundIds)
+      mesh.AddSurfaceElementsArray(boundData[:, 1:2] - 1, ids = boundData[:, 2:])
     assert(mesh.SurfaceElementCount() == nBounds)
-    boundHandle.close()
     
   if hasEdge and dim == 2:
     # Read the .edge file
     debug.dprint("Reading .edge file")
     
-    edgeHandle = file(baseName + ".edge", "r")
-    
-    # Extract the meta data
-    line = ReadNonCommentLine(edgeHandle)
-    lineSplit = line.split()
-    assert(len(lineSplit) == 2)
-    nEdges = int(lineSplit[0])
-    assert(nEdges >= 0)
-    nEdgeIds = int(lineSplit[1])
-    assert(nEdgeIds >= 0)
-    
-    # Read the edges
-    for line in edgeHandle.readlines():
-      line = StripComment(line)
-      if len(line.strip()) == 0:
-        continue
-      lineSplit = line.split()
-      assert(len(lineSplit) == 3 + nEdgeIds)
-      element = elements.Element()
-      for node in lineSplit[1:3]:
-        element.AddNode(int(node) - 1)
-      element.SetIds([int(edgeId) for edgeId in lineSplit[3:]])
-      mesh.AddSurfaceElement(element)
+    (nEdges, nEdgeIds), edgeData = _ReadTriangleFile(baseName + ".edge", 2)
+    if nEdges > 0:
+      assert(edgeData.shape[1] == 3 + nEdgeIds)
+      mesh.AddSurfaceElementsArray(edgeData[:, 1:3] - 1, ids = edgeData[:, 3:])
     assert(mesh.SurfaceElementCount() == nEdges)
-    edgeHandle.close()
       
   if hasFace and dim > 2:
     # Read the .face file
     debug.dprint("Reading .face file")
     
-    faceHandle = file(baseName + ".face", "r")
-    
-    # Extract the meta data
-    line = ReadNonCommentLine(faceHandle)
-    lineSplit = line.split()
-    assert(len(lineSplit) == 2)
-    nFaces = int(lineSplit[0])
-    assert(nFaces >= 0)
-    nFaceIds = int(lineSplit[1])
-    assert(nFaceIds >= 0)
-    
-    # Read the faces
-    for line in faceHandle.readlines():
-      line = StripComment(line)
-      if len(line.strip()) == 0:
-        continue
-      lineSplit = line.split()
-      assert(len(lineSplit) >= 4 + nFaceIds)
-      element = elements.Element()
-      for node in lineSplit[1:len(lineSplit) - nFaceIds]:
-        element.AddNode(int(node) - 1)
-      element.SetIds([int(faceId) for faceId in lineSplit[len(lineSplit) - nFaceIds:]])
-      mesh.AddSurfaceElement(element)
+    (nFaces, nFaceIds), faceData = _ReadTriangleFile(baseName + ".face", 2)
+    if nFaces > 0:
+      assert(faceData.shape[1] >= 4 + nFaceIds)
+      nodesEnd = faceData.shape[1] - nFaceIds
+      mesh.AddSurfaceElementsArray(faceData[:, 1:nodesEnd] - 1, ids = faceData[:, nodesEnd:])
     assert(mesh.SurfaceElementCount() == nFaces)
-    faceHandle.close()
     
   if hasEle:
     # Read the .ele file
     debug.dprint("Reading .ele file")
     
-    eleHandle = file(baseName + ".ele", "r")
-    
-    # Extract the meta data
-    line = ReadNonCommentLine(eleHandle)
-    lineSplit = line.split()
-    assert(len(lineSplit) == 3)
-    nEles = int(lineSplit[0])
-    assert(nEles >= 0)
-    nNodesPerEle = int(lineSplit[1])
-    assert(nNodesPerEle >= 0)
-    nEleIds = int(lineSplit[2])
-    assert(nEleIds >= 0)
-    
-    # Read the eles
-    for line in eleHandle.readlines():
-      line = StripComment(line)
-      if len(line.strip()) == 0:
-        continue
-      lineSplit = line.split()
-      assert(len(lineSplit) == 1 + nNodesPerEle + nEleIds)
-      element = elements.Element()
-      for node in lineSplit[1:len(lineSplit) - nEleIds]:
-        element.AddNode(int(node) - 1)
-      element.SetIds([int(eleId) for eleId in lineSplit[len(lineSplit) - nEleIds:]])
-      mesh.AddVolumeElement(element)
+    (nEles, nNodesPerEle, nEleIds), eleData = _ReadTriangleFile(baseName + ".ele", 3)
+    if nEles > 0:
+      assert(eleData.shape[1] == 1 + nNodesPerEle + nEleIds)
+      mesh.AddVolumeElementsArray(eleData[:, 1:1 + nNodesPerEle] - 1, ids = eleData[:, 1 + nNodesPerEle:])
     assert(mesh.VolumeElementCount() == nEles)
-    eleHandle.close()
     
   if hasHalo:
     # Read the .halo file
@@ -235,108 +187,40 @@ def WriteTriangle(mesh, baseName):
     return "# Created by triangletools.WriteTriangle\n" + \
            "# Command: " + " ".join(sys.argv) + "\n" + \
            "# " + str(time.ctime()) + "\n"
+           
+  def ElementData(nodes, ids):
+    if nodes.shape[0] == 0:
+      return numpy.empty((0, 0), dtype = numpy.int64), 0
+    else:
+      return _TriangleElementData(nodes, ids), ids.shape[1]
 
   debug.dprint("Writing triangle mesh with base name " + baseName)
     
   # Write the .node file
   debug.dprint("Writing .node file")
   
-  nodeHandle = file(baseName + ".node", "w")
-  
-  # Write the meta data
-  nodeHandle.write(utils.FormLine([mesh.NodeCount(), mesh.GetDim(), 0, 0]))
+  nodeData = numpy.empty((mesh.NodeCount(), 1 + mesh.GetDim()))
+  nodeData[:, 0] = numpy.arange(1, mesh.NodeCount() + 1)
+  nodeData[:, 1:] = mesh.GetNodeCoordsArray()
+  _WriteTriangleFile(baseName + ".node", [mesh.NodeCount(), mesh.GetDim(), 0, 0], nodeData, "%d" + " %r" * mesh.GetDim() + "\n", FileFooter())
+  del nodeData
   
-  # Write the nodes
-  for i in range(mesh.NodeCount()):
-    nodeHandle.write(utils.FormLine([i + 1, mesh.GetNodeCoord(i)]))
-  nodeHandle.write(FileFooter())
-  nodeHandle.close()
-    
-  if mesh.GetDim() == 1:
-    # Write the .bound file
-    debug.dprint("Writing .bound file")
-    
-    boundHandle = file(baseName + ".bound", "w")
-    
-    # Write the meta data
-    nBoundIds = 0
-    for i in range(mesh.SurfaceElementCount()):
-      if i == 0:
-        nBoundIds = len(mesh.GetSurfaceElement(i).GetIds())
-      else:
-        assert(nBoundIds == len(mesh.GetSurfaceElement(i).GetIds()))
-    boundHandle.write(utils.FormLine([mesh.SurfaceElementCount(), nBoundIds]))
-    
-    # Write the bounds
-    for i in range(mesh.SurfaceElementCount()):
-      boundHandle.write(utils.FormLine([i + 1, utils.OffsetList(mesh.GetSurfaceElement(i).GetNodes(), 1), mesh.GetSurfaceElement(i).GetIds()]))
-    boundHandle.write(FileFooter())
-    boundHandle.close()
-  elif mesh.GetDim() == 2:
-    # Write the .edge file
-    debug.dprint("Writing .edge file")
+  if mesh.GetDim() in [1, 2, 3]:
+    # Write the .bound, .edge or .face file
+    extension = {1:".bound", 2:".edge", 3:".face"}[mesh.GetDim()]
+    debug.dprint("Writing " + extension + " file")
     
-    edgeHandle = file(baseName + ".edge", "w")
-    
-    # Write the meta data
-    nEdgeIds = 0
-    for i in range(mesh.SurfaceElementCount()):
-      if i == 0:
-        nEdgeIds = len(mesh.GetSurfaceElement(i).GetIds())
-      else:
-        assert(nEdgeIds == len(mesh.GetSurfaceElement(i).GetIds()))
-    edgeHandle.write(utils.FormLine([mesh.SurfaceElementCount(), nEdgeIds]))
-    
-    # Write the edges
-    for i in range(mesh.SurfaceElementCount()):
-      edgeHandle.write(utils.FormLine([i + 1, utils.OffsetList(mesh.GetSurfaceElement(i).GetNodes(), 1), mesh.GetSurfaceElement(i).GetIds()]))
-    edgeHandle.write(FileFooter())
-    edgeHandle.close()
-  elif mesh.GetDim() == 3:
-    # Write the .face file
-    debug.dprint("Writing .face file")
-    
-    faceHandle = file(baseName + ".face", "w")
-    
-    # Write the meta data
-    nFaceIds = 0
-    for i in range(mesh.SurfaceElementCount()):
-      if i == 0:
-        nFaceIds = len(mesh.GetSurfaceElement(i).GetIds())
-      else:
-        assert(nFaceIds == len(mesh.GetSurfaceElement(i).GetIds()))
-    faceHandle.write(utils.FormLine([mesh.SurfaceElementCount(), nFaceIds]))
-    
-    # Write the faces
-    for i in range(mesh.SurfaceElementCount()):
-      faceHandle.write(utils.FormLine([i + 1, utils.OffsetList(mesh.GetSurfaceElement(i).GetNodes(), 1), mesh.GetSurfaceElement(i).GetIds()]))
-    faceHandle.write(FileFooter())
-    faceHandle.close()
+    surfaceData, nSurfaceIds = ElementData(mesh.GetSurfaceElementNodesArray(), mesh.GetSurfaceElementIdsArray())
+    _WriteTriangleFile(baseName + extension, [mesh.SurfaceElementCount(), nSurfaceIds], surfaceData, " ".join(["%d" for i in range(surfaceData.shape[1])]) + "\n", FileFooter())
+    del surfaceData
     
   # Write the .ele file
   debug.dprint("Writing .ele file")
   
-  eleHandle = file(baseName + ".ele", "w")
-  
-  # Write the meta data
-  nNodesPerEle = 0
-  nEleIds = 0
-  for i in range(mesh.VolumeElementCount()):
-    if i == 0:
-      nEleIds = len(mesh.GetVolumeElement(i).GetIds())
-      nNodesPerEle = mesh.GetVolumeElement(i).GetLoc()
-    else:
-      assert(nEleIds == len(mesh.GetVolumeElement(i).GetIds()))
-      assert(nNodesPerEle == mesh.GetVolumeElement(i).GetLoc())
-  eleHandle.write(utils.FormLine([mesh.VolumeElementCount(), nNodesPerEle, nEleIds]))
-  
-  # Write the eles
-  for i in range(mesh.VolumeElementCount()):
-    # Note: Triangle mesh indexes nodes from 1, Mesh s index nodes from 0
-    eleHandle.write(utils.FormLine([i + 1, utils.OffsetList(mesh.GetVolumeElement(i).GetNodes(), 1), mesh.GetVolumeElement(i).GetIds()]))
-  eleHandle.write(FileFooter())
-  eleHandle.close()
-  
+  nodes = mesh.GetVolumeElementNodesArray()
+  eleData, nEleIds = ElementData(nodes, mesh.GetVolumeElementIdsArray())
+  _WriteTriangleFile(baseName + ".ele", [mesh.VolumeElementCount(), nodes.shape[1], nEleIds], eleData, " ".join(["%d" for i in range(eleData.shape[1])]) + "\n", FileFooter())
+  del eleData
   
   halos = mesh.GetHalos()
   if halos.HaloCount() > 0:
@@ -395,3 +279,37 @@ class triangletoolsUnittests(unittest.TestCase):
     self.assertEquals(oldMesh.VolumeElementCount(), newMesh.VolumeElementCount())
     
     return
+    
+  def testTriangleFileParsing(self):
+    tempDir = tempfile.mkdtemp()
+    baseName = os.path.join(tempDir, "temp")
+    fileHandle = open(baseName + ".node", "w")
+    fileHandle.write("# Comment\n4 3 0 0\n1 0.0 0.0 0.0 # Comment\n\n2 1.0 0.0 0.0\n3 0.0 1.0 0.0\n4 0.0 0.0 1.0\n# Comment\n")
+    fileHandle.close()
+    fileHandle = open(baseName + ".face", "w")
+    fileHandle.write("2 2\n1 1 2 3 5 1\n2 1 2 4 6 1\n")
+    fileHandle.close()
+    fileHandle = open(baseName + ".ele", "w")
+    fileHandle.write("1 4 1\n1 1 2 3 4 9\n")
+    fileHandle.close()
+    
+    mesh = ReadTriangle(baseName)
+    self.assertEquals(mesh.GetDim(), 3)
+    self.assertEquals(mesh.GetNodeCoordsArray().tolist(), [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    self.assertEquals(mesh.GetSurfaceElementNodesArray().tolist(), [[0, 1, 2], [0, 1, 3]])
+    self.assertEquals(mesh.GetSurfaceElementIdsArray().tolist(), [[5, 1], [6, 1]])
+    self.assertEquals(mesh.GetVolumeElement(0).GetNodes(), [0, 1, 2, 3])
+    self.assertEquals(mesh.GetVolumeElement(0).GetIds(), [9])
+    
+    # Element IDs can be extended in place
+    for element in mesh.GetSurfaceElements():
+      ids = element.GetIds()
+      element.SetIds([ids[0], 0, 0, ids[1]])
+    WriteTriangle(mesh, baseName)
+    newMesh = ReadTriangle(baseName)
+    filehandling.Rmdir(tempDir, force = True)
+    self.assertEquals(newMesh.GetNodeCoordsArray().tolist(), mesh.GetNodeCoordsArray().tolist())
+    self.assertEquals(newMesh.GetSurfaceElementIdsArray().tolist(), [[5, 0, 0, 1], [6, 0, 0, 1]])
+    self.assertEquals(newMesh.GetVolumeElementIdsArray().tolist(), [[9]])
+    
+    return
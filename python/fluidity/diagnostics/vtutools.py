@@ -30,16 +30,23 @@ try:
 except ImportError:
   debug.deprint("Warning: Failed to import vtk module")
 
+try:
+  from vtk.util import numpy_support
+except ImportError:
+  debug.deprint("Warning: Failed to import vtk.util.numpy_support module")
+
 try:
   from vtktools import *
 except ImportError:
   debug.deprint("Warning: Failed to import vtktools module")
   
+import fluidity.diagnostics.adjacency as adjacency
 import fluidity.diagnostics.bounds as bounds
 import fluidity.diagnostics.calc as calc
 import fluidity.diagnostics.elements as elements
 import fluidity.diagnostics.optimise as optimise
 import fluidity.diagnostics.simplices as simplices
+import fluidity.diagnostics.tensors as tensors
 import fluidity.diagnostics.utils as utils
 
 def VtkSupport():
@@ -720,6 +727,157 @@ def RingVtuProbe(inputVtu, fieldName, radius, origin = (0.0, 0.0, 0.0), normal =
 
   return cutVtu.GetLocations(), cutVtu.GetField(fieldName)
   
+def LineTransectCoordinates(origins, directions, distances):
+  """
+  Return sample coordinates along lines, as a (lines x samples x 3) array. The
+  supplied directions are normalised, and the lines are sampled at the
+  supplied distances from their origins.
+  """
+  
+  origins = numpy.asarray(origins, dtype = float)
+  directions = numpy.asarray(directions, dtype = float)
+  distances = numpy.asarray(distances, dtype = float)
+  assert(origins.shape == directions.shape)
+  assert(origins.shape[1] == 3)
+  
+  directions = directions / numpy.sqrt((directions ** 2).sum(axis = 1))[:, numpy.newaxis]
+  
+  return origins[:, numpy.newaxis, :] + distances[numpy.newaxis, :, numpy.newaxis] * directions[:, numpy.newaxis, :]
+  
+def RingTransectCoordinates(radii, angles, origins, normals):
+  """
+  Return sample coordinates around rings, as a (rings x samples x 3) array.
+  Ring i has radius radii[i], centre origins[i] and normal normals[i], and is
+  sampled at the supplied angles (in radians).
+  """
+  
+  radii = numpy.asarray(radii, dtype = float)
+  angles = numpy.asarray(angles, dtype = float)
+  origins = numpy.asarray(origins, dtype = float)
+  normals = numpy.asarray(normals, dtype = float)
+  assert(origins.shape == normals.shape)
+  assert(origins.shape[1] == 3)
+  assert(len(radii) == origins.shape[0])
+  
+  normals = normals / numpy.sqrt((normals ** 2).sum(axis = 1))[:, numpy.newaxis]
+  # Form an orthonormal basis for each ring plane, using the coordinate axis
+  # least aligned with the normal
+  axes = numpy.identity(3)[numpy.argmin(numpy.abs(normals), axis = 1)]
+  e1 = numpy.cross(normals, axes)
+  e1 /= numpy.sqrt((e1 ** 2).sum(axis = 1))[:, numpy.newaxis]
+  e2 = numpy.cross(normals, e1)
+  
+  cos, sin = numpy.cos(angles), numpy.sin(angles)
+  
+  return origins[:, numpy.newaxis, :] + radii[:, numpy.newaxis, numpy.newaxis] * (cos[numpy.newaxis, :, numpy.newaxis] * e1[:, numpy.newaxis, :] + sin[numpy.newaxis, :, numpy.newaxis] * e2[:, numpy.newaxis, :])
+
+class VtuTransectProbe:
+  """
+  Class for probing vtu fields at many sample points at once, such as points
+  along many lines or rings. The cell search is performed, and the
+  interpolation weights are computed, once on construction. Fields can then be
+  probed from any vtu sharing the mesh of the input vtu (e.g. other dumps from
+  a fixed mesh simulation).
+  """
+  
+  def __init__(self, inputVtu, coordinates):
+    coordinates = numpy.asarray(coordinates, dtype = float)
+    assert(coordinates.shape[-1] == 3)
+    self._shape = coordinates.shape[:-1]
+    coordinates = coordinates.reshape((coordinates.size // 3, 3))
+    
+    self._inputVtu = inputVtu
+    self._coordinates = coordinates
+    
+    locator = vtk.vtkCellLocator()
+    locator.SetDataSet(inputVtu.ugrid)
+    locator.BuildLocator()
+    
+    offsets, nodes = VtuCellConnectivity(inputVtu)
+    maxNloc = numpy.diff(offsets).max() if len(offsets) > 1 else 1
+    
+    cell = vtk.vtkGenericCell()
+    pcoords = [0.0, 0.0, 0.0]
+    cellWeights = [0.0 for i in range(maxNloc)]
+    cells = numpy.empty(len(coordinates), dtype = numpy.int64)
+    self._weights = numpy.zeros((len(coordinates), maxNloc))
+    for i, coord in enumerate(coordinates):
+      cells[i] = locator.FindCell(coord, 0.0, cell, pcoords, cellWeights)
+      self._weights[i] = cellWeights
+    
+    self._valid = cells >= 0
+    cells[numpy.logical_not(self._valid)] = 0
+    
+    # Pad the cell nodes to the maximum node count, with zero weights
+    nlocs = numpy.diff(offsets)[cells] if len(offsets) > 1 else numpy.zeros(len(cells), dtype = numpy.int64)
+    local = numpy.arange(maxNloc)[numpy.newaxis, :]
+    mask = local < nlocs[:, numpy.newaxis]
+    self._nodes = numpy.zeros((len(coordinates), maxNloc), dtype = numpy.int64)
+    self._nodes[mask] = nodes[(offsets[cells][:, numpy.newaxis] + local)[mask]]
+    self._weights[numpy.logical_not(mask)] = 0.0
+    
+    debug.dprint("Transect sample points: " + str(len(coordinates)) + ", outside mesh: " + str(len(coordinates) - numpy.count_nonzero(self._valid)), 2)
+    
+    return
+    
+  def GetCoordinates(self):
+    """
+    Return the sample coordinates
+    """
+    
+    return self._coordinates.reshape(self._shape + (3,))
+    
+  def GetValid(self):
+    """
+    Return whether each sample point lies inside the mesh
+    """
+    
+    return self._valid.reshape(self._shape)
+    
+  def ProbeArray(self, field):
+    """
+    Interpolate the supplied (nodes x components) field array at the sample
+    points. Returns a (sample shape x components) array, with values at
+    sample points outside the mesh set to NaN.
+    """
+    
+    field = numpy.asarray(field, dtype = float)
+    if len(field.shape) == 1:
+      field = field[:, numpy.newaxis]
+    
+    result = numpy.einsum("ij,ijk->ik", self._weights, field[self._nodes])
+    result[numpy.logical_not(self._valid)] = numpy.nan
+    
+    return result.reshape(self._shape + (field.shape[1],))
+    
+  def GetField(self, fieldName, vtu = None):
+    """
+    Probe the named field at the sample points. If vtu is supplied the field is
+    read from it, and it must share the mesh of the input vtu.
+    """
+    
+    if vtu is None:
+      vtu = self._inputVtu
+    assert(vtu.ugrid.GetNumberOfPoints() == self._inputVtu.ugrid.GetNumberOfPoints())
+    
+    return self.ProbeArray(VtuFieldArray(vtu, fieldName))
+    
+def LineVtuTransects(inputVtu, origins, directions, distances):
+  """
+  Return a VtuTransectProbe for sampling along many lines at once. See
+  LineTransectCoordinates.
+  """
+  
+  return VtuTransectProbe(inputVtu, LineTransectCoordinates(origins, directions, distances))
+  
+def RingVtuTransects(inputVtu, radii, angles, origins, normals):
+  """
+  Return a VtuTransectProbe for sampling around many rings at once. See
+  RingTransectCoordinates.
+  """
+  
+  return VtuTransectProbe(inputVtu, RingTransectCoordinates(radii, angles, origins, normals))
+  
 def IsosurfaceVtuCut(inputVtu, scalarField, value):
   """
   Perform an isosurface cut
@@ -805,66 +963,87 @@ def BlankCopyVtu(inputVtu):
   return result
   
     
-def RemappedVtu(inputVtu, targetVtu):
+class VtuRemapper:
   """
-  Remap (via probing) the input vtu onto the mesh of the target vtu
+  Class for remapping (via probing) fields from an input vtu onto the meshes of
+  target vtus. The node locator used for target nodes outside the input mesh
+  is built once, and the cell search structure of the input vtu is cached by
+  VTK on the input grid, so remapping onto many targets reuses one spatial
+  index.
   """
-      
-  coordinates = targetVtu.GetLocations()
-      
-  ### The following is lifted from vtu.ProbeData in tools/vtktools.py (with 
-  ### self -> inputVtu and invalid node remapping rather than repositioning)
-  # Initialise locator
-  locator = vtk.vtkPointLocator()
-  locator.SetDataSet(inputVtu.ugrid)
-  locator.SetTolerance(10.0)
-  locator.Update()
-
-  # Initialise probe
-  points = vtk.vtkPoints()
-  ilen, jlen = coordinates.shape
-  for i in range(ilen):
-    points.InsertNextPoint(coordinates[i][0], coordinates[i][1], coordinates[i][2])
-  polydata = vtk.vtkPolyData()
-  polydata.SetPoints(points)
-  probe = vtk.vtkProbeFilter()
-  if vtk.vtkVersion.GetVTKMajorVersion() <= 5:
-    probe.SetInput(polydata)
-    probe.SetSource(inputVtu.ugrid)
-  else:
-    probe.SetInputData(polydata)
-    probe.SetSourceData(inputVtu.ugrid)
-  probe.Update()
-
-  # Generate a list invalidNodes, containing a map from invalid nodes in the
-  # result to their closest nodes in the input
-  valid_ids = probe.GetValidPoints()
-  valid_loc = 0
-  invalidNodes = []
-  for i in range(ilen):
-    if valid_ids.GetTuple1(valid_loc) == i:
-      valid_loc += 1
+  
+  def __init__(self, inputVtu):
+    self._inputVtu = inputVtu
+    
+    self._locator = vtk.vtkPointLocator()
+    self._locator.SetDataSet(inputVtu.ugrid)
+    self._locator.SetTolerance(10.0)
+    self._locator.BuildLocator()
+    
+    self._probe = vtk.vtkProbeFilter()
+    if vtk.vtkVersion.GetVTKMajorVersion() <= 5:
+      self._probe.SetSource(inputVtu.ugrid)
     else:
-      nearest = locator.FindClosestPoint([coordinates[i][0], coordinates[i][1], coordinates[i][2]])
-      invalidNodes.append((i, nearest))
-  ### End of code from vtktools.py
-
-  # Construct output  
-  result = vtu()
-  result.ugrid = PolyDataToUnstructuredGrid(probe.GetOutput())
-  # Add the cells
-  result.ugrid.SetCells(targetVtu.ugrid.GetCellTypesArray(), targetVtu.ugrid.GetCellLocationsArray(), targetVtu.ugrid.GetCells())
-  # Fix the point data at invalid nodes
-  if len(invalidNodes) > 0:
-    for i in range(inputVtu.ugrid.GetPointData().GetNumberOfArrays()):
-      oldField = inputVtu.ugrid.GetPointData().GetArray(i)
-      newField = result.ugrid.GetPointData().GetArray(i)      
-      components = oldField.GetNumberOfComponents()
-      for invalidNode, nearest in invalidNodes:
-        for comp in range(components):
-          newField.SetValue(invalidNode * components + comp, oldField.GetValue(nearest * components + comp))
-            
-  return result
+      self._probe.SetSourceData(inputVtu.ugrid)
+    
+    return
+    
+  def GetInputVtu(self):
+    return self._inputVtu
+    
+  def Remap(self, targetVtu):
+    """
+    Remap the input vtu onto the mesh of the target vtu. Target nodes outside
+    the input mesh take the values at their closest input nodes.
+    """
+    
+    coordinates = VtuPointCoordinates(targetVtu)
+    
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    points.SetData(numpy_support.numpy_to_vtk(coordinates, deep = 1))
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    if vtk.vtkVersion.GetVTKMajorVersion() <= 5:
+      self._probe.SetInput(polydata)
+    else:
+      self._probe.SetInputData(polydata)
+    self._probe.Update()
+    
+    # Map the invalid nodes in the result to their closest nodes in the input
+    valid = numpy.zeros(len(coordinates), dtype = bool)
+    validIds = self._probe.GetValidPoints()
+    if validIds.GetNumberOfTuples() > 0:
+      valid[numpy_support.vtk_to_numpy(validIds).astype(numpy.int64)] = True
+    invalidNodes = numpy.nonzero(numpy.logical_not(valid))[0]
+    nearestNodes = numpy.array([self._locator.FindClosestPoint(coordinates[node]) for node in invalidNodes], dtype = numpy.int64)
+    
+    # Construct output
+    result = vtu()
+    result.ugrid.SetPoints(points)
+    result.ugrid.SetCells(targetVtu.ugrid.GetCellTypesArray(), targetVtu.ugrid.GetCellLocationsArray(), targetVtu.ugrid.GetCells())
+    probePointData = self._probe.GetOutput().GetPointData()
+    inputPointData = self._inputVtu.ugrid.GetPointData()
+    for i in range(probePointData.GetNumberOfArrays()):
+      newField = vtk.vtkDataArray.CreateDataArray(probePointData.GetArray(i).GetDataType())
+      newField.DeepCopy(probePointData.GetArray(i))
+      oldField = inputPointData.GetArray(newField.GetName())
+      if len(invalidNodes) > 0 and not oldField is None:
+        # Fix the point data at invalid nodes
+        newValues = numpy_support.vtk_to_numpy(newField)
+        newValues[invalidNodes] = numpy_support.vtk_to_numpy(oldField)[nearestNodes]
+        newField.Modified()
+      result.ugrid.GetPointData().AddArray(newField)
+    
+    return result
+    
+def RemappedVtu(inputVtu, targetVtu):
+  """
+  Remap (via probing) the input vtu onto the mesh of the target vtu. Use a
+  VtuRemapper directly when remapping the same input onto several targets.
+  """
+  
+  return VtuRemapper(inputVtu).Remap(targetVtu)
   
 def ZeroField(components, tuples):
   """
@@ -970,25 +1149,17 @@ def RotateVtuField(vtu, fieldName, axis, angle):
   Rotate a field in a vtu
   """
   
-  field = vtu.GetField(fieldName)
   rank = VtuFieldRank(vtu, fieldName)
   if rank == 0:
     # Scalar field rotation (i.e., do nothing)
     pass
   elif rank == 1:
     # Vector field rotation
-    newField = []
-    for val in field:
-      newField.append(calc.RotatedVector(val, angle, axis = axis))
-    newField = numpy.array(newField)
-    vtu.AddVectorField(fieldName, newField)
+    VtuAddFieldArray(vtu, fieldName, tensors.RotatedVectors(VtuFieldArray(vtu, fieldName), angle, axis = axis))
+    vtu.ugrid.GetPointData().SetActiveVectors(fieldName)
   elif rank == 2:
     # Tensor field rotation
-    newField = []
-    for val in field:
-      newField.append(calc.RotatedTensor(val, angle, axis = axis))
-    newField = numpy.array(newField)
-    vtu.AddField(fieldName, newField)
+    VtuAddFieldArray(vtu, fieldName, tensors.RotatedTensors(VtuFieldArray(vtu, fieldName), angle, axis = axis))
   else:
     # Erm, erm ...
     raise Exception("Unexpected data shape: " + str(VtuFieldShape(vtu, fieldName)))
@@ -1015,10 +1186,9 @@ def RotateVtu(vtu, axis, angle):
   """
   
   # Rotate the locations
-  locations = vtu.GetLocations()
   newLocations = vtk.vtkPoints()
-  for location in locations:
-    newLocations.InsertNextPoint(calc.RotatedVector(location, angle, axis = axis))
+  newLocations.SetDataTypeToDouble()
+  newLocations.SetData(numpy_support.numpy_to_vtk(tensors.RotatedVectors(VtuPointCoordinates(vtu), angle, axis = axis), deep = 1))
   vtu.ugrid.SetPoints(newLocations)
     
   # Rotate the fields
@@ -1153,18 +1323,11 @@ def VtuFieldRank(vtu, fieldName):
  
 def MinVtuFieldEigenvalue(vtu, fieldName):
   """
-  Return a field containing the minimum eigenvalues of the supplied tensor
-  field
+  Return a field containing the minimum eigenvalues of the supplied symmetric
+  tensor field
   """
 
-  field = vtu.GetField(fieldName)
-  eigField = []
-  for val in field:
-    eigField.append(calc.MinVal(calc.Eigendecomposition(val, returnEigenvectors = False)))
-
-  eigField = numpy.array(eigField)
-
-  return eigField
+  return tensors.MinEigenvalues(VtuFieldArray(vtu, fieldName))
   
 def VtuGetCellFieldNames(vtu):
   """
@@ -1315,41 +1478,81 @@ def TimeAveragedVtu(filenames, timeFieldName = "Time", baseMesh = None, baseVtu
   
   return result
   
-def VtuNeList(vtu):
+def VtuCellConnectivity(vtu):
   """
-  Generate the node-element list for the supplied vtu
+  Return the cell-node connectivity of the supplied vtu, in compressed sparse
+  row form (see adjacency.py)
   """
   
-  nodeCount = vtu.ugrid.GetNumberOfPoints()
+  cells = vtu.ugrid.GetCells()
+  if cells is None or vtu.ugrid.GetNumberOfCells() == 0:
+    return numpy.zeros(1, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64)
+  
+  if hasattr(cells, "GetOffsetsArray"):
+    # VTK >= 9 stores offsets and connectivity separately
+    offsets = numpy_support.vtk_to_numpy(cells.GetOffsetsArray()).astype(numpy.int64)
+    nodes = numpy_support.vtk_to_numpy(cells.GetConnectivityArray()).astype(numpy.int64)
+  else:
+    # Legacy format: each cell is stored as its node count, followed by its
+    # nodes
+    data = numpy_support.vtk_to_numpy(cells.GetData()).astype(numpy.int64)
+    locations = numpy_support.vtk_to_numpy(vtu.ugrid.GetCellLocationsArray()).astype(numpy.int64)
+    counts = data[locations]
+    mask = numpy.ones(len(data), dtype = bool)
+    mask[locations] = False
+    nodes = data[mask]
+    offsets = numpy.zeros(len(counts) + 1, dtype = numpy.int64)
+    numpy.cumsum(counts, out = offsets[1:])
+  
+  return offsets, nodes
+  
+def VtuCellTypes(vtu):
+  """
+  Return an array containing the VTK cell type of each cell in the supplied vtu
+  """
+  
+  if vtu.ugrid.GetNumberOfCells() == 0:
+    return numpy.zeros(0, dtype = numpy.int64)
+  
+  return numpy_support.vtk_to_numpy(vtu.ugrid.GetCellTypesArray()).astype(numpy.int64)
   
-  neList = []
-  for i in range(nodeCount):
-    pointCells = vtu.GetPointCells(i)
-    neList.append(pointCells)
+def VtuNeList(vtu):
+  """
+  Generate the node-element list for the supplied vtu, in compressed sparse row
+  form (see adjacency.py)
+  """
+  
+  offsets, nodes = VtuCellConnectivity(vtu)
   
-  return neList
+  return adjacency.NeList(offsets, nodes, vtu.ugrid.GetNumberOfPoints())
   
 def VtuEeList(vtu):
   """
-  Generate the element-element list for the supplied vtu.
+  Generate the element-element list for the supplied vtu, in compressed sparse
+  row form (see adjacency.py). Elements are adjacent if they share a node, and
+  each element is listed as adjacent to itself.
   Note well: This will only work for a continuous mesh.
   """
   
-  nCells = vtu.ugrid.GetNumberOfCells()
+  offsets, nodes = VtuCellConnectivity(vtu)
   
-  eeList = []
-  for i in range(nCells):
-    eeList.append([])
-    
-    cellPoints = vtu.GetCellPoints(i)
-    for point in cellPoints:
-      pointCells = vtu.GetPointCells(point)
-      for cell in pointCells:
-        eeList[-1].append(cell)
-    
-    utils.StripListDuplicates(eeList[-1])
+  return adjacency.EeList(offsets, nodes, vtu.ugrid.GetNumberOfPoints(), includeSelf = True)
   
-  return eeList
+def VtuFaceEeList(vtu):
+  """
+  Generate the face element-element list for the supplied vtu, in compressed
+  sparse row form (see adjacency.py). Elements are adjacent if they share a
+  face. This currently assumes linear simplices.
+  Note well: This will only work for a continuous mesh.
+  """
+  
+  simplexTypes = numpy.array([VTK_VERTEX, VTK_LINE, VTK_TRIANGLE, VTK_TETRAHEDRON])
+  if not numpy.all(numpy.in1d(VtuCellTypes(vtu), simplexTypes)):
+    raise Exception("Face element-element list requires linear simplex cells")
+  
+  offsets, nodes = VtuCellConnectivity(vtu)
+  
+  return adjacency.FaceEeList(offsets, nodes)
 
 def VtuIntegrateCell(vtu, cell, fieldName):
   """
@@ -1358,7 +1561,6 @@ def VtuIntegrateCell(vtu, cell, fieldName):
   """
     
   dim = VtuDim(vtu)
-  nc = VtuFieldComponents(vtu, fieldName)
   field = vtu.ugrid.GetPointData().GetArray(fieldName)
   
   vtkCell = vtu.ugrid.GetCell(cell)
@@ -1366,9 +1568,112 @@ def VtuIntegrateCell(vtu, cell, fieldName):
   cellPoints = vtu.GetCellPoints(cell)
   
   nodeCoords = [cellCoords.GetPoint(i)[:dim] for i in range(cellCoords.GetNumberOfPoints())]
-  fieldVals = [numpy.array([field.GetValue(point * nc + i) for i in range(nc)]) for point in cellPoints]
+  fieldVals = [field.GetTuple(point) for point in cellPoints]
   
-  return simplices.SimplexIntegral(nodeCoords, fieldVals)
+  return simplices.SimplexIntegrals([nodeCoords], [fieldVals])[0]
+
+def VtuPointCoordinates(vtu):
+  """
+  Return the node coordinates of the supplied vtu, as a (nodes x 3) array
+  """
+  
+  points = vtu.ugrid.GetPoints()
+  if points is None or vtu.ugrid.GetNumberOfPoints() == 0:
+    return numpy.zeros((0, 3))
+  
+  return numpy_support.vtk_to_numpy(points.GetData()).astype(float)
+  
+def VtuFieldArray(vtu, fieldName):
+  """
+  Return the values of a field in the supplied vtu, as a (tuples x components)
+  array
+  """
+  
+  data = vtu.ugrid.GetPointData().GetArray(fieldName)
+  field = numpy_support.vtk_to_numpy(data).astype(float)
+  field.shape = (data.GetNumberOfTuples(), data.GetNumberOfComponents())
+  
+  return field
+  
+def VtuAddFieldArray(vtu, fieldName, field):
+  """
+  Add a field to the supplied vtu, given as an array whose first dimension is
+  the number of nodes
+  """
+  
+  field = numpy.asarray(field, dtype = float)
+  assert(field.shape[0] == vtu.ugrid.GetNumberOfPoints())
+  field = numpy.ascontiguousarray(field.reshape((field.shape[0], field.size // max(field.shape[0], 1))))
+  
+  data = numpy_support.numpy_to_vtk(field, deep = 1, array_type = vtk.VTK_DOUBLE)
+  data.SetName(fieldName)
+  pointData = vtu.ugrid.GetPointData()
+  pointData.RemoveArray(fieldName)
+  pointData.AddArray(data)
+  
+  return
+  
+def _VtuSimplexCellGroups(vtu):
+  """
+  Group the cells of the supplied vtu by node count. Returns a list of (cells,
+  cell nodes) pairs, where cell nodes is a (cells x nodes per cell) array.
+  """
+  
+  offsets, nodes = VtuCellConnectivity(vtu)
+  nlocs = numpy.diff(offsets)
+  
+  groups = []
+  for nloc in numpy.unique(nlocs):
+    cells = numpy.nonzero(nlocs == nloc)[0]
+    groups.append((cells, nodes[offsets[cells][:, numpy.newaxis] + numpy.arange(nloc)]))
+    
+  return groups
+  
+def VtuCellVolumes(vtu):
+  """
+  Return the volumes of all cells in the supplied vtu. This currently assumes
+  linear simplices.
+  """
+  
+  dim = VtuDim(vtu)
+  coords = VtuPointCoordinates(vtu)[:, :dim]
+  
+  volumes = numpy.empty(vtu.ugrid.GetNumberOfCells())
+  for cells, cellNodes in _VtuSimplexCellGroups(vtu):
+    volumes[cells] = simplices.SimplexVolumes(coords[cellNodes])
+  
+  return volumes
+  
+def VtuCellBarycentres(vtu):
+  """
+  Return the barycentres of all cells in the supplied vtu, as a (cells x dim)
+  array. This currently assumes linear simplices.
+  """
+  
+  dim = VtuDim(vtu)
+  coords = VtuPointCoordinates(vtu)[:, :dim]
+  
+  barycentres = numpy.empty((vtu.ugrid.GetNumberOfCells(), dim))
+  for cells, cellNodes in _VtuSimplexCellGroups(vtu):
+    barycentres[cells] = simplices.SimplexBarycentres(coords[cellNodes])
+  
+  return barycentres
+  
+def VtuCellIntegrals(vtu, fieldName):
+  """
+  Integrate the supplied field over every cell in the supplied vtu, returning a
+  (cells x components) array. This currently assumes linear simplices.
+  """
+  
+  dim = VtuDim(vtu)
+  coords = VtuPointCoordinates(vtu)[:, :dim]
+  field = VtuFieldArray(vtu, fieldName)
+  
+  integrals = numpy.empty((vtu.ugrid.GetNumberOfCells(), field.shape[1]))
+  for cells, cellNodes in _VtuSimplexCellGroups(vtu):
+    integrals[cells] = simplices.SimplexIntegrals(coords[cellNodes], field[cellNodes])
+  
+  return integrals
 
 def VtuIntegrateField(vtu, fieldName):
   """
@@ -1376,11 +1681,7 @@ def VtuIntegrateField(vtu, fieldName):
   linear simplices.
   """
   
-  integral = 0.0
-  for cell in range(vtu.ugrid.GetNumberOfCells()):
-    integral += VtuIntegrateCell(vtu, cell, fieldName)
-  
-  return integral
+  return VtuCellIntegrals(vtu, fieldName).sum(axis = 0)
   
 def VtuVolume(vtu):
   """
@@ -1388,19 +1689,26 @@ def VtuVolume(vtu):
   simplices.
   """
   
-  dim = VtuDim(vtu)
+  return VtuCellVolumes(vtu).sum()
   
-  volume = 0.0
-  for cell in range(vtu.ugrid.GetNumberOfCells()):
-    vtkCell = vtu.ugrid.GetCell(cell)
-    cellCoords = vtkCell.GetPoints()
-    cellPoints = vtu.GetCellPoints(cell)
+def VtuIntegrateLabelledCells(vtu, cellLabels, fieldName, nBins = None):
+  """
+  Integrate the supplied field over cell bins, where cellLabels contains the
+  bin index of each cell. Cells with a negative label are not integrated.
+  Returns a (bins x components) array.
+  """
   
-    nodeCoords = [cellCoords.GetPoint(i)[:dim] for i in range(cellCoords.GetNumberOfPoints())]
-    
-    volume += simplices.SimplexVolume(nodeCoords)
-    
-  return volume
+  cellLabels = numpy.asarray(cellLabels, dtype = numpy.int64)
+  assert(len(cellLabels) == vtu.ugrid.GetNumberOfCells())
+  
+  mask = cellLabels >= 0
+  cellLabels = cellLabels[mask]
+  if nBins is None:
+    nBins = cellLabels.max() + 1 if len(cellLabels) > 0 else 0
+  
+  integrals = VtuCellIntegrals(vtu, fieldName)[mask]
+  
+  return numpy.array([numpy.bincount(cellLabels, weights = integrals[:, i], minlength = nBins) for i in range(integrals.shape[1])]).T
 
 def VtuIntegrateBinnedCells(vtu, cellBins, fieldName):
   """
@@ -1409,12 +1717,16 @@ def VtuIntegrateBinnedCells(vtu, cellBins, fieldName):
   
   nc = VtuFieldComponents(vtu, fieldName)
   
-  integral = [numpy.array([0.0 for i in range(nc)]) for j in range(len(cellBins))]
-  for i, bin in enumerate(cellBins):
-    for cell in bin:
-      integral[i] += VtuIntegrateCell(vtu, cell, fieldName)
+  lengths = [len(bin) for bin in cellBins]
+  if sum(lengths) == 0:
+    return [numpy.zeros(nc) for bin in cellBins]
+  cells = numpy.concatenate([numpy.asarray(bin, dtype = numpy.int64) for bin in cellBins])
+  binIds = numpy.repeat(numpy.arange(len(cellBins)), lengths)
   
-  return integral
+  integrals = VtuCellIntegrals(vtu, fieldName)[cells]
+  integral = numpy.array([numpy.bincount(binIds, weights = integrals[:, i], minlength = len(cellBins)) for i in range(nc)]).T
+  
+  return list(integral)
   
 def VtuMeshMerge(vtu, mesh, idsName = "IDs"):
   """
@@ -1443,57 +1755,81 @@ def VtuMeshMerge(vtu, mesh, idsName = "IDs"):
   
   return merge
     
+def _VtkCellArray(offsets, nodes):
+  """
+  Construct a vtkCellArray from the supplied compressed sparse row cell-node
+  connectivity
+  """
+  
+  cells = vtk.vtkCellArray()
+  if hasattr(cells, "GetOffsetsArray"):
+    # VTK >= 9
+    cells.SetData(numpy_support.numpy_to_vtkIdTypeArray(numpy.asarray(offsets, dtype = numpy.int64), deep = 1), numpy_support.numpy_to_vtkIdTypeArray(numpy.asarray(nodes, dtype = numpy.int64), deep = 1))
+  else:
+    # Legacy format: each cell is stored as its node count, followed by its
+    # nodes
+    counts = numpy.diff(offsets)
+    data = numpy.empty(len(counts) + len(nodes), dtype = numpy.int64)
+    locations = offsets[:-1] + numpy.arange(len(counts))
+    data[locations] = counts
+    mask = numpy.ones(len(data), dtype = bool)
+    mask[locations] = False
+    data[mask] = nodes
+    cells.SetCells(len(counts), numpy_support.numpy_to_vtkIdTypeArray(data, deep = 1))
+    
+  return cells
+
+def VtuSetCells(vtu, cellTypes, offsets, nodes):
+  """
+  Replace the cells of the supplied vtu with cells of the supplied VTK types
+  and compressed sparse row cell-node connectivity
+  """
+
+  offsets = numpy.asarray(offsets, dtype = numpy.int64)
+  cellArray = _VtkCellArray(offsets, nodes)
+  types = numpy_support.numpy_to_vtk(numpy.asarray(cellTypes, dtype = numpy.uint8), deep = 1, array_type = vtk.VTK_UNSIGNED_CHAR)
+  if hasattr(cellArray, "GetOffsetsArray"):
+    # VTK >= 9
+    vtu.ugrid.SetCells(types, cellArray)
+  else:
+    locations = offsets[:-1] + numpy.arange(len(offsets) - 1)
+    vtu.ugrid.SetCells(types, numpy_support.numpy_to_vtkIdTypeArray(locations, deep = 1), cellArray)
+
+  return
+
 def VtuStripFloatingNodes(vtu):
   """
   Strip floating (unconnected) nodes from the supplied vtu
   """
   
-  nodeUsed = numpy.array([False for i in range(vtu.ugrid.GetNumberOfPoints())])
-  for i in range(vtu.ugrid.GetNumberOfCells()):
-    cell = vtu.ugrid.GetCell(i)
-    nodeIds = cell.GetPointIds()
-    nodes = [nodeIds.GetId(i) for i in range(nodeIds.GetNumberOfIds())]
-    nodeUsed[nodes] = True
+  offsets, nodes = VtuCellConnectivity(vtu)
   
-  nodeMap = [None for i in range(vtu.ugrid.GetNumberOfPoints())]
-  nnodes = 0
-  for node, used in enumerate(nodeUsed):
-    if used:
-      nodeMap[node] = nnodes
-      nnodes += 1
+  nodeUsed = numpy.zeros(vtu.ugrid.GetNumberOfPoints(), dtype = bool)
+  nodeUsed[nodes] = True
+  nnodes = numpy.count_nonzero(nodeUsed)
   nFloatingNodes = vtu.ugrid.GetNumberOfPoints() - nnodes
   debug.dprint("Floating nodes: " + str(nFloatingNodes))
   if nFloatingNodes == 0:
     return
+  nodeMap = numpy.cumsum(nodeUsed) - 1
   
-  coords = vtu.GetLocations()
   points = vtk.vtkPoints()
   points.SetDataTypeToDouble()
-  for node, coord in enumerate(coords):
-    if nodeUsed[node]:
-      points.InsertNextPoint(coord[0], coord[1], coord[2])
-  vtu.ugrid.SetPoints(points)
+  points.SetData(numpy_support.numpy_to_vtk(VtuPointCoordinates(vtu)[nodeUsed], deep = 1))
   
-  cells = vtk.vtkCellArray()
-  for i in range(vtu.ugrid.GetNumberOfCells()):
-    cell = vtu.ugrid.GetCell(i)
-    nodeIds = cell.GetPointIds()
-    nodes = [nodeIds.GetId(i) for i in range(nodeIds.GetNumberOfIds())]
-    for i, node in enumerate(nodes):
-      assert(not nodeMap[node] is None)
-      nodeIds.SetId(i, nodeMap[node])      
-    cells.InsertNextCell(cell)
-  vtu.ugrid.SetCells(vtu.ugrid.GetCellTypesArray(), vtu.ugrid.GetCellLocationsArray(), cells)
+  pointData = vtu.ugrid.GetPointData()
+  fields = []
+  for i in range(pointData.GetNumberOfArrays()):
+    field = pointData.GetArray(i)
+    nField = numpy_support.numpy_to_vtk(numpy_support.vtk_to_numpy(field)[nodeUsed], deep = 1, array_type = field.GetDataType())
+    nField.SetName(field.GetName())
+    fields.append(nField)
   
-  for fieldName in vtu.GetFieldNames():
-    field = vtu.GetField(fieldName)
-    shape = list(field.shape)
-    shape[0] = nnodes
-    nField = numpy.empty(shape)
-    for node, nNode in enumerate(nodeMap):
-      if not nNode is None:
-        nField[nNode] = field[node]
-    vtu.AddField(fieldName, nField)
+  vtu.ugrid.SetPoints(points)
+  vtu.ugrid.SetCells(vtu.ugrid.GetCellTypesArray(), vtu.ugrid.GetCellLocationsArray(), _VtkCellArray(offsets, nodeMap[nodes]))
+  for nField in fields:
+    pointData.RemoveArray(nField.GetName())
+    pointData.AddArray(nField)
   
   return
     
@@ -1556,3 +1892,169 @@ class vtutoolsUnittests(unittest.TestCase):
     self.assertEquals(VtuDim(vtu), 1)
     
     return
+    
+  def _TwoTriangleVtu(self):
+    import vtktools
+    vtu = vtktools.vtu()
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    for coord in [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (1.0, 1.0, 0.0), (2.0, 2.0, 0.0)]:
+      points.InsertNextPoint(coord)
+    vtu.ugrid.SetPoints(points)
+    for nodes in [(0, 1, 2), (1, 3, 2)]:
+      idList = vtk.vtkIdList()
+      for node in nodes:
+        idList.InsertNextId(node)
+      vtu.ugrid.InsertNextCell(VTK_TRIANGLE, idList)
+    
+    return vtu
+    
+  def testVtuCellConnectivity(self):
+    offsets, nodes = VtuCellConnectivity(self._TwoTriangleVtu())
+    self.assertEquals(offsets.tolist(), [0, 3, 6])
+    self.assertEquals(nodes.tolist(), [0, 1, 2, 1, 3, 2])
+    
+    return
+    
+  def testVtuNeList(self):
+    offsets, cells = VtuNeList(self._TwoTriangleVtu())
+    self.assertEquals(offsets.tolist(), [0, 1, 3, 5, 6, 6])
+    self.assertEquals(cells.tolist(), [0, 0, 1, 0, 1, 1])
+    
+    return
+    
+  def testVtuEeList(self):
+    offsets, cells = VtuEeList(self._TwoTriangleVtu())
+    self.assertEquals(offsets.tolist(), [0, 2, 4])
+    self.assertEquals(cells.tolist(), [0, 1, 0, 1])
+    
+    offsets, cells = VtuFaceEeList(self._TwoTriangleVtu())
+    self.assertEquals(offsets.tolist(), [0, 1, 2])
+    self.assertEquals(cells.tolist(), [1, 0])
+    
+    return
+    
+  def testVtuIntegrateField(self):
+    vtu = self._TwoTriangleVtu()
+    vtu.AddScalarField("Scalar", numpy.array([1.0, 1.0, 1.0, 4.0, 0.0]))
+    self.assertAlmostEquals(VtuVolume(vtu), 1.0)
+    volumes = VtuCellVolumes(vtu)
+    self.assertAlmostEquals(volumes[0], 0.5)
+    self.assertAlmostEquals(volumes[1], 0.5)
+    integral = VtuIntegrateField(vtu, "Scalar")
+    self.assertAlmostEquals(integral[0], 1.5)
+    for cell in range(2):
+      self.assertAlmostEquals(VtuCellIntegrals(vtu, "Scalar")[cell][0], VtuIntegrateCell(vtu, cell, "Scalar")[0])
+    
+    integral = VtuIntegrateBinnedCells(vtu, [[1], [], [0, 1]], "Scalar")
+    self.assertEquals(len(integral), 3)
+    self.assertAlmostEquals(integral[0][0], 1.0)
+    self.assertAlmostEquals(integral[1][0], 0.0)
+    self.assertAlmostEquals(integral[2][0], 1.5)
+    
+    integral = VtuIntegrateLabelledCells(vtu, [-1, 1], "Scalar")
+    self.assertEquals(integral.shape, (2, 1))
+    self.assertAlmostEquals(integral[0][0], 0.0)
+    self.assertAlmostEquals(integral[1][0], 1.0)
+    
+    return
+    
+  def testVtuCellBarycentres(self):
+    barycentres = VtuCellBarycentres(self._TwoTriangleVtu())
+    self.assertEquals(barycentres.shape, (2, 2))
+    self.assertAlmostEquals(barycentres[0][0], 1.0 / 3.0)
+    self.assertAlmostEquals(barycentres[0][1], 1.0 / 3.0)
+    self.assertAlmostEquals(barycentres[1][0], 2.0 / 3.0)
+    self.assertAlmostEquals(barycentres[1][1], 2.0 / 3.0)
+    
+    return
+    
+  def testVtuStripFloatingNodes(self):
+    vtu = self._TwoTriangleVtu()
+    vtu.AddScalarField("Scalar", numpy.array([0.0, 1.0, 2.0, 3.0, 4.0]))
+    VtuStripFloatingNodes(vtu)
+    self.assertEquals(vtu.ugrid.GetNumberOfPoints(), 4)
+    self.assertEquals(vtu.ugrid.GetNumberOfCells(), 2)
+    self.assertEquals(VtuCellConnectivity(vtu)[1].tolist(), [0, 1, 2, 1, 3, 2])
+    self.assertEquals(VtuFieldArray(vtu, "Scalar")[:, 0].tolist(), [0.0, 1.0, 2.0, 3.0])
+    self.assertAlmostEquals(VtuVolume(vtu), 1.0)
+    
+    return
+    
+  def testRemappedVtu(self):
+    inputVtu = self._TwoTriangleVtu()
+    VtuStripFloatingNodes(inputVtu)
+    inputVtu.AddScalarField("Scalar", numpy.array([0.0, 1.0, 1.0, 2.0]))
+    
+    targetVtu = self._TwoTriangleVtu()
+    points = vtk.vtkPoints()
+    points.SetDataTypeToDouble()
+    for coord in [(0.5, 0.0, 0.0), (0.5, 0.5, 0.0), (0.25, 0.25, 0.0), (1.0, 0.5, 0.0), (2.0, 2.0, 0.0)]:
+      points.InsertNextPoint(coord)
+    targetVtu.ugrid.SetPoints(points)
+    
+    remapper = VtuRemapper(inputVtu)
+    for i in range(2):
+      result = remapper.Remap(targetVtu)
+      self.assertEquals(result.ugrid.GetNumberOfCells(), 2)
+      field = VtuFieldArray(result, "Scalar")[:, 0]
+      self.assertAlmostEquals(field[0], 0.5)
+      self.assertAlmostEquals(field[1], 1.0)
+      self.assertAlmostEquals(field[2], 0.5)
+      self.assertAlmostEquals(field[3], 1.5)
+      # Outside the input mesh - takes the value at the closest node
+      self.assertAlmostEquals(field[4], 2.0)
+    
+    return
+    
+  def testVtuTensorFields(self):
+    vtu = self._TwoTriangleVtu()
+    field = numpy.array([[[i + 1.0, 0.0, 0.0], [0.0, 2.0 * i + 1.0, 0.0], [0.0, 0.0, 3.0]] for i in range(5)])
+    VtuAddFieldArray(vtu, "Tensor", field)
+    self.assertEquals(VtuFieldRank(vtu, "Tensor"), 2)
+    self.assertEquals(MinVtuFieldEigenvalue(vtu, "Tensor").tolist(), [1.0, 2.0, 3.0, 3.0, 3.0])
+    
+    RotateVtuField(vtu, "Tensor", (0.0, 0.0, 1.0), math.pi / 2.0)
+    rotated = VtuFieldArray(vtu, "Tensor")
+    self.assertEquals(rotated.shape, (5, 9))
+    self.assertAlmostEquals(rotated[1][0], 3.0)
+    self.assertAlmostEquals(rotated[1][4], 2.0)
+    
+    VtuAddFieldArray(vtu, "Vector", numpy.array([[1.0, 0.0, 0.0] for i in range(5)]))
+    RotateVtu(vtu, (0.0, 0.0, 1.0), math.pi / 2.0)
+    self.assertTrue(numpy.allclose(VtuFieldArray(vtu, "Vector"), [[0.0, 1.0, 0.0] for i in range(5)]))
+    self.assertTrue(numpy.allclose(VtuPointCoordinates(vtu)[1], [0.0, 1.0, 0.0]))
+    
+    return
+    
+  def testVtuTransects(self):
+    vtu = self._TwoTriangleVtu()
+    VtuStripFloatingNodes(vtu)
+    vtu.AddScalarField("Scalar", numpy.array([0.0, 1.0, 2.0, 3.0]))
+    
+    coords = LineTransectCoordinates([[0.0, 0.5, 0.0], [0.5, 0.0, 0.0]], [[2.0, 0.0, 0.0], [0.0, 1.0, 0.0]], [0.0, 0.5, 1.0, 2.0])
+    self.assertEquals(coords.shape, (2, 4, 3))
+    self.assertTrue(numpy.allclose(coords[1][1], [0.5, 0.5, 0.0]))
+    
+    probe = LineVtuTransects(vtu, [[0.0, 0.5, 0.0], [0.5, 0.0, 0.0]], [[2.0, 0.0, 0.0], [0.0, 1.0, 0.0]], [0.0, 0.5, 1.0, 2.0])
+    self.assertEquals(probe.GetValid().tolist(), [[True, True, True, False], [True, True, True, False]])
+    profiles = probe.GetField("Scalar")
+    self.assertEquals(profiles.shape, (2, 4, 1))
+    # Scalar = x + 2 y
+    self.assertTrue(numpy.allclose(profiles[:, :3, 0], [[1.0, 1.5, 2.0], [0.5, 1.5, 2.5]]))
+    self.assertTrue(numpy.all(numpy.isnan(profiles[:, 3, 0])))
+    
+    # Reuse on another dump on the same mesh
+    dump = CopyVtu(vtu)
+    dump.AddScalarField("Scalar", numpy.array([1.0, 1.0, 1.0, 1.0]))
+    self.assertTrue(numpy.allclose(probe.GetField("Scalar", vtu = dump)[:, :3, 0], 1.0))
+    
+    coords = RingTransectCoordinates([0.25, 0.5], [0.0, math.pi / 2.0, math.pi], [[0.5, 0.5, 0.0], [0.5, 0.5, 0.0]], [[0.0, 0.0, 1.0], [0.0, 0.0, 2.0]])
+    self.assertEquals(coords.shape, (2, 3, 3))
+    self.assertTrue(numpy.allclose(numpy.sqrt(((coords - 0.5) ** 2)[:, :, :2].sum(axis = 2)), [[0.25, 0.25, 0.25], [0.5, 0.5, 0.5]]))
+    self.assertTrue(numpy.allclose(coords[:, :, 2], 0.0))
+    profiles = RingVtuTransects(vtu, [0.25], [0.0, math.pi], [[0.5, 0.5, 0.0]], [[0.0, 0.0, 1.0]]).GetField("Scalar")
+    self.assertEquals(profiles.shape, (1, 2, 1))
+    self.assertAlmostEquals(profiles[0, 0, 0] + profiles[0, 1, 0], 3.0)
+    
+    return
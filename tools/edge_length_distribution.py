@@ -8,7 +8,8 @@ import glob
 import numpy
 import sys
 import os
-from pylab import *
+import fluidity.diagnostics.mesh_quality as mesh_quality
+import fluidity.diagnostics.vtutools as vtutools
 
 #######################################################
 
@@ -29,21 +30,14 @@ def usage():
     parser.add_option("-p", "--plotonly", dest="plot_only", action="store_true", help = "will allow plots to be made from the data in the log files 'time.log' and 'edge_lengths.log' rather than extracting the information from the vtus as this can take a while. Note: you must have run the script once WITHOUT this option otherwise the log files will not exist")
 #
     parser.add_option("--pvtu", dest="use_pvtu", action="store_true", help = "uses pvtus instead of vtus")
+#
+    parser.add_option("-n", "--noplots", dest="no_plots", action="store_true", help = "writes a histogram summary of the edge lengths in each vtu to 'edge_length_distribution_plots/edge_length_histograms.log' instead of making plots, reading one vtu at a time")
+#
+    parser.add_option("-r", "--range", dest="bin_range", type = "float", nargs = 2, help = "with --noplots, the minimum and maximum edge lengths spanned by the histogram bins, which are common to all vtus. If not used the bins span the edge lengths in the first vtu")
     return parser
 
 ######################################################
 
-def pair_off(nodes):
-# for a node list writes out all the pairs 
-# e.g. for [1,5,7,9] will yield [1,5], [1,7], [1,9]
-# then knock off 1 and yield [5,7], [5,9]
-# then knock off 5 and yield [7,9]
-  for (idx_i, node) in enumerate(nodes):
-    for (idx_j, node_j) in enumerate(nodes[idx_i+1:]):
-      yield (node, node_j)
-
-######################################################
-
 def GetFiles(filename,vtu_type):
 # gets list of vtus and sorts them into ascending time order
 
@@ -58,26 +52,13 @@ def GetFiles(filename,vtu_type):
 ######################################################
 
 def GetEdgeLengths(data):
+# every pair of nodes sharing a cell is an edge, and each edge
+# is counted once
 
-  eles = data.ugrid.GetNumberOfCells()
-  edgeset = set()
-
-  for ele in range(eles):
-  # for each element get the nodes associated with it
-  # and sort them in ascending numerical order
-    nodes = sorted(data.GetCellPoints(ele))
-  # pair off nodes and add them to a set
-  # note set will only add an element to it once
-  # i.e. keeps uniqueness
-    for edge in pair_off(nodes):
-      edgeset.add(edge)
+  offsets, nodes = vtutools.VtuCellConnectivity(data)
+  edges = mesh_quality.Edges(offsets, nodes, data.ugrid.GetNumberOfPoints())
 
-  edge_lengths = []
-# get the edge lengths and plot
-  for edge in edgeset:
-    edge_lengths.append(data.GetDistance(edge[0], edge[1]))
-
-  return edge_lengths
+  return mesh_quality.EdgeLengths(vtutools.VtuPointCoordinates(data), edges).tolist()
 
 ######################################################
 
@@ -149,6 +130,9 @@ if len(args)<1:
 
 filename = args[0]
 
+if options.no_plots != True:
+  from pylab import *
+
 vtu_type = 'vtu'
 if options.use_pvtu == True: vtu_type = 'pvtu'
 filelist = GetFiles(filename, vtu_type)
@@ -158,6 +142,16 @@ edge_lengths_all = []
 try: os.mkdir("edge_length_distribution_plots")
 except OSError: pass
 
+if options.no_plots == True:
+  if options.plot_only == True:
+    print "Options --noplots and --plotonly are incompatible"
+    sys.exit(1)
+  # Stream the dumps one at a time, recording each dump's filename
+  if options.end_vtu == None : options.end_vtu = len(filelist)
+  series = mesh_quality.DumpSeriesQuality(filelist[options.start_vtu:options.end_vtu+1], quantities = ["EdgeLength"], bins = options.no_bins, ranges = options.bin_range)
+  mesh_quality.WriteQualityHistograms(series, "edge_length_distribution_plots/edge_length_histograms.log")
+  sys.exit(0)
+
 if options.plot_only == True:
 
   try:
@@ -206,7 +200,6 @@ else:
   time_log.close()
   edge_lengths_log.close()
 
-
 PlotEdgeLengths(edge_lengths_all, time, options)
 
 if options.plot_maxmin == True:
@@ -4,13 +4,14 @@ from optparse import OptionParser
 import re
 import sys
 import os.path
+import numpy
 
 #####################################################################
 # Script starts here.
 optparser=OptionParser(usage='usage: %prog [options] <filename>',
                        add_help_option=True,
-                       description="""This takes a Gmsh 2.0 .msh ascii file """ + 
-                       """and produces .node, .ele and .edge or .face files.""")
+                       description="""This takes a Gmsh 2.0 .msh ascii file, or a Gmsh 4.1 .msh """ + 
+                       """binary file, and produces .node, .ele and .edge or .face files.""")
 
 optparser.add_option("--2D", "--2d", "-2",
                   help="discard 3rd coordinate of node positions",
@@ -25,6 +26,10 @@ optparser.add_option("--internal-boundary", "-i",
                        "a physical boundary id to lines (2D) or surfaces (3D) that are not on the domain boundary",
                   action="store_const", const=True, dest="internal_faces", default=False)
 
+optparser.add_option("--chunk-size",
+                  help="number of nodes or elements converted at a time for Gmsh 4.1 binary files (default 1048576)",
+                  type="int", dest="chunk_size", default=1048576)
+
 (options, argv) = optparser.parse_args()
 
 if len(argv)<1:
@@ -39,11 +44,36 @@ if argv[0][-4:]!=".msh":
 
 basename=os.path.basename(argv[0][:-4])
 
+def read_section_tokens(fileobj, dtype):
+  """
+  Tokenise all remaining lines in the current .msh section in one pass,
+  returning the tokens and the section end line
+  """
+  lines=[]
+  for line in iter(fileobj.readline, ""):
+    if line.startswith("$"):
+      break
+    lines.append(line)
+  return numpy.fromstring("".join(lines), dtype=dtype, sep=" "), line.strip()
+
 mshfile=file(argv[0], 'r')
 
 # Header section
 assert(mshfile.readline().strip()=="$MeshFormat")
-assert(mshfile.readline().strip()in["2 0 8", "2.1 0 8", "2.2 0 8"])
+version=mshfile.readline().strip()
+if version.startswith("4"):
+  # Gmsh 4.1 binary files are converted chunk-by-chunk, so that meshes larger
+  # than memory can be converted
+  mshfile.close()
+  if options.internal_faces:
+    sys.stderr.write("ERROR: --internal-boundary is not supported for Gmsh 4.1 files.\n")
+    sys.exit(1)
+  import fluidity.diagnostics.gmshtools as gmshtools
+  gmshtools.Msh4ToTriangle(argv[0], basename, coordDim=options.dim,
+                           sphericalShell=options.spherical_shell,
+                           chunkSize=options.chunk_size)
+  sys.exit(0)
+assert(version in ["2 0 8", "2.1 0 8", "2.2 0 8"])
 assert(mshfile.readline().strip()=="$EndMeshFormat")
 
 # Nodes section
@@ -64,49 +94,69 @@ nodefile_dim = dim
 if options.spherical_shell:
   nodefile_dim -= 1
 
-nodefile_linelist = []
-for i in range(nodecount):
-    # Node syntax
-    line = mshfile.readline().split()
-    # compare node id assigned by gmsh to consecutive node id (assumed by fluidity)
-    if eval(line[0])!=i+1:
-      print line[0], i+1
-      sys.stderr.write("ERROR: Nodes in gmsh .msh file must be numbered consecutively.")
-    nodefile_linelist.append( line[1:dim+1] )
-
-assert(mshfile.readline().strip()=="$EndNodes")
+nodedata, line = read_section_tokens(mshfile, float)
+assert(line=="$EndNodes")
+nodedata=nodedata.reshape((nodecount, 4))
+# compare node id assigned by gmsh to consecutive node id (assumed by fluidity)
+for i in numpy.nonzero(nodedata[:,0]!=numpy.arange(1, nodecount+1))[0]:
+  print int(nodedata[i,0]), i+1
+  sys.stderr.write("ERROR: Nodes in gmsh .msh file must be numbered consecutively.")
+nodecoords=nodedata[:,1:dim+1]
+del nodedata
 
 # Elements section
 assert(mshfile.readline().strip()=="$Elements")
 elementcount=int(mshfile.readline())
-
-# Now loop over the elements placing them in the appropriate buckets.
-edges=[]
-triangles=[]
-tets=[]
-quads=[]
-hexes=[]
-
-for i in range(elementcount):
-    
-    element=mshfile.readline().split()
-
-    if (element[1]=="1"):
-        edges.append(element[-2:]+[element[3]])
-    elif (element[1]=="2"):
-        triangles.append(element[-3:]+[element[3]])
-    elif (element[1]=="3"):
-        quads.append(element[-4:]+[element[3]])
-    elif (element[1]=="4"):
-        tets.append(element[-4:]+[element[3]])
-    elif (element[1]=="5"):
-        hexes.append(element[-8:]+[element[3]])
-    elif(element[1]=="15"):
-        # Ignore point elements
-        pass
-    else:
-        sys.stderr.write("Unknown element type "+`element[1]`+'\n')
+tokens, line = read_section_tokens(mshfile, numpy.int64)
+assert(line=="$EndElements")
+
+# Now loop over the runs of elements with the same type and number of tags,
+# placing them in the appropriate buckets. Each bucket entry is an array of
+# element nodes followed by the physical id.
+nodes_per_type={1:2, 2:3, 3:4, 4:4, 5:8, 15:1}
+buckets=dict([(type, []) for type in nodes_per_type])
+
+start=0
+count=0
+while start<len(tokens):
+    type, ntags = tokens[start+1], tokens[start+2]
+    if not type in nodes_per_type:
+        sys.stderr.write("Unknown element type "+`str(type)`+'\n')
         sys.exit(1)
+    recordlength=3+ntags+nodes_per_type[type]
+    
+    # Find the length of the run of records sharing this header, checking
+    # blocks of records of increasing size
+    maxrun=(len(tokens)-start)//recordlength
+    run=1
+    blocksize=1024
+    while run<maxrun:
+        end=min(run+blocksize, maxrun)
+        headers=tokens[start+run*recordlength:start+end*recordlength].reshape((end-run, recordlength))[:,1:3]
+        mismatches=numpy.nonzero((headers[:,0]!=type)|(headers[:,1]!=ntags))[0]
+        if len(mismatches)>0:
+            run+=mismatches[0]
+            break
+        run=end
+        blocksize*=2
+    
+    records=tokens[start:start+run*recordlength].reshape((run, recordlength))
+    buckets[type].append(numpy.column_stack([records[:,-nodes_per_type[type]:], records[:,3]]))
+    start+=run*recordlength
+    count+=run
+assert(count==elementcount)
+
+def bucket(type):
+    if len(buckets[type])==0:
+        return numpy.zeros((0, nodes_per_type[type]+1), dtype=numpy.int64)
+    return numpy.concatenate(buckets[type])
+
+# Ignore point elements
+edges=bucket(1)
+triangles=bucket(2)
+quads=bucket(3)
+tets=bucket(4)
+hexes=bucket(5)
 
 if len(tets) > 0:
   if len(hexes) > 0:
@@ -159,12 +209,22 @@ else:
     sys.stderr.write("Unable to determine dimension of problem\n")
     sys.exit(1)
 
+def write_rows(fileobj, rows, format, chunksize=65536):
+  """
+  Write the rows of a 2D array, with one string format operation per chunk of
+  rows
+  """
+  for start in range(0, rows.shape[0], chunksize):
+    chunk=rows[start:start+chunksize]
+    fileobj.write((format*chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
 nodefile=file(basename+".node", 'w')
 nodefile.write(`nodecount`+" "+`nodefile_dim`+" 0 0\n")
-j=0
-for i in range(nodecount):    
-  j=j+1
-  nodefile.write(" ".join( [str(j)] + nodefile_linelist[i] )+"\n")
+nodedata=numpy.empty((nodecount, 1+nodecoords.shape[1]))
+nodedata[:,0]=numpy.arange(1, nodecount+1)
+nodedata[:,1:]=nodecoords
+write_rows(nodefile, nodedata, "%d"+" %r"*nodecoords.shape[1]+"\n")
+del nodedata
 
 nodefile.write("# Produced by: "+" ".join(argv)+"\n")
 nodefile.close()
@@ -172,35 +232,34 @@ nodefile.close()
 # Output ele file
 elefile.write(`len(elements)`+" "+`loc`+" 1\n")
 
-for i, element in enumerate(elements):
-    elefile.write(`i+1`+" ")
-    for j in node_order:
-      elefile.write(" ".join(element[j-1:j])+" ")
-    elefile.write(" ".join(element[-1:]))
-    elefile.write(" "+"\n")
+eledata=numpy.empty((len(elements), loc+2), dtype=numpy.int64)
+eledata[:,0]=numpy.arange(1, len(elements)+1)
+eledata[:,1:loc+1]=elements[:,[j-1 for j in node_order]]
+eledata[:,-1]=elements[:,-1]
+write_rows(elefile, eledata, "%d "*(loc+1)+"%d \n")
 
 elefile.write("# Produced by: "+" ".join(sys.argv)+"\n")
 elefile.close()
 
 # Output ele or face file
 if options.internal_faces:
-  # make node element list
-  ne_list = [set() for i in range(nodecount)]
-  for i, element in enumerate(elements):
-      element=[eval(element[j-1]) for j in node_order]
-      for node in element:
-        ne_list[node-1].add(i)
+  # make node element list, in compressed sparse row form
+  element_nodes=elements[:,[j-1 for j in node_order]]-1
+  order=numpy.argsort(element_nodes.ravel(), kind="mergesort")
+  ne_elements=order//loc
+  ne_offsets=numpy.zeros(nodecount+1, dtype=numpy.int64)
+  numpy.cumsum(numpy.bincount(element_nodes.ravel(), minlength=nodecount), out=ne_offsets[1:])
 
   # make face list, containing: face_nodes, surface_id, element_owner
-  facelist=[]
-  for face in faces:
-    # last entry of face is surface-id
-    face_nodes=[eval(node) for node in face[:-1]]
-    # loop through elements around node face_nodes[0]
-    for ele in ne_list[face_nodes[0]-1]:
-      element=[eval(elements[ele][j-1]) for j in node_order]
-      if set(face_nodes) < set(element):
-        facelist.append(face+[`ele+1`])
+  # candidate owners are the elements around the first node of each face
+  face_nodes=faces[:,:-1]-1
+  counts=ne_offsets[face_nodes[:,0]+1]-ne_offsets[face_nodes[:,0]]
+  candidate_faces=numpy.repeat(numpy.arange(len(faces)), counts)
+  ends=numpy.cumsum(counts)
+  candidate_eles=ne_elements[numpy.arange(ends[-1] if len(ends)>0 else 0)+numpy.repeat(ne_offsets[face_nodes[:,0]]-(ends-counts), counts)]
+  # keep the candidates containing all face nodes
+  contained=(face_nodes[candidate_faces][:,:,numpy.newaxis]==element_nodes[candidate_eles][:,numpy.newaxis,:]).any(axis=2).all(axis=1)
+  facelist=numpy.column_stack([faces[candidate_faces[contained]], candidate_eles[contained]+1])
   
   facefile.write(`len(facelist)`+" 2\n")
   faces=facelist
@@ -208,9 +267,10 @@ if options.internal_faces:
 else:
   facefile.write(`len(faces)`+" 1\n")
 
-for i,face in enumerate(faces):
-    facefile.write(`i+1`+" "+" ".join(face)+"\n")
+facedata=numpy.empty((len(faces), faces.shape[1]+1), dtype=numpy.int64)
+facedata[:,0]=numpy.arange(1, len(faces)+1)
+facedata[:,1:]=faces
+write_rows(facefile, facedata, " ".join(["%d"]*facedata.shape[1])+"\n")
 
 facefile.write("# Produced by: "+" ".join(sys.argv)+"\n")
 facefile.close()
-
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from optparse import OptionParser
+import sys
+import fluidity.diagnostics.gmshtools as gmshtools
+import fluidity.diagnostics.mesh_halos as mesh_halos
+
+#####################################################################
+# Script starts here.
+optparser=OptionParser(usage='usage: %prog [options] input_mesh output_mesh',
+                       add_help_option=True,
+                       description="""Renumbers the nodes and elements of the given mesh to improve cache locality.""")
+
+optparser.set_usage(
+                  "usage: %prog [options] <input_mesh> <output_mesh>\n\n"+
+                  "<input_mesh> is the name of the gmsh mesh file. You need an input_mesh.msh file.\n"+
+                  "If an input_mesh.halo file exists, only owned nodes are renumbered and\n"+
+                  "a renumbered output_mesh.halo file is also written.\n"
+                  "<output_mesh> is the name of the renumbered gmsh mesh file to write.\n"
+                  "\n"+
+                  "Example:\n"
+                  "To renumber mesh_0.msh and mesh_0.halo along a Hilbert curve,\n"
+                  "%prog -m hilbert mesh_0 mesh_0_renumbered\n"
+		     )
+
+optparser.add_option("-m", "--method", dest="method", default="rcm",
+                     choices=["rcm", "hilbert", "morton"],
+                     help="renumbering method: rcm (reverse Cuthill-McKee, the default), hilbert or morton")
+optparser.add_option("-a", "--ascii", dest="ascii", action="store_true", default=False,
+                     help="write an ASCII .msh file")
+
+(options, argv) = optparser.parse_args()
+
+if len(argv) != 2:
+    optparser.print_help()
+    sys.exit(1)
+
+input_name = argv[0]
+output_name = argv[1]
+
+def print_metrics(label, metrics):
+    print label
+    for key in ["bandwidth", "profile", "meanNeighbourDistance", "meanElementNodeSpread", "meanElementDistance"]:
+        print "  %-22s %s" % (key, metrics[key])
+
+mesh = gmshtools.ReadMsh(input_name+'.msh')
+print_metrics("Before renumbering (" + input_name + ")", mesh.LocalityMetrics())
+
+mesh = mesh.Renumbered(method = options.method)
+print_metrics("After renumbering (" + options.method + ")", mesh.LocalityMetrics())
+
+gmshtools.WriteMsh(mesh, output_name+'.msh', binary = not options.ascii)
+if mesh.HasHalos() and mesh.GetHalos().HaloCount() > 0:
+    mesh_halos.WriteHalos(mesh.GetHalos(), output_name+'.halo')
@@ -46,8 +46,9 @@ vtuBasename = os.path.basename(vtuFilename[:-len(vtuFilename.split(".")[-1]) - 1
 vtuExt = vtuFilename[-len(vtuFilename.split(".")[-1]):]
 
 vtu = vtktools.vtu(vtuFilename)
+remapper = vtktools.VtuRemapper(vtu)
 for i, meshBasename in enumerate(meshBasenames):
   debug.dprint("Processing mesh partition " + meshBasename)
   meshVtu = gmshtools.ReadMsh(meshBasename).ToVtu(includeSurface = False)
-  partition = vtktools.RemappedVtu(vtu, meshVtu)
+  partition = remapper.Remap(meshVtu)
   partition.Write(vtuBasename + "_" + str(meshIds[i]) + "." + vtuExt)